@@ -111,6 +111,59 @@ class BaseProvider(oaipmh.interfaces.IOAI, object):
         """
         raise oaipmh.error.CannotDisseminateFormatError
 
+    def listIdentifiersPage(self, metadataPrefix, cursor=None,
+                            batch_size=100, set=None, from_=None, until=None):
+        """
+        Get a page of header information on records.
+
+        Takes the same arguments as :py:meth:`listIdentifiers`, plus:
+
+        :param cursor: where the page starts, as returned with the previous
+            page, or ``None`` for the first page
+        :type cursor: string
+
+        :param batch_size: most headers to return
+        :type batch_size: int
+
+        :raises oaipmh.error.BadResumptionTokenError: if ``cursor`` is not
+            one this provider returned.
+
+        :returns: a list of headers, and the cursor of the next page, or
+            ``None`` if this was the last.
+        """
+        return self._get_page_by_offset(
+            self.listIdentifiers(metadataPrefix, set=set, from_=from_,
+                                 until=until),
+            cursor, batch_size)
+
+    def listRecordsPage(self, metadataPrefix, cursor=None,
+                        batch_size=100, set=None, from_=None, until=None):
+        """
+        Get a page of header, metadata and about information on records.
+
+        Takes the same arguments as :py:meth:`listRecords`, plus ``cursor``
+        and ``batch_size`` as for :py:meth:`listIdentifiersPage`.
+
+        :returns: a list of ``header``, ``metadata``, ``about`` tuples, and
+            the cursor of the next page, or ``None`` if this was the last.
+        """
+        return self._get_page_by_offset(
+            self.listRecords(metadataPrefix, set=set, from_=from_,
+                             until=until),
+            cursor, batch_size)
+
+    def _get_page_by_offset(self, results, cursor, batch_size):
+        # Providers which don't page their own results have to produce all
+        # of them for every page
+        try:
+            offset = int(cursor or 0)
+        except ValueError:
+            raise oaipmh.error.BadResumptionTokenError
+        results = list(results)
+        end = offset + batch_size
+        return results[offset:end], (str(end) if end < len(results)
+                                     else None)
+
     def listSets(self):
         """
         Get a list of sets in the repository.
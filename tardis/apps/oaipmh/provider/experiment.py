@@ -1,7 +1,10 @@
 from abc import abstractmethod
+from datetime import datetime
+from itertools import chain
 
 from django.conf import settings
 from django.core.urlresolvers import reverse
+from django.db.models import Q
 from lxml.etree import SubElement
 
 from oaipmh.common import Identify, Header, Metadata
@@ -14,13 +17,17 @@ import pytz
 
 from tardis.tardis_portal.ParameterSetManager import ParameterSetManager
 from tardis.tardis_portal.models import Author_Experiment, Experiment,\
-    ExperimentParameterSet, ExperimentParameter, License, User
+    ExperimentACL, ExperimentParameterSet, ExperimentParameter, License, \
+    User, UserProfile
 from tardis.tardis_portal.util import get_local_time, get_utc_time
 
 from .base import BaseProvider
 
 class AbstractExperimentProvider(BaseProvider):
 
+    # Format of the experiment update times in cursors
+    CURSOR_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
     NS_CC = 'http://www.tardis.edu.au/schemas/creative_commons/2011/05/17'
 
     def getRecord(self, metadataPrefix, identifier):
@@ -52,9 +59,21 @@ class AbstractExperimentProvider(BaseProvider):
         if not self._handles_metadata_prefix(metadataPrefix):
             raise oaipmh.error.CannotDisseminateFormatError
         objects = self._get_in_range(from_, until)
-        print str(objects)
         return map(self._get_header, objects)
 
+    def listIdentifiersPage(self, metadataPrefix, cursor=None,
+                            batch_size=100, set=None, from_=None, until=None):
+        """
+        Return a page of identifiers in range, provided we handle this
+        metadata prefix.
+        """
+        if set:
+            raise oaipmh.error.NoSetHierarchyError
+        if not self._handles_metadata_prefix(metadataPrefix):
+            raise oaipmh.error.CannotDisseminateFormatError
+        objects, cursor = self._get_page(from_, until, cursor, batch_size)
+        return map(self._get_header, objects), cursor
+
     def listRecords(self, metadataPrefix, set=None, from_=None, until=None):
         """
         Return records in range, provided we handle this metadata prefix.
@@ -72,6 +91,30 @@ class AbstractExperimentProvider(BaseProvider):
             return (header, metadata, None)
         return map(get_tuple, objects)
 
+    def listRecordsPage(self, metadataPrefix, cursor=None,
+                        batch_size=100, set=None, from_=None, until=None):
+        """
+        Return a page of records in range, provided we handle this metadata
+        prefix.
+        """
+        if set:
+            raise oaipmh.error.NoSetHierarchyError
+        if not self._handles_metadata_prefix(metadataPrefix):
+            raise oaipmh.error.CannotDisseminateFormatError
+        objects, cursor = self._get_page(from_, until, cursor, batch_size)
+        # Fetch the owners of the whole page at once
+        owners = self._get_owners([obj.id for obj in objects
+                                   if isinstance(obj, Experiment)])
+        def get_tuple(obj):
+            header = self._get_header(obj)
+            if isinstance(obj, User):
+                metadata = self._get_user_metadata(obj, metadataPrefix)
+            else:
+                metadata = self._get_experiment_metadata(
+                    obj, metadataPrefix, owners=owners.get(obj.id, []))
+            return (header, metadata, None)
+        return map(get_tuple, objects), cursor
+
     def listSets(self):
         """
         No support for sets.
@@ -112,7 +155,8 @@ class AbstractExperimentProvider(BaseProvider):
             return self._get_experiment_metadata(obj, metadataPrefix)
 
     @abstractmethod
-    def _get_experiment_metadata(self):
+    def _get_experiment_metadata(self, experiment, metadataPrefix,
+                                 owners=None):
         raise NotImplementedError
 
     @abstractmethod
@@ -120,7 +164,10 @@ class AbstractExperimentProvider(BaseProvider):
         raise NotImplementedError
 
     def _get_in_range(self, from_, until):
-        from itertools import chain
+        return chain(self._get_experiments_in_range(from_, until).iterator(),
+                     self._get_users_in_range(from_, until).iterator())
+
+    def _get_experiments_in_range(self, from_, until):
         experiments = Experiment.objects\
             .select_related('created_by')\
             .exclude(public_access=Experiment.PUBLIC_ACCESS_NONE)\
@@ -132,11 +179,116 @@ class AbstractExperimentProvider(BaseProvider):
         if until:
             until = get_local_time(until.replace(tzinfo=pytz.utc)) # UTC->local
             experiments = experiments.filter(update_time__lte=until)
-        def get_users_from_experiment(experiment):
-            return filter(lambda u: u.get_profile().isValidPublicContact(),
-                          experiment.get_owners())
-        users = chain(map(get_users_from_experiment, experiments))
-        return frozenset(chain(experiments, *users))
+        return experiments
+
+    def _get_owner_ids_in_range(self, from_, until):
+        '''
+        Returns the ACL entity ids of the owners of the experiments in range,
+        in order.
+        '''
+        experiments = self._get_experiments_in_range(from_, until)
+        return ExperimentACL.objects\
+            .filter(pluginId='django_user', isOwner=True,
+                    experiment__in=experiments.values('id'))\
+            .order_by('entityId')\
+            .values_list('entityId', flat=True)\
+            .distinct()
+
+    def _get_users_in_range(self, from_, until):
+        return self._get_valid_public_contacts(
+            User.objects.filter(id__in=map(int,
+                self._get_owner_ids_in_range(from_, until)))).order_by('id')
+
+    @staticmethod
+    def _get_valid_public_contacts(users):
+        # As UserProfile.isValidPublicContact, in the query
+        return users.exclude(email='').exclude(first_name='')
+
+    def _get_page(self, from_, until, cursor, batch_size):
+        '''
+        Returns up to batch_size experiments and their owners in range,
+        starting at cursor, and the cursor of the next page, or None if
+        there isn't one.
+
+        Experiments are paged by their update time and id, then their owners
+        by id, so no page is slower to find than the first however far
+        through the range it is.
+        '''
+        phase, key = self._decode_cursor(cursor)
+        objects = []
+        if phase == 'experiment':
+            experiments = self._get_experiments_in_range(from_, until)\
+                .order_by('update_time', 'id')
+            if key:
+                update_time, id_ = key
+                experiments = experiments.filter(
+                    Q(update_time__gt=update_time) |
+                    Q(update_time=update_time, id__gt=id_))
+            # One more, to tell if there are more
+            objects = list(experiments[:batch_size + 1])
+            if len(objects) > batch_size:
+                objects = objects[:batch_size]
+                last = objects[-1]
+                return objects, self._encode_cursor(
+                    'experiment', (last.update_time, last.id))
+            phase, key = 'user', None
+        owner_ids = self._get_owner_ids_in_range(from_, until)
+        if key:
+            owner_ids = owner_ids.filter(entityId__gt=key)
+        if len(objects) == batch_size:
+            return objects, (self._encode_cursor('user', None)
+                             if owner_ids.exists() else None)
+        owner_ids = list(owner_ids[:batch_size - len(objects) + 1])
+        more = len(owner_ids) > batch_size - len(objects)
+        if more:
+            owner_ids = owner_ids[:batch_size - len(objects)]
+        objects += self._get_valid_public_contacts(
+            User.objects.filter(id__in=map(int, owner_ids))).order_by('id')
+        return objects, (self._encode_cursor('user', owner_ids[-1])
+                         if more else None)
+
+    def _encode_cursor(self, phase, key):
+        if phase == 'experiment':
+            update_time, id_ = key
+            return 'experiment/%s/%d' % \
+                (update_time.strftime(self.CURSOR_TIME_FORMAT), id_)
+        return 'user/%s' % (key or '')
+
+    def _decode_cursor(self, cursor):
+        if not cursor:
+            return 'experiment', None
+        try:
+            phase, key = cursor.split('/', 1)
+            if phase == 'user':
+                return phase, key
+            assert phase == 'experiment'
+            update_time, id_ = key.split('/')
+            return phase, (datetime.strptime(update_time,
+                                             self.CURSOR_TIME_FORMAT),
+                           int(id_))
+        except (AssertionError, ValueError):
+            raise oaipmh.error.BadResumptionTokenError
+
+    def _get_owners(self, experiment_ids):
+        '''
+        Returns the owners of each of the experiments, as get_owners() does,
+        fetched together.
+        '''
+        acls = ExperimentACL.objects\
+            .filter(pluginId='django_user', isOwner=True,
+                    experiment__in=experiment_ids)\
+            .values_list('experiment', 'entityId')
+        acls = [(experiment_id, int(user_id))
+                for experiment_id, user_id in acls]
+        users = User.objects.in_bulk(set(u for _, u in acls))
+        # Used by the RIF-CS writer
+        for profile in UserProfile.objects.filter(user__in=users.keys()):
+            users[profile.user_id]._profile_cache = profile
+        owners = {}
+        for experiment_id, user_id in acls:
+            if user_id in users:
+                owners.setdefault(experiment_id, []).append(users[user_id])
+        return owners
 
     @abstractmethod
     def _handles_metadata_prefix(self):
@@ -161,15 +313,16 @@ class DcExperimentProvider(AbstractExperimentProvider):
         except oaipmh.error.IdDoesNotExistError:
             return []
 
-    def _get_in_range(self, from_, until):
-        return filter(lambda obj: isinstance(obj, Experiment),
-                      super(DcExperimentProvider, self)\
-                        ._get_in_range(from_, until))
+    def _get_owner_ids_in_range(self, from_, until):
+        # Users have no Dublin Core records
+        return ExperimentACL.objects.none().values_list('entityId',
+                                                        flat=True)
 
     def _get_id_from_identifier(self, identifier):
         return self._split_type_and_id(identifier, ["experiment"])
 
-    def _get_experiment_metadata(self, experiment, metadataPrefix):
+    def _get_experiment_metadata(self, experiment, metadataPrefix,
+                                 owners=None):
         return Metadata({
             '_writeMetadata': lambda e, m: oai_dc_writer(e, m),
             'title': [experiment.title],
@@ -199,7 +352,8 @@ class RifCsExperimentProvider(AbstractExperimentProvider):
         except oaipmh.error.IdDoesNotExistError:
             return []
 
-    def _get_experiment_metadata(self, experiment, metadataPrefix):
+    def _get_experiment_metadata(self, experiment, metadataPrefix,
+                                 owners=None):
         license_ = experiment.license or License.get_none_option_license()
         # Access Rights statement
         if experiment.public_access == Experiment.PUBLIC_ACCESS_METADATA:
@@ -246,7 +400,8 @@ class RifCsExperimentProvider(AbstractExperimentProvider):
             'licence_uri': license_.url,
             'access': access,
             'collectors': collectors,
-            'managers': experiment.get_owners(),
+            'managers': experiment.get_owners() if owners is None \
+                else owners,
             'related_info': related_info,
             'subjects': subjects
         })
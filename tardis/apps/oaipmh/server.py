@@ -7,16 +7,22 @@ from django.core.urlresolvers import reverse
 
 from datetime import datetime
 
-from oaipmh.common import Identify, Header, Metadata
+from oaipmh.common import Identify, Header, Metadata, ResumptionOAIPMH, \
+    getMethodForVerb
 import oaipmh.error
 from oaipmh.interfaces import IOAI
 from oaipmh.metadata import MetadataRegistry
-from oaipmh.server import Server, oai_dc_writer
+from oaipmh.server import ServerBase, oai_dc_writer, \
+    decodeResumptionToken, encodeResumptionToken
 
 import itertools
 
 import pytz
 
+# Most records or identifiers in each response to ListRecords or
+# ListIdentifiers; the rest follow with the resumption token
+BATCH_SIZE = getattr(settings, 'OAIPMH_BATCH_SIZE', 100)
+
 def _safe_import_class(path):
     try:
         dot = path.rindex('.')
@@ -144,6 +150,72 @@ class ProxyingServer(IOAI):
                 return list_
         return frozenset(reduce(appendIdents, self.providers, []))
 
+    def listIdentifiersPage(self, metadataPrefix, cursor=None,
+                            batch_size=BATCH_SIZE, **kwargs):
+        """
+        Lists a page of identifiers from the providers in turn.
+
+        :param cursor: where the page starts, as returned with the
+            previous page, or ``None`` for the first page.
+
+        :raises error.CannotDisseminateFormatError: if ``metadataPrefix``
+            is not supported by the repository.
+
+        :raises error.NoSetHierarchyError: if a set is provided, as the
+            repository does not support sets.
+
+        :returns: a list of up to ``batch_size`` headers, and the cursor of
+            the next page, or ``None`` if this was the last.
+        """
+        return self._list_page('listIdentifiersPage', metadataPrefix,
+                               cursor, batch_size, kwargs)
+
+    def listRecordsPage(self, metadataPrefix, cursor=None,
+                        batch_size=BATCH_SIZE, **kwargs):
+        """
+        Lists a page of records from the providers in turn.
+
+        Takes the same arguments as :py:meth:`listIdentifiersPage`.
+
+        :returns: a list of up to ``batch_size`` ``header``, ``metadata``,
+            ``about`` tuples, and the cursor of the next page, or ``None``
+            if this was the last.
+        """
+        return self._list_page('listRecordsPage', metadataPrefix,
+                               cursor, batch_size, kwargs)
+
+    def _list_page(self, method_name, metadataPrefix, cursor, batch_size,
+                   kwargs):
+        if kwargs.has_key('set') and kwargs['set']:
+            raise oaipmh.error.NoSetHierarchyError
+        providers = [p for p in self.providers
+                     if metadataPrefix in [f[0] for f in
+                                           p.listMetadataFormats()]]
+        if not providers:
+            raise oaipmh.error.CannotDisseminateFormatError
+        # Cursors are the provider's index, and its own cursor within it
+        index, provider_cursor = 0, None
+        if cursor:
+            try:
+                index, provider_cursor = cursor.split(':', 1)
+                index = int(index)
+            except ValueError:
+                raise oaipmh.error.BadResumptionTokenError
+            if not 0 <= index < len(providers):
+                raise oaipmh.error.BadResumptionTokenError
+        results = []
+        while index < len(providers) and len(results) < batch_size:
+            method = getattr(providers[index], method_name)
+            page, provider_cursor = method(
+                metadataPrefix, cursor=provider_cursor or None,
+                batch_size=batch_size - len(results), **kwargs)
+            results.extend(page)
+            if provider_cursor is None:
+                index += 1
+        if index >= len(providers):
+            return results, None
+        return results, '%d:%s' % (index, provider_cursor or '')
+
     def listMetadataFormats(self, **kwargs):
         """
         List metadata formats from all providers in a single set.
@@ -228,6 +300,49 @@ class ProxyingServer(IOAI):
         # We might as well advertise our ignorance
         return ['noreply@'+current_site]
 
+class PagingResumption(ResumptionOAIPMH):
+    """
+    Turns a :py:class:`ProxyingServer` into a ResumptionOAIPMH interface,
+    which lists records and identifiers a page at a time.
+
+    Unlike :py:class:`oaipmh.server.Resumption`, each page is fetched
+    from where the last one ended, rather than by listing everything
+    again, so responses take as long and as much memory however many
+    records there are.
+    """
+
+    # Resumption token key of the ProxyingServer cursor
+    CURSOR_KEY = 'page'
+
+    def __init__(self, server, batch_size=BATCH_SIZE):
+        self._server = server
+        self._batch_size = batch_size
+
+    def handleVerb(self, verb, kw):
+        if verb == 'ListSets':
+            return list(self._server.listSets()), None
+        if verb not in ('ListIdentifiers', 'ListRecords'):
+            return getMethodForVerb(self._server, verb)(**kw)
+        cursor, count = None, 0
+        if 'resumptionToken' in kw:
+            kw, count = decodeResumptionToken(kw['resumptionToken'])
+            try:
+                cursor = kw.pop(self.CURSOR_KEY)
+            except KeyError:
+                raise oaipmh.error.BadResumptionTokenError
+        # e.g. listRecordsPage
+        method = getattr(self._server,
+                         '%s%sPage' % (verb[0].lower(), verb[1:]))
+        result, cursor = method(cursor=cursor, batch_size=self._batch_size,
+                                **kw)
+        if cursor is None:
+            return result, None
+        # The token's cursor counts what has been listed already
+        kw = dict(kw)
+        kw[self.CURSOR_KEY] = cursor
+        return result, encodeResumptionToken(kw, count + len(result))
+
+
 _servers = {}
 
 def get_server(current_site):
@@ -239,8 +354,8 @@ def get_server(current_site):
         return class_(current_site)
     # Create new objects with site argument
     providers = [create_provider(p) for p in settings.OAIPMH_PROVIDERS]
-    server = Server(ProxyingServer(providers),
-                    metadata_registry=ProxyingMetadataRegistry(providers))
+    server = ServerBase(PagingResumption(ProxyingServer(providers)),
+                        metadata_registry=ProxyingMetadataRegistry(providers))
     # Memoize
     _servers[current_site.domain] = server
     return server
@@ -107,6 +107,30 @@ class AbstractExperimentProviderTC():
         # First is not public, so should not appear
         expect(len(headers)).to_equal(1)
 
+    def testListIdentifiersPage(self):
+        provider = self._getProvider()
+        prefix = self._getProviderMetadataPrefix()
+        expected = sorted(h.identifier()
+                          for h in provider.listIdentifiers(prefix))
+        # A page at a time, ending with no cursor
+        identifiers, cursor = [], None
+        for _ in range(len(expected)):
+            headers, cursor = provider.listIdentifiersPage(
+                prefix, cursor=cursor, batch_size=1)
+            expect(len(headers)).to_equal(1)
+            identifiers += [h.identifier() for h in headers]
+            if cursor is None:
+                break
+        expect(cursor).to_be_none()
+        expect(sorted(identifiers)).to_equal(expected)
+        # Experiments come in order of their update time
+        self._experiment.save()
+        headers, _ = provider.listIdentifiersPage(prefix, batch_size=2)
+        expect(headers[1].identifier())\
+            .to_equal('experiment/%d' % self._experiment.id)
+        expect(lambda: provider.listIdentifiersPage(prefix, cursor='bad'))\
+            .to_raise(oaipmh.error.BadResumptionTokenError)
+
     def testListIdentifiersDoesNotHandleSets(self):
         def call_with_set():
             self._getProvider() \
@@ -1,6 +1,7 @@
 from compare import expect
 
 from django.contrib.auth.models import User
+from django.contrib.sites.models import Site
 from django.test import TestCase
 from django.test.client import Client
 
@@ -10,6 +11,9 @@ import oaipmh.error
 import pytz
 
 from tardis.tardis_portal.creativecommonshandler import CreativeCommonsHandler
+from tardis.apps.oaipmh.provider.experiment import DcExperimentProvider, \
+    RifCsExperimentProvider
+from tardis.apps.oaipmh.server import PagingResumption, ProxyingServer
 from tardis.tardis_portal.models import \
     Experiment, ExperimentACL, License, UserProfile
 
@@ -310,3 +314,34 @@ class EndpointTestCase(TestCase):
     def tearDown(self):
         pass
 
+
+class PagingTestCase(TestCase):
+
+    def setUp(self):
+        user, self.experiment = _create_test_data()
+        site = Site.objects.get_current()
+        self.server = PagingResumption(
+            ProxyingServer([DcExperimentProvider(site),
+                            RifCsExperimentProvider(site)]),
+            batch_size=1)
+
+    def testListIdentifiers(self):
+        headers, token = self.server.listIdentifiers(metadataPrefix='rif')
+        expect([h.identifier() for h in headers])\
+            .to_equal(['experiment/%d' % self.experiment.id])
+        headers, token = self.server.listIdentifiers(resumptionToken=token)
+        expect([h.identifier() for h in headers]).to_equal(['user/1'])
+        expect(token).to_be_none()
+
+    def testListRecords(self):
+        # Experiments have Dublin Core records, but their owners don't
+        records, token = self.server.listRecords(metadataPrefix='oai_dc')
+        expect([header.identifier() for header, _, _ in records])\
+            .to_equal(['experiment/%d' % self.experiment.id])
+        expect(token).to_be_none()
+
+    def testBadResumptionToken(self):
+        for token in ('cursor=1&metadataPrefix=rif',
+                      'cursor=1&metadataPrefix=rif&page=9%3A'):
+            expect(lambda: self.server.listIdentifiers(resumptionToken=token))\
+                .to_raise(oaipmh.error.BadResumptionTokenError)
@@ -44,6 +44,14 @@ BROKER_TRANSPORT = 'django'
 #    }
 #}
 
+# Seconds the groups users belong to, and the experiments they have been
+# granted access to, are cached for.  They are only cached once CACHES is
+# set to a cache shared by every process, like memcached above; changes
+# made in MyTardis then take effect straight away, and this bounds how
+# long group changes in external providers (e.g. LDAP) and ACL
+# effective/expiry dates take to be noticed.  0 turns the cache off.
+ACL_CACHE_TIMEOUT = 300
+
 # Local time zone for this installation. Choices can be found here:
 # http://en.wikipedia.org/wiki/List_of_tz_zones_by_name
 # although not all choices may be available on all operating systems.
@@ -144,6 +152,51 @@ STAGING_MOUNT_PREFIX = 'smb://localhost/staging/'
 STAGING_MOUNT_USER_SUFFIX_ENABLE = False
 
 DEFAULT_FILE_STORAGE = 'tardis.tardis_portal.storage.MyTardisLocalFileSystemStorage'
+# To store identical files only once, keyed by their SHA-512 digest, use
+# 'tardis.tardis_portal.storage.DeduplicatingFileSystemStorage' instead and
+# run "manage.py dedupfiles" to fold in existing files.
+# Directory under FILE_STORE_PATH which holds the deduplicated files
+DEDUP_BLOB_DIRECTORY = 'blobs'
+# Directory under FILE_STORE_PATH which holds the preview images made by
+# filters.  Run "manage.py storepreviews" to move previews stored in
+# parameters as base64 encoded strings there.
+PREVIEW_DIRECTORY = 'previews'
+
+# Where images rendered by the IIIF API are cached, and how many bytes the
+# cache may use before the least recently used images are removed.
+IIIF_CACHE_PATH = path.abspath(path.join(path.dirname(__file__),
+    '../var/iiif-cache/')).replace('\\', '/')
+IIIF_CACHE_SIZE = 1024 * 1024 * 1024
+# To have the web server send cached images, set to 'X-Sendfile', or to
+# 'X-Accel-Redirect' with IIIF_CACHE_SENDFILE_PREFIX the internal nginx
+# location IIIF_CACHE_PATH is served from.
+IIIF_CACHE_SENDFILE = None
+IIIF_CACHE_SENDFILE_PREFIX = '/iiif-cache/'
+# Where thumbnails, previews and tile pyramids are pre-rendered for image
+# datafiles once they are verified (remove to turn this off).  Images
+# larger than IIIF_PYRAMID_MIN_SIZE pixels across are cut into
+# IIIF_TILE_SIZE pixel tiles at a series of halving resolutions.
+IIIF_PYRAMID_PATH = path.abspath(path.join(path.dirname(__file__),
+    '../var/iiif-pyramid/')).replace('\\', '/')
+IIIF_PYRAMID_MIN_SIZE = 2048
+IIIF_TILE_SIZE = 512
+# At most IIIF_RENDER_SLOTS images are rendered for the IIIF API at once on
+# each host, by all its web server processes together, which hold the
+# slots as lock files in IIIF_RENDER_SLOT_PATH.  Requests finding no free
+# slot are told straight away to retry after IIIF_RENDER_RETRY_AFTER
+# seconds.  Images are rendered in the web server's process, or by a pool
+# of IIIF_RENDER_PROCESSES processes of each web server process's own,
+# which renders taking more than IIIF_RENDER_TIMEOUT seconds are turned
+# away from.  ImageMagick's use of memory and disk is limited to
+# IIIF_RENDER_MEMORY_LIMIT and IIIF_RENDER_DISK_LIMIT bytes.
+IIIF_RENDER_SLOTS = 4
+IIIF_RENDER_SLOT_PATH = path.abspath(path.join(path.dirname(__file__),
+    '../var/iiif-render/')).replace('\\', '/')
+IIIF_RENDER_PROCESSES = 0
+IIIF_RENDER_TIMEOUT = 30
+IIIF_RENDER_RETRY_AFTER = 5
+IIIF_RENDER_MEMORY_LIMIT = 256 * 1024 * 1024
+IIIF_RENDER_DISK_LIMIT = 1024 * 1024 * 1024
 
 # Absolute path to the directory that holds media.
 # Example: "/home/media/media.lawrence.com/"
@@ -257,9 +310,22 @@ EMAIL_USE_TLS = True
 #POST_SAVE_FILTERS = [
 #    ("tardis.tardis_portal.filters.diffractionimage.make_filter",
 #     ["DIFFRACTION", "http://www.tardis.edu.au/schemas/trdDatafile/1",
-#      "/Users/steve/Desktop/diffdump"]),  #  requires ccp4 diffdump binary
+#      "/Users/steve/Desktop/diffdump",    #  requires ccp4 diffdump and
+#      "/Users/steve/Desktop/diff2jpeg"],  #  diff2jpeg binaries
+#     # Only read these images, rather than trying every file
+#     {"extensions": ["img", "osc", "mccd", "cbf", "sfrm"]}),
 #    ]
 
+# Post-save filters are run by the Celery workers, this many seconds after
+# a datafile is created or its file changes, on up to
+# POST_SAVE_FILTER_BATCH_SIZE datafiles at a time.  Filters limiting how
+# many of their runs go at once try again after
+# POST_SAVE_FILTER_RETRY_DELAY seconds when they are busy; they need CACHES
+# to be shared by the workers, like memcached above.
+POST_SAVE_FILTER_DELAY = 10
+POST_SAVE_FILTER_BATCH_SIZE = 100
+POST_SAVE_FILTER_RETRY_DELAY = 30
+
 # logging levels are: DEBUG, INFO, WARN, ERROR, CRITICAL
 SYSTEM_LOG_LEVEL = 'INFO'
 MODULE_LOG_LEVEL = 'INFO'
@@ -281,9 +347,13 @@ UPLOADIFY_UPLOAD_PATH = '%s/%s' % (MEDIA_URL, 'uploads')
 # Download size limit: zero means no limit
 DOWNLOAD_ARCHIVE_SIZE_LIMIT = 0
 
-# Safety margin for temporary space when downloading.  (Estimated archive
-# file size + safety_margin must be less that available disk space ...)
-DOWNLOAD_SPACE_SAFETY_MARGIN = 8388608
+# Datafile verification: bytes read at a time while checksumming, and the
+# number of datafiles checked by each background verification task
+VERIFY_BUFFER_SIZE = 4 * 1024 * 1024
+VERIFY_BATCH_SIZE = 100
+
+# Largest chunk accepted by the chunked upload API, in bytes
+UPLOAD_CHUNK_SIZE_LIMIT = 64 * 1024 * 1024
 
 # Disable registration (copy to your settings.py first!)
 # INSTALLED_APPS = filter(lambda x: x != 'registration', INSTALLED_APPS)
@@ -304,6 +374,10 @@ DEFAULT_INSTITUTION = "Monash University"
 #Are the datasets ingested via METS xml (web services) to be immutable?
 IMMUTABLE_METS_DATASETS = True
 
+# Rows written by each bulk insert when ingesting METS datafiles and their
+# parameters
+METS_INGEST_BATCH_SIZE = 1000
+
 TOKEN_EXPIRY_DAYS = 30
 TOKEN_LENGTH = 30
 TOKEN_USERNAME = 'tokenuser'
@@ -317,6 +391,10 @@ RIFCS_TEMPLATE_DIR = path.join(path.dirname(__file__),
     'tardis_portal/templates/tardis_portal/rif-cs/profiles/')
 RIFCS_GROUP = "MyTARDIS Default Group"
 RIFCS_KEY = "keydomain.example"
+# The RIF-CS of a changed experiment is regenerated by the Celery workers
+# this many seconds later, once for however many changes are made to it.
+# Run "django republishrifcs" after changing the providers or templates.
+RIFCS_PUBLISH_DELAY = 30
 RELATED_INFO_SCHEMA_NAMESPACE = 'http://www.tardis.edu.au/schemas/related_info/2011/11/10'
 RELATED_OTHER_INFO_SCHEMA_NAMESPACE = 'http://www.tardis.edu.au/schemas/experiment/annotation/2011/07/07'
 
@@ -334,6 +412,8 @@ OAIPMH_PROVIDERS = [
     'tardis.apps.oaipmh.provider.experiment.DcExperimentProvider',
     'tardis.apps.oaipmh.provider.experiment.RifCsExperimentProvider',
 ]
+# Most records in each OAI-PMH ListRecords or ListIdentifiers response
+OAIPMH_BATCH_SIZE = 100
 
 
 CELERYBEAT_SCHEDULE = {
@@ -40,16 +40,19 @@ auth_service = AuthService()
 def login(request, user):
     from django.contrib.auth import login
     login(request, user)
-    request.__class__.groups = auth_service.getGroups(request)
-    request.session[GROUPS] = request.groups
+    # Look the groups up again for the newly logged in user
+    request.__class__.groups = LazyGroups()
+    if hasattr(request, '_cached_groups'):
+        del request._cached_groups
 
 
 class LazyGroups(object):
+    # Groups used to be kept in the session for its lifetime; now they are
+    # looked up on each request, with the expensive providers' answers
+    # cached between requests by acl_cache
 
     def __get__(self, request, obj_type=None):
         if not hasattr(request, '_cached_groups'):
-            if GROUPS in request.session:
-                return request.session[GROUPS]
             request._cached_groups = auth_service.getGroups(request)
         return request._cached_groups
 
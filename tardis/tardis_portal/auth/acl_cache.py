@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+acl_cache.py
+
+A cache, shared between requests and processes, of the groups users
+belong to and of the experiments they have been granted read access to.
+Looking either up can be expensive: group providers may search a
+directory, and the experiments query has a clause per group.
+
+Invalidations have to reach every process, so nothing is cached unless
+the default Django cache is shared between them (e.g. memcached, set up
+in CACHES), rather than the local memory cache Django uses by default.
+
+Entries expire after ACL_CACHE_TIMEOUT seconds and are evicted by the
+cache backend as it sees fit.  Changes made through MyTardis to ACLs,
+group membership or group admins invalidate the affected entries straight
+away (see ``models/hooks.py``); the timeout bounds how long ACLs reaching
+their effective or expiry dates, and group changes made elsewhere, take to
+be noticed.
+
+Invalidation works by changing a version number which is part of each
+entry's key, so that a single cache operation invalidates every entry for
+a user (or, for ACLs, for everyone).
+"""
+
+import hashlib
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.cache import cache
+
+from tardis.tardis_portal.util import is_cache_shared
+
+ACL_CACHE_TIMEOUT = getattr(settings, 'ACL_CACHE_TIMEOUT', 300)
+
+_ACL_VERSION_KEY = 'tardis_portal.acl.version'
+
+
+def _groups_version_key(user_id):
+    return 'tardis_portal.groups.version.%s' % user_id
+
+
+def _get_version(key):
+    version = cache.get(key)
+    if version is None:
+        # A fresh random version can't match any stale entries; add() makes
+        # concurrent requests agree on which one is used
+        cache.add(key, uuid4().hex, ACL_CACHE_TIMEOUT)
+        version = cache.get(key)
+    return version
+
+
+def _is_enabled():
+    return bool(ACL_CACHE_TIMEOUT) and is_cache_shared(cache)
+
+
+def _get_or_calculate(key, calculate):
+    value = cache.get(key)
+    if value is None:
+        value = calculate()
+        cache.set(key, value, ACL_CACHE_TIMEOUT)
+    return value
+
+
+def get_groups(user, provider_name, calculate):
+    """
+    Return the groups a group provider puts a user in, calling calculate
+    to look them up if they aren't cached.
+    """
+    if not _is_enabled():
+        return calculate()
+    key = 'tardis_portal.groups.%s.%s.%s' % \
+        (user.id, _get_version(_groups_version_key(user.id)), provider_name)
+    return _get_or_calculate(key, calculate)
+
+
+def get_granted_experiment_ids(request, calculate):
+    """
+    Return the ids of the experiments the request's user and groups have
+    been granted read access to, calling calculate to look them up if they
+    aren't cached.
+    """
+    if not _is_enabled():
+        return calculate()
+    groups = hashlib.md5(repr(sorted(request.groups))).hexdigest()
+    key = 'tardis_portal.acl.%s.%s.%s' % \
+        (_get_version(_ACL_VERSION_KEY), request.user.id, groups)
+    return _get_or_calculate(key, calculate)
+
+
+def invalidate_groups(user_ids):
+    """Forget the cached groups of the given users."""
+    cache.delete_many([_groups_version_key(user_id) for user_id in user_ids])
+
+
+def invalidate_acls():
+    """Forget everyone's cached experiment access."""
+    cache.delete(_ACL_VERSION_KEY)
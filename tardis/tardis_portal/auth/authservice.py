@@ -44,6 +44,7 @@ from django.core.exceptions import ImproperlyConfigured
 from django.contrib import auth
 from django.contrib.auth.models import Permission
 from tardis.tardis_portal.staging import get_full_staging_path
+from tardis.tardis_portal.auth import acl_cache
 from tardis.tardis_portal.auth.localdb_auth import auth_key as localdb_auth_key
 
 logger = logging.getLogger(__name__)
@@ -250,7 +251,13 @@ class AuthService():
         grouplist = []
         for gp in self._group_providers:
             # logger.debug("group provider: " + gp.name)
-            for group in gp.getGroups(request):
+            if getattr(gp, 'cache_groups', False) and request.user.is_authenticated():
+                groups = acl_cache.get_groups(
+                    request.user, gp.name,
+                    lambda: list(gp.getGroups(request) or []))
+            else:
+                groups = gp.getGroups(request)
+            for group in groups:
                 grouplist.append((gp.name, group))
         return grouplist
 
@@ -36,24 +36,123 @@ from django.db.models import Q
 
 from tardis.tardis_portal.models import Experiment, Dataset, Dataset_File, GroupAdmin, User
 from tardis.tardis_portal.shortcuts import return_response_error
+from tardis.tardis_portal.auth import acl_cache
+
+# Most ids put in a single IN clause (SQLite allows 999 parameters)
+ACL_QUERY_BATCH_SIZE = 500
+
+
+def _batches(ids):
+    ids = list(ids)
+    for i in range(0, len(ids), ACL_QUERY_BATCH_SIZE):
+        yield ids[i:i + ACL_QUERY_BATCH_SIZE]
+
+
+class ACLResolver(object):
+    """
+    Answers read and download access questions for one request.
+
+    The experiments the user has been granted read access to (directly or
+    through their groups, within the ACLs' effective and expiry dates) are
+    looked up once (or taken from :mod:`acl_cache`), as are the public
+    access levels of the experiments asked about.  Datasets and datafiles
+    are mapped to their experiments with one query per batch of ids, so
+    checking a whole selection costs a handful of queries rather than
+    several per datafile.
+
+    Use :func:`get_acl_resolver` to get the resolver for a request.  It
+    doesn't see ACLs changed after its first check, so views which change
+    ACLs shouldn't rely on it afterwards in the same request.
+    """
+
+    def __init__(self, request):
+        self.request = request
+        self._granted = None
+        self._public_access = {}
+
+    def _granted_ids(self):
+        if self._granted is None:
+            request = self.request
+            self._granted = acl_cache.get_granted_experiment_ids(
+                request, lambda: set(Experiment.safe.owned_and_shared(request)
+                                     .values_list('id', flat=True)))
+        return self._granted
+
+    def _get_public_access(self, experiment_ids):
+        missing = [id_ for id_ in experiment_ids
+                   if id_ not in self._public_access]
+        for batch in _batches(missing):
+            self._public_access.update(
+                Experiment.objects.filter(id__in=batch)
+                                  .values_list('id', 'public_access'))
+        return self._public_access
+
+    def _allowed(self, experiment_ids, public_allows):
+        experiment_ids = set(int(id_) for id_ in experiment_ids)
+        allowed = experiment_ids & self._granted_ids()
+        public_access = self._get_public_access(experiment_ids - allowed)
+        allowed.update(id_ for id_ in experiment_ids - allowed
+                       if id_ in public_access and
+                          public_allows(public_access[id_]))
+        return allowed
+
+    def readable_experiments(self, experiment_ids):
+        """Return the ids of the given experiments the user may see."""
+        return self._allowed(experiment_ids, lambda level:
+                             level != Experiment.PUBLIC_ACCESS_NONE)
+
+    def downloadable_experiments(self, experiment_ids):
+        """Return the ids of the given experiments the user may download."""
+        return self._allowed(experiment_ids,
+                             Experiment.public_access_implies_distribution)
+
+    def _filter(self, model, field, ids, allowed):
+        # Map each id to its experiments, then keep those with at least
+        # one experiment the user is allowed
+        experiments = {}
+        for batch in _batches(set(int(id_) for id_ in ids)):
+            for id_, experiment_id in model.objects.filter(id__in=batch) \
+                                                   .values_list('id', field):
+                experiments.setdefault(id_, set()).add(experiment_id)
+        experiments = dict((id_, exps - set([None]))
+                           for id_, exps in experiments.items())
+        permitted = allowed(set().union(*experiments.values()))
+        return set(id_ for id_, exps in experiments.items()
+                   if exps & permitted)
+
+    def readable_datasets(self, dataset_ids):
+        return self._filter(Dataset, 'experiments', dataset_ids,
+                            self.readable_experiments)
+
+    def downloadable_datasets(self, dataset_ids):
+        return self._filter(Dataset, 'experiments', dataset_ids,
+                            self.downloadable_experiments)
+
+    def readable_datafiles(self, datafile_ids):
+        return self._filter(Dataset_File, 'dataset__experiments',
+                            datafile_ids, self.readable_experiments)
+
+    def downloadable_datafiles(self, datafile_ids):
+        return self._filter(Dataset_File, 'dataset__experiments',
+                            datafile_ids, self.downloadable_experiments)
+
+
+def get_acl_resolver(request):
+    """Return the :class:`ACLResolver` for a request, creating it if needed."""
+    if not hasattr(request, '_acl_resolver'):
+        request._acl_resolver = ACLResolver(request)
+    return request._acl_resolver
+
 
 def get_accessible_experiments(request):
     return Experiment.safe.all(request)
 
 
 def get_accessible_experiments_for_dataset(request, dataset_id):
-    experiments = Experiment.safe.all(request)
-    
-    # probably a much cleverer way of writing this with safe
-    experiment_dataset_access = []
-    for experiment in experiments:
-        experiment_dataset = Experiment.objects.filter(\
-            id=experiment.id,
-            datasets__in=[dataset_id])
-        if experiment_dataset.count():
-            experiment_dataset_access.append(experiment_dataset[0])
-
-    return experiment_dataset_access
+    experiments = Experiment.objects.filter(datasets__id=dataset_id)
+    readable = get_acl_resolver(request) \
+        .readable_experiments([e.id for e in experiments])
+    return [e for e in experiments if e.id in readable]
 
 
 def get_shared_experiments(request):
@@ -89,25 +188,15 @@ def has_experiment_ownership(request, experiment_id):
 
 
 def has_experiment_access(request, experiment_id):
-    try:
-        Experiment.safe.get(request, experiment_id)
-        return True
-    except PermissionDenied:
-        return False
+    return bool(get_acl_resolver(request)
+                .readable_experiments([experiment_id]))
 
 def has_experiment_write(request, experiment_id):
     return has_write_permissions(request, experiment_id)
 
 def has_experiment_download_access(request, experiment_id):
-    
-    if Experiment.safe.owned_and_shared(request) \
-                      .filter(id=experiment_id) \
-                      .exists():
-                      
-        return True
-    else:
-        exp = Experiment.objects.get(id=experiment_id)
-        return Experiment.public_access_implies_distribution(exp.public_access)
+    return bool(get_acl_resolver(request)
+                .downloadable_experiments([experiment_id]))
 
 def has_dataset_ownership(request, dataset_id):
     dataset = Dataset.objects.get(id=dataset_id)
@@ -115,10 +204,7 @@ def has_dataset_ownership(request, dataset_id):
                for experiment in dataset.experiments.all())
 
 def has_dataset_access(request, dataset_id):
-    dataset = Dataset.objects.get(id=dataset_id)
-
-    return any(has_experiment_access(request, experiment.id)
-               for experiment in dataset.experiments.all())
+    return bool(get_acl_resolver(request).readable_datasets([dataset_id]))
 
 def has_dataset_write(request, dataset_id):
     dataset = Dataset.objects.get(id=dataset_id)
@@ -128,17 +214,16 @@ def has_dataset_write(request, dataset_id):
                for experiment in dataset.experiments.all())
 
 def has_dataset_download_access(request, dataset_id):
-    dataset = Dataset.objects.get(id=dataset_id)
-    return any(has_experiment_download_access(request, experiment.id)
-               for experiment in dataset.experiments.all())
+    return bool(get_acl_resolver(request)
+                .downloadable_datasets([dataset_id]))
 
 def has_datafile_access(request, dataset_file_id):
-    dataset = Dataset.objects.get(dataset_file=dataset_file_id)
-    return has_dataset_access(request, dataset.id)
+    return bool(get_acl_resolver(request)
+                .readable_datafiles([dataset_file_id]))
 
 def has_datafile_download_access(request, dataset_file_id):
-    dataset = Dataset.objects.get(dataset_file=dataset_file_id)
-    return has_dataset_download_access(request, dataset.id)
+    return bool(get_acl_resolver(request)
+                .downloadable_datafiles([dataset_file_id]))
 
 def has_read_or_owner_ACL(request, experiment_id):
     """
@@ -92,6 +92,10 @@ class UserProvider:
 
 class GroupProvider:
 
+    # Whether the groups returned by getGroups depend only on the user, so
+    # they can be cached between requests (see acl_cache)
+    cache_groups = False
+
     def getGroups(self, request):
         """
         return an iteration of the available groups.
@@ -54,6 +54,8 @@ auth_display_name = u'LDAP'
 
 
 class LDAPBackend(AuthProvider, UserProvider, GroupProvider):
+    cache_groups = True
+
     def __init__(self, name, url, base, login_attr, user_base,
                  user_attr_map, group_id_attr, group_base,
                  group_attr_map, admin_user='', admin_pass=''):
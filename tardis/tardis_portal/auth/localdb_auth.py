@@ -52,6 +52,7 @@ class DjangoAuthBackend(AuthProvider):
 
 class DjangoGroupProvider(GroupProvider):
     name = u'django_group'
+    cache_groups = True
 
     def getGroups(self, request):
         """return an iteration of the available groups.
@@ -0,0 +1,133 @@
+"""
+checksums.py
+
+Computes datafile checksums.  Each hash algorithm is fed from its own
+thread, so md5 and sha512 are calculated concurrently with each other and
+with reading the next buffer (hashlib releases the GIL while hashing).
+"""
+import hashlib
+import logging
+import os
+import time
+from Queue import Queue
+from threading import Thread, Lock
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Size of each read when checksumming a file
+BUFFER_SIZE = getattr(settings, 'VERIFY_BUFFER_SIZE', 4 * 1024 * 1024)
+# Buffers which may be waiting for each hashing thread
+QUEUE_DEPTH = getattr(settings, 'VERIFY_QUEUE_DEPTH', 4)
+
+ALGORITHMS = ('md5', 'sha512')
+
+
+class ParallelHasher(object):
+    """
+    Calculates several digests of the same data at once, with one thread per
+    algorithm.  Data is passed to :meth:`update` as it is read, and the
+    digests are collected with :meth:`hexdigests` once it is all through.
+    """
+
+    _END = None
+
+    def __init__(self, algorithms=ALGORITHMS, queue_depth=QUEUE_DEPTH):
+        self._hashes = dict((name, hashlib.new(name)) for name in algorithms)
+        self._queues = []
+        self._threads = []
+        for hash_ in self._hashes.values():
+            queue = Queue(maxsize=queue_depth)
+            thread = Thread(target=self._consume, args=(hash_, queue))
+            thread.daemon = True
+            thread.start()
+            self._queues.append(queue)
+            self._threads.append(thread)
+
+    @staticmethod
+    def _consume(hash_, queue):
+        for data in iter(queue.get, ParallelHasher._END):
+            hash_.update(data)
+
+    def update(self, data):
+        # Blocks if a hashing thread is more than queue_depth buffers behind,
+        # which keeps memory use bounded for slow algorithms
+        for queue in self._queues:
+            queue.put(data)
+
+    def close(self):
+        for queue in self._queues:
+            queue.put(self._END)
+        for thread in self._threads:
+            thread.join()
+        self._queues = []
+
+    def hexdigests(self):
+        """Return a dict of lower-case hex digests, keyed by algorithm."""
+        self.close()
+        return dict((name, hash_.hexdigest())
+                    for name, hash_ in self._hashes.items())
+
+
+def compute_checksums(f, tempfile=None, header_size=0,
+                      buffer_size=BUFFER_SIZE, algorithms=ALGORITHMS):
+    """
+    Read the file-like object f to the end, returning a tuple of the digests
+    (as returned by :meth:`ParallelHasher.hexdigests`), the number of bytes
+    read and the first header_size bytes of the data.
+
+    If passed a file handle in tempfile, the data is also written to it.
+    """
+    hasher = ParallelHasher(algorithms)
+    size = 0
+    header = ''
+    start = time.time()
+    try:
+        for chunk in iter(lambda: f.read(buffer_size), ''):
+            size += len(chunk)
+            if len(header) < header_size:
+                header += chunk[:header_size - len(header)]
+            hasher.update(chunk)
+            if tempfile:
+                tempfile.write(chunk)
+    finally:
+        digests = hasher.hexdigests()
+    throughput.add(size, time.time() - start)
+    return digests, size, header
+
+
+class ThroughputCounter(object):
+    """
+    Running totals of the data checksummed by this process, so workers can
+    report how fast they are getting through a store.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.files = 0
+            self.bytes = 0
+            self.seconds = 0.0
+
+    def add(self, size, seconds):
+        with self._lock:
+            self.files += 1
+            self.bytes += size
+            self.seconds += seconds
+
+    def megabytes_per_second(self):
+        if not self.seconds:
+            return 0.0
+        return self.bytes / self.seconds / (1024 * 1024)
+
+    def log(self):
+        logger.info('Worker %d checksummed %d files (%.1f MB) '
+                    'in %.1fs: %.1f MB/s' %
+                    (os.getpid(), self.files, self.bytes / (1024.0 * 1024),
+                     self.seconds, self.megabytes_per_second()))
+
+throughput = ThroughputCounter()
@@ -8,10 +8,8 @@ download.py
 
 """
 import logging
-import shutil
-import subprocess
 import urllib
-import os, platform, ctypes, stat, time, struct
+import os, stat, time, struct
 
 try:
     import zlib # We may need its compression method
@@ -20,11 +18,8 @@ except ImportError:
     zlib = None
     crc32 = binascii.crc32
     
-from itertools import chain
-from tempfile import mkstemp, gettempdir, NamedTemporaryFile
-from threading import Thread
-from urllib2 import urlopen, URLError
-from zipfile import ZipFile, ZipInfo, ZIP_STORED, ZIP_DEFLATED
+from urllib2 import URLError
+from zipfile import ZipFile, ZipInfo, ZIP_STORED, ZIP_DEFLATED, ZIP64_LIMIT
 
 from django.core.servers.basehttp import FileWrapper
 from django.http import HttpResponse, HttpResponseRedirect, \
@@ -38,59 +33,59 @@ from tardis.tardis_portal.views import return_response_not_found, \
 
 logger = logging.getLogger(__name__)
 
-class StreamingFile:
-
-    def __init__(self, writer_callable, asynchronous_file_creation=False):
-        # Caution, only use 'asynchronous_file_creation=True' if the 
-        # writer_callable outputs the file strictly sequentially.  If it seeks
-        # backwards to back-fill details (like ZipFile does!), this can cause 
-        # a data race and can result in a corrupted download.
-        _, self.name = mkstemp()
-        self.asynchronous = asynchronous_file_creation
-        if asynchronous_file_creation:
-            self.runnable = writer_callable
-            self.thread = Thread(target=self)
-            self.thread.start()
-        else:
-            writer_callable(self.name)
-        self.reader = open(self.name, 'rb')
+# Size of the blocks read from datafiles when streaming them into an archive
+ARCHIVE_BLOCK_SIZE = 64 * 1024
 
-    def __call__(self):
-        self.runnable(self.name)
 
-    def read(self, size=1):
-        def read_file(size):
-            return self.reader.read(size)
+class ArchiveSink(object):
+    """
+    Write-only file-like object which holds the bytes written to it until
+    they are drained by an archive generator.  It tracks the number of bytes
+    written so far, which is all :class:`zipfile.ZipFile` needs from
+    :meth:`tell` when entries use trailing data descriptors.
 
-        remaining_bytes = size
-        buf = ''
-        if self.asynchronous:
-            while self.thread.is_alive() and remaining_bytes > 0:
-                from time import sleep
-                sleep(0.01)
-                read_bytes = read_file(remaining_bytes)
-                buf += read_bytes
-                remaining_bytes -= len(read_bytes)
+    A discarding sink only counts bytes, which is used to measure archives.
+    """
 
-        if remaining_bytes > 0:
-            buf += read_file(remaining_bytes)
+    def __init__(self, discard=False):
+        self._chunks = []
+        self._offset = 0
+        self.discard = discard
 
-        return buf
+    def write(self, data):
+        if data:
+            if not self.discard:
+                self._chunks.append(data)
+            self._offset += len(data)
+
+    def advance(self, length):
+        """Account for length bytes which were not passed through the sink."""
+        self._offset += length
+
+    def tell(self):
+        return self._offset
+
+    def flush(self):
+        pass
 
     def close(self):
-        self.reader.close()
-        os.unlink(self.name)
-        
+        pass
+
+    def drain(self):
+        data = ''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
 class StreamableZipFile(ZipFile):
     def __init__(self, file, mode="r", compression=ZIP_STORED, allowZip64=False):
         ZipFile.__init__(self, file, mode, compression, allowZip64)
-    
+
     def write(self, filename, arcname=None, compress_type=None):
         """Put the bytes from filename into the archive under the name
         arcname.  The file is written in strictly sequential fashion - no seeking."""
-        
+
         # This code is a tweaked version of ZipFile.write ...
-        # TODO: add an alternative version that works with a stream rather than a filename.
         if not self.fp:
             raise RuntimeError(
                   "Attempt to write to ZIP archive that was already closed")
@@ -98,59 +93,114 @@ class StreamableZipFile(ZipFile):
         st = os.stat(filename)
         isdir = stat.S_ISDIR(st.st_mode)
         mtime = time.localtime(st.st_mtime)
-        date_time = mtime[0:6]
-        # Create ZipInfo instance to store file information
         if arcname is None:
             arcname = filename
+        zinfo = self._make_zinfo(arcname, mtime[0:6], st[0], compress_type,
+                                 isdir=isdir)
+        if isdir:
+            zinfo.file_size = 0
+            zinfo.compress_size = 0
+            zinfo.CRC = 0
+            zinfo.header_offset = self.fp.tell()
+            self._writecheck(zinfo)
+            self._didModify = True
+            self.filelist.append(zinfo)
+            self.NameToInfo[zinfo.filename] = zinfo
+            self.fp.write(zinfo.FileHeader())
+            return
+
+        with open(filename, "rb") as fp:
+            for _ in self._iter_write_data(zinfo, fp, st.st_size):
+                pass
+
+    def iter_write_fileobj(self, fileobj, arcname, date_time,
+                           file_size=None, compress_type=None):
+        """Put the bytes read from the file-like fileobj into the archive
+        under the name arcname.
+
+        This is a generator which yields after each block has been written
+        to the underlying file, so a caller streaming the archive can pass
+        the bytes on without buffering the whole member.  file_size is the
+        expected size of the data, and is only used to decide whether the
+        entry needs ZIP64 extensions."""
+        zinfo = self._make_zinfo(arcname, date_time, 0100644, compress_type)
+        return self._iter_write_data(zinfo, fileobj, file_size)
+
+    def layout_member(self, arcname, date_time, file_size):
+        """Lay out an uncompressed member of file_size bytes as
+        iter_write_fileobj would, but write only its header and data
+        descriptor.  The data itself must be accounted for by the caller.
+        Used to compute the size of an archive without reading any files."""
+        zinfo = self._make_zinfo(arcname, date_time, 0100644, ZIP_STORED)
+        zip64 = file_size > ZIP64_LIMIT
+        zinfo.file_size = file_size
+        zinfo.flag_bits = 0x08
+        zinfo.header_offset = self.fp.tell()
+        self._writecheck(zinfo)
+        self._didModify = True
+        self.fp.write(zinfo.FileHeader(zip64))
+        zinfo.CRC = 0
+        zinfo.compress_size = file_size
+        self.fp.write(self._data_descriptor(zinfo, zip64))
+        self.filelist.append(zinfo)
+        self.NameToInfo[zinfo.filename] = zinfo
+        return zinfo
+
+    def _data_descriptor(self, zinfo, zip64):
+        return struct.pack("<LQQ" if zip64 else "<LLL", zinfo.CRC,
+                           zinfo.compress_size, zinfo.file_size)
+
+    def _make_zinfo(self, arcname, date_time, mode, compress_type,
+                    isdir=False):
+        # Create ZipInfo instance to store file information
         arcname = os.path.normpath(os.path.splitdrive(arcname)[1])
         while arcname[0] in (os.sep, os.altsep):
             arcname = arcname[1:]
         if isdir:
             arcname += '/'
+        # DOS timestamps can't represent anything before 1980
+        if date_time[0] < 1980:
+            date_time = (1980, 1, 1, 0, 0, 0)
         zinfo = ZipInfo(arcname, date_time)
-        zinfo.external_attr = (st[0] & 0xFFFF) << 16L      # Unix attributes
+        zinfo.external_attr = (mode & 0xFFFF) << 16L      # Unix attributes
         if compress_type is None:
             zinfo.compress_type = self.compression
         else:
             zinfo.compress_type = compress_type
-
-        zinfo.file_size = st.st_size
-        zinfo.flag_bits = 0x08                  # Use trailing data descriptor for file sizes and CRC 
+        return zinfo
+
+    def _iter_write_data(self, zinfo, fp, expected_size):
+        # Entries which may exceed 4GB need a ZIP64 local header, so readers
+        # will expect 8 byte sizes in the trailing data descriptor
+        zip64 = bool(expected_size) and expected_size > ZIP64_LIMIT
+        zinfo.file_size = expected_size or 0
+        zinfo.flag_bits = 0x08                  # Use trailing data descriptor for file sizes and CRC
         zinfo.header_offset = self.fp.tell()    # Start of header bytes
 
         self._writecheck(zinfo)
         self._didModify = True
 
-        if isdir:
-            zinfo.file_size = 0
-            zinfo.compress_size = 0
-            zinfo.CRC = 0
-            self.filelist.append(zinfo)
-            self.NameToInfo[zinfo.filename] = zinfo
-            self.fp.write(zinfo.FileHeader())
-            return
-
-        with open(filename, "rb") as fp:
-            # The CRC and sizes in the file header are zero ...
-            zinfo.CRC = CRC = 0
-            zinfo.compress_size = compress_size = 0
-            zinfo.file_size = file_size = 0
-            self.fp.write(zinfo.FileHeader())
-            if zinfo.compress_type == ZIP_DEFLATED:
-                cmpr = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
-                     zlib.DEFLATED, -15)
-            else:
-                cmpr = None
-            while 1:
-                buf = fp.read(1024 * 8)
-                if not buf:
-                    break
-                file_size = file_size + len(buf)
-                CRC = crc32(buf, CRC) & 0xffffffff
-                if cmpr:
-                    buf = cmpr.compress(buf)
-                    compress_size = compress_size + len(buf)
-                self.fp.write(buf)
+        # The CRC and sizes in the file header are zero ...
+        zinfo.CRC = CRC = 0
+        zinfo.compress_size = compress_size = 0
+        zinfo.file_size = file_size = 0
+        self.fp.write(zinfo.FileHeader(zip64))
+        if zinfo.compress_type == ZIP_DEFLATED:
+            cmpr = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+                 zlib.DEFLATED, -15)
+        else:
+            cmpr = None
+        while 1:
+            buf = fp.read(ARCHIVE_BLOCK_SIZE)
+            if not buf:
+                break
+            file_size = file_size + len(buf)
+            CRC = crc32(buf, CRC) & 0xffffffff
+            if cmpr:
+                buf = cmpr.compress(buf)
+                compress_size = compress_size + len(buf)
+            self.fp.write(buf)
+            yield
         if cmpr:
             buf = cmpr.flush()
             compress_size = compress_size + len(buf)
@@ -161,11 +211,11 @@ class StreamableZipFile(ZipFile):
         # Write the data descriptor after the file containing the true sizes and CRC
         zinfo.CRC = CRC
         zinfo.file_size = file_size
-        self.fp.write(struct.pack("<LLL", zinfo.CRC, zinfo.compress_size,
-              zinfo.file_size))
+        self.fp.write(self._data_descriptor(zinfo, zip64))
         self.filelist.append(zinfo)
         self.NameToInfo[zinfo.filename] = zinfo
-        
+        yield
+
 def _create_download_response(request, datafile_id, disposition='attachment'):
     # Get datafile (and return 404 if absent)
     try:
@@ -211,131 +261,280 @@ def download_datafile(request, datafile_id):
 def _get_filename(rootdir, df):
     return os.path.join(rootdir, str(df.dataset.id), df.filename)
 
+def _get_datafile_size(df):
+    return long(df.get_size() or 0)
+
+def _get_datafile_mtime(df):
+    # Archive timestamps come from the database only, so that the same
+    # selection always produces a byte-identical archive
+    timestamp = df.modification_time or df.created_time
+    if timestamp:
+        return long(time.mktime(timestamp.timetuple()))
+    return 0
+
 def _get_datafile_details_for_archive(rootdir, datafiles):
-    # It would be simplest to do this lazily.  But if we do that, we implicitly
-    # passing the database context to the thread that will write the archive, and
-    # that is a bit dodgy.  (It breaks in unit tests!)  Instead, we populate the
-    # list eagerly, but with a file getter rather than the file itself.  If we
-    # populate with actual File objects, we risk running out of file descriptors.
-    return [(df.get_file_getter(), _get_filename(rootdir, df)) \
-             for df in datafiles]
-
-def _write_files_to_archive(write_func, files):
-    for fileGetter, name in files:
+    """
+    Returns the members of the archive as (file getter, name, size, mtime,
+    checksum) tuples, sorted by name.  Only verified files are included.
+
+    The member order, names, sizes and timestamps fully determine the
+    archive layout, so its length and the offset of every member can be
+    computed without reading any file.
+    """
+    # The archive is generated while the response is being sent, after the
+    # view has returned.  Rather than touching the database from inside the
+    # generator, we populate the list eagerly, but with a file getter rather
+    # than the file itself.  If we populate with actual File objects, we risk
+    # running out of file descriptors.
+    files = []
+    for df in datafiles:
+        name = _get_filename(rootdir, df)
+        fileGetter = df.get_file_getter()
         if not fileGetter:
             logger.debug('Skipping %s - no verified file is available.' % name)
             continue
-        fileObj = fileGetter()
-        if not fileObj:
-            logger.debug('Skipping %s - file open failed.' % name)
-            continue
-        with NamedTemporaryFile(prefix='mytardis_tmp_dl_') as fdst:
+        files.append((fileGetter, name, _get_datafile_size(df),
+                      _get_datafile_mtime(df), df.sha512sum or df.md5sum))
+    return sorted(files, key=lambda f: f[1])
+
+class _SizedReader(object):
+    """
+    Wraps an archive member's file so that exactly the number of bytes
+    recorded in the database is read from it.  Longer files are truncated,
+    and short or unreadable files are padded with zeros, so the archive
+    layout never deviates from the computed one.
+    """
+
+    def __init__(self, fileGetter, name, size):
+        self.name = name
+        self.remaining = size
+        try:
+            self.fileObj = fileGetter()
+        except IOError:
+            self.fileObj = None
+        if not self.fileObj:
+            logger.error('Unable to open %s for archive download - '
+                         'sending zeros instead' % name)
+
+    def skip(self, length):
+        length = min(length, self.remaining)
+        if self.fileObj:
+            try:
+                self.fileObj.seek(length)
+            except (AttributeError, IOError):
+                # Not seekable (eg. a remote file), so read past the data
+                while length > 0:
+                    length -= len(self.read(min(ARCHIVE_BLOCK_SIZE, length)))
+                return
+        self.remaining -= length
+
+    def read(self, size):
+        size = min(size, self.remaining)
+        if size <= 0:
+            return ''
+        buf = ''
+        if self.fileObj:
             try:
-                # Copy url to destination file
-                shutil.copyfileobj(fileObj, fdst)
-                # Flush the file so we can read from it properly
-                fdst.flush()
-                # Write file
-                write_func(fdst.name, name)
+                buf = self.fileObj.read(size)
             except URLError:
-                logger.warn("Unable to fetch %s for archive download." % name)
-            finally:
-                fileObj.close()
+                logger.warn("Unable to fetch %s for archive download." %
+                            self.name)
+                self.close()
+            if not buf:
+                logger.error('%s is %d bytes shorter than expected - '
+                             'padding with zeros' % (self.name, self.remaining))
+                self.close()
+        if not buf:
+            buf = '\0' * size
+        self.remaining -= len(buf)
+        return buf
 
-def _write_tar_func(rootdir, datafiles):
-    logger.debug('Getting files to write to archive')
-    # Resolve url and name for the files
-    files = _get_datafile_details_for_archive(rootdir, datafiles)
-    # Define the function
-    def write_tar(filename):
-        from tarfile import TarFile
-        try:
-            tf = TarFile(filename, 'w')
-            logger.debug('Writing tar archive to %s' % filename)
-            _write_files_to_archive(tf.add, files)
-            tf.close()
-            logger.debug('Completed tar archive size is %i' % os.stat(filename).st_size)
-        except IOError as ex:
-            logger.warn("I/O error({0}) while writing tar archive: {1}".format(e.errno, e.strerror))
-            os.unlink(filename)
-        finally:
-            tf.close()
-    # Returns the function to do the actual writing
-    return write_tar
+    def close(self):
+        if self.fileObj:
+            self.fileObj.close()
+            self.fileObj = None
 
-def _write_zip_func(rootdir, datafiles):
-    logger.debug('Getting files to write to archive')
-    # Resolve url and name for the files
-    files = _get_datafile_details_for_archive(rootdir, datafiles)
-    # Define the function
-    def write_zip(filename):
+def _iter_tar_segments(files):
+    """
+    Describes a tar archive of the given files as a sequence of
+    (length, producer) pairs, where producer(skip, count) yields the
+    count bytes of the segment which follow its first skip bytes.
+    """
+    from tarfile import TarInfo, GNU_FORMAT, BLOCKSIZE, RECORDSIZE, NUL
+
+    def bytes_segment(data):
+        return len(data), lambda skip, count: [data[skip:skip + count]]
+
+    def file_segment(fileGetter, name, size):
+        def produce(skip, count):
+            reader = _SizedReader(fileGetter, name, size)
+            try:
+                reader.skip(skip)
+                while count > 0:
+                    buf = reader.read(min(ARCHIVE_BLOCK_SIZE, count))
+                    count -= len(buf)
+                    yield buf
+            finally:
+                reader.close()
+        return size, produce
+
+    offset = 0
+    for fileGetter, name, size, mtime, _ in files:
+        tarinfo = TarInfo(name)
+        tarinfo.size = size
+        tarinfo.mtime = mtime
+        tarinfo.mode = 0644
+        for segment in (bytes_segment(tarinfo.tobuf(GNU_FORMAT)),
+                        file_segment(fileGetter, name, size),
+                        bytes_segment(NUL * (-size % BLOCKSIZE))):
+            offset += segment[0]
+            yield segment
+    # Two zero blocks mark the end of the archive, then pad out the record
+    offset += BLOCKSIZE * 2
+    yield bytes_segment(NUL * (BLOCKSIZE * 2 + (-offset % RECORDSIZE)))
+
+def _stream_tar(files, start=0, stop=None):
+    """
+    Generator producing a tar archive of the given files chunk by chunk,
+    reading each datafile straight from its file getter.  If start and
+    stop are given, only that byte range of the archive is produced, and
+    members before the range are never opened.
+    """
+    offset = 0
+    for length, produce in _iter_tar_segments(files):
+        segment_start, offset = offset, offset + length
+        if offset <= start or length == 0:
+            continue
+        if stop is not None and segment_start >= stop:
+            break
+        skip = max(start - segment_start, 0)
+        end = offset if stop is None else min(offset, stop)
+        for buf in produce(skip, end - segment_start - skip):
+            if buf:
+                yield buf
+
+def _get_tar_archive_size(files):
+    return sum(length for length, _ in _iter_tar_segments(files))
+
+def _stream_zip(files):
+    """
+    Generator producing a zip archive of the given files chunk by chunk.
+    Entries are stored uncompressed and use trailing data descriptors, so
+    CRCs are computed as the data passes through and nothing needs to be
+    seeked back to.
+    """
+    sink = ArchiveSink()
+    zf = StreamableZipFile(sink, 'w', allowZip64=True)
+    for fileGetter, name, size, mtime, _ in files:
+        reader = _SizedReader(fileGetter, name, size)
         try:
-            zf = StreamableZipFile(filename, 'w', allowZip64=True)
-            logger.debug('Writing zip archive to %s' % filename)
-            _write_files_to_archive(zf.write, files)
-            zf.close()
-            logger.debug('Completed zip archive size is %i' % os.stat(filename).st_size)
-        except IOError as ex:
-            logger.warn("I/O error({0}) while writing zip archive: {1}".format(e.errno, e.strerror))
-            os.unlink(filename)
+            for _ in zf.iter_write_fileobj(reader, name,
+                                           time.localtime(mtime)[0:6],
+                                           file_size=size):
+                buf = sink.drain()
+                if buf:
+                    yield buf
         finally:
-            zf.close()
-    # Returns the function to do the actual writing
-    return write_zip
+            reader.close()
+    zf.close()
+    yield sink.drain()
 
-def _estimate_archive_size(rootdir, datafiles, comptype):
+def _get_zip_archive_size(files):
     """
-    produces an estimate of the size of the uncompressed file archive.  This is
-    made based on the information we have to hand (i.e. the names and the notional file 
-    sizes from the database.  We don't try to access the files themselves, as this
-    potentially increases temporary disc space usage which is the resource we
-    are primarily trying to protect at this point.
+    Computes the exact size of the archive produced by _stream_zip, by
+    laying out the headers and central directory without any file data.
     """
-    # TODO - include the implied entries for directories in the estimates.
-    estimate = 0
-    for df in datafiles:
-        if comptype == "tar":
-            # File header + file size with padding to 512
-            estimate += 512 + ((int(df.get_size()) + 511) / 512) * 512
-        elif comptype == "zip":
-            name_length = len(_get_filename(rootdir, df))
-            # local header + content + DD + file header
-            estimate += (20 + name_length) + int(df.get_size()) + 8 + (46 + name_length) 
-    if comptype == "tar":
-         # Two records of zeros at the end.
-         estimate += 1024
-    elif comptype == "zip":
-        # Central directory overheads
-        estimate += 100 
-    return estimate
-
-def _get_free_temp_space():
-    """ Return free space on the file system holding the temporary directory (in bytes)
+    sink = ArchiveSink(discard=True)
+    zf = StreamableZipFile(sink, 'w', allowZip64=True)
+    for _, name, size, mtime, _ in files:
+        zinfo = zf.layout_member(name, time.localtime(mtime)[0:6], size)
+        sink.advance(zinfo.compress_size)
+    zf.close()
+    return sink.tell()
+
+def _get_archive_etag(files):
+    import hashlib
+    digest = hashlib.md5()
+    for _, name, size, mtime, checksum in files:
+        digest.update(('%s\0%d\0%d\0%s\0' % (name, size, mtime, checksum))
+                      .encode('utf-8'))
+    return '"%s"' % digest.hexdigest()
+
+def parse_range_header(request, length, etag):
     """
-    sys_type = platform.system()
-    if sys_type == 'Windows':
-        free_bytes = ctypes.c_ulonglong(0)
-        ctypes.windll.kernel32.GetDiskFreeSpaceExW(ctypes.c_wchar_p(gettempdir()), 
-                                                   None, None, ctypes.pointer(free_bytes))
-        return free_bytes.value
-    elif sys_type == 'Darwin' or sys_type == 'DragonFly' or 'BSD' in sys_type:
-        st = os.statvfs(gettempdir())
-        return st.f_bfree * st.f_frsize
-    elif sys_type == 'Linux':
-        st = os.statvfs(gettempdir())
-        return st.f_bfree * st.f_bsize
+    Returns the (start, stop) byte range requested by a single range
+    "Range" header, or None if the whole file should be sent, as it should
+    be if the header is invalid.  Raises ValueError if the range can't be
+    satisfied.
+    """
+    header = request.META.get('HTTP_RANGE', '')
+    if not header.startswith('bytes=') or ',' in header:
+        return None
+    # Only resume if the archive is the one the client started with
+    if request.META.get('HTTP_IF_RANGE', etag) != etag:
+        return None
+    first, _, last = header[len('bytes='):].strip().partition('-')
+    if not (first or last) or \
+            not all(part.isdigit() for part in (first, last) if part):
+        return None
+    if first:
+        start = long(first)
+        stop = long(last) + 1 if last else length
+        # A range ending before it starts is invalid, not unsatisfiable
+        if last and stop <= start:
+            return None
+    else:
+        start, stop = max(length - long(last), 0), length
+    stop = min(stop, length)
+    if start >= stop:
+        raise ValueError('Unsatisfiable range: %s' % header)
+    return start, stop
+
+def _streaming_archive_response(request, files, comptype, filename):
+    if comptype == "tar":
+        length = _get_tar_archive_size(files)
+        etag = _get_archive_etag(files)
+        try:
+            byte_range = parse_range_header(request, length, etag)
+        except ValueError:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = 'bytes */%d' % length
+            return response
+        if byte_range:
+            start, stop = byte_range
+            response = HttpResponse(_stream_tar(files, start, stop),
+                                    mimetype='application/x-tar',
+                                    status=206)
+            response['Content-Range'] = \
+                'bytes %d-%d/%d' % (start, stop - 1, length)
+            length = stop - start
+        else:
+            response = HttpResponse(_stream_tar(files),
+                                    mimetype='application/x-tar')
+        response['Accept-Ranges'] = 'bytes'
+        response['ETag'] = etag
     else:
-        raise RuntimeError('Unsupported / unexpected platform type: %s' % sys_type)
+        # Resuming would need the CRCs of every earlier member, which are
+        # only known once their data has been read
+        length = _get_zip_archive_size(files)
+        response = HttpResponse(_stream_zip(files),
+                                mimetype='application/zip')
+        response['Accept-Ranges'] = 'none'
+    response['Content-Length'] = str(length)
+    response['Content-Disposition'] = \
+            'attachment; filename="%s.%s"' % (filename, comptype)
+    return response
 
-def _check_download_limits(rootdir, datafiles, comptype):
-    estimate = _estimate_archive_size(rootdir, datafiles, comptype)
-    available = _get_free_temp_space()
-    logger.debug('Estimated archive size: %i, available tempfile space %i' % (estimate, available))
-    if settings.DOWNLOAD_ARCHIVE_SIZE_LIMIT > 0 and estimate > settings.DOWNLOAD_ARCHIVE_SIZE_LIMIT:
+def _get_archive_size(files, comptype):
+    if comptype == "tar":
+        return _get_tar_archive_size(files)
+    return _get_zip_archive_size(files)
+
+def _check_download_limits(files, comptype):
+    size = _get_archive_size(files, comptype)
+    logger.debug('Archive size: %i' % size)
+    if settings.DOWNLOAD_ARCHIVE_SIZE_LIMIT > 0 and size > settings.DOWNLOAD_ARCHIVE_SIZE_LIMIT:
         return 'Download archive size exceeds the allowed limit: try a smaller download'
-    elif estimate > available + settings.DOWNLOAD_SPACE_SAFETY_MARGIN:
-        return 'Insufficient temp file space available to create the archive:' \
-                ' try a smaller download, or try again later'
     else:
         return None
 
@@ -345,33 +544,18 @@ def download_experiment(request, experiment_id, comptype):
     takes string parameter "comptype" for compression method.
     Currently implemented: "zip" and "tar"
     """
-    # TODO: intelligent selection of temp file versus in-memory buffering.
     datafiles = Dataset_File.objects\
         .filter(dataset__experiments__id=experiment_id)
     rootdir = str(experiment_id)
-    msg = _check_download_limits(rootdir, datafiles, comptype)
+    if comptype not in ("tar", "zip"):
+        return render_error_message(request, 'Unsupported download format: %s' % comptype, status=404)
+    files = _get_datafile_details_for_archive(rootdir, datafiles)
+    msg = _check_download_limits(files, comptype)
     if msg:
         return render_error_message(request, 'Requested download is too large: %s' % msg, status=403)
 
-    if comptype == "tar":
-        reader = StreamingFile(_write_tar_func(rootdir, datafiles),
-                               asynchronous_file_creation=True)
-
-        response = HttpResponse(FileWrapper(reader),
-                                mimetype='application/x-tar')
-        response['Content-Disposition'] = 'attachment; filename="experiment' \
-            + rootdir + '-complete.tar"'
-    elif comptype == "zip":
-        reader = StreamingFile(_write_zip_func(rootdir, datafiles),
-                               asynchronous_file_creation=True)
-        response = HttpResponse(FileWrapper(reader),
-                                mimetype='application/zip')
-
-        response['Content-Disposition'] = 'attachment; filename="experiment' \
-            + rootdir + '-complete.zip"'
-    else:
-        response = render_error_message(request, 'Unsupported download format: %s' % comptype, status=404)
-    return response
+    return _streaming_archive_response(request, files, comptype,
+                                       'experiment%s-complete' % rootdir)
 
 
 def download_datafiles(request):
@@ -384,7 +568,6 @@ def download_datafiles(request):
     """
     # Create the HttpResponse object with the appropriate headers.
     # TODO: handle no datafile, invalid filename, all http links
-    # TODO: intelligent selection of temp file versus in-memory buffering.
     
     logger.error('In download_datafiles !!')
     comptype = "zip"
@@ -395,28 +578,20 @@ def download_datafiles(request):
         if (len(request.POST.getlist('datafile')) > 0 \
                 or len(request.POST.getlist('dataset'))) > 0:
 
-            datasets = request.POST.getlist('dataset')
-            datafiles = request.POST.getlist('datafile')
-
-            # Generator to produce datafiles from dataset id
-            def get_dataset_datafiles(dsid):
-                for datafile in Dataset_File.objects.filter(dataset=dsid):
-                    if has_datafile_download_access(request=request,
-                                                    dataset_file_id=datafile.id):
-                        yield datafile
-
-            # Generator to produce datafile from datafile id
-            def get_datafile(dfid):
-                datafile = Dataset_File.objects.get(pk=dfid)
-                if has_datafile_download_access(request=request,
-                                                dataset_file_id=datafile.id):
-                    yield datafile
-
-            # Take chained generators and turn them into a set of datafiles
-            df_set = set(chain(chain.from_iterable(map(get_dataset_datafiles,
-                                                       datasets)),
-                               chain.from_iterable(map(get_datafile,
-                                                       datafiles))))
+            # Work out what may be downloaded for the whole selection at
+            # once, rather than checking each datafile in turn
+            resolver = get_acl_resolver(request)
+            datasets = resolver.downloadable_datasets(
+                request.POST.getlist('dataset'))
+            datafiles = resolver.downloadable_datafiles(
+                request.POST.getlist('datafile'))
+
+            df_set = set()
+            for ids, field in ((list(datasets), 'dataset__in'),
+                               (list(datafiles), 'pk__in')):
+                for i in range(0, len(ids), ACL_QUERY_BATCH_SIZE):
+                    df_set.update(Dataset_File.objects.filter(
+                        **{field: ids[i:i + ACL_QUERY_BATCH_SIZE]}))
         else:
             return render_error_message(request, 'No Datasets or Datafiles were selected for downloaded',
                                         status=404)
@@ -445,8 +620,11 @@ def download_datafiles(request):
         return render_error_message(request, 'You do not have download access for any of the '
                                     'selected Datasets or Datafiles ', status=403)
     
+    if comptype not in ("tar", "zip"):
+        return render_error_message(request, 'Unsupported download format: %s' % comptype, status=404)
     rootdir = 'datasets'
-    msg = _check_download_limits(rootdir, df_set, comptype)
+    files = _get_datafile_details_for_archive(rootdir, df_set)
+    msg = _check_download_limits(files, comptype)
     if msg:
         return render_error_message(request, 'Requested download is too large: %s' % msg, status=403)
 
@@ -456,22 +634,5 @@ def download_datafiles(request):
     except KeyError:
         expid = iter(df_set).next().dataset.get_first_experiment().id
 
-    if comptype == "tar":
-        reader = StreamingFile(_write_tar_func(rootdir, df_set),
-                               asynchronous_file_creation=True)
-        response = HttpResponse(FileWrapper(reader),
-                                mimetype='application/x-tar')
-        response['Content-Disposition'] = \
-                'attachment; filename="experiment%s-selection.tar"' % expid
-    elif comptype == "zip":
-        reader = StreamingFile(_write_zip_func(rootdir, df_set),
-                               asynchronous_file_creation=True)
-        response = HttpResponse(FileWrapper(reader),
-                                mimetype='application/zip')    
-        response['Content-Disposition'] = \
-                'attachment; filename="experiment%s-selection.zip"' % expid
-    else:
-        response = render_error_message(request, 'Unsupported download format: %s' % comptype, status=404)
-    return response
-
-        
\ No newline at end of file
+    return _streaming_archive_response(request, files, comptype,
+                                       'experiment%s-selection' % expid)
@@ -37,58 +37,315 @@ __init__.py
 """
 
 import logging
+import os
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from threading import Lock, local
 
 from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
 from django.utils.importlib import import_module
 from django.core.exceptions import ImproperlyConfigured
-from django.db.models.signals import post_save
+from django.db.models.signals import post_init, post_save
 from django.core.exceptions import MiddlewareNotUsed
 
+from tardis.tardis_portal.util import is_cache_shared
+
 
 logger = logging.getLogger(__name__)
 
+# Seconds after a save its filters run.  This gives the transaction the
+# save was made in time to be committed, and any further saves of the
+# datafile in that time are handled by the same run.
+DELAY = getattr(settings, 'POST_SAVE_FILTER_DELAY', 10)
+
+# Seconds a filter waits for one of its slots, when as many runs of it as
+# it allows are already going
+RETRY_DELAY = getattr(settings, 'POST_SAVE_FILTER_RETRY_DELAY', 30)
+
+# Seconds a slot is held for at most, in case its worker dies
+SLOT_TIMEOUT = getattr(settings, 'POST_SAVE_FILTER_SLOT_TIMEOUT', 3600)
+
+# Number of datafiles each run of a filter handles
+BATCH_SIZE = getattr(settings, 'POST_SAVE_FILTER_BATCH_SIZE', 100)
+
+# Times a run looks again for datafiles it can't find, which may not have
+# been committed yet
+MISSING_TRIES = 3
+
+# How often the metrics are logged, in runs
+_LOG_EVERY = 100
+
 
 class FilterInitMiddleware(object):
-    def __init__(self):
-        from tardis.tardis_portal.models import Dataset_File
-        for f in settings.POST_SAVE_FILTERS:
-            cls = f[0]
-            args = []
-            kw = {}
+    """
+    Loads the POST_SAVE_FILTERS, and has them run on datafiles once they
+    have been created, or their file has changed.
 
-            if len(f) == 2:
-                args = f[1]
+    Filters are run by Celery workers, a batch of datafiles at a time (see
+    :func:`run_filter`).  A filter may declare which datafiles it is
+    interested in, so that others are passed over without reading them:
 
-            if len(f) == 3:
-                kw = f[2]
+    * ``mimetypes``: a list of mimetypes, or of prefixes like "image/";
+    * ``extensions``: a list of filename extensions, like "img".
 
-            hook = self._safe_import(cls, args, kw)
-            # XXX seems to requre a strong ref else it won't fire,
-            # could be because some hooks are classes not functions.
-            # Need to use dispatch_uid to avoid expensive duplicate signals.
-            #https://docs.djangoproject.com/en/dev/topics/signals/#preventing-duplicate-signals
-            post_save.connect(hook, sender=Dataset_File, weak=False,dispatch_uid=cls)
-            logger.debug('Initialised postsave hook %s' % post_save.receivers)
+    It may also declare ``concurrency``, the number of runs of it which may
+    go at once (kept track of in the cache, which must be shared between
+    the workers), and may handle a batch itself with
+    ``process_batch(datafiles)``.  Otherwise it is called as a post_save
+    receiver, with each datafile as the instance.
+    """
+
+    def __init__(self):
+        from tardis.tardis_portal.models import Dataset_File
+        get_filters()
+        post_init.connect(remember_datafile_location, sender=Dataset_File,
+                          dispatch_uid='tardis_portal.filters.remember')
+        post_save.connect(queue_datafile_filters, sender=Dataset_File,
+                          dispatch_uid='tardis_portal.filters.queue')
+        logger.debug('Initialised post-save filters %s' %
+                     ', '.join(get_filters()))
 
         # disable middleware
         raise MiddlewareNotUsed()
 
-    def _safe_import(self, path, args, kw):
-        try:
-            dot = path.rindex('.')
-        except ValueError:
-            raise ImproperlyConfigured('%s isn\'t a filter module' % path)
-        filter_module, filter_classname = path[:dot], path[dot + 1:]
-        try:
-            mod = import_module(filter_module)
-        except ImportError, e:
-            raise ImproperlyConfigured('Error importing filter %s: "%s"' %
-                                       (filter_module, e))
-        try:
-            filter_class = getattr(mod, filter_classname)
-        except AttributeError:
-            raise ImproperlyConfigured('Filter module "%s" does not define a "%s" class' %
-                                       (filter_module, filter_classname))
-
-        filter_instance = filter_class(*args, **kw)
-        return filter_instance
+
+def _safe_import(path, args, kw):
+    try:
+        dot = path.rindex('.')
+    except ValueError:
+        raise ImproperlyConfigured('%s isn\'t a filter module' % path)
+    filter_module, filter_classname = path[:dot], path[dot + 1:]
+    try:
+        mod = import_module(filter_module)
+    except ImportError, e:
+        raise ImproperlyConfigured('Error importing filter %s: "%s"' %
+                                   (filter_module, e))
+    try:
+        filter_class = getattr(mod, filter_classname)
+    except AttributeError:
+        raise ImproperlyConfigured('Filter module "%s" does not define a "%s" class' %
+                                   (filter_module, filter_classname))
+
+    filter_instance = filter_class(*args, **kw)
+    return filter_instance
+
+
+_filters = None
+_filters_lock = Lock()
+
+def get_filters():
+    """
+    Return the POST_SAVE_FILTERS, by the path they are configured with, in
+    the order they are configured.
+    """
+    global _filters
+    with _filters_lock:
+        if _filters is None:
+            filters = OrderedDict()
+            for f in getattr(settings, 'POST_SAVE_FILTERS', []):
+                cls = f[0]
+                args = []
+                kw = {}
+
+                if len(f) >= 2:
+                    args = f[1]
+
+                if len(f) == 3:
+                    kw = f[2]
+
+                filters[cls] = _safe_import(cls, args, kw)
+                if getattr(filters[cls], 'concurrency', None) and \
+                        not is_cache_shared(cache):
+                    raise ImproperlyConfigured(
+                        'Filter %s limits its concurrency, which needs '
+                        'CACHES to be shared between processes' % cls)
+            _filters = filters
+        return _filters
+
+
+def accepts(filter_, datafile):
+    """
+    Return whether a filter is interested in a datafile, judging by the
+    mimetypes and extensions it declares, without reading the file.
+    """
+    mimetypes = getattr(filter_, 'mimetypes', None)
+    extensions = getattr(filter_, 'extensions', None)
+    if mimetypes is None and extensions is None:
+        return True
+    if mimetypes:
+        mimetype = datafile.get_mimetype()
+        if any(mimetype.startswith(m) if m.endswith('/') else mimetype == m
+               for m in mimetypes):
+            return True
+    if extensions:
+        extension = os.path.splitext(datafile.filename)[1][1:].lower()
+        if extension in [e.lower() for e in extensions]:
+            return True
+    return False
+
+
+def remember_datafile_location(sender, **kwargs):
+    datafile = kwargs['instance']
+    datafile._filtered_location = (datafile.url, datafile.sha512sum)
+
+
+def queue_datafile_filters(sender, **kwargs):
+    # Filters look at the file, so only run them for new datafiles, or
+    # those whose file has changed
+    datafile = kwargs['instance']
+    location = (datafile.url, datafile.sha512sum)
+    old_location = getattr(datafile, '_filtered_location', None)
+    datafile._filtered_location = location
+    if kwargs.get('raw'):
+        return
+    if not kwargs.get('created') and old_location in (None, location):
+        return
+    for name, filter_ in get_filters().items():
+        if accepts(filter_, datafile):
+            queue_filter(name, [datafile.id])
+
+
+_batching = local()
+
+@contextmanager
+def batched():
+    """
+    Gather the filter runs queued within it, and queue them in batches
+    once it exits.
+    """
+    if getattr(_batching, 'queued', None) is not None:
+        # Already gathering
+        yield
+        return
+    _batching.queued = OrderedDict()
+    try:
+        yield
+        queued = _batching.queued
+    finally:
+        _batching.queued = None
+    for name, datafile_ids in queued.items():
+        queue_filter(name, datafile_ids)
+
+
+def _get_queued_key(name, datafile_id):
+    return 'post-save-filter:%s:%d' % (name, datafile_id)
+
+def queue_filter(name, datafile_ids):
+    """
+    Queue a filter to run on datafiles in DELAY seconds, apart from any it
+    is already queued to run on.  Each is only taken to be queued for
+    DELAY seconds, so that saves are never missed if the worker's
+    clearing of it doesn't reach this process's cache.
+    """
+    queued = getattr(_batching, 'queued', None)
+    if queued is not None:
+        queued.setdefault(name, []).extend(datafile_ids)
+        return
+    datafile_ids = [datafile_id for datafile_id in OrderedDict.fromkeys(
+                        datafile_ids)
+                    if cache.add(_get_queued_key(name, datafile_id), True,
+                                 DELAY)]
+    from tardis.tardis_portal.tasks import run_post_save_filter
+    for i in range(0, len(datafile_ids), BATCH_SIZE):
+        run_post_save_filter.apply_async(
+            args=[name, datafile_ids[i:i + BATCH_SIZE]], countdown=DELAY)
+
+
+def _take_slot(name, concurrency):
+    for slot in range(concurrency):
+        key = 'post-save-filter-slot:%s:%d' % (name, slot)
+        if cache.add(key, True, SLOT_TIMEOUT):
+            return key
+    return None
+
+
+class FilterMetrics(object):
+    """
+    Running totals of the datafiles each filter has run on in this process,
+    and of how long it took.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.runs = {}
+
+    def add(self, name, datafiles, failed, seconds):
+        with self._lock:
+            totals = self.runs.setdefault(name, [0, 0, 0, 0.0])
+            for i, n in enumerate((1, datafiles, failed, seconds)):
+                totals[i] += n
+            runs = totals[0]
+        logger.debug('Filter %s ran on %d datafiles in %.3fs' %
+                     (name, datafiles, seconds))
+        if runs % _LOG_EVERY == 0:
+            self.log(name)
+
+    def log(self, name):
+        runs, datafiles, failed, seconds = self.runs.get(name,
+                                                         [0, 0, 0, 0.0])
+        logger.info('Process %d ran filter %s on %d datafiles (%d failed) '
+                    'in %.1fs, %.3fs per datafile' %
+                    (os.getpid(), name, datafiles, failed, seconds,
+                     seconds / (datafiles or 1)))
+
+
+metrics = FilterMetrics()
+
+
+def run_filter(name, datafile_ids):
+    """
+    Run a filter on the datafiles with the given ids, writing everything
+    it records in one transaction.  Return None if as many runs of the
+    filter as it allows are already going, or else the ids of the datafiles
+    which could not be found.
+    """
+    from tardis.tardis_portal.models import Dataset_File
+    filter_ = get_filters().get(name)
+    if filter_ is None:
+        logger.warning('Post-save filter %s is no longer configured' % name)
+        return []
+    concurrency = getattr(filter_, 'concurrency', None)
+    slot = _take_slot(name, concurrency) if concurrency else None
+    if concurrency and slot is None:
+        return None
+    try:
+        # Saves from now on need another run
+        cache.delete_many([_get_queued_key(name, datafile_id)
+                           for datafile_id in datafile_ids])
+        found = list(Dataset_File.objects.filter(id__in=datafile_ids)
+                                         .select_related('dataset'))
+        datafiles = [datafile for datafile in found
+                     if accepts(filter_, datafile)]
+        started = time.time()
+        failed = 0
+        with transaction.commit_on_success():
+            if hasattr(filter_, 'process_batch'):
+                filter_.process_batch(datafiles)
+            else:
+                for datafile in datafiles:
+                    # A failure only undoes what was recorded for its
+                    # datafile
+                    sid = transaction.savepoint()
+                    try:
+                        filter_(Dataset_File, instance=datafile,
+                                created=True)
+                        transaction.savepoint_commit(sid)
+                    except Exception:
+                        transaction.savepoint_rollback(sid)
+                        failed += 1
+                        logger.exception('Filter %s failed on datafile %d' %
+                                         (name, datafile.id))
+        metrics.add(name, len(datafiles), failed, time.time() - started)
+        found_ids = set(datafile.id for datafile in found)
+        return [datafile_id for datafile_id in datafile_ids
+                if datafile_id not in found_ids]
+    finally:
+        if slot:
+            cache.delete(slot)
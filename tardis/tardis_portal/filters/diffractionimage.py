@@ -35,18 +35,26 @@ diffractionimage.py
 .. moduleauthor:: Steve Androulakis <steve.androulakis@gmail.com>
 
 """
-from fractions import Fraction
 import logging
+from itertools import imap
+from multiprocessing import Pool
 
+from django.db import connection
+from tardis.tardis_portal.filters import accepts
 from tardis.tardis_portal.models import Schema, DatafileParameterSet
 from tardis.tardis_portal.models import ParameterName, DatafileParameter
+from tardis.tardis_portal.models import Dataset_File, SearchIndexMarker
+from tardis.tardis_portal.models.hooks import mark_for_indexing
+from tardis.tardis_portal.storage import store_preview
 import subprocess
 import tempfile
-import base64
 from os import path
 
 logger = logging.getLogger(__name__)
 
+# Number of images read and saved together by process_dataset
+BATCH_SIZE = 100
+
 class DiffractionImageFilter(object):
     """This filter runs the CCP4 diffdump binary on a diffraction image
     and collects its output into the trddatafile schema
@@ -62,15 +70,21 @@ class DiffractionImageFilter(object):
     :type tagsToFind: list of strings
     :param tagsToExclude: a list of the tags to exclude.
     :type tagsToExclude: list of strings
+    :param extensions: the extensions of the files to read, e.g.
+        ``['img', 'osc', 'mccd', 'cbf']``, or None to try every file.
+    :type extensions: list of strings
     """
+
     def __init__(self, name, schema, diffdump_path, diff2jpeg_path,
-                 tagsToFind=[], tagsToExclude=[]):
+                 tagsToFind=[], tagsToExclude=[], extensions=None):
         self.name = name
         self.schema = schema
+        self.extensions = extensions
         self.tagsToFind = tagsToFind
         self.tagsToExclude = tagsToExclude
         self.diffdump_path = diffdump_path
         self.diff2jpeg_path = diff2jpeg_path
+        self._schema = None
 
         #these values map across directly
         self.terms = \
@@ -112,57 +126,138 @@ class DiffractionImageFilter(object):
         """
         instance = kwargs.get('instance')
 
-        schema = self.getSchema()
-
-        filepath = instance.get_absolute_filepath()
- 
         try:
-            metadata = self.getDiffractionImageMetadata(filepath)
-            
-            previewImage64 = self.getDiffractionPreviewImage(filepath)
-            
-            if previewImage64:
-                metadata['previewImage'] = previewImage64
-            
-            self.saveDiffractionImageMetadata(instance, schema, metadata)
+            self.process_batch([instance])
         except Exception, e:
             logger.debug(e)
             return None
 
+    def process_batch(self, datafiles, pool=None):
+        """Read a batch of diffraction images, in a pool of processes if
+        one is given, and save their metadata together.
+
+        :param datafiles: the datafiles of the images.
+        :param pool: a :class:`multiprocessing.Pool` to read them in.
+        """
+        mapper = pool.imap if pool else imap
+        config = (self.name, self.schema, self.diffdump_path,
+                  self.diff2jpeg_path, tuple(self.tagsToFind),
+                  tuple(self.tagsToExclude))
+        filepaths = [df.get_absolute_filepath() for df in datafiles]
+        results = zip(datafiles, mapper(_read_image,
+                                        [(config, filepath)
+                                         for filepath in filepaths]))
+        return self.saveMetadata(self.getSchema(), results)
+
+    def process_dataset(self, dataset, processes=1):
+        """Save the metadata of every diffraction image in a dataset which
+        has none yet, reading BATCH_SIZE images at a time across a pool of
+        processes.  Return the number of images processed.
+
+        :param dataset: the dataset of the images.
+        :param processes: the number of images to read at once.
+        """
+        schema = self.getSchema()
+        datafiles = [df for df in Dataset_File.objects
+                     .filter(dataset=dataset)
+                     .exclude(datafileparameterset__schema=schema)
+                     .order_by('id')
+                     if accepts(self, df)]
+        pool = None
+        if processes > 1:
+            # Workers must not inherit the database connection
+            connection.close()
+            pool = Pool(processes)
+        processed = 0
+        try:
+            for i in range(0, len(datafiles), BATCH_SIZE):
+                processed += self.process_batch(
+                    datafiles[i:i + BATCH_SIZE], pool)
+            if pool:
+                pool.close()
+                pool.join()
+        finally:
+            if pool:
+                pool.terminate()
+        return processed
+
+    def getMetadata(self, filepath):
+        """Return the metadata of an image, with the name of its preview
+        image in the file store.
+        """
+        metadata = self.getDiffractionImageMetadata(filepath)
+
+        previewImage = self.getDiffractionPreviewImage(filepath)
+
+        if previewImage:
+            metadata['previewImage'] = previewImage
+        return metadata
+
     def saveDiffractionImageMetadata(self, instance, schema, metadata):
         """Save all the metadata to a Dataset_Files paramamter set.
         """
-        parameters = self.getParameters(schema, metadata)
-        if not parameters:
-            return None
-
+        self.saveMetadata(schema, [(instance, metadata)])
         try:
-            ps = DatafileParameterSet.objects.get(schema=schema,
-                                                  dataset_file=instance)
-            return ps  # if already exists then just return it
+            return DatafileParameterSet.objects.get(schema=schema,
+                                                    dataset_file=instance)
         except DatafileParameterSet.DoesNotExist:
-            ps = DatafileParameterSet(schema=schema,
-                                      dataset_file=instance)
-            ps.save()
-
-        for p in parameters:
-            if p.name in metadata:
-                dfp = DatafileParameter(parameterset=ps,
-                                        name=p)
+            return None
+
+    def saveMetadata(self, schema, results):
+        """Save the metadata of several datafiles, given as (datafile,
+        metadata) pairs, with bulk inserts.  Datafiles which already have
+        a parameter set of the schema are left as they are.  Return the
+        number of datafiles saved.
+        """
+        param_names = dict((pn.name, pn) for pn in
+                           ParameterName.objects.filter(schema=schema))
+        results = [(datafile, metadata,
+                    self.getParameters(param_names, metadata))
+                   for datafile, metadata in results]
+        results = [result for result in results if result[2]]
+        existing = set(DatafileParameterSet.objects
+                       .filter(schema=schema,
+                               dataset_file__in=[r[0].id for r in results])
+                       .values_list('dataset_file', flat=True))
+        results = [result for result in results
+                   if result[0].id not in existing]
+        if not results:
+            return 0
+        datafile_ids = [r[0].id for r in results]
+
+        DatafileParameterSet.objects.bulk_create(
+            [DatafileParameterSet(schema=schema, dataset_file=datafile)
+             for datafile, _, _ in results])
+        # Bulk inserts don't give back the ids
+        parametersets = dict(DatafileParameterSet.objects
+                             .filter(schema=schema,
+                                     dataset_file__in=datafile_ids)
+                             .values_list('dataset_file', 'id'))
+
+        params = []
+        for datafile, metadata, parameters in results:
+            for p in parameters:
+                dfp = DatafileParameter(
+                    parameterset_id=parametersets[datafile.id], name=p)
                 if p.isNumeric():
                     if metadata[p.name] != '':
                         dfp.numerical_value = metadata[p.name]
-                        dfp.save()
+                        params.append(dfp)
                 else:
                     dfp.string_value = metadata[p.name]
-                    dfp.save()
+                    params.append(dfp)
+        for i in range(0, len(params), BATCH_SIZE):
+            DatafileParameter.objects.bulk_create(params[i:i + BATCH_SIZE])
 
-        return ps
+        # Which the search index would have been told about by post_save
+        mark_for_indexing(SearchIndexMarker.DATAFILE, datafile_ids)
+        return len(results)
 
-    def getParameters(self, schema, metadata):
+    def getParameters(self, param_names, metadata):
         """Return a list of the paramaters that will be saved.
+
+        :param param_names: the schema's parameter names, by name.
         """
-        param_objects = ParameterName.objects.filter(schema=schema)
         parameters = []
         for p in metadata:
 
@@ -172,51 +267,24 @@ class DiffractionImageFilter(object):
             if p in self.tagsToExclude:
                 continue
 
-            parameter = filter(lambda x: x.name == p, param_objects)
-
-            if parameter:
-                parameters.append(parameter[0])
-                continue
-
-            # detect type of parameter
-            datatype = ParameterName.STRING
-
-            # Int test
-            try:
-                int(metadata[p])
-            except ValueError:
-                pass
-            except TypeError:
-                pass
-            else:
-                datatype = ParameterName.NUMERIC
-
-            # Fraction test
-            if isinstance(metadata[p], Fraction):
-                datatype = ParameterName.NUMERIC
-
-            # Float test
-            try:
-                float(metadata[p])
-            except ValueError:
-                pass
-            except TypeError:
-                pass
-            else:
-                datatype = ParameterName.NUMERIC
+            if p in param_names:
+                parameters.append(param_names[p])
 
         return parameters
 
     def getSchema(self):
         """Return the schema object that the paramaterset will use.
         """
-        try:
-            return Schema.objects.get(namespace__exact=self.schema)
-        except Schema.DoesNotExist:
-            schema = Schema(namespace=self.schema, name=self.name,
-                            type=Schema.DATAFILE)
-            schema.save()
-            return schema
+        if self._schema is None:
+            try:
+                self._schema = Schema.objects.get(
+                    namespace__exact=self.schema)
+            except Schema.DoesNotExist:
+                schema = Schema(namespace=self.schema, name=self.name,
+                                type=Schema.DATAFILE)
+                schema.save()
+                self._schema = schema
+        return self._schema
 
     def getDiffractionImageMetadata(self, filename):
         """Return a dictionary of the metadata.
@@ -235,12 +303,14 @@ class DiffractionImageFilter(object):
         return ret
         
     def getDiffractionPreviewImage(self, filename):
-        """Return a base64 encoded preview image.
+        """Write a preview image to the file store, and return its name.
         """
         try:
-            previewImage64 = self.run_diff2jpeg(filename)
-            
-            return previewImage64
+            previewImage = self.run_diff2jpeg(filename)
+            if not previewImage:
+                return None
+
+            return store_preview(previewImage, 'jpg')
 
         except IOError:
             return None
@@ -327,15 +397,12 @@ class DiffractionImageFilter(object):
         cd = split_diffdump_path[0]
         diffdump_exec = split_diffdump_path[1]
 
-        cmd = "cd '" + cd + "'; ./'" + diffdump_exec + "' '" + file_path + "'"
-	with open("test2.txt", "a") as myfile:
-            myfile.write(cmd)
-        output = subprocess.Popen(
-                            cmd,
-                            stdout=subprocess.PIPE,
-                            shell=True).stdout
+        # Wait for it, so that batches don't leave processes behind
+        output = subprocess.Popen(['./' + diffdump_exec, file_path],
+                                  cwd=cd,
+                                  stdout=subprocess.PIPE).communicate()[0]
 
-        return output
+        return output.splitlines(True)
         
     def run_diff2jpeg(self, filename):
         split_diff2jpeg_path = self.diff2jpeg_path.rsplit('/', 1)
@@ -344,31 +411,41 @@ class DiffractionImageFilter(object):
 
         tf = tempfile.NamedTemporaryFile()
 
-        cmd = "cd '" + cd + "'; ./'" + diff2jpeg_exec + "' '" + filename + "' '" + tf.name + "'"
-
-        p = subprocess.Popen(
-                            cmd,
-                            stdout=subprocess.PIPE,
-                            shell=True)
+        p = subprocess.Popen(['./' + diff2jpeg_exec, filename, tf.name],
+                             cwd=cd,
+                             stdout=subprocess.PIPE)
 
-        p.wait()
+        result_str = p.communicate()[0]
 
-        result_str = p.stdout.read()
-
-        encoded = None
+        read = None
         if not result_str.startswith('Exception'):
             read = tf.read()
-            encoded = base64.b64encode(read)
-        
-        tf.close()
-        return encoded       
 
-def make_filter(name='', schema='', tagsToFind=[], tagsToExclude=[]):
+        tf.close()
+        return read
+
+_filters = {}
+
+def _read_image(args):
+    """Return the metadata of an image.  Run in the pool's processes."""
+    config, filepath = args
+    if config not in _filters:
+        _filters[config] = DiffractionImageFilter(*config)
+    try:
+        return _filters[config].getMetadata(filepath)
+    except Exception, e:
+        logger.debug(e)
+        return {}
+
+def make_filter(name='', schema='', diffdump_path='', diff2jpeg_path='',
+                tagsToFind=[], tagsToExclude=[], extensions=None):
     if not name:
         raise ValueError("DiffractionImageFilter "
                          "requires a name to be specified")
     if not schema:
         raise ValueError("DiffractionImageFilter "
                          "requires a schema to be specified")
-    return DiffractionImageFilter(name, schema, tagsToFind, tagsToExclude)
+    return DiffractionImageFilter(name, schema, diffdump_path,
+                                  diff2jpeg_path, tagsToFind, tagsToExclude,
+                                  extensions)
 make_filter.__doc__ = DiffractionImageFilter.__doc__
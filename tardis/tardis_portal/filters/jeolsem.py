@@ -24,6 +24,9 @@ class JEOLSEMFilter(object):
 
     SCHEMA = 'http://www.jeol.com/#jeol-sem-schema'
 
+    # Only text files are read
+    mimetypes = ['text/plain']
+
     def __init__(self):
         pass
 
@@ -2,7 +2,6 @@ from lxml import etree
 from lxml.etree import Element, SubElement
 import json
 import mimetypes
-from StringIO import StringIO
 from urllib2 import urlopen
 from django.conf import settings
 from django.core.servers.basehttp import FileWrapper
@@ -10,14 +9,20 @@ from django.http import HttpResponse, HttpResponseNotFound
 from django.views.decorators.http import etag
 from django.utils.cache import patch_cache_control
 
-from tardis.tardis_portal.models import Experiment, Dataset_File
+from tardis.tardis_portal.models import Experiment, Dataset_File, ImageInfo
 from tardis.tardis_portal.auth.decorators import has_datafile_download_access
+from tardis.tardis_portal.iiif_cache import get_derivative_cache
+from tardis.tardis_portal.iiif_pyramid import get_pyramid
 
-from wand.exceptions import MissingDelegateError
-from wand.image import Image
+from tardis.tardis_portal.iiif_render import get_render_pool, get_size, \
+    get_source, render_image, RenderError, RenderPoolBusy, UnsupportedFormat
 
 MAX_AGE = getattr(settings, 'DATAFILE_CACHE_MAX_AGE', 60*60*24*7)
 
+# How long clients are asked to wait when too many images are being
+# rendered
+RETRY_AFTER = getattr(settings, 'IIIF_RENDER_RETRY_AFTER', 5)
+
 NSMAP = { None: 'http://library.stanford.edu/iiif/image-api/ns/' }
 ALLOWED_MIMETYPES = ['image/jpeg', 'image/png', 'image/tiff',
                      'image/gif', 'image/jp2', 'application/pdf']
@@ -49,46 +54,39 @@ def _invalid_media_response():
     return HttpResponse(xml, status=415, mimetype='application/xml')
 
 
-def _do_resize(img, size):
-    def pct_resize(pct):
-        w, h = [int(round(n*pct)) for n in (img.width, img.height)]
-        return img.resize(w, h)
-
-    # Width (aspect ratio preserved)
-    if size.endswith(','):
-        width = float(size[:-1])
-        pct_resize(width/img.width)
-        return True
-    # Height (aspect ratio preserved)
-    if size.startswith(','):
-        height = float(size[1:])
-        pct_resize(height/img.height)
-        return True
-    # Percent size (aspect ratio preserved)
-    if size.startswith('pct:'):
-        pct = float(size[4:])/100
-        pct_resize(pct)
-        return True
-    # Width & height specified
-    if ',' in size:
-        if size.startswith('!'):
-            size = size[1:]
-            width, height = map(float, size.split(','))
-            image_ratio = float(img.width) / img.height
-            # Maximum dimensions (aspect ratio preserved)
-            if image_ratio * height > width:
-                # Width determines resize
-                pct_resize(width/img.width)
-            else:
-                # Height determines resize
-                pct_resize(height/img.height)
-            return True
+def _busy_response():
+    response = HttpResponse('Too many images are being rendered',
+                            status=503, mimetype='text/plain')
+    response['Retry-After'] = RETRY_AFTER
+    return response
+
+def _get_pyramid_source(datafile, region, size):
+    """
+    Return the pre-rendered copy of the image to render from, the box to
+    crop from it and the size to make that, or None to use the original.
+    """
+    pyramid = get_pyramid(datafile)
+    if pyramid is None:
+        return None
+    try:
+        if region == 'full':
+            box = (0, 0, pyramid.width, pyramid.height)
+        else:
+            box = tuple(map(int, region.split(',')))
+        if size == 'full':
+            new_size = box[2:]
         else:
-            # Exact dimensions *without* aspect ratio preserved
-            w, h = [int(round(float(n))) for n in size.split(',')[:2]]
-            img.resize(w, h)
-            return True
-    return False
+            new_size = get_size(size, box[2], box[3])
+    except (ValueError, ZeroDivisionError):
+        # Let the original report the problem
+        return None
+    if not new_size or 0 in new_size:
+        return None
+    found = pyramid.find(box, new_size)
+    if found is None:
+        return None
+    filename, crop = found
+    return filename, crop, new_size
 
 def compute_etag(request, datafile_id, *args, **kwargs):
     try:
@@ -103,6 +101,16 @@ def compute_etag(request, datafile_id, *args, **kwargs):
     import hashlib
     return hashlib.sha1(signature).hexdigest()
 
+def _set_image_headers(response, datafile, format, is_public): #@ReservedAssignment
+    response['Content-Disposition'] = \
+        'inline; filename="%s.%s"' % (datafile.filename, format)
+    # Set Cache
+    if is_public:
+        patch_cache_control(response, public=True, max_age=MAX_AGE)
+    else:
+        patch_cache_control(response, private=True, max_age=MAX_AGE)
+    return response
+
 @etag(compute_etag)
 @compliance_header
 def download_image(request, datafile_id, region, size, rotation, quality, format=None): #@ReservedAssignment
@@ -119,60 +127,60 @@ def download_image(request, datafile_id, region, size, rotation, quality, format
                                             dataset_file_id=datafile.id):
             return HttpResponseNotFound()
 
-    buf = StringIO()
-    try:
+    # Handle quality (mostly by rejecting it)
+    if not quality in ['native', 'color']:
+        return _bad_request('quality',
+            'This server does not support greyscale or bitonal quality.')
+    # Handle format
+    if format:
+        mimetype = mimetypes.types_map['.%s' % format.lower()]
+        if not mimetype in ALLOWED_MIMETYPES:
+            return _invalid_media_response()
+    else:
+        mimetype = datafile.get_mimetype()
+        # If the native format is not allowed, pretend it doesn't exist.
+        if not mimetype in ALLOWED_MIMETYPES:
+            return HttpResponseNotFound()
+
+    # Serve an earlier rendering if there is one
+    cache = get_derivative_cache()
+    cache_key = cache and cache.get_key(datafile, region, size, rotation,
+                                        quality, format)
+    if cache_key:
+        filename = cache.get(cache_key)
+        response = filename and cache.get_response(filename, mimetype)
+        if response:
+            return _set_image_headers(response, datafile, format, is_public)
+
+    # The pre-rendered copies are PNGs, so can't stand in for the native
+    # format
+    pyramid_source = format and _get_pyramid_source(datafile, region, size)
+    if pyramid_source:
+        filename, crop, new_size = pyramid_source
+        source, region, size = ('filename', filename), crop, new_size
+    else:
         file_obj = datafile.get_image_data()
         if file_obj == None:
             return HttpResponseNotFound()
-        from contextlib import closing
-        with closing(file_obj) as f:
-            with Image(file=f) as img:
-                # Handle region
-                if region != 'full':
-                    x, y, w, h = map(lambda x: int(x), region.split(','))
-                    img.crop(x, y, width=w, height=h)
-                # Handle size
-                if size != 'full':
-                    # Check the image isn't empty
-                    if 0 in (img.height, img.width):
-                        return _bad_request('size', 'Cannot resize empty image')
-                    # Attempt resize
-                    if not _do_resize(img, size):
-                        return _bad_request('size',
-                                            'Invalid size argument: %s' % size)
-                # Handle rotation
-                if rotation:
-                    img.rotate(float(rotation))
-                # Handle quality (mostly by rejecting it)
-                if not quality in ['native', 'color']:
-                    return _get_iiif_error('quality',
-                    'This server does not support greyscale or bitonal quality.')
-                # Handle format
-                if format:
-                    mimetype = mimetypes.types_map['.%s' % format.lower()]
-                    img.format = format
-                    if not mimetype in ALLOWED_MIMETYPES:
-                        return _invalid_media_response()
-                else:
-                    mimetype = datafile.get_mimetype()
-                    # If the native format is not allowed, pretend it doesn't exist.
-                    if not mimetype in ALLOWED_MIMETYPES:
-                        return HttpResponseNotFound()
-                img.save(file=buf)
-                response = HttpResponse(buf.getvalue(), mimetype=mimetype)
-                response['Content-Disposition'] = \
-                    'inline; filename="%s.%s"' % (datafile.filename, format)
-                # Set Cache
-                if is_public:
-                    patch_cache_control(response, public=True, max_age=MAX_AGE)
-                else:
-                    patch_cache_control(response, private=True, max_age=MAX_AGE)
-                return response
-    except MissingDelegateError:
+        source = get_source(file_obj)
+
+    try:
+        data = get_render_pool().run(render_image, source, region, size,
+                                     rotation, format)
+    except RenderPoolBusy:
+        return _busy_response()
+    except RenderError as e:
+        return _bad_request(e.parameter, e.text)
+    except UnsupportedFormat:
         if format:
             return _invalid_media_response()
         return HttpResponseNotFound()
 
+    if cache_key:
+        cache.put(cache_key, data)
+    return _set_image_headers(HttpResponse(data, mimetype=mimetype),
+                              datafile, format, is_public)
+
 @etag(compute_etag)
 @compliance_header
 def download_info(request, datafile_id, format): #@ReservedAssignment
@@ -186,15 +194,22 @@ def download_info(request, datafile_id, format): #@ReservedAssignment
                                         dataset_file_id=datafile.id):
         return HttpResponseNotFound()
 
-    file_obj = datafile.get_file()
-    if file_obj == None:
+    # Recorded when the image was verified, or now (by the render pool) if
+    # it wasn't
+    try:
+        image_info = ImageInfo.get_for(datafile, get_render_pool())
+    except RenderPoolBusy:
+        return _busy_response()
+    if image_info is None:
         return HttpResponseNotFound()
-    from contextlib import closing
-    with closing(file_obj) as f:
-        with Image(file=f) as img:
-            data = {'identifier': datafile.id,
-                    'height': img.height,
-                    'width':  img.width }
+    data = {'identifier': datafile.id,
+            'height': image_info.height,
+            'width':  image_info.width }
+    scale_factors = image_info.get_scale_factors()
+    if scale_factors:
+        # Tell tiling viewers which tiles have been pre-rendered
+        data['tile_width'] = data['tile_height'] = image_info.tile_size
+        data['scale_factors'] = scale_factors
 
     if format == 'xml':
         info = Element('info', nsmap=NSMAP)
@@ -204,6 +219,13 @@ def download_info(request, datafile_id, format): #@ReservedAssignment
         height.text = str(data['height'])
         width = SubElement(info, 'width')
         width.text = str(data['width'])
+        if 'scale_factors' in data:
+            SubElement(info, 'tile_width').text = str(data['tile_width'])
+            SubElement(info, 'tile_height').text = str(data['tile_height'])
+            scale_factors = SubElement(info, 'scale_factors')
+            for scale_factor in data['scale_factors']:
+                SubElement(scale_factors, 'scale_factor').text = \
+                    str(scale_factor)
         return HttpResponse(etree.tostring(info, method='xml'),
                             mimetype="application/xml")
     if format == 'json':
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+iiif_cache.py
+
+A cache, on local disk, of the images rendered by the IIIF views.  Each
+rendering is keyed on the datafile's checksum and the parameters it was
+rendered with, so it stays valid as long as the datafile is unchanged,
+and identical files share their renderings.
+
+The cache is limited to IIIF_CACHE_SIZE bytes.  Each hit marks the
+rendering as recently used (by its modification time), and the least
+recently used renderings are removed when the limit is passed.  Several
+processes can share the cache: each keeps track of what it has written,
+and rescans the cache every so often to see what the others have.
+
+Cached renderings can be sent by the web server, rather than read through
+Django, by setting IIIF_CACHE_SENDFILE to 'X-Sendfile' (Apache's
+mod_xsendfile, lighttpd) or 'X-Accel-Redirect' (nginx, with
+IIIF_CACHE_SENDFILE_PREFIX the internal location IIIF_CACHE_PATH is
+served from).
+"""
+
+import hashlib
+import json
+import logging
+import os
+from os import path
+from tempfile import NamedTemporaryFile
+from threading import Lock
+
+from django.conf import settings
+from django.core.servers.basehttp import FileWrapper
+from django.http import HttpResponse
+
+logger = logging.getLogger(__name__)
+
+# Fraction of the size limit the cache is cut down to when it is reached,
+# so that it isn't scanned on every write once full
+_EVICT_TO = 0.9
+
+# Fraction of the size limit written by a process between rescans
+_RESCAN_AFTER = 0.1
+
+
+class DerivativeCache(object):
+    """
+    Renderings of images, stored as files under location, which may use
+    up to max_size bytes.
+    """
+
+    def __init__(self, location, max_size):
+        self.location = location
+        self.max_size = max_size
+        self._lock = Lock()
+        # The size of the cache when it was last scanned, plus what this
+        # process has written since
+        self._size = None
+        self._written = 0
+
+    def get_key(self, datafile, *args):
+        """
+        Return the key of a rendering of a datafile with the given
+        parameters, or None if the datafile has no checksum to key it on.
+        """
+        checksum = datafile.sha512sum or datafile.md5sum
+        if not checksum:
+            return None
+        return hashlib.sha1(json.dumps((checksum,) + args)).hexdigest()
+
+    def get_path(self, key):
+        return path.join(self.location, key[:2], key)
+
+    def get(self, key):
+        """Return the path of a cached rendering, or None."""
+        filename = self.get_path(key)
+        try:
+            # Mark it as recently used
+            os.utime(filename, None)
+        except OSError:
+            return None
+        return filename
+
+    def put(self, key, data):
+        """Cache a rendering, and return its path."""
+        filename = self.get_path(key)
+        directory = path.dirname(filename)
+        if not path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Another process got there first
+                pass
+        # Readers only ever see complete renderings
+        with NamedTemporaryFile(dir=directory, prefix='.',
+                                delete=False) as f:
+            f.write(data)
+        # The web server may be sending it
+        os.chmod(f.name, 0644)
+        os.rename(f.name, filename)
+
+        with self._lock:
+            if self._size is None or \
+                    self._written > self.max_size * _RESCAN_AFTER:
+                self._scan()
+            else:
+                self._size += len(data)
+                self._written += len(data)
+            if self._size > self.max_size:
+                self._evict()
+        return filename
+
+    def _list(self):
+        entries = []
+        for dirpath, _, filenames in os.walk(self.location):
+            for name in filenames:
+                if name.startswith('.'):
+                    # Still being written
+                    continue
+                filename = path.join(dirpath, name)
+                try:
+                    stat = os.stat(filename)
+                except OSError:
+                    # Removed by another process
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, filename))
+        return entries
+
+    def _scan(self):
+        self._size = sum(size for _, size, _ in self._list())
+        self._written = 0
+
+    def _evict(self):
+        # Remove the least recently used renderings
+        entries = sorted(self._list())
+        self._size = sum(size for _, size, _ in entries)
+        self._written = 0
+        for _, size, filename in entries:
+            if self._size <= self.max_size * _EVICT_TO:
+                break
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+            self._size -= size
+        logger.debug('IIIF cache cut down to %d bytes' % self._size)
+
+    def get_response(self, filename, mimetype):
+        """
+        Return a response sending a cached rendering, or None if it has
+        been evicted since it was looked up.
+        """
+        sendfile = getattr(settings, 'IIIF_CACHE_SENDFILE', None)
+        if sendfile == 'X-Accel-Redirect':
+            response = HttpResponse(mimetype=mimetype)
+            response[sendfile] = \
+                getattr(settings, 'IIIF_CACHE_SENDFILE_PREFIX', '') + \
+                path.relpath(filename, self.location)
+        elif sendfile:
+            response = HttpResponse(mimetype=mimetype)
+            response[sendfile] = filename
+        else:
+            try:
+                f = open(filename, 'rb')
+            except IOError:
+                return None
+            response = HttpResponse(FileWrapper(f), mimetype=mimetype)
+            response['Content-Length'] = os.fstat(f.fileno()).st_size
+        return response
+
+
+_cache = None
+
+
+def get_derivative_cache():
+    """
+    Return the cache of IIIF renderings, or None if IIIF_CACHE_PATH isn't
+    set.
+    """
+    global _cache
+    location = getattr(settings, 'IIIF_CACHE_PATH', None)
+    if not location:
+        return None
+    if _cache is None or _cache.location != location:
+        _cache = DerivativeCache(location,
+                                 getattr(settings, 'IIIF_CACHE_SIZE',
+                                         1024 * 1024 * 1024))
+    return _cache
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""
+iiif_pyramid.py
+
+Pre-rendered, reduced copies of image datafiles, so the IIIF views can
+render thumbnails, previews and the tiles of large images without decoding
+the whole original.
+
+For each image, IIIF_PYRAMID_PATH holds a directory, named after the
+image's SHA-512 digest, with:
+
+* a thumbnail, as wide as the dataset thumbnails, and a preview;
+* for images larger than IIIF_PYRAMID_MIN_SIZE, a pyramid of levels, each
+  half the size of the one before, down to a single tile.  Every level,
+  and the original, is also cut into IIIF_TILE_SIZE square tiles, which
+  serve requests for regions aligned with them (as tiling viewers make);
+* pyramid.json, describing the above.
+
+The pyramids are made by the generate_image_pyramid task, once an image
+has been verified.
+"""
+
+import json
+import os
+import shutil
+from contextlib import closing
+from os import path
+from tempfile import mkdtemp
+
+from django.conf import settings
+
+TILE_SIZE = getattr(settings, 'IIIF_TILE_SIZE', 512)
+MIN_SIZE = getattr(settings, 'IIIF_PYRAMID_MIN_SIZE', 2048)
+
+# The widths of the thumbnail (as used for datasets) and of the preview
+THUMBNAIL_WIDTH = 100
+PREVIEW_WIDTH = 1024
+
+_DESCRIPTION = 'pyramid.json'
+
+
+def _get_location(datafile):
+    root = getattr(settings, 'IIIF_PYRAMID_PATH', None)
+    if not (root and datafile.sha512sum):
+        return None
+    checksum = datafile.sha512sum.lower()
+    return path.join(root, checksum[:2], checksum)
+
+
+class Pyramid(object):
+    """
+    The pre-rendered copies of an image.
+
+    :attribute width: the width of the original.
+    :attribute height: the height of the original.
+    :attribute levels: for each copy, a dict with its name, width and
+       height, whether there is a whole image of it, and whether it has
+       been cut into tiles.
+    """
+
+    def __init__(self, location, description):
+        self.location = location
+        self.width = description['width']
+        self.height = description['height']
+        self.tile_size = description['tile_size']
+        self.levels = description['levels']
+
+    def get_scale_factors(self):
+        """Return how much each tiled level is reduced by."""
+        return [int(round(float(self.width) / level['width']))
+                for level in self.levels if level['tiled']]
+
+    def find(self, region, size):
+        """
+        Find the smallest copy which covers a region of the original, given
+        as (x, y, width, height), in enough detail to render it at size,
+        given as (width, height).  Return the name of its file and the box,
+        as (x, y, width, height), to crop from it, or None if only the
+        original will do.
+        """
+        x, y, w, h = region
+        if w <= 0 or h <= 0 or x < 0 or y < 0 or \
+                x + w > self.width or y + h > self.height:
+            return None
+
+        def reduction(level):
+            return (float(self.width) / level['width'],
+                    float(self.height) / level['height'])
+
+        # Smallest first
+        for level in sorted(self.levels, key=lambda l: l['width']):
+            sx, sy = reduction(level)
+            if w / sx < size[0] - 1 or h / sy < size[1] - 1:
+                # Not enough detail (allowing for levels' sizes having
+                # been rounded)
+                continue
+            left = int(round(x / sx))
+            top = int(round(y / sy))
+            right = max(min(int(round((x + w) / sx)), level['width']),
+                        left + 1)
+            bottom = max(min(int(round((y + h) / sy)), level['height']),
+                         top + 1)
+            if level['tiled']:
+                col, row = left // self.tile_size, top // self.tile_size
+                if (right - 1) // self.tile_size == col and \
+                        (bottom - 1) // self.tile_size == row:
+                    return (path.join(self.location, level['name'],
+                                      '%d_%d.png' % (col, row)),
+                            (left - col * self.tile_size,
+                             top - row * self.tile_size,
+                             right - left, bottom - top))
+            if level['whole']:
+                return (path.join(self.location, '%s.png' % level['name']),
+                        (left, top, right - left, bottom - top))
+        return None
+
+
+def get_pyramid(datafile):
+    """Return the :class:`Pyramid` of a datafile, or None."""
+    location = _get_location(datafile)
+    if location is None:
+        return None
+    try:
+        with open(path.join(location, _DESCRIPTION)) as f:
+            return Pyramid(location, json.load(f))
+    except IOError:
+        return None
+
+
+def _save(img, filename):
+    img.format = 'png'
+    img.save(filename=filename)
+
+
+def _save_tiles(img, directory):
+    os.mkdir(directory)
+    for row, top in enumerate(range(0, img.height, TILE_SIZE)):
+        bottom = min(top + TILE_SIZE, img.height)
+        # Slicing copies the image, so cut each row out first
+        with img[0:img.width, top:bottom] as strip:
+            for col, left in enumerate(range(0, img.width, TILE_SIZE)):
+                right = min(left + TILE_SIZE, img.width)
+                with strip[left:right, 0:strip.height] as tile:
+                    _save(tile, path.join(directory,
+                                          '%d_%d.png' % (col, row)))
+
+
+def _scaled(img, width, height):
+    scaled = img.clone()
+    scaled.resize(width, height)
+    return scaled
+
+
+def generate_pyramid(datafile):
+    """
+    Render the copies of an image datafile, unless they have already been
+    rendered (for this or an identical file).  Return True if there were
+    any to render.
+    """
+    from wand.image import Image
+
+    location = _get_location(datafile)
+    if location is None or path.exists(location) or \
+            not datafile.is_image():
+        return False
+    file_obj = datafile.get_file()
+    if file_obj is None:
+        return False
+
+    parent = path.dirname(location)
+    if not path.isdir(parent):
+        try:
+            os.makedirs(parent)
+        except OSError:
+            # Another worker got there first
+            pass
+    # Write everything somewhere else, so that a pyramid is complete
+    # whenever it's seen
+    working = mkdtemp(dir=parent, prefix='.')
+    try:
+        with closing(file_obj) as f:
+            with Image(file=f) as img:
+                width, height = img.width, img.height
+                if 0 in (width, height):
+                    return False
+                levels = []
+
+                for name, level_width in (('thumbnail', THUMBNAIL_WIDTH),
+                                          ('preview', PREVIEW_WIDTH)):
+                    if level_width >= width:
+                        continue
+                    level_height = max(1, int(round(
+                        height * float(level_width) / width)))
+                    with _scaled(img, level_width, level_height) as copy:
+                        _save(copy, path.join(working, '%s.png' % name))
+                    levels.append({'name': name,
+                                   'width': level_width,
+                                   'height': level_height,
+                                   'whole': True,
+                                   'tiled': False})
+
+                if max(width, height) > MIN_SIZE:
+                    _save_tiles(img, path.join(working, 'level-0'))
+                    levels.append({'name': 'level-0',
+                                   'width': width,
+                                   'height': height,
+                                   # That's the original
+                                   'whole': False,
+                                   'tiled': True})
+                    level, current = 0, img
+                    while max(current.width, current.height) > TILE_SIZE:
+                        level += 1
+                        name = 'level-%d' % level
+                        smaller = _scaled(current,
+                                          max(1, current.width // 2),
+                                          max(1, current.height // 2))
+                        if current is not img:
+                            current.close()
+                        current = smaller
+                        _save(current, path.join(working, '%s.png' % name))
+                        _save_tiles(current, path.join(working, name))
+                        levels.append({'name': name,
+                                       'width': current.width,
+                                       'height': current.height,
+                                       'whole': True,
+                                       'tiled': True})
+                    if current is not img:
+                        current.close()
+
+        with open(path.join(working, _DESCRIPTION), 'w') as f:
+            json.dump({'width': width,
+                       'height': height,
+                       'tile_size': TILE_SIZE,
+                       'levels': levels}, f)
+        os.chmod(working, 0755)
+        try:
+            os.rename(working, location)
+        except OSError:
+            # Another worker rendered it at the same time
+            if not path.exists(location):
+                raise
+        return True
+    finally:
+        if path.exists(working):
+            shutil.rmtree(working, ignore_errors=True)
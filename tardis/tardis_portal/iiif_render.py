@@ -0,0 +1,402 @@
+# -*- coding: utf-8 -*-
+"""
+iiif_render.py
+
+Renders images for the IIIF views, so that a burst of requests for images
+can't tie up the web server's processes with ImageMagick work.
+
+At most IIIF_RENDER_SLOTS images are rendered at once on each host, by all
+of its web server processes together.  Each render holds a slot, a lock
+file under IIIF_RENDER_SLOT_PATH, which the operating system frees if the
+process holding it dies.  Requests finding no free slot are turned away
+straight away, without waiting, and the views answer them with a 503.
+ImageMagick's use of memory (and disk) is limited to
+IIIF_RENDER_MEMORY_LIMIT (and IIIF_RENDER_DISK_LIMIT) bytes.
+
+Images are rendered in the web server's process, unless
+IIIF_RENDER_PROCESSES is set, in which case each web server process hands
+them to a pool of that many worker processes of its own, which give back
+the memory ImageMagick holds on to every so often.  Renders taking the
+pool more than IIIF_RENDER_TIMEOUT seconds are turned away too.
+"""
+
+import logging
+import os
+import time
+from os import path
+from tempfile import gettempdir
+from multiprocessing import Pool, TimeoutError
+from StringIO import StringIO
+from threading import Lock
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+PROCESSES = getattr(settings, 'IIIF_RENDER_PROCESSES', 0)
+SLOTS = getattr(settings, 'IIIF_RENDER_SLOTS', 4)
+SLOT_PATH = getattr(settings, 'IIIF_RENDER_SLOT_PATH',
+                    path.join(gettempdir(), 'mytardis-iiif-render'))
+TIMEOUT = getattr(settings, 'IIIF_RENDER_TIMEOUT', 30)
+MEMORY_LIMIT = getattr(settings, 'IIIF_RENDER_MEMORY_LIMIT', None)
+DISK_LIMIT = getattr(settings, 'IIIF_RENDER_DISK_LIMIT', None)
+
+# Workers are replaced after this many renders, to give back any memory
+# ImageMagick has held on to
+_RENDERS_PER_PROCESS = 100
+
+# How often the metrics are logged, in renders
+_LOG_EVERY = 100
+
+# ImageMagick's ResourceType values
+_DISK_RESOURCE = 2
+_MAP_RESOURCE = 4
+_MEMORY_RESOURCE = 5
+
+
+class RenderError(Exception):
+    """A request which can't be rendered, because of the named parameter."""
+
+    def __init__(self, parameter, text):
+        Exception.__init__(self, parameter, text)
+        self.parameter = parameter
+        self.text = text
+
+
+class UnsupportedFormat(Exception):
+    """An image ImageMagick can't read or write."""
+
+
+class RenderFailed(Exception):
+    """An unexpected error in a worker."""
+
+
+class RenderPoolBusy(Exception):
+    """No render slot is free, or the pool took too long."""
+
+
+def get_size(size, width, height):
+    """
+    Return the (width, height) an image of the given dimensions is resized
+    to by an IIIF size parameter (other than 'full'), or None if it isn't
+    valid.
+    """
+    def pct_size(pct):
+        return tuple(int(round(n*pct)) for n in (width, height))
+
+    # Width (aspect ratio preserved)
+    if size.endswith(','):
+        return pct_size(float(size[:-1])/width)
+    # Height (aspect ratio preserved)
+    if size.startswith(','):
+        return pct_size(float(size[1:])/height)
+    # Percent size (aspect ratio preserved)
+    if size.startswith('pct:'):
+        return pct_size(float(size[4:])/100)
+    # Width & height specified
+    if ',' in size:
+        if size.startswith('!'):
+            max_width, max_height = map(float, size[1:].split(','))
+            image_ratio = float(width) / height
+            # Maximum dimensions (aspect ratio preserved)
+            if image_ratio * max_height > max_width:
+                # Width determines resize
+                return pct_size(max_width/width)
+            else:
+                # Height determines resize
+                return pct_size(max_height/height)
+        else:
+            # Exact dimensions *without* aspect ratio preserved
+            return tuple(int(round(float(n))) for n in size.split(',')[:2])
+    return None
+
+
+def get_source(file_obj):
+    """
+    Return how the render pool is to read an image: from its file, if it
+    has one, or otherwise from its data.
+    """
+    from contextlib import closing
+    with closing(file_obj) as f:
+        filename = getattr(f, 'name', None)
+        if filename and os.path.isabs(filename) and os.path.isfile(filename):
+            return ('filename', filename)
+        return ('blob', f.read())
+
+
+def read_image_info(source):
+    """
+    Decode an image, and return its width, height, format and number of
+    pages, as :class:`ImageInfo` records them.
+
+    :param source: ('filename', path) or ('blob', data) of the image.
+    """
+    from wand.api import library
+    from wand.exceptions import WandException
+    from wand.image import Image
+
+    kind, value = source
+    try:
+        with Image(**{kind: value}) as img:
+            return {'width': img.width,
+                    'height': img.height,
+                    'format': img.format or '',
+                    'pages': max(1, library.MagickGetNumberImages(img.wand))}
+    except WandException:
+        raise UnsupportedFormat()
+
+
+def render_image(source, region, size, rotation, format): #@ReservedAssignment
+    """
+    Render an image, and return the data of the rendering.
+
+    :param source: ('filename', path) or ('blob', data) of the image.
+    :param region: 'full', an IIIF region or an (x, y, width, height) box.
+    :param size: 'full', an IIIF size or a (width, height) to resize to.
+    :param rotation: degrees to rotate the image by.
+    :param format: the format to render in, or None for the image's own.
+    """
+    from wand.exceptions import MissingDelegateError
+    from wand.image import Image
+
+    kind, value = source
+    try:
+        with Image(**{kind: value}) as img:
+            # Handle region
+            if region != 'full':
+                if isinstance(region, basestring):
+                    try:
+                        region = map(int, region.split(','))
+                    except ValueError:
+                        raise RenderError('region',
+                            'Invalid region argument: %s' % region)
+                x, y, w, h = region
+                if (x, y, w, h) != (0, 0, img.width, img.height):
+                    img.crop(x, y, width=w, height=h)
+            # Handle size
+            if size != 'full':
+                # Check the image isn't empty
+                if 0 in (img.height, img.width):
+                    raise RenderError('size', 'Cannot resize empty image')
+                new_size = size
+                if isinstance(size, basestring):
+                    new_size = get_size(size, img.width, img.height)
+                if not new_size:
+                    raise RenderError('size',
+                        'Invalid size argument: %s' % size)
+                if (img.width, img.height) != tuple(new_size):
+                    img.resize(*new_size)
+            # Handle rotation
+            if rotation:
+                img.rotate(float(rotation))
+            if format:
+                img.format = format
+            buf = StringIO()
+            img.save(file=buf)
+            return buf.getvalue()
+    except MissingDelegateError:
+        raise UnsupportedFormat()
+
+
+def _set_limits():
+    if not (MEMORY_LIMIT or DISK_LIMIT):
+        return
+    from ctypes import c_ulonglong
+    from wand.api import library
+    if MEMORY_LIMIT:
+        for resource in (_MEMORY_RESOURCE, _MAP_RESOURCE):
+            library.MagickSetResourceLimit(resource,
+                                           c_ulonglong(MEMORY_LIMIT))
+    if DISK_LIMIT:
+        library.MagickSetResourceLimit(_DISK_RESOURCE,
+                                       c_ulonglong(DISK_LIMIT))
+
+
+def _run(func, args, submitted):
+    # Runs in a worker.  Everything is handed back, as the pool can't pass
+    # on errors it can't pickle.
+    started = time.time()
+    try:
+        result = (True, func(*args))
+    except (RenderError, UnsupportedFormat) as e:
+        result = (False, e)
+    except Exception as e:
+        logger.exception('Rendering failed')
+        result = (False, RenderFailed(repr(e)))
+    return started - submitted, time.time() - started, result
+
+
+class RenderMetrics(object):
+    """
+    Running totals of the renders made for this process, and of the
+    requests turned away.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.renders = 0
+            self.rejected = 0
+            self.wait = 0.0
+            self.seconds = 0.0
+            self.bytes = 0
+
+    def add(self, wait, seconds, size):
+        with self._lock:
+            self.renders += 1
+            self.wait += wait
+            self.seconds += seconds
+            self.bytes += size
+            renders = self.renders
+        logger.debug('Rendered %d bytes in %.3fs, after waiting %.3fs' %
+                     (size, seconds, wait))
+        if renders % _LOG_EVERY == 0:
+            self.log()
+
+    def reject(self):
+        with self._lock:
+            self.rejected += 1
+
+    def log(self):
+        renders = self.renders or 1
+        logger.info('Process %d rendered %d images (%.1f MB), %d turned '
+                    'away; average wait %.3fs, average render %.3fs' %
+                    (os.getpid(), self.renders,
+                     self.bytes / (1024.0 * 1024), self.rejected,
+                     self.wait / renders, self.seconds / renders))
+
+
+class RenderSlots(object):
+    """
+    The slots renders hold while they run, shared by every process (on the
+    same host) using the same directory.  Each is a file with a POSIX lock
+    on it, which processes forked while it is held (like the pool's
+    workers) don't inherit, and which is let go of if its process dies.
+    Those locks belong to the whole process, so it keeps track of the
+    slots its threads hold itself.
+    """
+
+    def __init__(self, directory, count):
+        self.directory = directory
+        self.count = count
+        self._lock = Lock()
+        self._held = {}
+
+    def take(self):
+        """Return a free slot, having taken it, or None if none is free."""
+        import fcntl
+        if not path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                # Another process got there first
+                pass
+        with self._lock:
+            for slot in range(self.count):
+                if slot in self._held:
+                    # Closing it again would let go of the lock
+                    continue
+                f = open(path.join(self.directory, 'slot-%d' % slot), 'a')
+                try:
+                    fcntl.lockf(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError:
+                    f.close()
+                    continue
+                self._held[slot] = f
+                return slot
+        return None
+
+    def release(self, slot):
+        with self._lock:
+            self._held.pop(slot).close()
+
+
+class RenderPool(object):
+    """
+    Renders images while it can take one of the slots, in a pool of
+    processes, which it waits up to timeout seconds for.  With no
+    processes, images are rendered in the calling thread.
+    """
+
+    def __init__(self, processes, slots, timeout, slot_path):
+        self.processes = processes
+        self.slots = RenderSlots(slot_path, slots)
+        self.timeout = timeout
+        self.metrics = RenderMetrics()
+        self._lock = Lock()
+        self._pool = None
+        self._limited = False
+
+    def _get_pool(self):
+        # Made on first use, so that each web server process (which may
+        # have been forked after this module was imported) has its own
+        with self._lock:
+            if self._pool is None:
+                self._pool = Pool(self.processes, initializer=_set_limits,
+                                  maxtasksperchild=_RENDERS_PER_PROCESS)
+            return self._pool
+
+    def close(self):
+        """Stop the pool's processes."""
+        with self._lock:
+            if self._pool is not None:
+                self._pool.terminate()
+                self._pool.join()
+                self._pool = None
+
+    def run(self, func, *args):
+        """
+        Run func(*args) in the pool and return its result, or raise
+        :class:`RenderPoolBusy` if no slot is free or the pool takes too
+        long.
+        """
+        slot = self.slots.take()
+        if slot is None:
+            self.metrics.reject()
+            raise RenderPoolBusy()
+        submitted = time.time()
+        if self.processes:
+            try:
+                # A job which times out keeps its slot until it finishes,
+                # as it is still rendering.  _run doesn't raise, so this is
+                # called however the job ends.
+                job = self._get_pool().apply_async(
+                    _run, (func, args, submitted),
+                    callback=lambda result: self.slots.release(slot))
+            except:
+                self.slots.release(slot)
+                raise
+            try:
+                wait, seconds, result = job.get(self.timeout)
+            except TimeoutError:
+                self.metrics.reject()
+                raise RenderPoolBusy()
+        else:
+            try:
+                with self._lock:
+                    if not self._limited:
+                        _set_limits()
+                        self._limited = True
+                wait, seconds, result = _run(func, args, submitted)
+            finally:
+                self.slots.release(slot)
+        succeeded, value = result
+        if not succeeded:
+            raise value
+        self.metrics.add(wait, seconds,
+                         len(value) if isinstance(value, str) else 0)
+        return value
+
+
+_pool = None
+
+
+def get_render_pool():
+    """Return this process's :class:`RenderPool`."""
+    global _pool
+    if _pool is None:
+        _pool = RenderPool(PROCESSES, SLOTS, TIMEOUT, SLOT_PATH)
+    return _pool
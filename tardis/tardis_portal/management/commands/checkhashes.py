@@ -1,73 +1,217 @@
 """
-Management utility to create a token user
+Management utility to check file hashes against the actual files
+
+Progress is recorded in a checkpoint file, so an interrupted run can be
+continued with --resume.  The checkpoint also remembers the size and mtime
+of every local file which checked out, so --mtime-skip can skip files which
+haven't changed on disk since.
 """
 
-import hashlib
+import json
+import os
+import shelve
+import time
 from contextlib import closing
+from datetime import datetime
+from itertools import imap
+from multiprocessing import Pool
+from optparse import make_option
 from urllib2 import urlopen
 
 from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Q
+from tardis.tardis_portal.checksums import compute_checksums
 from tardis.tardis_portal.models import Dataset_File
 
-CHUNK_SIZE = 32*1024
-
-class AlgorithmNotSupported(Exception):
-    pass
-
-class NoHashAvailable(Exception):
-    pass
-
-class ValidationFailed(Exception):
-    pass
+# Datafiles fetched and checked at a time.  The resume point advances
+# once a whole batch has been checked.
+BATCH_SIZE = 1000
 
 class Command(BaseCommand):
 
     help = 'Used to check file hashes against actual files.'
 
+    option_list = BaseCommand.option_list + (
+        make_option('--dataset', dest='dataset', type='int',
+            help='Only check datafiles in this dataset'),
+        make_option('--experiment', dest='experiment', type='int',
+            help='Only check datafiles in this experiment'),
+        make_option('--since', dest='since',
+            help='Only check datafiles created or modified since this '
+                 'date (YYYY-MM-DD)'),
+        make_option('-j', '--processes', dest='processes', type='int',
+            default=1,
+            help='Number of files to hash concurrently'),
+        make_option('--checkpoint', dest='checkpoint',
+            default='checkhashes.checkpoint',
+            help='File to record progress and file states in'),
+        make_option('--resume', dest='resume', default=False,
+            action='store_true',
+            help='Continue from where the last run with the same scope '
+                 'stopped'),
+        make_option('--mtime-skip', dest='mtime_skip', default=False,
+            action='store_true',
+            help="Skip local files whose size and mtime haven't changed "
+                 "since they last passed"),
+        make_option('--report', dest='report',
+            help='Append failures and throughput to this file as JSON lines'),
+    )
+
     def handle(self, *args, **options):
         verbosity = int(options.get('verbosity', 1))
-
-        for df in Dataset_File.objects.all():
-            for algorithm in ('sha512', 'md5'):
-                try:
-                    validate_digest(algorithm, df)
-                    # Success, so don't try another
+        processes = options.get('processes') or 1
+        datafiles = self._get_datafiles(options)
+        watermark_key = str('watermark:dataset=%s,experiment=%s,since=%s' %
+                            (options.get('dataset'),
+                             options.get('experiment'),
+                             options.get('since')))
+
+        pool = None
+        if processes > 1:
+            # Workers only ever see plain data, but must not inherit the
+            # database connection
+            connection.close()
+            pool = Pool(processes)
+        checkpoint = shelve.open(options.get('checkpoint'))
+        report = None
+        if options.get('report'):
+            report = open(options.get('report'), 'a')
+        self.totals = dict(files=0, skipped=0, failed=0, bytes=0)
+        started = time.time()
+        try:
+            last_id = 0
+            if options.get('resume'):
+                last_id = checkpoint.get(watermark_key, 0)
+            while True:
+                batch = list(datafiles.filter(id__gt=last_id)
+                                      .order_by('id')[:BATCH_SIZE])
+                if not batch:
                     break
-                except AlgorithmNotSupported:
-                    continue
-                except NoHashAvailable:
-                    continue
-                except ValidationFailed:
-                    self.stdout.write("%d/%s: FAILED\n" % (df.dataset.id, df))
-                if verbosity > 1:
-                    self.stdout.write("%d/%s: OK\n" % (df.dataset.id, df))
-
-
-
-def validate_digest(algorithm, datafile):
+                tasks = []
+                for df in batch:
+                    task = _get_check_task(df)
+                    if options.get('mtime_skip') and \
+                            _is_unchanged(checkpoint, task):
+                        self.totals['skipped'] += 1
+                        continue
+                    tasks.append(task)
+                mapper = pool.imap_unordered if pool else imap
+                for result in mapper(_check_datafile, tasks):
+                    self._record(result, checkpoint, report, verbosity)
+                last_id = batch[-1].id
+                checkpoint[watermark_key] = last_id
+                checkpoint.sync()
+            # Finished, so the next run starts from the beginning
+            if watermark_key in checkpoint:
+                del checkpoint[watermark_key]
+        finally:
+            if pool:
+                pool.terminate()
+            checkpoint.close()
+            self._summarise(time.time() - started, report, verbosity)
+            if report:
+                report.close()
+
+    def _get_datafiles(self, options):
+        datafiles = Dataset_File.objects.all()
+        if options.get('dataset'):
+            datafiles = datafiles.filter(dataset__id=options['dataset'])
+        if options.get('experiment'):
+            datafiles = datafiles.filter(
+                dataset__experiments__id=options['experiment'])
+        if options.get('since'):
+            try:
+                since = datetime.strptime(options['since'], '%Y-%m-%d')
+            except ValueError:
+                raise CommandError("--since must be a date like 2012-12-31")
+            datafiles = datafiles.filter(Q(created_time__gte=since) |
+                                         Q(modification_time__gte=since))
+        return datafiles
+
+    def _record(self, result, checkpoint, report, verbosity):
+        self.totals['files'] += 1
+        self.totals['bytes'] += result.get('bytes', 0)
+        if 'mtime' in result:
+            checkpoint['df:%d' % result['id']] = \
+                (result['size'], result['mtime'], result['status'])
+        if result['status'] == 'FAILED':
+            self.totals['failed'] += 1
+            self.stdout.write("%s: FAILED\n" % result['datafile'])
+            if report:
+                report.write(json.dumps(result) + '\n')
+        elif verbosity > 1:
+            self.stdout.write("%s: %s\n" % (result['datafile'],
+                                            result['status']))
+
+    def _summarise(self, seconds, report, verbosity):
+        summary = dict(self.totals, seconds=seconds,
+                       mb_per_second=(self.totals['bytes'] / (1024.0 * 1024)
+                                      / seconds) if seconds else 0.0)
+        if report:
+            report.write(json.dumps({'summary': summary}) + '\n')
+        if verbosity > 0:
+            self.stdout.write("Checked %(files)d files (%(skipped)d skipped, "
+                              "%(failed)d failed) at %(mb_per_second).1f "
+                              "MB/s\n" % summary)
+
+
+def _get_check_task(datafile):
+    """
+    Everything a worker needs to check a datafile, without the database.
+    """
+    if datafile.sha512sum:
+        algorithm, expected = 'sha512', datafile.sha512sum
+    elif datafile.md5sum:
+        algorithm, expected = 'md5', datafile.md5sum
+    else:
+        algorithm, expected = None, None
+    return (datafile.id,
+            "%d/%s" % (datafile.dataset_id, datafile),
+            datafile.get_actual_url(),
+            datafile.get_absolute_filepath(),
+            algorithm,
+            expected)
+
+def _is_unchanged(checkpoint, task):
+    datafile_id, path = task[0], task[3]
     try:
-        expected = getattr(datafile, "%ssum" % algorithm)
-    except AttributeError:
-        raise AlgorithmNotSupported()
-
-    if not expected:
-        raise NoHashAvailable()
-
-    url = datafile.get_actual_url()
+        size, mtime, status = checkpoint['df:%d' % datafile_id]
+        st = os.stat(path)
+    except (KeyError, OSError):
+        return False
+    return status == 'OK' and st.st_size == size and st.st_mtime == mtime
+
+def _check_datafile(task):
+    """
+    Hash a single datafile, returning a dict describing the result.  Run in
+    the worker processes.
+    """
+    datafile_id, label, url, path, algorithm, expected = task
+    result = {'id': datafile_id, 'datafile': label, 'algorithm': algorithm}
+    if path:
+        try:
+            st = os.stat(path)
+        except OSError as e:
+            result.update(status='FAILED', error=str(e))
+            return result
+        result.update(size=st.st_size, mtime=st.st_mtime)
+    if not algorithm:
+        result['status'] = 'NOHASH'
+        return result
     if not url:
-        raise ValidationFailed()
-
-    digest = getattr(hashlib, algorithm)()
-    with closing(urlopen(url)) as f:
-        for chunk in iter(lambda: f.read(CHUNK_SIZE), ''):
-            digest.update(chunk)
-
-    if expected != digest.hexdigest():
-        raise ValidationFailed
-
-
-
-
-
-
-
+        result.update(status='FAILED', error='No URL for datafile')
+        return result
+    start = time.time()
+    try:
+        with closing(urlopen(url)) as f:
+            digests, size, _ = compute_checksums(f, algorithms=(algorithm,))
+    except IOError as e:
+        result.update(status='FAILED', error=str(e))
+        return result
+    result.update(bytes=size, seconds=time.time() - start)
+    if digests[algorithm] == expected.lower():
+        result['status'] = 'OK'
+    else:
+        result.update(status='FAILED', error='%s mismatch' % algorithm)
+    return result
@@ -0,0 +1,92 @@
+"""
+Management utility to fold existing datafiles into the content-addressed
+store used by DeduplicatingFileSystemStorage.
+
+Each verified local datafile is re-hashed, linked into the blob for its
+SHA-512 digest (unless that blob already exists), pointed at the blob and
+then removed from its old location.  Files whose contents no longer match
+their recorded digest are left alone.
+"""
+
+import os
+from contextlib import closing
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from tardis.tardis_portal.checksums import compute_checksums
+from tardis.tardis_portal.models import Dataset_File, StoredBlob
+from tardis.tardis_portal.storage import adopt_blob, is_blob, purge_blobs
+
+
+class Command(BaseCommand):
+
+    help = 'Moves local datafiles into the deduplicated blob store.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--dataset', dest='dataset', type='int',
+            help='Only fold datafiles in this dataset'),
+        make_option('--dry-run', dest='dry_run', default=False,
+            action='store_true',
+            help="Only report the space which would be saved, don't "
+                 "move anything"),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        dry_run = options.get('dry_run')
+        datafiles = Dataset_File.objects.filter(verified=True) \
+                                        .exclude(sha512sum='') \
+                                        .order_by('id')
+        if options.get('dataset'):
+            datafiles = datafiles.filter(dataset__id=options['dataset'])
+
+        seen = set()
+        folded = duplicates = saved = 0
+        for datafile in datafiles.iterator():
+            if not datafile.is_local() or is_blob(datafile.url):
+                continue
+            filepath = datafile.get_absolute_filepath()
+            try:
+                size = os.path.getsize(filepath)
+            except OSError:
+                self.stdout.write("%d/%s: missing\n" %
+                                  (datafile.dataset_id, datafile))
+                continue
+            sha512sum = datafile.sha512sum.lower()
+            duplicate = sha512sum in seen or \
+                StoredBlob.objects.filter(sha512sum=sha512sum).exists()
+            seen.add(sha512sum)
+            if not dry_run:
+                if not self._fold(datafile, filepath, sha512sum, size):
+                    self.stdout.write("%d/%s: checksum mismatch, skipped\n" %
+                                      (datafile.dataset_id, datafile))
+                    continue
+                # The blob is committed, so the original can go
+                os.remove(filepath)
+                if verbosity > 1:
+                    self.stdout.write("%d/%s: %s\n" % (datafile.dataset_id,
+                                                       datafile,
+                                                       datafile.url))
+            folded += 1
+            if duplicate:
+                duplicates += 1
+                saved += size
+        if not dry_run:
+            purge_blobs()
+        if verbosity > 0:
+            self.stdout.write("%s %d files, %d duplicates (%d bytes "
+                              "saved)\n" %
+                              ('Would fold' if dry_run else 'Folded',
+                               folded, duplicates, saved))
+
+    @transaction.commit_on_success
+    def _fold(self, datafile, filepath, sha512sum, size):
+        with closing(open(filepath, 'rb')) as f:
+            digests, _, _ = compute_checksums(f, algorithms=('sha512',))
+        if digests['sha512'] != sha512sum:
+            return False
+        datafile.url = adopt_blob(filepath, sha512sum, size)
+        # Update directly, so post-save filters don't run again
+        Dataset_File.objects.filter(pk=datafile.pk).update(url=datafile.url)
+        return True
@@ -0,0 +1,130 @@
+"""
+Management utility to (re)build the single search index of datafiles.
+
+Datafiles are indexed in batches: the parameters, datasets and
+experiments of each batch are fetched in a few queries, and its documents
+sent to Solr together.  With --processes, batches are indexed by a pool of
+worker processes, each with its own database connection.  Nothing is
+cached between batches, so memory use doesn't grow with the index.
+
+With --dirty, only the datafiles affected by changes marked since they
+were last indexed are reindexed, which is usually done as the changes
+are made.
+"""
+
+import time
+from itertools import imap
+from multiprocessing import Pool
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Max
+from tardis.tardis_portal.models import Dataset_File, SearchIndexMarker
+
+
+class Command(BaseCommand):
+
+    help = 'Indexes datafiles for the single search box in batches.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--dataset', dest='dataset', type='int',
+            help='Only index datafiles in this dataset'),
+        make_option('--experiment', dest='experiment', type='int',
+            help='Only index datafiles in this experiment'),
+        make_option('-j', '--processes', dest='processes', type='int',
+            default=1,
+            help='Number of batches to index concurrently'),
+        make_option('--clear', dest='clear', default=False,
+            action='store_true',
+            help='Remove every datafile from the index first'),
+        make_option('--dirty', dest='dirty', default=False,
+            action='store_true',
+            help='Only reindex datafiles affected by changes since they '
+                 'were last indexed'),
+    )
+
+    def handle(self, *args, **options):
+        # Only importable with the search engine configured
+        from tardis.tardis_portal import search_indexes
+
+        verbosity = int(options.get('verbosity', 1))
+        processes = options.get('processes') or 1
+        if options.get('dirty') and (options.get('clear') or
+                                     options.get('dataset') or
+                                     options.get('experiment')):
+            raise CommandError("--dirty reindexes every change, so can't "
+                               "be combined with --clear, --dataset or "
+                               "--experiment")
+
+        pool = None
+        if processes > 1:
+            # Workers must not inherit the database connection
+            connection.close()
+            pool = Pool(processes)
+        started = time.time()
+        indexed = 0
+        try:
+            mapper = pool.imap_unordered if pool else imap
+            if options.get('dirty'):
+                while True:
+                    marker_ids, datafile_ids = search_indexes.get_changes(
+                        search_indexes.MARKERS_PER_RUN)
+                    if not marker_ids:
+                        break
+                    indexed += self._index(search_indexes, mapper,
+                                           sorted(datafile_ids), verbosity)
+                    search_indexes.clear_markers(marker_ids)
+            else:
+                # Changes made before now are about to be indexed
+                last_marker = SearchIndexMarker.objects \
+                    .aggregate(Max('id'))['id__max']
+                if options.get('clear'):
+                    search_indexes.site.get_index(Dataset_File).clear()
+                indexed = self._index(search_indexes, mapper,
+                                      self._get_datafile_ids(options),
+                                      verbosity)
+                if last_marker and not (options.get('dataset') or
+                                        options.get('experiment')):
+                    SearchIndexMarker.objects \
+                        .filter(id__lte=last_marker).delete()
+            if pool:
+                pool.close()
+                pool.join()
+        finally:
+            if pool:
+                pool.terminate()
+        if verbosity > 0:
+            self.stdout.write("Indexed %d datafiles in %.1fs\n" %
+                              (indexed, time.time() - started))
+
+    def _get_datafile_ids(self, options):
+        datafiles = Dataset_File.objects.all()
+        if options.get('dataset'):
+            datafiles = datafiles.filter(dataset__id=options['dataset'])
+        if options.get('experiment'):
+            datafiles = datafiles.filter(
+                dataset__experiments__id=options['experiment'])
+        return list(datafiles.order_by('id')
+                             .values_list('id', flat=True)
+                             .distinct())
+
+    def _index(self, search_indexes, mapper, datafile_ids, verbosity):
+        batch_size = search_indexes.INDEX_BATCH_SIZE
+        batches = [datafile_ids[i:i + batch_size]
+                   for i in range(0, len(datafile_ids), batch_size)]
+        indexed = 0
+        for count in mapper(_index_batch, batches):
+            indexed += count
+            if verbosity > 1:
+                self.stdout.write("Indexed %d of %d datafiles\n" %
+                                  (indexed, len(datafile_ids)))
+        search_indexes.commit_index()
+        return indexed
+
+
+def _index_batch(datafile_ids):
+    """Index a batch of datafiles.  Run in the worker processes."""
+    from tardis.tardis_portal.search_indexes import index_datafiles
+    # Committed once every batch has been sent
+    return index_datafiles(datafile_ids, commit=False)
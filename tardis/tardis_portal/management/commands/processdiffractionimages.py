@@ -0,0 +1,61 @@
+"""
+Management utility to record the metadata of the diffraction images in
+whole datasets with the DiffractionImageFilter configured in
+POST_SAVE_FILTERS, for images saved before it was, or which it failed on.
+
+Only images without the filter's metadata are read, across a pool of
+--processes worker processes, and their metadata is saved with bulk
+inserts, a batch of images at a time.
+"""
+
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from tardis.tardis_portal.filters import get_filters
+from tardis.tardis_portal.filters.diffractionimage import \
+    DiffractionImageFilter
+from tardis.tardis_portal.models import Dataset
+
+
+class Command(BaseCommand):
+
+    args = '<dataset id> [<dataset id> ...]'
+    help = 'Records the metadata of the diffraction images in datasets.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--experiment', dest='experiment', type='int',
+            help='Process every dataset in this experiment'),
+        make_option('-j', '--processes', dest='processes', type='int',
+            default=1,
+            help='Number of images to read concurrently'),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        filters = [f for f in get_filters().values()
+                   if isinstance(f, DiffractionImageFilter)]
+        if not filters:
+            raise CommandError('No DiffractionImageFilter is configured in '
+                               'POST_SAVE_FILTERS')
+        try:
+            dataset_ids = map(int, args)
+        except ValueError:
+            raise CommandError('Datasets are given by their ids')
+        datasets = Dataset.objects.filter(id__in=dataset_ids)
+        if options.get('experiment'):
+            datasets = Dataset.objects.filter(
+                experiments__id=options['experiment'])
+        elif not dataset_ids:
+            raise CommandError('Give the datasets to process, or '
+                               '--experiment')
+
+        for dataset in datasets.order_by('id'):
+            started = time.time()
+            processed = sum(f.process_dataset(dataset,
+                                              options.get('processes') or 1)
+                            for f in filters)
+            if verbosity > 0:
+                self.stdout.write("Dataset %d: processed %d images in "
+                                  "%.1fs\n" % (dataset.id, processed,
+                                               time.time() - started))
@@ -0,0 +1,73 @@
+"""
+Management utility to record the width, height, format and page count of
+image datafiles verified before they were recorded automatically, so that
+the IIIF views can describe them without decoding them.
+
+Images are recorded by the record_image_info task, so with --queue the
+work is spread over the Celery workers.
+"""
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from tardis.tardis_portal.models import Dataset_File, ImageInfo
+from tardis.tardis_portal.tasks import record_image_info
+
+
+class Command(BaseCommand):
+
+    help = 'Records the dimensions of image datafiles for the IIIF views.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--dataset', dest='dataset', type='int',
+            help='Only record images in this dataset'),
+        make_option('--all', dest='all', default=False,
+            action='store_true',
+            help='Record images again, even if they have been before'),
+        make_option('--queue', dest='queue', default=False,
+            action='store_true',
+            help='Queue the images to be recorded by the Celery workers, '
+                 'rather than recording them here'),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        datafiles = Dataset_File.objects \
+            .filter(Q(mimetype__startswith='image/') | Q(mimetype=''),
+                    verified=True) \
+            .order_by('id')
+        if options.get('dataset'):
+            datafiles = datafiles.filter(dataset__id=options['dataset'])
+        if not options.get('all'):
+            datafiles = datafiles.filter(image_info__isnull=True)
+
+        recorded = failed = 0
+        for datafile in datafiles.iterator():
+            # Those without a mimetype are judged by their extension
+            if not datafile.is_image():
+                continue
+            if options.get('queue'):
+                record_image_info.delay(datafile.id)
+                recorded += 1
+                continue
+            try:
+                info = ImageInfo.record(datafile)
+            except Exception as e:
+                info = None
+                if verbosity > 1:
+                    self.stdout.write("%d/%s: %s\n" % (datafile.dataset_id,
+                                                       datafile, e))
+            if info is None:
+                failed += 1
+                self.stdout.write("%d/%s: could not be read\n" %
+                                  (datafile.dataset_id, datafile))
+                continue
+            recorded += 1
+            if verbosity > 1:
+                self.stdout.write("%d/%s: %s\n" % (datafile.dataset_id,
+                                                   datafile, info))
+        if verbosity > 0:
+            self.stdout.write("%s %d images, %d could not be read\n" %
+                              ('Queued' if options.get('queue')
+                               else 'Recorded', recorded, failed))
@@ -0,0 +1,103 @@
+"""
+Management utility to regenerate the RIF-CS of every experiment in
+OAI_DOCS_PATH, e.g. after changing the RIF-CS providers or templates.
+
+Experiments are published by a pool of --processes worker processes,
+each with its own database connection, or with --queue by the Celery
+workers.  RIF-CS left behind by experiments which no longer exist is
+removed.
+"""
+
+import os
+import re
+import time
+from itertools import imap
+from multiprocessing import Pool
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from tardis.tardis_portal.models import Experiment
+from tardis.tardis_portal.publish.publishservice import remove_rifcs
+
+_RIFCS_FILENAME = re.compile(r'^MyTARDIS-(\d+)\.xml$')
+
+
+class Command(BaseCommand):
+
+    args = '[<experiment id> ...]'
+    help = 'Regenerates the RIF-CS of experiments.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('-j', '--processes', dest='processes', type='int',
+            default=1,
+            help='Number of experiments to publish concurrently'),
+        make_option('--queue', dest='queue', default=False,
+            action='store_true',
+            help='Publish them in Celery tasks instead'),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        processes = options.get('processes') or 1
+        experiment_ids = map(int, args) or \
+            list(Experiment.objects.order_by('id')
+                                   .values_list('id', flat=True))
+        started = time.time()
+        removed = 0
+        if not args:
+            removed = self._remove_stale(set(experiment_ids))
+
+        if options.get('queue'):
+            from tardis.tardis_portal.tasks import publish_rifcs
+            for experiment_id in experiment_ids:
+                publish_rifcs.delay(experiment_id)
+            if verbosity > 0:
+                self.stdout.write("Queued %d experiments, removed %d stale "
+                                  "records\n" % (len(experiment_ids),
+                                                 removed))
+            return
+
+        pool = None
+        if processes > 1:
+            # Workers must not inherit the database connection
+            connection.close()
+            pool = Pool(processes)
+        published = 0
+        try:
+            mapper = pool.imap_unordered if pool else imap
+            for experiment_id in mapper(_publish, experiment_ids):
+                published += 1
+                if verbosity > 1:
+                    self.stdout.write("Published experiment %d (%d of %d)\n"
+                                      % (experiment_id, published,
+                                         len(experiment_ids)))
+            if pool:
+                pool.close()
+                pool.join()
+        finally:
+            if pool:
+                pool.terminate()
+        if verbosity > 0:
+            self.stdout.write("Published %d experiments, removed %d stale "
+                              "records in %.1fs\n" %
+                              (published, removed, time.time() - started))
+
+    def _remove_stale(self, experiment_ids):
+        if not os.path.isdir(settings.OAI_DOCS_PATH):
+            return 0
+        removed = 0
+        for filename in os.listdir(settings.OAI_DOCS_PATH):
+            match = _RIFCS_FILENAME.match(filename)
+            if match and int(match.group(1)) not in experiment_ids:
+                remove_rifcs(settings.OAI_DOCS_PATH, int(match.group(1)))
+                removed += 1
+        return removed
+
+
+def _publish(experiment_id):
+    """Publish an experiment's RIF-CS.  Run in the worker processes."""
+    from tardis.tardis_portal.tasks import publish_rifcs
+    publish_rifcs(experiment_id)
+    return experiment_id
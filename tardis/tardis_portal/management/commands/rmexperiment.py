@@ -19,6 +19,7 @@ from tardis.tardis_portal.models import Author_Experiment, ExperimentACL
 from tardis.tardis_portal.models import ExperimentParameterSet, ExperimentParameter
 from tardis.tardis_portal.models import DatasetParameterSet
 from tardis.tardis_portal.models import DatafileParameterSet
+from tardis.tardis_portal.storage import purge_blobs
 
 class Command(BaseCommand):
     args = '<MyTardis Exp ID>'
@@ -142,6 +143,8 @@ class Command(BaseCommand):
 
             transaction.commit(using=using)
             transaction.leave_transaction_management(using=using)
+            # Only remove shared blobs once the deletion can't be rolled back
+            purge_blobs([df.url for df in uniqueDatafiles])
         except Exception:
             transaction.rollback(using=using)
             exc_class, exc, tb = sys.exc_info()
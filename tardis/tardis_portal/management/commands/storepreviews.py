@@ -0,0 +1,91 @@
+"""
+Management utility to move the preview images filters stored in
+parameters as base64 encoded strings into the file store, leaving only
+their names in the parameters, which the image views then stream.
+
+Parameters are converted a batch at a time, so the command can be stopped
+and run again; previews already in the file store are left alone.
+"""
+
+import binascii
+import imghdr
+from base64 import b64decode
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from tardis.tardis_portal.models import DatafileParameter, \
+    DatasetParameter, ExperimentParameter, ParameterName
+from tardis.tardis_portal.storage import PREVIEW_DIRECTORY, store_preview
+
+BATCH_SIZE = 100
+
+
+class Command(BaseCommand):
+
+    help = 'Moves base64 encoded preview images into the file store.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--dry-run', dest='dry_run', default=False,
+            action='store_true',
+            help='Only count the previews which would be moved'),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        moved = failed = 0
+        for model in (DatafileParameter, DatasetParameter,
+                      ExperimentParameter):
+            # The parameters shown by the image views
+            parameters = model.objects \
+                .filter(name__data_type=ParameterName.STRING,
+                        name__name__endswith='Image') \
+                .exclude(string_value__isnull=True) \
+                .exclude(string_value='') \
+                .exclude(string_value__startswith=PREVIEW_DIRECTORY + '/') \
+                .order_by('id')
+            last_id = 0
+            while True:
+                batch = list(parameters.filter(id__gt=last_id)
+                             .values_list('id', 'string_value')
+                             [:BATCH_SIZE])
+                if not batch:
+                    break
+                last_id = batch[-1][0]
+                if options.get('dry_run'):
+                    moved += len(batch)
+                    continue
+                with transaction.commit_on_success():
+                    for parameter_id, value in batch:
+                        name = self._store(value)
+                        if name is None:
+                            failed += 1
+                            if verbosity > 1:
+                                self.stdout.write(
+                                    "%s %d: not a base64 encoded image\n" %
+                                    (model.__name__, parameter_id))
+                            continue
+                        model.objects.filter(id=parameter_id) \
+                                     .update(string_value=name)
+                        moved += 1
+                if verbosity > 1:
+                    self.stdout.write("%s: moved up to %d\n" %
+                                      (model.__name__, last_id))
+        if verbosity > 0:
+            self.stdout.write("%s %d previews, %d could not be decoded\n" %
+                              ('Would move' if options.get('dry_run')
+                               else 'Moved', moved, failed))
+
+    def _store(self, value):
+        modulo = len(value) % 4
+        if modulo:
+            value += (4 - modulo) * '='
+        try:
+            data = b64decode(value.encode('ascii'))
+        except (TypeError, UnicodeError, binascii.Error):
+            return None
+        extension = imghdr.what(None, data)
+        if not extension:
+            return None
+        return store_preview(data, 'jpg' if extension == 'jpeg'
+                             else extension)
@@ -80,29 +80,235 @@ recommends.
 
 """
 
+import cPickle
 import hashlib
 import logging
+import os
 import re
+import sqlite3
+import tempfile
+from uuid import uuid4
 
-from xml.sax import SAXParseException, ContentHandler
-from xml.sax.handler import feature_namespaces
-from xml.sax import make_parser
+from lxml import etree
+from xml.sax import ContentHandler
 
 from tardis.tardis_portal import metsstruct
 from tardis.tardis_portal import models
 from tardis.tardis_portal.metshandler import store_metadata_value
+from tardis.tardis_portal.models.statistics import update_statistics
 from tardis.tardis_portal.staging import \
     get_sync_root, get_sync_url_and_protocol
 
 from django.conf import settings
+from django.db import connection
 
 
 logger = logging.getLogger(__name__)
 
+# Number of rows written by each bulk insert during an ingest
+INGEST_BATCH_SIZE = getattr(settings, 'METS_INGEST_BATCH_SIZE', 1000)
+
+
+def _getChecksum(obj, type_):
+    # Check if the checksum is of type
+    if obj.checksumType != type_:
+        return ''
+    checksum = obj.checksum.lower()
+    # Ensure the checksum is hexdecimal
+    if not re.match('[0-9a-f]+$', checksum):
+        return ''
+    # Get algorithm
+    try:
+        name = type_.replace('-','').lower()
+        alg = getattr(hashlib, name)
+    except:
+        return ''
+    # Check checksum is the correct length
+    hex_length = alg('').digest_size * 2
+    if hex_length != len(checksum):
+        return ''
+    # Should be valid checksum of given type
+    return checksum
+
+
+# SQLite allows at most this many parameters in a statement
+_SQLITE_MAX_PARAMETERS = 999
+
+
+def _bulkCreate(model, objects, batchSize):
+    # SQLite also allows at most 500 rows in a statement
+    if connection.vendor == 'sqlite':
+        batchSize = min(batchSize, 500,
+                        _SQLITE_MAX_PARAMETERS //
+                        len(model._meta.local_fields))
+    for i in range(0, len(objects), batchSize):
+        model.objects.bulk_create(objects[i:i + batchSize])
+
+
+def _lookupChunkSize(batchSize):
+    # Values looked up with __in at once, leaving room for other conditions
+    if connection.vendor == 'sqlite':
+        return min(batchSize, _SQLITE_MAX_PARAMETERS - 10)
+    return batchSize
+
+
+class MetsDatafileIngester(object):
+    '''Buffers the datafiles, and their parameter sets and parameters, that
+    MetsIngester creates and writes them with bulk inserts.
+
+    Bulk inserts don't send post_save, so the datafiles' post-save hooks
+    (staging, filters) aren't run; their ids are collected in datafileIds
+    so the hooks can be queued once the ingest has been committed.  The
+    dataset and experiment totals are brought up to date as each batch is
+    written.
+
+    '''
+
+    def __init__(self, batchSize=None):
+        self.batchSize = batchSize or INGEST_BATCH_SIZE
+        self.datafileIds = []
+        # Marks the datafiles this ingest inserts until their ids are known
+        self._marker = uuid4().hex
+
+        # (dataset id, filename, size) -> datafile, saved or waiting to be
+        self._datafiles = {}
+        self._loadedDatasets = set()
+        self._pendingDatafiles = []
+        # (datafile, schema, parameters), where parameters is a list of
+        # (ParameterName, values) pairs
+        self._pendingParameterSets = []
+        self._pendingParameterSetKeys = set()
+        self._pendingParameterCount = 0
+
+    def getDatafile(self, dataset, metsDatafile, syncRootDir):
+        '''Return the datafile for metsDatafile, queueing it to be created
+        if the dataset doesn't already have a file of that name and size.
+
+        '''
+        size = long(metsDatafile.size or 0)
+        if dataset.id not in self._loadedDatasets:
+            # Find the files the dataset already has in one query
+            for datafile in dataset.dataset_file_set.all():
+                self._datafiles.setdefault(
+                    (dataset.id, datafile.filename, datafile.size), datafile)
+            self._loadedDatasets.add(dataset.id)
+        key = (dataset.id, metsDatafile.name, size)
+        if key not in self._datafiles:
+            sync_url, proto = get_sync_url_and_protocol(syncRootDir,
+                                                        metsDatafile.url)
+            datafile = models.Dataset_File(
+                dataset=dataset,
+                filename=metsDatafile.name,
+                url=sync_url,
+                size=size,
+                md5sum=_getChecksum(metsDatafile, 'MD5'),
+                sha512sum=_getChecksum(metsDatafile, 'SHA-512'),
+                protocol=proto,
+                ingest_marker=self._marker)
+            logger.info('=== saving datafile: %s' % metsDatafile.name)
+            self._datafiles[key] = datafile
+            self._pendingDatafiles.append(datafile)
+            self._flushIfFull()
+        return self._datafiles[key]
+
+    def addParameterSet(self, datafile, schema, parameters):
+        '''Queue a parameter set for a datafile returned by getDatafile.
+
+        '''
+        key = (id(datafile), schema.id)
+        if key in self._pendingParameterSetKeys:
+            # The new set's id is told apart from the pending one's by
+            # being written later
+            self.flush()
+        self._pendingParameterSets.append((datafile, schema, parameters))
+        self._pendingParameterSetKeys.add(key)
+        self._pendingParameterCount += sum(len(values)
+                                           for _, values in parameters)
+        self._flushIfFull()
+
+    def _flushIfFull(self):
+        if len(self._pendingDatafiles) + len(self._pendingParameterSets) + \
+                self._pendingParameterCount >= self.batchSize:
+            self.flush()
+
+    def flush(self):
+        '''Write everything queued so far.'''
+        self._flushDatafiles()
+        self._flushParameterSets()
+
+    def _flushDatafiles(self):
+        datafiles = self._pendingDatafiles
+        if not datafiles:
+            return
+        self._pendingDatafiles = []
+        _bulkCreate(models.Dataset_File, datafiles, self.batchSize)
+
+        # Bulk inserts don't return ids, so look up the rows this ingest
+        # marked, where the dataset, name and size are unique, and unmark
+        # them for the next batch
+        inserted = models.Dataset_File.objects \
+            .filter(ingest_marker=self._marker)
+        ids = dict(((datasetId, filename, size), id_)
+                   for id_, datasetId, filename, size in inserted
+                   .values_list('id', 'dataset', 'filename', 'size'))
+        inserted.update(ingest_marker=None)
+        byDataset = {}
+        for datafile in datafiles:
+            datafile.id = ids[(datafile.dataset_id, datafile.filename,
+                               datafile.size)]
+            datafile.ingest_marker = None
+            byDataset.setdefault(datafile.dataset_id, []).append(datafile)
+        for datasetId, datasetFiles in byDataset.items():
+            update_statistics(datasetId, len(datasetFiles),
+                              sum(df.size for df in datasetFiles))
+        self.datafileIds.extend(df.id for df in datafiles)
+
+    def _flushParameterSets(self):
+        pending = self._pendingParameterSets
+        if not pending:
+            return
+        self._pendingParameterSets = []
+        self._pendingParameterSetKeys = set()
+        self._pendingParameterCount = 0
+        _bulkCreate(models.DatafileParameterSet,
+                    [models.DatafileParameterSet(schema=schema,
+                                                 dataset_file=datafile)
+                     for datafile, schema, _ in pending],
+                    self.batchSize)
+
+        # Only one of each was written for a datafile and schema, and it is
+        # the newest
+        setIds = {}
+        datafileIds = list(set(datafile.id for datafile, _, _ in pending))
+        chunkSize = _lookupChunkSize(self.batchSize)
+        for i in range(0, len(datafileIds), chunkSize):
+            for id_, datafileId, schemaId in \
+                    models.DatafileParameterSet.objects \
+                    .filter(dataset_file__in=datafileIds[i:i + chunkSize]) \
+                    .values_list('id', 'dataset_file', 'schema'):
+                key = (datafileId, schemaId)
+                setIds[key] = max(id_, setIds.get(key, id_))
+
+        parameters = []
+        for datafile, schema, parameterValues in pending:
+            setId = setIds[(datafile.id, schema.id)]
+            for parameterName, values in parameterValues:
+                for value in values:
+                    if value == '':
+                        continue
+                    parameter = models.DatafileParameter(
+                        parameterset_id=setId, name=parameterName)
+                    if parameterName.isNumeric():
+                        parameter.numerical_value = float(value)
+                    else:
+                        parameter.string_value = value
+                    parameters.append(parameter)
+        _bulkCreate(models.DatafileParameter, parameters, self.batchSize)
+
 
 class MetsDataHolder():
-    '''An instance of this class is used by MetsExperimentStructCreator and
-    MetsMetadataInfoHandler to pass information between each other.
+    '''An instance of this class holds the experiment structure read by
+    MetsExperimentStructCreator.
 
     '''
 
@@ -116,9 +322,9 @@ class MetsDataHolder():
 
 
 class MetsExperimentStructCreator(ContentHandler):
-    '''The METS document parser which creates the experiment structure before
-    the MetsMetadataInfoHandler starts saving the metadata of the experiments,
-    datasets, and datafiles in the database.
+    '''A SAX handler which reads the experiment structure of a METS
+    document, and which metadata belongs to what, without saving anything.
+    parseMets uses MetsIngester, which does both in one pass, instead.
 
     '''
 
@@ -304,589 +510,386 @@ class MetsExperimentStructCreator(ContentHandler):
         pass
 
 
-class MetsMetadataInfoHandler(ContentHandler):
-    '''This parser does the actual database ingestion.
+class _MetsIndex(object):
+    '''A temporary, on-disk index of the metadata (techMD) sections and
+    files of a METS document.
 
-    After the MetsExperimentStructCreator creates the experiment structure,
-    this parser goes through the METS document again to look up which file
-    the metadata belongs to, links the file and metadata and saves an entry of
-    the datafile in the database.
+    The structMap, which says what the metadata and files belong to, comes
+    last in a METS document, so they're kept here until it's reached rather
+    than in memory.
 
     '''
 
-    def __init__(self, holder, tardisExpId, createdBy, syncRootDir):
-        self.holder = holder
+    def __init__(self):
+        fd, self.path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.db = sqlite3.connect(self.path)
+        # The index is thrown away afterwards, so needn't survive a crash
+        self.db.execute('PRAGMA synchronous = OFF')
+        self.db.execute('PRAGMA journal_mode = OFF')
+        self.db.execute('CREATE TABLE entry (kind TEXT, id TEXT, '
+                        'value BLOB, PRIMARY KEY (kind, id))')
+        self.db.execute('CREATE TABLE claim (kind TEXT, id TEXT, '
+                        'PRIMARY KEY (kind, id))')
+
+    def put(self, kind, id_, value):
+        self.db.execute('INSERT OR REPLACE INTO entry VALUES (?, ?, ?)',
+                        (kind, id_, sqlite3.Binary(
+                            cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL))))
+
+    def get(self, kind, id_):
+        row = self.db.execute('SELECT value FROM entry '
+                              'WHERE kind = ? AND id = ?',
+                              (kind, id_)).fetchone()
+        return row and cPickle.loads(str(row[0])) or None
+
+    def claim(self, kind, id_):
+        '''Return True the first time it's called for a kind and id.'''
+        return self.db.execute('INSERT OR IGNORE INTO claim VALUES (?, ?)',
+                               (kind, id_)).rowcount == 1
+
+    def close(self):
+        self.db.close()
+        os.remove(self.path)
+
+
+class MetsIngester(object):
+    '''Saves the experiment, datasets and datafiles described by a METS
+    document, and their metadata, in the database.
+
+    The document is read once, with lxml's iterparse, and each section is
+    discarded once it has been read, so the memory used doesn't grow with
+    the size of the document.  The descriptions (dmdSec) of the experiment
+    and datasets are kept until the structMap is reached; the metadata
+    (techMD) and files go in a _MetsIndex.  The experiment and datasets are
+    saved as their divs in the structMap are reached, and the datafiles as
+    their fptrs are.
+
+    As before, a metadata section referred to by several datasets or
+    datafiles is only saved for the first of them.
+
+    '''
+
+    def __init__(self, tardisExpId, createdBy, syncRootDir, progress=None):
         self.tardisExpId = tardisExpId
         self.createdBy = createdBy
         self.syncRootDir = syncRootDir
+        self.progress = progress
 
-        self.inDmdSec = False
-        self.inName = False
-        self.inInstitution = False
-        self.inAmdSec = False
-        self.inTechMd = False
-        self.grabInstitution = False
-        self.grabTitle = False
-        self.metsObject = None
-        self.grabMightBeAuthor = False
-        self.grabRoleTerm = False
-        self.mightBeAuthor = None
-        self.grabExperimentUrl = False
-        self.grabStartTime = False
-        self.grabEndTime = False
-
-        self.processExperimentStruct = False
-        self.processDatasetStruct = False
-
-        self.processMetadata = False
-
-        # this will hold the techMD ID
-        self.metadataId = None
+        # the number of datasets and datafiles read so far
+        self.datasetCount = 0
+        self.datafileCount = 0
 
+        self.experimentDatabaseId = None
         self.institution = None
-        self.grabAbstract = False
-
-        # a flag to tell if we are now inside techMD's xmlData element
-        self.inXmlData = False
 
-        # holds the current direct xmlData child element we are processing
-        self.xmlDataChildElement = None
+        # dmdSec ID -> the description read from the dmdSec
+        self.descriptions = {}
 
-        self.parameterName = None
-
-        # a cache of the current experiment model object we are processing
+        # the experiment and dataset whose divs we are in
         self.modelExperiment = None
-
-        # a cache of the current dataset model object we are processing
         self.modelDataset = None
+        self.divs = []
+
+        # schemas and their parameter names, looked up once per namespace
+        self.schemaCache = {}
+
+        # writes the datafiles and their metadata in batches
+        self.ingester = MetsDatafileIngester()
+
+    def parse(self, filename):
+        index = _MetsIndex()
+        try:
+            self._parse(filename, index)
+        finally:
+            index.close()
+        self.ingester.flush()
+
+    def _parse(self, filename, index):
+        inStructMap = False
+        xmlDataDepth = 0
+        for event, element in etree.iterparse(filename,
+                                              events=('start', 'end')):
+            elName = etree.QName(element).localname
+
+            if elName == 'xmlData':
+                xmlDataDepth += event == 'start' and 1 or -1
+            if xmlDataDepth > 0:
+                # the metadata is read when its section ends
+                continue
 
-        # a cache of the current datafile being processed
-        self.modelDatafile = None
-
-        # this will hold the URI of the experiment/dataset/datafile
-        # metadata schema
-        self.elementNamespace = None
-
-        # this will be used to temporarily hold the metadata for the
-        # experiment, dataset or datafile
-        self.tempMetadataHolder = {}
-
-        # holds a quick lookup table of all the instantiated Dataset objects
-        # that the new instantiated datafiles will be linked to
-        self.datasetLookupDict = {}
-
-        # the custom parser (or handler) to use for the given metadata
-        self.customHandler = None
-
-    def startElementNS(self, name, qname, attrs):
-        # just get the element name without the namespace
-        elName = name[1]
-
-        if elName == 'dmdSec':
-            self.inDmdSec = True
-
-            structId = _getAttrValueByQName(attrs, 'ID')
-            self.metsObject = self.holder.metsStructMap[structId]
-
-            metsObjectClassName = self.metsObject.__class__.__name__
-
-            if metsObjectClassName == 'Experiment':
-                self.processExperimentStruct = True
-            elif metsObjectClassName == 'Dataset':
-                self.processDatasetStruct = True
-            else:
-                # we'll definitely have only either Experiment or Dataset
-                # object in the metsStructMap, if there are other type of
-                # objects that got saved in the map, we'll throw an exception
-                raise SAXParseException
-
-        elif elName == 'title' and self.inDmdSec:
-            self.grabTitle = True
-
-        elif elName == 'startTime' and self.processExperimentStruct:
-            self.grabStartTime = True
-
-        elif elName == 'endTime' and self.processExperimentStruct:
-            self.grabEndTime = True
-
-        elif elName == 'url' and self.processExperimentStruct:
-            self.grabExperimentUrl = True
-
-        elif elName == 'abstract' and self.processExperimentStruct:
-            self.grabAbstract = True
-            self.metsObject.description = ''
-
-        elif elName == 'name' and self.processExperimentStruct:
-            self.inName = True
-
-        elif elName == 'namePart' and self.inName:
-            self.grabMightBeAuthor = True
-
-        elif elName == 'roleTerm' and self.mightBeAuthor is not None:
-            self.grabRoleTerm = True
-
-        elif elName == 'agent':
-            agentRole = _getAttrValueByQName(attrs, 'ROLE')
-            agentType = _getAttrValueByQName(attrs, 'TYPE')
-            if agentRole == 'DISSEMINATOR' and agentType == 'ORGANIZATION':
-                self.inInstitution = True
-
-        elif elName == 'name' and self.inInstitution:
-            self.grabInstitution = True
-
-        elif elName == 'amdSec':
-            # let's start processing the metadata info..
-            self.inAmdSec = True
-
-        elif elName == 'techMD' and self.inAmdSec:
-            self.inTechMd = True
-            self.metadataId = _getAttrValueByQName(attrs, 'ID')
-            self.processMetadata = True
-
-        elif elName == 'xmlData' and self.inTechMd:
-            self.inXmlData = True
-
-        elif self.xmlDataChildElement is None and self.inXmlData:
-            self.xmlDataChildElement = elName
-
-            # let's reset the tempMetadataHolder dictionary for this new batch
-            # of datafile metadata
-            self.tempMetadataHolder = {}
-            self.elementNamespace = name[0]
-
-            # let's check if there's a custom parser that we should use for
-            # this metadata block (aka parameter set). if there is, use it!
-            from tardis.tardis_portal.metshandler import customHandlers
-            if self.elementNamespace in customHandlers:
-                self.customHandler = customHandlers[self.elementNamespace]
-                self.customHandler.resetMetadataDict()
+            if event == 'start':
+                if elName == 'structMap':
+                    inStructMap = True
+                elif elName == 'div' and inStructMap:
+                    self._startDiv(element, index)
+                continue
 
-        elif self.customHandler is not None:
-            self.customHandler.startElement(elName, attrs)
+            if elName == 'agent':
+                if element.get('ROLE') == 'DISSEMINATOR' and \
+                        element.get('TYPE') == 'ORGANIZATION':
+                    self.institution = _findText(element, 'name')
+
+            elif elName == 'dmdSec':
+                self.descriptions[element.get('ID')] = \
+                    _readDescription(element)
+
+            elif elName == 'techMD':
+                metadata = []
+                for namespace, metadataDict in _readMetadata(element):
+                    try:
+                        self._getSchema(namespace)
+                        metadata.append((namespace, metadataDict))
+                    except models.Schema.DoesNotExist:
+                        logger.warning('unsupported schema being ingested ' +
+                                       namespace)
+                if metadata:
+                    index.put('techMD', element.get('ID'), metadata)
+
+            elif elName == 'file':
+                index.put('file', element.get('ID'), _readFile(element))
+
+            elif elName == 'fptr' and self.modelDataset is not None:
+                self._addDatafile(index, element.get('FILEID'))
+
+            elif elName == 'div' and inStructMap:
+                divType = self.divs.pop()
+                if divType == 'dataset':
+                    self.modelDataset = None
+                elif divType == 'investigation':
+                    self.modelExperiment = None
+
+            elif elName == 'structMap':
+                inStructMap = False
+
+            elif elName not in ('metsHdr', 'amdSec', 'fileGrp', 'fileSec'):
+                # keep the element until the section it's in has been read
+                continue
 
-        elif self.parameterName is None and \
-                self.xmlDataChildElement is not None:
-            # let's save the metadata field name so we can handle it's value
-            # when we see its closing tag...
-            self.parameterName = elName
+            _release(element)
 
-    def endElementNS(self, name, qname):
-        # just get the element name without the namespace
-        elName = name[1]
+    def _startDiv(self, element, index):
+        divType = element.get('TYPE')
+        metadataIds = (element.get('ADMID') or '').split()
+        description = self.descriptions.get(element.get('DMDID'), {})
 
-        if elName == 'dmdSec':
-            self.inDmdSec = False
-            # if we currently processing an experiment structure, let's
-            # save the institution value before we finalise the experiment
-            if self.processExperimentStruct:
-                self.metsObject.institution = self.institution
-
-                # let's save the experiment in the DB
-                if self.tardisExpId:
-                    self.modelExperiment = models.Experiment.objects.get(
-                        pk=self.tardisExpId)
-                else:
-                    self.modelExperiment = models.Experiment()
-                self.modelExperiment.id = self.tardisExpId
-                self.modelExperiment.url = self.metsObject.url
-                self.modelExperiment.approved = True
-                self.modelExperiment.title = self.metsObject.title
-                self.modelExperiment.institution_name = \
-                                            self.metsObject.institution
-                self.modelExperiment.description = self.metsObject.description
-                self.modelExperiment.start_time = self.metsObject.start_time
-                self.modelExperiment.end_time = self.metsObject.end_time
-                self.modelExperiment.created_by = self.createdBy
-
-                self.modelExperiment.save()
-
-                self.holder.experimentDatabaseId = self.modelExperiment.id
-
-                x = 0
-                for author in self.metsObject.authors:
-                    author_experiment = models.Author_Experiment(
-                        experiment=self.modelExperiment,
-                        author=author, order=x)
-                    author_experiment.save()
-                    x = x + 1
-
-            elif self.processDatasetStruct:
-                # let's save the dataset in the DB
-                self.modelDataset = models.Dataset(
-                    description=self.metsObject.title,
-                    immutable=settings.IMMUTABLE_METS_DATASETS)
-                self.modelDataset.save()
-                self.modelDataset.experiments.add(self.modelExperiment)
-                self.modelDataset.save()
-
-                # let's also save the modelDataset in a dictionary so that we
-                # can look it up easily later on when we start processing
-                # the datafiles.
-                self.datasetLookupDict[self.metsObject.id] = self.modelDataset
-
-            self.metsObject = None
+        if divType == 'investigation':
+            # investigation maps to an experiment in the METS world
+            self._saveExperiment(description)
+            for metadataId in metadataIds:
+                for schema, parameterNames, metadataDict in \
+                        self._getMetadata(index, 'experiment', metadataId):
+                    parameterSet = models.ExperimentParameterSet(
+                        schema=schema, experiment=self.modelExperiment)
+                    parameterSet.save()
+                    self._saveParameters('ExperimentParameter',
+                                         parameterNames, metadataDict,
+                                         parameterSet)
+
+        elif divType == 'dataset' and self.modelExperiment is not None:
+            self.modelDataset = models.Dataset(
+                description=description.get('title'),
+                immutable=settings.IMMUTABLE_METS_DATASETS)
+            self.modelDataset.save()
+            self.modelDataset.experiments.add(self.modelExperiment)
+            self.datasetCount += 1
+            self._reportProgress()
+            for metadataId in metadataIds:
+                for schema, parameterNames, metadataDict in \
+                        self._getMetadata(index, 'dataset', metadataId):
+                    parameterSet = models.DatasetParameterSet(
+                        schema=schema, dataset=self.modelDataset)
+                    parameterSet.save()
+                    self._saveParameters('DatasetParameter',
+                                         parameterNames, metadataDict,
+                                         parameterSet)
+
+        self.divs.append(divType)
+
+    def _saveExperiment(self, description):
+        if self.tardisExpId:
+            self.modelExperiment = models.Experiment.objects.get(
+                pk=self.tardisExpId)
+        else:
+            self.modelExperiment = models.Experiment()
+        self.modelExperiment.id = self.tardisExpId
+        self.modelExperiment.url = description.get('url')
+        self.modelExperiment.approved = True
+        self.modelExperiment.title = description.get('title')
+        self.modelExperiment.institution_name = self.institution
+        self.modelExperiment.description = description.get('description')
+        self.modelExperiment.start_time = description.get('startTime')
+        self.modelExperiment.end_time = description.get('endTime')
+        self.modelExperiment.created_by = self.createdBy
+        self.modelExperiment.save()
+
+        self.experimentDatabaseId = self.modelExperiment.id
+
+        for order, author in enumerate(description.get('authors', [])):
+            models.Author_Experiment(experiment=self.modelExperiment,
+                                     author=author, order=order).save()
+
+    def _addDatafile(self, index, fileId):
+        metsDatafile = index.get('file', fileId)
+        if metsDatafile is None:
+            raise ValueError('no file with the ID %s' % fileId)
+        logger.info('=== found datafile: %s' % metsDatafile.name)
+
+        modelDatafile = self.ingester.getDatafile(
+            self.modelDataset, metsDatafile, self.syncRootDir)
+        self.datafileCount += 1
+        if self.datafileCount % self.ingester.batchSize == 0:
+            self._reportProgress()
+        for metadataId in metsDatafile.metadataIds or []:
+            for schema, parameterNames, metadataDict in \
+                    self._getMetadata(index, 'datafile', metadataId):
+                # queue a new parameter set for the metadata
+                self.ingester.addParameterSet(
+                    modelDatafile, schema,
+                    [(parameterName, metadataDict[parameterName.name])
+                     for parameterName in parameterNames
+                     if parameterName.name in metadataDict])
+
+    def _reportProgress(self):
+        if self.progress is not None:
+            self.progress('parsing', self.datasetCount, self.datafileCount)
+
+    def _getMetadata(self, index, kind, metadataId):
+        '''Return (schema, parameter names, metadata) for each parameter set
+        in a metadata section, unless it has already been used for the kind
+        of object.
 
-            self.processExperimentStruct = False
-            self.processDatasetStruct = False
+        '''
+        metadata = index.get('techMD', metadataId)
+        if metadata is None or not index.claim(kind, metadataId):
+            return []
+        return [self._getSchema(namespace) + (metadataDict,)
+                for namespace, metadataDict in metadata]
 
-        elif elName == 'title' and self.inDmdSec:
-            self.grabTitle = False
-
-        elif elName == 'startTime' and self.processExperimentStruct:
-            self.grabStartTime = False
-
-        elif elName == 'endTime' and self.processExperimentStruct:
-            self.grabEndTime = False
-
-        elif elName == 'url' and self.processExperimentStruct:
-            self.grabExperimentUrl = False
-
-        elif elName == 'abstract' and self.processExperimentStruct:
-            self.grabAbstract = False
-
-        elif elName == 'name' and self.processExperimentStruct:
-            self.inName = False
-
-        elif elName == 'namePart' and self.inName:
-            self.grabMightBeAuthor = False
-
-        elif elName == 'roleTerm' and self.inName:
-            self.grabRoleTerm = False
-            self.mightBeAuthor = None
-
-        elif elName == 'name' and self.inInstitution:
-            self.grabInstitution = False
-
-        elif elName == 'agent':
-            self.inInstitution = False
-
-        elif elName == 'amdSec':
-
-            # we're done processing the metadata entries
-            self.inAmdSec = False
-
-            # let's reset the cached experiment model object
-            self.modelExperiment = None
-
-            logger.info(self.holder.metadataMap)
-            for mdId in self.holder.metadataMap:
-                if mdId.startswith('NOMD-'):
-                    df = self.holder.metadataMap[mdId][0]
-
-                    if df.dataset.id in self.datasetLookupDict:
-                        # look up the dataset this file belongs to
-                        thisFilesDataset = self.datasetLookupDict[
-                            df.dataset.id]
-
-                        size = df.size
-
-                        if not df.size:
-                            size = 0
-
-                        def checksum(obj, type_):
-                            # Check if the checksum is of type
-                            if obj.checksumType != type_:
-                                return ''
-                            checksum = obj.checksum.lower()
-                            # Ensure the checksum is hexdecimal
-                            if not re.match('[0-9a-f]+$', checksum):
-                                return ''
-                            # Get algorithm
-                            try:
-                                name = type_.replace('-','').lower()
-                                alg = getattr(hashlib, name)
-                            except:
-                                return ''
-                            # Check checksum is the correct length
-                            hex_length = alg('').digest_size * 2
-                            if hex_length != len(checksum):
-                                return ''
-                            # Should be valid checksum of given type
-                            return checksum
-                
-                        sync_url, proto = get_sync_url_and_protocol(
-                                            get_sync_root(),
-                                            df.url)
-                
-                        self.modelDatafile = models.Dataset_File(
-                            dataset=thisFilesDataset,
-                            filename=df.name,
-                            url=sync_url,
-                            size=size,
-                            md5sum=checksum(df, 'MD5'),
-                            sha512sum=checksum(df,
-                                               'SHA-512'),
-                            protocol=proto)
-                
-                        logger.info('=== saving datafile: %s' % df.name)
-                        self.modelDatafile.save()            
-
-        elif elName == 'techMD' and self.inAmdSec:
-            self.inTechMd = False
-            self.metadataId = None
-            self.metsObject = None
-            self.processMetadata = False
-
-        elif elName == 'xmlData' and self.inTechMd:
-            self.inXmlData = False
-
-        elif elName != self.xmlDataChildElement and \
-                self.customHandler is not None:
-            self.customHandler.endElement(elName)
-
-        elif elName == self.xmlDataChildElement and self.inXmlData:
-
-            if self.customHandler is not None:
-                self.tempMetadataHolder = self.customHandler.metadataDict            
+    def _getSchema(self, namespace):
+        '''Return the schema with the given namespace and its parameter
+        names, raising Schema.DoesNotExist if there isn't one.
 
+        '''
+        if namespace not in self.schemaCache:
             try:
-                schema = models.Schema.objects.get(
-                    namespace__exact=self.elementNamespace)
-
+                schema = models.Schema.objects.get(namespace__exact=namespace)
                 # get the associated parameter names for the given schema
-                parameterNames = \
-                    models.ParameterName.objects.filter(
-                    schema__namespace__exact=schema.namespace).order_by('id')
-
-                # let's create a trigger holder which we can use to check
-                # if we still need to create another parameterset entry in the
-                # DB
-                createParamSetFlag = {'experiment': True, 'dataset': True,
-                                      'datafile': True}
-                datasetParameterSet = None
-                datafileParameterSet = None
-
-                if self.metadataId  in self.holder.metadataMap:
-                    for metsObject in self.holder.metadataMap[self.metadataId]:
-                        self.metsObject = metsObject
-
-                        metsObjectClassName = self.metsObject.__class__.__name__
-
-                        if metsObjectClassName == 'Experiment':
-                            if createParamSetFlag['experiment']:
-                                # create a new parameter set for the metadata
-                                parameterSet = \
-                                    models.ExperimentParameterSet(
-                                    schema=schema,
-                                    experiment=self.modelExperiment)
-                                parameterSet.save()
-
-                                # now let's process the experiment parameters
-                                for parameterName in parameterNames:
-                                    if parameterName.name in \
-                                            self.tempMetadataHolder:
-                                        parameterValues = self.tempMetadataHolder[
-                                            parameterName.name]
-                                        self._saveParameters('ExperimentParameter',
-                                                parameterName, parameterValues,
-                                                parameterSet)
-
-                                createParamSetFlag['experiment'] = False
-
-                            else:
-                                # this is not even allowed as there's only going
-                                # to be one experiment per METS file
-                                raise Exception('forbidden state!')
-
-                        elif metsObjectClassName == 'Dataset':
-                            if createParamSetFlag['dataset']:
-                                dataset = self.datasetLookupDict[
-                                    self.metsObject.id]
-
-                                # create a new parameter set for the
-                                # dataset metadata
-                                datasetParameterSet = \
-                                    models.DatasetParameterSet(schema=schema,
-                                    dataset=dataset)
-
-                                datasetParameterSet.save()
-
-                                # now let's process the dataset parameters
-                                for parameterName in parameterNames:
-                                    if parameterName.name in \
-                                            self.tempMetadataHolder:
-                                        parameterValues = self.tempMetadataHolder[
-                                            parameterName.name]
-                                        self._saveParameters('DatasetParameter',
-                                                parameterName, parameterValues,
-                                                datasetParameterSet)
-
-                                # disable creation for the next visit
-                                createParamSetFlag['dataset'] = False
-
-                        elif metsObjectClassName == 'Datafile':
-                            # this will be a good time to save the
-                            # "hard" metadata of this datafile so that
-                            # when we start adding "soft" metadata
-                            # parameters to it, we already have an
-                            # entry for it in the DB
-                            logger.info('=== found datafile: %s' % self.metsObject.name)
-
-                            # look up the dataset this file belongs to
-                            thisFilesDataset = self.datasetLookupDict[
-                                self.metsObject.dataset.id]
-
-                            # also check if the file already exists
-                            datafile = thisFilesDataset.dataset_file_set.filter(
-                                filename=self.metsObject.name, size=self.metsObject.size)
-
-
-                            if datafile.count() == 0:
-                                size = self.metsObject.size
-
-                                if not self.metsObject.size:
-                                    size = 0
-
-
-                                def checksum(obj, type_):
-                                    # Check if the checksum is of type
-                                    if obj.checksumType != type_:
-                                        return ''
-                                    checksum = obj.checksum.lower()
-                                    # Ensure the checksum is hexdecimal
-                                    if not re.match('[0-9a-f]+$', checksum):
-                                        return ''
-                                    # Get algorithm
-                                    try:
-                                        name = type_.replace('-','').lower()
-                                        alg = getattr(hashlib, name)
-                                    except:
-                                        return ''
-                                    # Check checksum is the correct length
-                                    hex_length = alg('').digest_size * 2
-                                    if hex_length != len(checksum):
-                                        return ''
-                                    # Should be valid checksum of given type
-                                    return checksum
-
-                                sync_url, proto = get_sync_url_and_protocol(
-                                                    self.syncRootDir,
-                                                    self.metsObject.url)
-
-                                self.modelDatafile = models.Dataset_File(
-                                    dataset=thisFilesDataset,
-                                    filename=self.metsObject.name,
-                                    url=sync_url,
-                                    size=size,
-                                    md5sum=checksum(self.metsObject, 'MD5'),
-                                    sha512sum=checksum(self.metsObject,
-                                                       'SHA-512'),
-                                    protocol=proto)
-
-                                logger.info('=== saving datafile: %s' % self.metsObject.name)
-                                self.modelDatafile.save()
-                            else:
-                                self.modelDatafile = thisFilesDataset.dataset_file_set.get(
-                                    filename=self.metsObject.name, size=self.metsObject.size)
-                            # TODO: we need to note here that we are
-                            # only creating a datafile entry in the DB
-                            # for files that have corresponding
-                            # metadata. if we are to create a file
-                            # entry for files with no metadata, we'll
-                            # need to get the unaccessed datafiles
-                            # from datasetLookupDict.
-
-                            if createParamSetFlag['datafile']:
-                                # create a new parameter set for the metadata
-                                datafileParameterSet = \
-                                    models.DatafileParameterSet(schema=schema,
-                                    dataset_file=self.modelDatafile)
-                                datafileParameterSet.save()
-
-                                # now let's process the datafile parameters
-                                for parameterName in parameterNames:
-                                    if parameterName.name in \
-                                            self.tempMetadataHolder:
-                                        parameterValues = self.tempMetadataHolder[
-                                            parameterName.name]
-                                        self._saveParameters('DatafileParameter',
-                                                parameterName, parameterValues,
-                                                datafileParameterSet)
-                                createParamSetFlag['datafile'] = False
+                parameterNames = list(models.ParameterName.objects.filter(
+                    schema=schema).order_by('id'))
+                self.schemaCache[namespace] = (schema, parameterNames)
+            except models.Schema.DoesNotExist:
+                self.schemaCache[namespace] = None
+        if self.schemaCache[namespace] is None:
+            raise models.Schema.DoesNotExist
+        return self.schemaCache[namespace]
+
+    def _saveParameters(self, parameterTypeClass, parameterNames,
+                        metadataDict, parameterSet):
+        '''Save the metadata fields in the database.'''
+        for parameterName in parameterNames:
+            for parameterValue in metadataDict.get(parameterName.name, []):
+                if parameterValue == '':
+                    continue
+                parameter = getattr(models, parameterTypeClass)(
+                    parameterset=parameterSet, name=parameterName)
+                if parameterName.isNumeric():
+                    parameter.numerical_value = float(parameterValue)
+                else:
+                    parameter.string_value = parameterValue
+                parameter.save()
 
 
-            except models.Schema.DoesNotExist:
-                logger.warning('unsupported schema being ingested ' +
-                    self.elementNamespace)
+def _release(element):
+    # Free an element that has been read, and the siblings before it
+    element.clear()
+    parent = element.getparent()
+    if parent is not None:
+        while element.getprevious() is not None:
+            del parent[0]
 
-            # reset the current xmlData child element so that if a new
-            # parameter set is read, we can process it again
-            self.xmlDataChildElement = None
-            self.customHandler = None
 
-        elif elName == self.parameterName and \
-                self.xmlDataChildElement is not None:
+def _descendants(element, elName):
+    return [child for child in element.iter(etree.Element)
+            if etree.QName(child).localname == elName]
 
-            # reset self.parameterName to None so the next parameter can be
-            # processed
-            self.parameterName = None
 
-    def _saveParameters(self, parameterTypeClass, parameterName,
-                       parameterValues, parameterSet):
-        '''Save the metadata field in the database.
+def _findText(element, elName):
+    '''Return the text of the last descendant with the given name.'''
+    texts = [''.join(child.itertext())
+             for child in _descendants(element, elName)]
+    return texts and texts[-1] or None
 
-        Reference:
-        http://stackoverflow.com/questions/452969/does-python-have-an-equivalent-to-java-class-forname
 
-        '''
-        #logger.debug('saving parameter %s: %s' %
-        #    (parameterName, parameterValue))
-        for parameterValue in parameterValues:
-            if parameterValue == '':
-                continue
-            if parameterName.isNumeric():
-                parameter = \
-                    getattr(models, parameterTypeClass)(
-                    parameterset=parameterSet,
-                    name=parameterName,
-                    string_value=None,
-                    numerical_value=float(parameterValue))
-            else:
-                parameter = \
-                    getattr(models, parameterTypeClass)(
-                    parameterset=parameterSet,
-                    name=parameterName,
-                    string_value=parameterValue,
-                    numerical_value=None)
-            parameter.save()
+def _readDescription(dmdSec):
+    '''Read the title, and for an experiment the other fields, from a
+    dmdSec.
 
-    def characters(self, chars):
-        if self.processExperimentStruct:
-
-            # handle the different experiment fields
-            if self.grabTitle:
-                self.metsObject.title = chars
-            elif self.grabExperimentUrl:
-                self.metsObject.url = chars
-            elif self.grabAbstract:
-                self.metsObject.description += chars
-            elif self.grabMightBeAuthor:
-                self.mightBeAuthor = chars
-            elif self.grabStartTime:
-                self.metsObject.start_time = chars
-            elif self.grabEndTime:
-                self.metsObject.end_time = chars
-
-            # if it's really an author, add the mightBeAuthor into the
-            # experiment's author list
-            elif self.grabRoleTerm and chars == 'author':
-                self.metsObject.authors.append(self.mightBeAuthor)
-
-        elif self.grabInstitution:
-            self.institution = chars
-
-        elif self.processDatasetStruct:
-            if self.grabTitle:
-                self.metsObject.title = chars
-
-        elif self.customHandler is not None:
-            self.customHandler.characters(chars)
-
-        elif chars.strip() != '' and self.parameterName is not None and \
-                self.processMetadata:
-            # save the parameter values in the temporary metadata dictionary
-            store_metadata_value(self.tempMetadataHolder,
-                                 self.parameterName, chars)
+    '''
+    description = {}
+    for field in ('title', 'url', 'startTime', 'endTime'):
+        description[field] = _findText(dmdSec, field)
+    description['description'] = _findText(dmdSec, 'abstract')
+
+    authors = description['authors'] = []
+    for name in _descendants(dmdSec, 'name'):
+        roles = [''.join(roleTerm.itertext())
+                 for roleTerm in _descendants(name, 'roleTerm')]
+        namePart = _findText(name, 'namePart')
+        if 'author' in roles and namePart is not None:
+            authors.append(namePart)
+    return description
+
+
+def _readMetadata(techMD):
+    '''Return (namespace, metadata) for each parameter set in a techMD.'''
+    from tardis.tardis_portal.metshandler import customHandlers
+    metadata = []
+    for xmlData in _descendants(techMD, 'xmlData'):
+        for child in xmlData.iterchildren(etree.Element):
+            namespace = etree.QName(child).namespace
+            if namespace in customHandlers:
+                # let's use the custom handler for this metadata block
+                customHandler = customHandlers[namespace]
+                customHandler.resetMetadataDict()
+                _replay(customHandler, child)
+                metadataDict = customHandler.metadataDict
+            else:
+                metadataDict = {}
+                for parameter in child.iterchildren(etree.Element):
+                    parameterName = etree.QName(parameter).localname
+                    for chars in parameter.itertext():
+                        if chars.strip() != '':
+                            store_metadata_value(metadataDict,
+                                                 parameterName, chars)
+            metadata.append((namespace, metadataDict))
+    return metadata
+
+
+def _replay(handler, element):
+    # Pass what's inside an element to a metshandler custom handler, as
+    # SAX would
+    if element.text:
+        handler.characters(element.text)
+    for child in element.iterchildren(etree.Element):
+        elName = etree.QName(child).localname
+        handler.startElement(elName, child.attrib)
+        _replay(handler, child)
+        handler.endElement(elName)
+        if child.tail:
+            handler.characters(child.tail)
+
+
+def _readFile(element):
+    metadataIds = element.get('ADMID')
+    datafile = metsstruct.Datafile(
+        element.get('ID'), element.get('OWNERID'), element.get('SIZE'),
+        metadataIds is not None and metadataIds.split() or None,
+        element.get('CHECKSUMTYPE'), element.get('CHECKSUM'))
+    for flocat in _descendants(element, 'FLocat'):
+        if flocat.get('LOCTYPE') == 'URL':
+            datafile.url = flocat.get('{http://www.w3.org/1999/xlink}href')
+    return datafile
 
 
 def _getAttrValue(attrs, attrName):
@@ -903,14 +906,21 @@ def _getAttrValueByQName(attrs, attrName):
         return None
 
 
-def parseMets(filename, createdBy, expId=None):
-    '''Parse the METS document using the SAX Parser classes provided in the
-    metsparser module.
+def parseMets(filename, createdBy, expId=None, createdDatafileIds=None,
+              progress=None):
+    '''Parse the METS document, and save what it describes, using the
+    MetsIngester class provided in the metsparser module.
 
     Arguments:
     filename -- path of the document to parse (METS or notMETS)
     created_by -- a User instance
     expid -- the experiment ID to use
+    createdDatafileIds -- a list the ids of the new datafiles are added to,
+        so the caller can queue their post-save hooks with
+        queue_datafile_post_save_hooks once the ingest has been committed.
+        If not given, the hooks are queued when parsing finishes.
+    progress -- a function called, with the phase and the number of datasets
+        and datafiles read so far, as the document is read
 
     Returns:
     The experiment ID
@@ -922,26 +932,22 @@ def parseMets(filename, createdBy, expId=None):
 
     logger.debug('parse experiment id: ' + str(expId))
 
-    parser = make_parser(["drv_libxml2"])
-    parser.setFeature(feature_namespaces, 1)
-    dataHolder = MetsDataHolder()
-
-    # on the first pass, we'll parse the document just so we can
-    # create the experiment's structure
-    parser.setContentHandler(MetsExperimentStructCreator(dataHolder))
-    parser.parse(filename)
-
     # Get the destination directory
     if expId:
         sync_root = get_sync_root(prefix="%d-" % expId)
     else:
         sync_root = get_sync_root()
 
-    # on the second pass, we'll parse the document so that we can tie
-    # the metadata info with the experiment/dataset/datafile objects
-    parser.setContentHandler(
-        MetsMetadataInfoHandler(dataHolder, expId, createdBy, sync_root))
-    parser.parse(filename)
+    # a single pass ties the metadata info with the
+    # experiment/dataset/datafile objects as they are read
+    handler = MetsIngester(expId, createdBy, sync_root, progress)
+    handler.parse(filename)
+
+    if createdDatafileIds is None:
+        from tardis.tardis_portal.tasks import queue_datafile_post_save_hooks
+        queue_datafile_post_save_hooks(handler.ingester.datafileIds)
+    else:
+        createdDatafileIds.extend(handler.ingester.datafileIds)
 
     endParseTime = time.time()
 
@@ -949,4 +955,4 @@ def parseMets(filename, createdBy, expId=None):
     timeDiff = endParseTime - startParseTime
     logger.debug('time difference in seconds: %s' % (timeDiff))
 
-    return (dataHolder.experimentDatabaseId, sync_root)
+    return (handler.experimentDatabaseId, sync_root)
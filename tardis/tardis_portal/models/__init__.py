@@ -51,3 +51,9 @@ from .parameters import DatafileParameter, DatafileParameterSet, \
                         ExperimentParameter, ExperimentParameterSet, \
                         FreeTextSearchField, ParameterName, Schema
 from .token import Token
+from .blob import StoredBlob
+from .upload import ChunkedUpload
+from .registration_job import RegistrationJob
+from .statistics import DatasetStatistics, ExperimentStatistics
+from .image import ImageInfo
+from .search import SearchIndexMarker
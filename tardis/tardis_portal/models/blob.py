@@ -0,0 +1,24 @@
+from django.db import models
+
+
+class StoredBlob(models.Model):
+    """Reference count for a file in the content-addressed store
+
+    :attribute sha512sum: the SHA-512 digest the blob is stored under.
+    :attribute size: the size of the blob in bytes.
+    :attribute refcount: the number of datafiles whose url is this blob.
+
+    Blobs are only created by
+    :class:`tardis.tardis_portal.storage.DeduplicatingFileSystemStorage`
+    and the ``dedupfiles`` management command.
+    """
+
+    sha512sum = models.CharField(max_length=128, unique=True)
+    size = models.BigIntegerField(default=0)
+    refcount = models.IntegerField(default=0)
+
+    class Meta:
+        app_label = 'tardis_portal'
+
+    def __unicode__(self):
+        return '%s (%d references)' % (self.sha512sum, self.refcount)
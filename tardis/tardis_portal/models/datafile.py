@@ -1,4 +1,3 @@
-import hashlib
 from magic import Magic
 from os import path
 from urllib2 import build_opener
@@ -7,7 +6,7 @@ from urlparse import urlparse
 from django.conf import settings
 from django.core.urlresolvers import reverse
 from django.db import models
-from django.db.models import Q
+from django.db.models import Q, Sum
 from django.db.models.signals import pre_save
 from django.core.files.storage import default_storage
 from django.utils import _os
@@ -36,6 +35,8 @@ class Dataset_File(models.Model):
     :attribute modification_time: last modification time of the file
     :attribute mimetype: for example 'application/pdf'
     :attribute md5sum: digest of length 32, containing only hexadecimal digits
+    :attribute ingest_marker: set while a METS ingest bulk inserts the file,
+       to find the rows it inserted
 
     The `protocol` field is only used for rendering the download link, this
     done by insterting the protocol into the url generated to the download
@@ -46,7 +47,7 @@ class Dataset_File(models.Model):
     dataset = models.ForeignKey(Dataset)
     filename = models.CharField(max_length=400)
     url = models.CharField(max_length=400)
-    size = models.CharField(blank=True, max_length=400)
+    size = models.BigIntegerField(null=True, blank=True, db_index=True)
     protocol = models.CharField(blank=True, max_length=10)
     created_time = models.DateTimeField(null=True, blank=True)
     modification_time = models.DateTimeField(null=True, blank=True)
@@ -55,6 +56,8 @@ class Dataset_File(models.Model):
     sha512sum = models.CharField(blank=True, max_length=128)
     stay_remote = models.BooleanField(default=False)
     verified = models.BooleanField(default=False)
+    ingest_marker = models.CharField(null=True, blank=True, max_length=32,
+                                     db_index=True)
 
     class Meta:
         app_label = 'tardis_portal'
@@ -64,17 +67,8 @@ class Dataset_File(models.Model):
         """
         Takes a query set of datafiles and returns their total size.
         """
-        def sum_str(*args):
-            def coerce_to_long(x):
-                try:
-                    return long(x)
-                except ValueError:
-                    return 0
-            return sum(map(coerce_to_long, args))
-        # Filter empty sizes, get array of sizes, then reduce
-        return reduce(sum_str, datafiles.exclude(size='')
-                                        .values_list('size', flat=True), 0)
-        
+        return datafiles.aggregate(size=Sum('size'))['size'] or 0
+
     def get_size(self):
         return self.size
 
@@ -266,6 +260,14 @@ class Dataset_File(models.Model):
 
     def deleteCompletely(self):
         import os
+        from tardis.tardis_portal.storage import is_blob, purge_blobs
+        if is_blob(self.url):
+            # Deleting releases this datafile's reference to a shared blob,
+            # which is only removed if nothing else refers to it
+            url = self.url
+            self.delete()
+            purge_blobs([url])
+            return
         filename = self.get_absolute_filepath()
         os.remove(filename)
         self.delete()
@@ -283,32 +285,17 @@ class Dataset_File(models.Model):
         if not (allowEmptyChecksums or self.sha512sum or self.md5sum):
             return False
 
-        def read_file(sf, tf):
-            logger.info("Downloading %s for verification" % self.url)
-            from contextlib import closing
-            with closing(sf) as f:
-                md5 = hashlib.new('md5')
-                sha512 = hashlib.new('sha512')
-                size = 0
-                mimetype_buffer = ''
-                for chunk in iter(lambda: f.read(32 * sha512.block_size), ''):
-                    size += len(chunk)
-                    if len(mimetype_buffer) < 8096: # Arbitrary memory limit
-                        mimetype_buffer += chunk
-                    md5.update(chunk)
-                    sha512.update(chunk)
-                    if tf:
-                        tf.write(chunk)
-                return (md5.hexdigest(),
-                        sha512.hexdigest(),
-                        size,
-                        mimetype_buffer)
-
         sourcefile = self._get_file()
         if not sourcefile:
             return False
-        md5sum, sha512sum, size, mimetype_buffer = read_file(sourcefile,
-                                                             tempfile)
+        logger.info("Downloading %s for verification" % self.url)
+        from contextlib import closing
+        from tardis.tardis_portal.checksums import compute_checksums
+        with closing(sourcefile) as f:
+            # Limit sniffed mimetype data to an arbitrary memory limit
+            digests, size, mimetype_buffer = \
+                compute_checksums(f, tempfile, header_size=8096)
+        md5sum, sha512sum = digests['md5'], digests['sha512']
 
         if not (self.size and size == int(self.size)):
             if (self.sha512sum or self.md5sum) and not self.size: 
@@ -332,7 +319,7 @@ class Dataset_File(models.Model):
 
         self.md5sum = md5sum.lower()
         self.sha512sum = sha512sum.lower()
-        self.size = str(size)
+        self.size = size
         if not self.mimetype and len(mimetype_buffer) > 0:
             self.mimetype = Magic(mime=True).from_buffer(mimetype_buffer)
         self.verified = True
@@ -73,5 +73,5 @@ class Dataset(models.Model):
     image = property(_get_image)
 
     def get_size(self):
-        from .datafile import Dataset_File
-        return Dataset_File.sum_sizes(self.dataset_file_set)
+        from .statistics import DatasetStatistics
+        return DatasetStatistics.get_for(self).size
@@ -67,11 +67,6 @@ class Experiment(models.Model):
     class Meta:
         app_label = 'tardis_portal'
 
-    def save(self, *args, **kwargs):
-        super(Experiment, self).save(*args, **kwargs)
-        from .hooks import publish_public_expt_rifcs
-        publish_public_expt_rifcs(self)
-
     def getParameterSets(self, schemaType=None):
         """Return the experiment parametersets associated with this
         experiment.
@@ -160,8 +155,8 @@ class Experiment(models.Model):
                                    .filter(IMAGE_FILTER)
 
     def get_size(self):
-        from .datafile import Dataset_File
-        return Dataset_File.sum_sizes(self.get_datafiles())
+        from .statistics import ExperimentStatistics
+        return ExperimentStatistics.get_for(self).size
 
     @classmethod
     def public_access_implies_distribution(cls, public_access_level):
@@ -261,14 +256,6 @@ class Author_Experiment(models.Model):
         blank=True,
         help_text="URL identifier for the author")
 
-    def save(self, *args, **kwargs):
-        super(Author_Experiment, self).save(*args, **kwargs)
-        try:
-            from .hooks import publish_public_expt_rifcs
-            publish_public_expt_rifcs(self.experiment)
-        except StandardError:
-            logger.exception('')
-
     def __unicode__(self):
         return SafeUnicode(self.author) + ' | ' \
             + SafeUnicode(self.experiment.id) + ' | ' \
@@ -1,12 +1,20 @@
 from django.conf import settings
-from django.db.models.signals import post_save, post_delete
+from django.contrib.auth.models import Group, User
+from django.db.models.signals import post_init, post_save, pre_delete, \
+    post_delete, m2m_changed
 from django.dispatch import receiver
 
 from tardis.tardis_portal.staging import StagingHook
 
-from .experiment import Experiment, Author_Experiment
+from .experiment import Experiment, ExperimentACL, Author_Experiment
+from .dataset import Dataset
 from .datafile import Dataset_File
-from .parameters import ExperimentParameter, ExperimentParameterSet
+from .parameters import DatafileParameter, DatafileParameterSet, \
+    DatasetParameter, DatasetParameterSet, ExperimentParameter, \
+    ExperimentParameterSet
+from .access_control import GroupAdmin
+from .search import SearchIndexMarker
+from .statistics import reset_experiment_statistics, update_statistics
 
 import logging
 logger = logging.getLogger(__name__)
@@ -16,8 +24,251 @@ logger = logging.getLogger(__name__)
 staging_hook = StagingHook()
 post_save.connect(staging_hook, sender=Dataset_File)
 
+### Deduplicated store hooks ###
+
+@receiver(post_delete, sender=Dataset_File)
+def release_datafile_blob(sender, **kwargs):
+    # Blobs are only removed from disk by purge_blobs, once the deletion
+    # has been committed
+    from tardis.tardis_portal.storage import release_blob
+    release_blob(kwargs['instance'].url)
+
+### Statistics hooks ###
+
+def _get_statistics_state(datafile):
+    return (datafile.dataset_id, long(datafile.size or 0))
+
+@receiver(post_init, sender=Dataset_File)
+def remember_datafile_statistics(sender, **kwargs):
+    # Keep what the totals were last told about this datafile, so a save
+    # only has to apply the difference
+    datafile = kwargs['instance']
+    if datafile.pk:
+        datafile._statistics_state = _get_statistics_state(datafile)
+
+@receiver(post_save, sender=Dataset_File)
+def update_datafile_statistics(sender, **kwargs):
+    datafile = kwargs['instance']
+    if kwargs.get('bulk_created'):
+        # Counted when they were inserted
+        return
+    old_state = getattr(datafile, '_statistics_state', None)
+    new_state = _get_statistics_state(datafile)
+    if kwargs.get('created'):
+        update_statistics(new_state[0], 1, new_state[1])
+    elif old_state is None:
+        pass
+    elif old_state[0] != new_state[0]:
+        update_statistics(old_state[0], -1, -old_state[1])
+        update_statistics(new_state[0], 1, new_state[1])
+    else:
+        update_statistics(new_state[0], 0, new_state[1] - old_state[1])
+    datafile._statistics_state = new_state
+
+@receiver(post_delete, sender=Dataset_File)
+def remove_datafile_statistics(sender, **kwargs):
+    datafile = kwargs['instance']
+    dataset_id, size = getattr(datafile, '_statistics_state',
+                               _get_statistics_state(datafile))
+    update_statistics(dataset_id, -1, -size)
+
+@receiver(m2m_changed, sender=Dataset.experiments.through)
+def reset_experiment_statistics_on_change(sender, **kwargs):
+    # Experiment totals are recalculated when next needed, once datasets
+    # have been added to or removed from them
+    action = kwargs['action']
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    instance = kwargs['instance']
+    if kwargs['reverse']:
+        experiment_ids = [instance.pk]
+    elif action == 'pre_clear':
+        experiment_ids = list(instance.experiments.values_list('id',
+                                                               flat=True))
+    else:
+        experiment_ids = kwargs['pk_set']
+    reset_experiment_statistics(experiment_ids)
+
+@receiver(pre_delete, sender=Dataset)
+def reset_experiment_statistics_on_delete(sender, **kwargs):
+    dataset = kwargs['instance']
+    reset_experiment_statistics(list(dataset.experiments.values_list('id',
+                                                                     flat=True)))
+
+### Image hooks ###
+
+@receiver(post_init, sender=Dataset_File)
+def remember_datafile_verified(sender, **kwargs):
+    # A new datafile hasn't been processed yet, even if it is created
+    # verified (as uploads are)
+    datafile = kwargs['instance']
+    datafile._was_verified = bool(datafile.pk) and datafile.verified
+
+@receiver(post_save, sender=Dataset_File)
+def queue_image_processing(sender, **kwargs):
+    # Record what the IIIF views need to know about an image, and pre-render
+    # the copies they use, once it is verified
+    datafile = kwargs['instance']
+    was_verified = not kwargs.get('created') and \
+        getattr(datafile, '_was_verified', False)
+    datafile._was_verified = datafile.verified
+    if kwargs.get('raw') or was_verified or not datafile.verified:
+        return
+    if not datafile.is_image():
+        return
+    from tardis.tardis_portal.tasks import generate_image_pyramid, \
+        record_image_info
+    record_image_info.delay(datafile.id)
+    if getattr(settings, 'IIIF_PYRAMID_PATH', None):
+        generate_image_pyramid.delay(datafile.id)
+
+### Search index hooks ###
+
+def mark_for_indexing(kind, object_ids):
+    # Only tracked while single search is on, as nothing else clears the
+    # markers.  Also called for changes made with bulk inserts, which
+    # don't send post_save.
+    if not getattr(settings, 'SINGLE_SEARCH_ENABLED', False):
+        return
+    SearchIndexMarker.mark(kind, object_ids)
+    from tardis.tardis_portal.tasks import queue_search_index_update
+    queue_search_index_update()
+
+@receiver(post_save, sender=Dataset_File)
+@receiver(post_delete, sender=Dataset_File)
+def mark_datafile_for_indexing(sender, **kwargs):
+    if not kwargs.get('raw'):
+        mark_for_indexing(SearchIndexMarker.DATAFILE,
+                           [kwargs['instance'].pk])
+
+@receiver(post_save, sender=Dataset)
+def mark_dataset_for_indexing(sender, **kwargs):
+    if not kwargs.get('raw'):
+        mark_for_indexing(SearchIndexMarker.DATASET,
+                           [kwargs['instance'].pk])
+
+@receiver(post_save, sender=Experiment)
+def mark_experiment_for_indexing(sender, **kwargs):
+    if not kwargs.get('raw'):
+        mark_for_indexing(SearchIndexMarker.EXPERIMENT,
+                           [kwargs['instance'].pk])
+
+@receiver(pre_delete, sender=Experiment)
+def mark_experiment_datasets_for_indexing(sender, **kwargs):
+    # The datasets outlive the experiment
+    experiment = kwargs['instance']
+    mark_for_indexing(SearchIndexMarker.DATASET,
+                       experiment.datasets.values_list('id', flat=True))
+
+@receiver(m2m_changed, sender=Dataset.experiments.through)
+def mark_moved_datasets_for_indexing(sender, **kwargs):
+    action = kwargs['action']
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    instance = kwargs['instance']
+    if not kwargs['reverse']:
+        dataset_ids = [instance.pk]
+    elif action == 'pre_clear':
+        dataset_ids = instance.datasets.values_list('id', flat=True)
+    else:
+        dataset_ids = kwargs['pk_set']
+    mark_for_indexing(SearchIndexMarker.DATASET, dataset_ids)
+
+@receiver(post_save, sender=Author_Experiment)
+@receiver(post_delete, sender=Author_Experiment)
+@receiver(post_save, sender=ExperimentACL)
+@receiver(post_delete, sender=ExperimentACL)
+@receiver(post_save, sender=ExperimentParameterSet)
+@receiver(post_delete, sender=ExperimentParameterSet)
+def mark_experiment_details_for_indexing(sender, **kwargs):
+    if not kwargs.get('raw'):
+        mark_for_indexing(SearchIndexMarker.EXPERIMENT,
+                           [kwargs['instance'].experiment_id])
+
+@receiver(post_save, sender=DatasetParameterSet)
+@receiver(post_delete, sender=DatasetParameterSet)
+def mark_dataset_parameters_for_indexing(sender, **kwargs):
+    if not kwargs.get('raw'):
+        mark_for_indexing(SearchIndexMarker.DATASET,
+                           [kwargs['instance'].dataset_id])
+
+@receiver(post_save, sender=DatafileParameterSet)
+@receiver(post_delete, sender=DatafileParameterSet)
+def mark_datafile_parameters_for_indexing(sender, **kwargs):
+    if not kwargs.get('raw'):
+        mark_for_indexing(SearchIndexMarker.DATAFILE,
+                           [kwargs['instance'].dataset_file_id])
+
+_PARAMETER_OWNERS = {
+    DatafileParameter: (SearchIndexMarker.DATAFILE, DatafileParameterSet,
+                        'dataset_file'),
+    DatasetParameter: (SearchIndexMarker.DATASET, DatasetParameterSet,
+                       'dataset'),
+    ExperimentParameter: (SearchIndexMarker.EXPERIMENT,
+                          ExperimentParameterSet, 'experiment'),
+}
+
+@receiver(post_save, sender=DatafileParameter)
+@receiver(post_delete, sender=DatafileParameter)
+@receiver(post_save, sender=DatasetParameter)
+@receiver(post_delete, sender=DatasetParameter)
+@receiver(post_save, sender=ExperimentParameter)
+@receiver(post_delete, sender=ExperimentParameter)
+def mark_parameter_owner_for_indexing(sender, **kwargs):
+    if kwargs.get('raw') or \
+            not getattr(settings, 'SINGLE_SEARCH_ENABLED', False):
+        return
+    kind, parameterset_model, owner = _PARAMETER_OWNERS[sender]
+    # If the parameter set has gone too, it was marked when it went
+    mark_for_indexing(kind, parameterset_model.objects
+                       .filter(id=kwargs['instance'].parameterset_id)
+                       .values_list(owner, flat=True))
+
+### ACL cache hooks ###
+
+@receiver(post_save, sender=ExperimentACL)
+@receiver(post_delete, sender=ExperimentACL)
+def invalidate_acl_cache(sender, **kwargs):
+    from tardis.tardis_portal.auth import acl_cache
+    acl_cache.invalidate_acls()
+
+@receiver(post_save, sender=GroupAdmin)
+@receiver(post_delete, sender=GroupAdmin)
+def invalidate_group_admin_cache(sender, **kwargs):
+    from tardis.tardis_portal.auth import acl_cache
+    acl_cache.invalidate_groups([kwargs['instance'].user_id])
+
+@receiver(m2m_changed, sender=User.groups.through)
+def invalidate_group_membership_cache(sender, **kwargs):
+    from tardis.tardis_portal.auth import acl_cache
+    action = kwargs['action']
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if kwargs['reverse']:
+        # Users were added to or removed from a group
+        if action == 'pre_clear':
+            user_ids = kwargs['instance'].user_set.values_list('id', flat=True)
+        else:
+            user_ids = kwargs['pk_set']
+    else:
+        user_ids = [kwargs['instance'].id]
+    acl_cache.invalidate_groups(list(user_ids))
+
+@receiver(pre_delete, sender=Group)
+def invalidate_deleted_group_cache(sender, **kwargs):
+    from tardis.tardis_portal.auth import acl_cache
+    acl_cache.invalidate_groups(list(kwargs['instance'].user_set
+                                     .values_list('id', flat=True)))
+
 ### RIF-CS hooks ###
 
+def ensure_doi_exists(experiment):
+    if settings.DOI_ENABLE and experiment.public_access != Experiment.PUBLIC_ACCESS_NONE:
+        doi_url = settings.DOI_BASE_URL + experiment.get_absolute_url()
+        from tardis.tardis_portal.ands_doi import DOIService
+        doi_service = DOIService(experiment)
+        doi_service.get_or_mint_doi(doi_url)
+
 def publish_public_expt_rifcs(experiment):
     try:
         providers = settings.RIFCS_PROVIDERS
@@ -31,38 +282,35 @@ def publish_public_expt_rifcs(experiment):
         logger.error('RIF-CS publish hook failed for experiment %d.'\
                      % experiment.id)
 
+def _queue_rifcs_publish(experiment_id):
+    # The RIF-CS is regenerated in the background, once however many
+    # changes are made to the experiment in quick succession
+    if experiment_id is None:
+        return
+    from tardis.tardis_portal.tasks import queue_rifcs_publish
+    queue_rifcs_publish(experiment_id)
+
 @receiver(post_save, sender=Author_Experiment)
 @receiver(post_delete, sender=Author_Experiment)
 def post_save_author_experiment(sender, **kwargs):
-    author_experiment = kwargs['instance']
-    try:
-        publish_public_expt_rifcs(author_experiment.experiment)
-    except Experiment.DoesNotExist:
-        # If for some reason the experiment is missing, then ignore update
-        pass
+    _queue_rifcs_publish(kwargs['instance'].experiment_id)
 
 @receiver(post_save, sender=ExperimentParameter)
 @receiver(post_delete, sender=ExperimentParameter)
 def post_save_experiment_parameter(sender, **kwargs):
     experiment_param = kwargs['instance']
-    try:
-        publish_public_expt_rifcs(experiment_param.parameterset.experiment)
-    except ExperimentParameterSet.DoesNotExist:
-        # If for some reason the experiment parameter set is missing,
-        # then ignore update
-        pass
+    # If the parameter set has gone too, the experiment was queued then
+    for experiment_id in ExperimentParameterSet.objects \
+            .filter(id=experiment_param.parameterset_id) \
+            .values_list('experiment', flat=True):
+        _queue_rifcs_publish(experiment_id)
+
+@receiver(post_save, sender=ExperimentParameterSet)
+@receiver(post_delete, sender=ExperimentParameterSet)
+def post_save_experiment_parameterset(sender, **kwargs):
+    _queue_rifcs_publish(kwargs['instance'].experiment_id)
 
 @receiver(post_save, sender=Experiment)
 @receiver(post_delete, sender=Experiment)
 def post_save_experiment(sender, **kwargs):
-    experiment = kwargs['instance']
-    publish_public_expt_rifcs(experiment)
-
-@receiver(post_save, sender=Experiment)  # THIS MUST BE DEFINED BEFORE GENERATING RIF-CS
-def ensure_doi_exists(sender, **kwargs):
-    experiment = kwargs['instance']
-    if settings.DOI_ENABLE and experiment.public_access != Experiment.PUBLIC_ACCESS_NONE:
-        doi_url = settings.DOI_BASE_URL + experiment.get_absolute_url()
-        from tardis.tardis_portal.ands_doi import DOIService
-        doi_service = DOIService(experiment)
-        doi_service.get_or_mint_doi(doi_url)
\ No newline at end of file
+    _queue_rifcs_publish(kwargs['instance'].pk)
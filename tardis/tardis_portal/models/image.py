@@ -0,0 +1,97 @@
+from django.db import models
+
+from .datafile import Dataset_File
+
+
+class ImageInfo(models.Model):
+    """What the IIIF views need to know about an image datafile
+
+    :attribute datafile: the image the information is for.
+    :attribute width: the width of the image, in pixels.
+    :attribute height: the height of the image, in pixels.
+    :attribute format: the image format, as named by ImageMagick.
+    :attribute pages: the number of images (pages or frames) in the file.
+    :attribute tile_size: the size of the pre-rendered tiles of the image,
+       if it has any.
+    :attribute scale_factors: how much each level of pre-rendered tiles
+       is reduced by, separated by commas.
+
+    Recorded by the record_image_info task once the image is verified, so
+    that describing the image doesn't mean decoding it.
+    """
+
+    datafile = models.OneToOneField(Dataset_File, related_name='image_info')
+    width = models.PositiveIntegerField()
+    height = models.PositiveIntegerField()
+    format = models.CharField(blank=True, max_length=20)
+    pages = models.PositiveIntegerField(default=1)
+    tile_size = models.PositiveIntegerField(null=True, blank=True)
+    scale_factors = models.CharField(blank=True, max_length=100)
+
+    class Meta:
+        app_label = 'tardis_portal'
+
+    def __unicode__(self):
+        return '%dx%d %s' % (self.width, self.height, self.format)
+
+    def get_scale_factors(self):
+        return [int(n) for n in self.scale_factors.split(',') if n]
+
+    def set_pyramid(self, pyramid):
+        """Record the tiles of the image's :class:`Pyramid`, if it has one."""
+        if pyramid is None:
+            self.tile_size = None
+            self.scale_factors = ''
+            return
+        scale_factors = pyramid.get_scale_factors()
+        self.tile_size = pyramid.tile_size if scale_factors else None
+        self.scale_factors = ','.join(map(str, scale_factors))
+
+    @classmethod
+    def get_for(cls, datafile, pool=None):
+        """
+        Return the information recorded for an image datafile, recording it
+        first if it hasn't been.  Return None if the image can't be read.
+        """
+        try:
+            return cls.objects.get(datafile=datafile)
+        except cls.DoesNotExist:
+            return cls.record(datafile, pool)
+
+    @classmethod
+    def record(cls, datafile, pool=None):
+        """
+        Decode an image datafile and record its information, replacing
+        anything recorded before.  Return None if the image can't be read.
+
+        The image is decoded by pool, a :class:`RenderPool`, if one is given
+        (which raises :class:`RenderPoolBusy` if it is too busy), or else in
+        this process.
+        """
+        file_obj = datafile.get_file()
+        if file_obj is None:
+            return None
+        from tardis.tardis_portal.iiif_pyramid import get_pyramid
+        from tardis.tardis_portal.iiif_render import get_source, \
+            read_image_info, RenderFailed, UnsupportedFormat
+        source = get_source(file_obj)
+        try:
+            if pool is None:
+                values = read_image_info(source)
+            else:
+                values = pool.run(read_image_info, source)
+        except (UnsupportedFormat, RenderFailed):
+            return None
+        info = cls(datafile=datafile, **values)
+        info.set_pyramid(get_pyramid(datafile))
+        values.update(tile_size=info.tile_size,
+                      scale_factors=info.scale_factors)
+        # If it was recorded by someone else in the meantime, get_or_create
+        # returns theirs, which is brought up to date
+        info, created = cls.objects.get_or_create(datafile=datafile,
+                                                  defaults=values)
+        if not created:
+            cls.objects.filter(pk=info.pk).update(**values)
+            for name, value in values.items():
+                setattr(info, name, value)
+        return info
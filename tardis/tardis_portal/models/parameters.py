@@ -358,14 +358,6 @@ class ExperimentParameter(models.Model):
     datetime_value = models.DateTimeField(null=True, blank=True, db_index=True)
     objects = OracleSafeManager()
 
-    def save(self, *args, **kwargs):
-        super(ExperimentParameter, self).save(*args, **kwargs)
-        try:
-            from .hooks import publish_public_expt_rifcs
-            publish_public_expt_rifcs(self.parameterset.experiment)
-        except StandardError:
-            logger.exception('')
-
     def get(self):
         return _getParameter(self)
 
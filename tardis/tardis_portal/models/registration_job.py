@@ -0,0 +1,86 @@
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import models
+
+from .experiment import Experiment
+
+# How long the progress of a running registration is kept in the cache
+_PROGRESS_TIMEOUT = 24 * 60 * 60
+
+
+class RegistrationJob(models.Model):
+    """An experiment registration running in the background
+
+    :attribute job_id: the random identifier clients refer to it by.
+    :attribute experiment: the experiment being registered.
+    :attribute user: the user who submitted the experiment.
+    :attribute filename: where the submitted document is stored.
+    :attribute owners: the usernames or email addresses of the experiment
+       owners, one per line.
+    :attribute origin_id: the experiment's id at the site it came from.
+    :attribute from_url: the site the experiment came from.
+    :attribute status: queued, running, finished or failed.
+    :attribute phase: what the registration is doing.
+    :attribute datasets: the number of datasets created.
+    :attribute datafiles: the number of datafiles created.
+    :attribute sync_path: where the experiment's files are to be synced
+       to, once finished.
+    :attribute error: why the registration failed.
+    """
+
+    STATUS_QUEUED = 'queued'
+    STATUS_RUNNING = 'running'
+    STATUS_FINISHED = 'finished'
+    STATUS_FAILED = 'failed'
+
+    job_id = models.CharField(max_length=32, unique=True)
+    experiment = models.ForeignKey(Experiment)
+    user = models.ForeignKey(User)
+    filename = models.CharField(max_length=400)
+    owners = models.TextField(blank=True)
+    origin_id = models.CharField(blank=True, max_length=400)
+    from_url = models.CharField(blank=True, max_length=400)
+    status = models.CharField(max_length=10, default=STATUS_QUEUED)
+    phase = models.CharField(blank=True, max_length=100)
+    datasets = models.IntegerField(default=0)
+    datafiles = models.IntegerField(default=0)
+    sync_path = models.CharField(blank=True, max_length=400)
+    error = models.TextField(blank=True)
+    created_time = models.DateTimeField(auto_now_add=True)
+    modified_time = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        app_label = 'tardis_portal'
+
+    def __unicode__(self):
+        return '%s (%s)' % (self.experiment, self.status)
+
+    def _progress_key(self):
+        return 'tardis_portal.registration.%s' % self.job_id
+
+    def get_owners(self):
+        return [owner for owner in self.owners.split('\n') if owner]
+
+    def report(self, phase, datasets=None, datafiles=None):
+        """
+        Record what a running registration is doing, and how many datasets
+        and datafiles it has created.  The registration happens in a
+        transaction, so this goes in the cache, where the status of the job
+        can be read from any process sharing it.
+        """
+        self.phase = phase
+        if datasets is not None:
+            self.datasets = datasets
+        if datafiles is not None:
+            self.datafiles = datafiles
+        cache.set(self._progress_key(),
+                  (self.phase, self.datasets, self.datafiles),
+                  _PROGRESS_TIMEOUT)
+
+    def get_progress(self):
+        """Return the phase, and the datasets and datafiles created."""
+        if self.status == self.STATUS_RUNNING:
+            progress = cache.get(self._progress_key())
+            if progress is not None:
+                return progress
+        return (self.phase, self.datasets, self.datafiles)
@@ -0,0 +1,38 @@
+from django.db import models
+
+
+class SearchIndexMarker(models.Model):
+    """A change to something in the search documents of datafiles
+
+    :attribute kind: what changed: a datafile, dataset or experiment.
+    :attribute object_id: the id of what changed.
+    :attribute created_time: when it changed.
+
+    Changes to a dataset or experiment, or to their parameters, mean every
+    datafile in it is to be reindexed.  Markers are removed once the
+    datafiles they cover have been reindexed.
+    """
+
+    DATAFILE = 'datafile'
+    DATASET = 'dataset'
+    EXPERIMENT = 'experiment'
+    __KIND_CHOICES = ((DATAFILE, 'Datafile'),
+                      (DATASET, 'Dataset'),
+                      (EXPERIMENT, 'Experiment'))
+
+    kind = models.CharField(max_length=10, choices=__KIND_CHOICES)
+    object_id = models.IntegerField()
+    created_time = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        app_label = 'tardis_portal'
+
+    def __unicode__(self):
+        return '%s %d' % (self.kind, self.object_id)
+
+    @classmethod
+    def mark(cls, kind, object_ids):
+        """Record that the objects of a kind with the given ids changed."""
+        cls.objects.bulk_create([cls(kind=kind, object_id=object_id)
+                                 for object_id in set(object_ids)
+                                 if object_id is not None])
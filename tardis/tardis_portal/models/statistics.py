@@ -0,0 +1,191 @@
+from django.db import IntegrityError, models, transaction
+from django.db.models import Count, F, Sum
+
+from .dataset import Dataset
+from .experiment import Experiment
+
+
+class DatasetStatistics(models.Model):
+    """Running totals of the datafiles in a dataset
+
+    :attribute dataset: the dataset the totals are for.
+    :attribute datafile_count: the number of datafiles in the dataset.
+    :attribute size: the total size of those datafiles, in bytes.
+
+    Totals are calculated the first time they are asked for, then kept
+    up to date as datafiles are saved and deleted.
+    """
+
+    dataset = models.OneToOneField(Dataset, related_name='statistics')
+    datafile_count = models.IntegerField(default=0)
+    size = models.BigIntegerField(default=0)
+
+    class Meta:
+        app_label = 'tardis_portal'
+
+    def __unicode__(self):
+        return '%d files, %d bytes' % (self.datafile_count, self.size)
+
+    @classmethod
+    def get_for(cls, dataset):
+        if hasattr(dataset, '_preloaded_statistics'):
+            return dataset._preloaded_statistics
+        try:
+            return cls.objects.get(dataset=dataset)
+        except cls.DoesNotExist:
+            totals = dataset.dataset_file_set.aggregate(
+                datafile_count=Count('id'), size=Sum('size'))
+            return _create_statistics(cls, {'dataset': dataset},
+                                      datafile_count=totals['datafile_count'],
+                                      size=totals['size'] or 0)
+
+    @classmethod
+    def load_for(cls, datasets):
+        """
+        Fetch the totals for a page of datasets at once, so that
+        :meth:`get_for` doesn't need to query the database for each one.
+        """
+        def calculate(dataset_ids):
+            from .datafile import Dataset_File
+            totals = Dataset_File.objects.filter(dataset__in=dataset_ids) \
+                                         .values('dataset') \
+                                         .annotate(datafile_count=Count('id'),
+                                                   size=Sum('size'))
+            totals = dict((t['dataset'], t) for t in totals)
+            for dataset_id in dataset_ids:
+                t = totals.get(dataset_id, {})
+                yield cls(dataset_id=dataset_id,
+                          datafile_count=t.get('datafile_count', 0),
+                          size=t.get('size') or 0)
+        _load_statistics(cls, 'dataset', datasets, calculate)
+
+
+class ExperimentStatistics(models.Model):
+    """Running totals of the datasets and datafiles in an experiment
+
+    :attribute experiment: the experiment the totals are for.
+    :attribute dataset_count: the number of datasets in the experiment.
+    :attribute datafile_count: the number of datafiles in the experiment.
+    :attribute size: the total size of those datafiles, in bytes.
+
+    Maintained in the same way as :class:`DatasetStatistics`, except that
+    they are recalculated from scratch after datasets are added to or
+    removed from the experiment.
+    """
+
+    experiment = models.OneToOneField(Experiment, related_name='statistics')
+    dataset_count = models.IntegerField(default=0)
+    datafile_count = models.IntegerField(default=0)
+    size = models.BigIntegerField(default=0)
+
+    class Meta:
+        app_label = 'tardis_portal'
+
+    def __unicode__(self):
+        return '%d datasets, %d files, %d bytes' % \
+            (self.dataset_count, self.datafile_count, self.size)
+
+    @classmethod
+    def get_for(cls, experiment):
+        if hasattr(experiment, '_preloaded_statistics'):
+            return experiment._preloaded_statistics
+        try:
+            return cls.objects.get(experiment=experiment)
+        except cls.DoesNotExist:
+            totals = experiment.get_datafiles().aggregate(
+                datafile_count=Count('id'), size=Sum('size'))
+            return _create_statistics(cls, {'experiment': experiment},
+                                      dataset_count=experiment.datasets.count(),
+                                      datafile_count=totals['datafile_count'],
+                                      size=totals['size'] or 0)
+
+    @classmethod
+    def load_for(cls, experiments):
+        """
+        Fetch the totals for a page of experiments at once, so that
+        :meth:`get_for` doesn't need to query the database for each one.
+        """
+        def calculate(experiment_ids):
+            from .datafile import Dataset_File
+            datasets = Dataset.objects.filter(experiments__in=experiment_ids) \
+                                      .values('experiments') \
+                                      .annotate(dataset_count=Count('id'))
+            datasets = dict((t['experiments'], t['dataset_count'])
+                            for t in datasets)
+            files = Dataset_File.objects \
+                .filter(dataset__experiments__in=experiment_ids) \
+                .values('dataset__experiments') \
+                .annotate(datafile_count=Count('id'), size=Sum('size'))
+            files = dict((t['dataset__experiments'], t) for t in files)
+            for experiment_id in experiment_ids:
+                t = files.get(experiment_id, {})
+                yield cls(experiment_id=experiment_id,
+                          dataset_count=datasets.get(experiment_id, 0),
+                          datafile_count=t.get('datafile_count', 0),
+                          size=t.get('size') or 0)
+        _load_statistics(cls, 'experiment', experiments, calculate)
+
+
+def _create_statistics(cls, key, **totals):
+    # If they were created by someone else in the meantime, get_or_create
+    # returns theirs
+    return cls.objects.get_or_create(defaults=totals, **key)[0]
+
+
+def _load_statistics(cls, field, instances, calculate):
+    """
+    Attach statistics to each of the instances, using one query for those
+    which have been calculated before and a couple more to calculate the
+    rest.  instances may be a queryset, which is left evaluated.
+    """
+    by_id = {}
+    for instance in instances:
+        by_id.setdefault(instance.pk, []).append(instance)
+    if not by_id:
+        return
+
+    def attach(statistics):
+        for instance in by_id.pop(getattr(statistics, field + '_id')):
+            instance._preloaded_statistics = statistics
+
+    for statistics in cls.objects.filter(**{field + '__in': by_id.keys()}):
+        attach(statistics)
+    if not by_id:
+        return
+    missing = list(calculate(by_id.keys()))
+    sid = transaction.savepoint()
+    try:
+        cls.objects.bulk_create(missing)
+        transaction.savepoint_commit(sid)
+    except IntegrityError:
+        # Some were created by someone else in the meantime
+        transaction.savepoint_rollback(sid)
+        missing = cls.objects.filter(**{field + '__in': by_id.keys()})
+    for statistics in missing:
+        attach(statistics)
+
+
+def update_statistics(dataset_id, datafile_count, size):
+    """
+    Add the given number of datafiles and bytes (which may be negative) to
+    the totals of a dataset and the experiments it belongs to.  Totals
+    which haven't been calculated yet are left to be calculated when they
+    are first needed.
+    """
+    if not (datafile_count or size):
+        return
+    changes = {'datafile_count': F('datafile_count') + datafile_count,
+               'size': F('size') + size}
+    DatasetStatistics.objects.filter(dataset__id=dataset_id) \
+                             .update(**changes)
+    ExperimentStatistics.objects.filter(experiment__datasets__id=dataset_id) \
+                                .update(**changes)
+
+
+def reset_experiment_statistics(experiment_ids):
+    """
+    Throw away the totals of the given experiments, so they are
+    recalculated when next needed.
+    """
+    ExperimentStatistics.objects.filter(experiment__id__in=experiment_ids) \
+                                .delete()
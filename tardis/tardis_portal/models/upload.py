@@ -0,0 +1,38 @@
+from django.contrib.auth.models import User
+from django.db import models
+
+from .dataset import Dataset
+
+
+class ChunkedUpload(models.Model):
+    """An upload in progress, written to the store a chunk at a time
+
+    :attribute upload_id: the random identifier clients refer to it by.
+    :attribute dataset: the dataset the finished datafile will belong to.
+    :attribute user: the user who started the upload.
+    :attribute filename: the name of the file being uploaded.
+    :attribute url: where the file is being written, relative to the store.
+    :attribute size: the size of the whole file.
+    :attribute offset: the number of bytes received so far.
+    :attribute chunks: the number of chunks received so far.
+    :attribute md5sum: the expected digest of the whole file, if known.
+    :attribute sha512sum: the expected digest of the whole file, if known.
+    """
+
+    upload_id = models.CharField(max_length=32, unique=True)
+    dataset = models.ForeignKey(Dataset)
+    user = models.ForeignKey(User)
+    filename = models.CharField(max_length=400)
+    url = models.CharField(max_length=400)
+    size = models.BigIntegerField()
+    offset = models.BigIntegerField(default=0)
+    chunks = models.IntegerField(default=0)
+    md5sum = models.CharField(blank=True, max_length=32)
+    sha512sum = models.CharField(blank=True, max_length=128)
+    created_time = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        app_label = 'tardis_portal'
+
+    def __unicode__(self):
+        return '%s (%d/%d bytes)' % (self.filename, self.offset, self.size)
@@ -43,16 +43,24 @@ class PublishService():
             self._remove_rifcs_from_oai_dir(oaipath)    
         
     def _remove_rifcs_from_oai_dir(self, oaipath):    
-        import os
-        filename = os.path.join(oaipath, "MyTARDIS-%s.xml" % self.experiment.id)
-        if os.path.exists(filename):
-            os.remove(filename)
+        remove_rifcs(oaipath, self.experiment.id)
     
     def _write_rifcs_to_oai_dir(self, oaipath):
         from tardis.tardis_portal.xmlwriter import XMLWriter
         xmlwriter = XMLWriter()
-        xmlwriter.write_template_to_dir(oaipath, "MyTARDIS-%s.xml" % self.experiment.id, 
+        xmlwriter.write_template_to_dir(oaipath, get_rifcs_filename(self.experiment.id),
                                         self.get_template(), self.get_context())
 
     def get_template(self):
         return self.provider.get_template(self.experiment)
+
+
+def get_rifcs_filename(experiment_id):
+    return "MyTARDIS-%s.xml" % experiment_id
+
+def remove_rifcs(oaipath, experiment_id):
+    """Remove the published RIF-CS of an experiment, if there is any."""
+    import os
+    filename = os.path.join(oaipath, get_rifcs_filename(experiment_id))
+    if os.path.exists(filename):
+        os.remove(filename)
@@ -38,9 +38,13 @@ search indexes for single search
 '''
 from haystack.indexes import *
 from haystack import site
-from models import Dataset_File, \
-    DatafileParameter, DatasetParameter, ExperimentParameter, \
-    ParameterName, Schema
+from models import Author_Experiment, Dataset, Dataset_File, Experiment, \
+    DatafileParameter, DatasetParameter, ExperimentACL, ExperimentParameter, \
+    FreeTextSearchField, ParameterName, Schema, SearchIndexMarker
+from search_query import PUBLIC_PRINCIPAL, get_principal
+from datetime import date
+from django.conf import settings
+from django.db.models import Q
 from django.db.utils import DatabaseError
 import logging
 from django.template.defaultfilters import slugify
@@ -48,6 +52,12 @@ import re
 
 logger = logging.getLogger(__name__)
 
+# Datafiles prepared and sent to the search engine at a time
+INDEX_BATCH_SIZE = getattr(settings, 'SEARCH_INDEX_BATCH_SIZE', 500)
+
+# Changes reindexed at a time
+MARKERS_PER_RUN = INDEX_BATCH_SIZE * 10
+
 
 #
 # Removes anything unwholesome before text is added to a text field for
@@ -180,151 +190,280 @@ class GetDatasetFileParameters(SearchIndex.__metaclass__):
         
         return super(GetDatasetFileParameters, cls).__new__(cls, name, bases, attrs)
 
-class DatasetFileIndex(RealTimeSearchIndex):
-    
-    __metaclass__ = GetDatasetFileParameters
-    
-    text=CharField(document=True)
-    datafile_filename  = CharField(model_attr='filename')
-    
-    dataset_id_stored = IntegerField(model_attr='dataset__pk', indexed=True) #changed
-    dataset_description = CharField(model_attr='dataset__description')
+class IndexBatch(object):
+    """
+    Everything needed to prepare the search documents of a batch of
+    datafiles, fetched in a few queries.  The text and fields of each
+    dataset and experiment are worked out once per batch.
+    """
 
-    experiment_id_stored = IntegerField(model_attr='dataset__experiment__pk', indexed=True) # changed
-    experiment_description = CharField(model_attr='dataset__experiment__description')
-    experiment_title = CharField(model_attr='dataset__experiment__title')
-    experiment_created_time = DateTimeField(model_attr='dataset__experiment__created_time')
-    experiment_start_time = DateTimeField(model_attr='dataset__experiment__start_time', default=None)
-    experiment_end_time = DateTimeField(model_attr='dataset__experiment__end_time', default=None)
-    experiment_update_time = DateTimeField(model_attr='dataset__experiment__update_time', default=None)
-    experiment_institution_name = CharField(model_attr='dataset__experiment__institution_name', default=None)
-    experiment_creator=CharField(model_attr='dataset__experiment__created_by__username')
-    experiment_institution_name=CharField(model_attr='dataset__experiment__institution_name')
-    experiment_authors = MultiValueField()
-   
-    exp_cache = {}
-    ds_cache = {}
-    exp_param_cache = {}
-    ds_param_cache = {}
-   
-    def get_experiment_text(self, obj, exp):
-        
-        if not exp in self.exp_cache:
+    def __init__(self, datafiles):
+        self.datafiles = list(datafiles)
+        self.ids = set(df.id for df in self.datafiles)
+        dataset_ids = set(df.dataset_id for df in self.datafiles)
+
+        links = list(Dataset.experiments.through.objects
+                     .filter(dataset__in=dataset_ids)
+                     .values_list('dataset', 'experiment'))
+        by_id = dict((e.id, e) for e in Experiment.objects
+                     .filter(id__in=set(e for _, e in links))
+                     .select_related('created_by'))
+        # Each dataset's experiments, earliest first
+        self.experiments = {}
+        for dataset_id, experiment_id in links:
+            self.experiments.setdefault(dataset_id, []) \
+                            .append(by_id[experiment_id])
+        for experiments in self.experiments.values():
+            experiments.sort(key=lambda e: (e.created_time, e.id))
+
+        self.authors = {}
+        for author in Author_Experiment.objects \
+                .filter(experiment__in=by_id.keys()).order_by('order'):
+            self.authors.setdefault(author.experiment_id, []) \
+                        .append(author.author)
+
+        # Who may read each experiment.  ACLs which have expired are left
+        # out, but the searches check the dates of the rest.
+        self.principals = dict((e.id, set([PUBLIC_PRINCIPAL]))
+                               for e in by_id.values() if e.public_access !=
+                               Experiment.PUBLIC_ACCESS_NONE)
+        for experiment_id, plugin_id, entity_id in ExperimentACL.objects \
+                .filter(Q(expiryDate__gte=date.today()) |
+                        Q(expiryDate__isnull=True),
+                        experiment__in=by_id.keys(), canRead=True) \
+                .values_list('experiment', 'pluginId', 'entityId'):
+            self.principals.setdefault(experiment_id, set()) \
+                           .add(get_principal(plugin_id, entity_id))
+
+        self.free_text_names = set(FreeTextSearchField.objects
+                                   .values_list('parameter_name', flat=True))
+        self.datafile_params = self._get_params(
+            DatafileParameter, 'dataset_file', self.ids)
+        self.dataset_params = self._get_params(
+            DatasetParameter, 'dataset', dataset_ids)
+        self.experiment_params = self._get_params(
+            ExperimentParameter, 'experiment', by_id.keys())
+
+        self._dataset_text = {}
+        self._experiment_text = {}
+
+    def __contains__(self, datafile):
+        return datafile.id in self.ids
+
+    def _get_params(self, model, owner, owner_ids):
+        params = {}
+        for par in model.objects \
+                .filter(**{'parameterset__%s__in' % owner: owner_ids,
+                           'name__is_searchable': True}) \
+                .select_related('name__schema', 'parameterset'):
+            owner_id = getattr(par.parameterset, owner + '_id')
+            params.setdefault(owner_id, []).append(par)
+        return params
+
+    def _get_text(self, text_list, params):
+        # Only soft parameters with a FreeTextSearchField go in the text
+        text_list.extend(toIntIfNumeric(par) for par in params
+                         if par.name_id in self.free_text_names)
+        # Always convert to strings as this is a text index
+        return ' '.join(map(cleanText, text_list))
+
+    def get_experiment_text(self, exp):
+        if exp.id not in self._experiment_text:
+            creator = exp.created_by
             text_list = [exp.title, exp.description, exp.institution_name]
-            params = ExperimentParameter.objects.filter(
-                    parameterset__experiment__id=exp.id,
-                    name__is_searchable=True,
-                    name__freetextsearchfield__isnull=False)
-            
-            text_list.extend(map(toIntIfNumeric, params))
-            
-            # add all authors to the free text search
-            text_list.extend(self.prepare_experiment_authors(obj))
-            text_list.extend(self.prepare_experiment_creator(obj))
-            self.exp_cache[exp] = ' '.join(map(cleanText,text_list))
-        
-        return self.exp_cache[exp]
+            # add all authors and the creator to the free text search
+            text_list.extend(self.authors.get(exp.id, []))
+            text_list.extend([creator.first_name, creator.last_name,
+                              creator.username, creator.email])
+            self._experiment_text[exp.id] = self._get_text(
+                text_list, self.experiment_params.get(exp.id, []))
+        return self._experiment_text[exp.id]
+
+    def get_dataset_text(self, ds):
+        if ds.id not in self._dataset_text:
+            self._dataset_text[ds.id] = self._get_text(
+                [ds.description], self.dataset_params.get(ds.id, []))
+        return self._dataset_text[ds.id]
 
-    def get_dataset_text(self, obj, ds):
-        ds = obj.dataset
-        
-        if not ds in self.ds_cache:
-            text_list = [ds.description]
-            params = DatasetParameter.objects.filter(
-                    parameterset__dataset__id=ds.id,
-                    name__is_searchable=True,
-                    name__freetextsearchfield__isnull=False)
-            
-            text_list.extend(map(toIntIfNumeric, params))
-            
-            # Always convert to strings as this is a text index
-            self.ds_cache[ds] = ' '.join(map(cleanText,text_list))
-        return self.ds_cache[ds]
-
-    def get_experiment_params(self, exp):
-        if exp not in self.exp_param_cache:
-            param_dict = {}
-            for par in ExperimentParameter.objects.filter(
-                    parameterset__experiment__pk=exp.id, 
-                    name__is_searchable=True):
-                fn = prepareFieldName(par.name)
-                param_dict[fn] = _getParamValue(par)
-   
-            self.exp_param_cache[exp] = param_dict
-
-        return self.exp_param_cache[exp]
-
-    def get_dataset_params(self, ds):
-        if ds not in self.ds_param_cache:
-            param_dict = {}
-            for par in DatasetParameter.objects.filter(
-                    parameterset__dataset__pk=ds.id, 
-                    name__is_searchable=True):
-                fn = prepareFieldName(par.name)
-                param_dict[fn] = _getParamValue(par)
-            self.ds_param_cache[ds] = param_dict
-
-        return self.ds_param_cache[ds]
-
-    def prepare_experiment_authors(self, obj):
-        return [a.author for a in obj.dataset.experiment.author_experiment_set.all()]
-    
-    def prepare_experiment_creator(self, obj):
-        exp = obj.dataset.experiment 
-        return ' '.join([exp.created_by.first_name, exp.created_by.last_name,\
-                exp.created_by.username, exp.created_by.email]) 
-    
     def prepare(self, obj):
-        self.prepared_data = super(DatasetFileIndex, self).prepare(obj)
-        
-        # 
-        # prepare the free text field and also add all searchable
-        # soft parameters as field-searchable fields
-        #
-        exp = obj.dataset.experiment
+        """
+        Return the text and fields of a datafile's search document which
+        come from its dataset and experiments.
+        """
         ds = obj.dataset
-        text_list = [obj.filename]
-        
-        
-        # Get all searchable soft params for this experiment that
+        experiments = self.experiments.get(ds.id, [])
+        datafile_params = self.datafile_params.get(obj.id, [])
+
+        # Get all searchable soft params for this datafile that
         # appear in the list of soft params to be indexed for
         # full text search
         #
-        # NOTE: soft params that are flagged as not being 
+        # NOTE: soft params that are flagged as not being
         # searchable will be silently ignored even if they
         # have an associated FreeTextSearchField
+        text = [self.get_experiment_text(exp) for exp in experiments]
+        text.append(self.get_dataset_text(ds))
+        text.append(self._get_text([obj.filename], datafile_params))
+        data = {'text': ' '.join(text),
+                'experiment_id_stored': [exp.id for exp in experiments],
+                'experiment_authors': [],
+                'access_principals': sorted(set().union(
+                    *[self.principals.get(exp.id, ()) for exp in experiments]))}
 
-        params = DatafileParameter.objects.filter(
-                parameterset__dataset_file__id=obj.id,
-                name__is_searchable=True,
-                name__freetextsearchfield__isnull=False)
-        
-        text_list.extend(map(toIntIfNumeric, params))
-        
-        exp_text = self.get_experiment_text(obj, exp) 
-        ds_text = self.get_dataset_text(obj, ds)
-       
-        # Always convert to strings as this is a text index
-        df_text  = ' '.join(map(cleanText, text_list))
-        
-        self.prepared_data['text'] = ' '.join([exp_text, ds_text, df_text])
+        # The experiment fields are those of the dataset's first experiment
+        if experiments:
+            exp = experiments[0]
+            data.update({
+                'experiment_description': exp.description,
+                'experiment_title': exp.title,
+                'experiment_created_time': exp.created_time,
+                'experiment_start_time': exp.start_time,
+                'experiment_end_time': exp.end_time,
+                'experiment_update_time': exp.update_time,
+                'experiment_institution_name': exp.institution_name,
+                'experiment_creator': exp.created_by.username,
+                'experiment_authors': self.authors.get(exp.id, [])})
 
         # add all soft parameters listed as searchable as in field search
-        for par in DatafileParameter.objects.filter(
-                parameterset__dataset_file__pk=obj.pk, 
-                name__is_searchable=True):
-            fn = prepareFieldName(par.name)
-            self.prepared_data[fn] = _getParamValue(par) 
-        
-        self.prepared_data.update(self.get_experiment_params(exp))
-        self.prepared_data.update(self.get_dataset_params(ds))
-        
-        for par in DatasetParameter.objects.filter(
-                parameterset__dataset__pk=ds.id, 
-                name__is_searchable=True):
-            fn = prepareFieldName(par.name)
-            self.prepared_data[fn] = _getParamValue(par)
-        
+        for params in [self.experiment_params.get(exp.id, [])
+                       for exp in reversed(experiments)] + \
+                [self.dataset_params.get(ds.id, []), datafile_params]:
+            for par in params:
+                data[prepareFieldName(par.name)] = _getParamValue(par)
+        return data
+
+
+class DatasetFileIndex(SearchIndex):
+
+    __metaclass__ = GetDatasetFileParameters
+
+    text=CharField(document=True)
+    datafile_filename  = CharField(model_attr='filename')
+
+    dataset_id_stored = IntegerField(model_attr='dataset__pk', indexed=True) #changed
+    dataset_description = CharField(model_attr='dataset__description')
+
+    # Datasets may be in several experiments
+    experiment_id_stored = MultiValueField(indexed=True)
+    experiment_description = CharField(null=True)
+    experiment_title = CharField(null=True)
+    experiment_created_time = DateTimeField(null=True)
+    experiment_start_time = DateTimeField(null=True)
+    experiment_end_time = DateTimeField(null=True)
+    experiment_update_time = DateTimeField(null=True)
+    experiment_institution_name = CharField(null=True)
+    experiment_creator = CharField(null=True)
+    experiment_authors = MultiValueField()
+    # Who may read the datafile, through any of its experiments
+    access_principals = MultiValueField(indexed=True)
+
+    def __init__(self, *args, **kwargs):
+        super(DatasetFileIndex, self).__init__(*args, **kwargs)
+        self._batch = None
+
+    # Kept up to date by the search index hooks, which mark what has
+    # changed to be reindexed, rather than as datafiles are saved
+
+    def index_queryset(self):
+        return self.model._default_manager.all().defer(None) \
+                                            .select_related('dataset')
+
+    def update_batch(self, datafiles, commit=True):
+        """
+        Index a batch of datafiles, sending their documents to the search
+        engine together.  Return the :class:`IndexBatch`.
+        """
+        batch = IndexBatch(datafiles)
+        self._batch = batch
+        try:
+            self.backend.update(self, batch.datafiles, commit=commit)
+        finally:
+            self._batch = None
+        return batch
+
+    def prepare(self, obj):
+        self.prepared_data = super(DatasetFileIndex, self).prepare(obj)
+        batch = self._batch
+        if batch is None or obj not in batch:
+            batch = IndexBatch([obj])
+        self.prepared_data.update(batch.prepare(obj))
         return self.prepared_data
 
+
+def _get_identifier(datafile_id):
+    return 'tardis_portal.dataset_file.%d' % datafile_id
+
+def index_datafiles(datafile_ids, commit=True):
+    """
+    Index the datafiles with the given ids, INDEX_BATCH_SIZE at a time, and
+    remove any which no longer exist from the index.  Return the number
+    indexed.
+    """
+    index = site.get_index(Dataset_File)
+    datafile_ids = sorted(set(datafile_ids))
+    indexed = 0
+    for i in range(0, len(datafile_ids), INDEX_BATCH_SIZE):
+        chunk = datafile_ids[i:i + INDEX_BATCH_SIZE]
+        batch = index.update_batch(
+            Dataset_File.objects.filter(id__in=chunk)
+                                .select_related('dataset'),
+            commit=False)
+        indexed += len(batch.datafiles)
+        for datafile_id in set(chunk) - batch.ids:
+            index.backend.remove(_get_identifier(datafile_id), commit=False)
+    if commit and datafile_ids:
+        commit_index()
+    return indexed
+
+def commit_index():
+    """Make the changes sent to the search engine searchable."""
+    site.get_index(Dataset_File).backend.conn.commit()
+
+def get_changes(limit=None):
+    """
+    Return the ids of the oldest limit (or all) :class:`SearchIndexMarker`
+    objects, and of the datafiles they cover.
+    """
+    markers = SearchIndexMarker.objects.order_by('id') \
+                                       .values_list('id', 'kind', 'object_id')
+    if limit:
+        markers = markers[:limit]
+    marker_ids = []
+    object_ids = {}
+    for marker_id, kind, object_id in markers:
+        marker_ids.append(marker_id)
+        object_ids.setdefault(kind, set()).add(object_id)
+
+    datafile_ids = object_ids.get(SearchIndexMarker.DATAFILE, set())
+    # Changes to datasets and experiments cover all their datafiles
+    for kind, lookup in ((SearchIndexMarker.DATASET, 'dataset__in'),
+                         (SearchIndexMarker.EXPERIMENT,
+                          'dataset__experiments__in')):
+        ids = sorted(object_ids.get(kind, []))
+        for i in range(0, len(ids), INDEX_BATCH_SIZE):
+            datafile_ids.update(
+                Dataset_File.objects
+                .filter(**{lookup: ids[i:i + INDEX_BATCH_SIZE]})
+                .values_list('id', flat=True))
+    return marker_ids, datafile_ids
+
+def clear_markers(marker_ids):
+    """Remove markers whose datafiles have been reindexed."""
+    for i in range(0, len(marker_ids), INDEX_BATCH_SIZE):
+        SearchIndexMarker.objects \
+            .filter(id__in=marker_ids[i:i + INDEX_BATCH_SIZE]).delete()
+
+def index_changes():
+    """
+    Reindex the datafiles affected by changes since they were last
+    indexed.  Return the number indexed.
+    """
+    indexed = 0
+    while True:
+        marker_ids, datafile_ids = get_changes(MARKERS_PER_RUN)
+        if not marker_ids:
+            return indexed
+        indexed += index_datafiles(datafile_ids)
+        clear_markers(marker_ids)
+
 site.register(Dataset_File, DatasetFileIndex)
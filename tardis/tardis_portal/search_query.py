@@ -51,3 +51,29 @@ class FacetFixedSearchQuery(SearchQuery):
             self.get_results()
 
         return self._facet_counts
+
+
+# Each search document lists the principals which may read it: everyone,
+# for public experiments, or the user or group of each of its experiments'
+# ACLs which grants read access, as "pluginId:entityId"
+PUBLIC_PRINCIPAL = 'public'
+
+def get_principal(plugin_id, entity_id):
+    return '%s:%s' % (plugin_id, entity_id)
+
+def get_request_principals(request):
+    """Return the principals the requesting user may read documents as."""
+    from tardis.tardis_portal.auth.localdb_auth import django_user
+    principals = [PUBLIC_PRINCIPAL]
+    if request.user.is_authenticated():
+        principals.append(get_principal(django_user, request.user.id))
+        principals.extend(get_principal(name, group)
+                          for name, group in getattr(request, 'groups', []))
+    return principals
+
+def get_access_filter(principals):
+    """Return a filter query for the documents any of principals may read."""
+    def quote(value):
+        return '"%s"' % unicode(value).replace('\\', '\\\\') \
+                                      .replace('"', '\\"')
+    return 'access_principals:(%s)' % ' OR '.join(map(quote, principals))
@@ -185,6 +185,23 @@ def get_staging_path():
     return settings.STAGING_PATH
 
 
+def get_upload_path(dataset, filename):
+    """
+    Returns the path, relative to the file store, that a file uploaded to
+    the dataset would be written to (before any name clashes are resolved)
+    """
+    from django.core.files.storage import default_storage
+
+    # Path on disk can contain subdirectories - but if the request gets tricky with "../" or "/var" or something
+    # we strip them out..
+    try:
+        copyto = path.join(get_dataset_path(dataset), filename)
+        default_storage.path(copyto)
+    except (SuspiciousOperation, ValueError):
+        copyto = path.join(get_dataset_path(dataset), path.basename(filename))
+    return copyto
+
+
 def write_uploaded_file_to_dataset(dataset, uploaded_file_post):
     """
     Writes file POST data to the dataset directory in the file store
@@ -196,17 +213,9 @@ def write_uploaded_file_to_dataset(dataset, uploaded_file_post):
     :rtype: the path of the file written to
     """
 
-    filename = uploaded_file_post.name
-
     from django.core.files.storage import default_storage
 
-    # Path on disk can contain subdirectories - but if the request gets tricky with "../" or "/var" or something
-    # we strip them out..
-    try:
-        copyto = path.join(get_dataset_path(dataset), filename)
-        default_storage.path(copyto)
-    except (SuspiciousOperation, ValueError):
-        copyto = path.join(get_dataset_path(dataset), path.basename(filename))
+    copyto = get_upload_path(dataset, uploaded_file_post.name)
 
     logger.debug("Writing uploaded file %s" % copyto)
 
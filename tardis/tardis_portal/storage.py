@@ -1,6 +1,23 @@
+import errno
+import os
+import re
+from uuid import uuid4
+
 from django.conf import settings
 from django.core.files.storage import FileSystemStorage
 
+# Directory (relative to the file store) which holds content-addressed blobs
+BLOB_DIRECTORY = getattr(settings, 'DEDUP_BLOB_DIRECTORY', 'blobs')
+
+# Directory (relative to the file store) which holds the preview images
+# filters make
+PREVIEW_DIRECTORY = getattr(settings, 'PREVIEW_DIRECTORY', 'previews')
+
+# Exactly the names get_preview_name makes, so parameter values can't name
+# any other file
+_PREVIEW_NAME = re.compile(r'^%s/([0-9a-f]{2})/\1[0-9a-f]{38}\.[a-z0-9]+$' %
+                           re.escape(PREVIEW_DIRECTORY))
+
 class MyTardisLocalFileSystemStorage(FileSystemStorage):
     '''
     Simply changes the FileSystemStorage default store location to the MyTardis
@@ -10,4 +27,199 @@ class MyTardisLocalFileSystemStorage(FileSystemStorage):
     def __init__(self, location=None, base_url=None):
         if location is None:
             location = settings.FILE_STORE_PATH
-        super(MyTardisLocalFileSystemStorage, self).__init__(location, base_url)
\ No newline at end of file
+        super(MyTardisLocalFileSystemStorage, self).__init__(location, base_url)
+
+
+class DeduplicatingFileSystemStorage(MyTardisLocalFileSystemStorage):
+    '''
+    Stores each distinct file once, under its SHA-512 digest, instead of at
+    the name it was saved as.  Saving content which is already in the store
+    just adds a reference to the existing blob, and deleting a blob only
+    removes it once nothing refers to it any more.
+
+    Enable it with::
+
+        DEFAULT_FILE_STORAGE = \\
+            'tardis.tardis_portal.storage.DeduplicatingFileSystemStorage'
+
+    and fold existing files into the store with ``manage.py dedupfiles``.
+    '''
+
+    def _save(self, name, content):
+        from tardis.tardis_portal.checksums import compute_checksums
+        if hasattr(content, 'seek'):
+            content.seek(0)
+        digests, size, _ = compute_checksums(content, algorithms=('sha512',))
+        return store_blob(content, digests['sha512'], size)
+
+    def delete(self, name):
+        if is_blob(name):
+            release_blob(name)
+            purge_blobs([name])
+        else:
+            super(DeduplicatingFileSystemStorage, self).delete(name)
+
+
+def get_blob_name(sha512sum):
+    """
+    Return the store-relative name of the blob holding the given digest.
+    Blobs are spread over two levels of directories so none get too big.
+    """
+    sha512sum = sha512sum.lower()
+    return '/'.join((BLOB_DIRECTORY, sha512sum[:2], sha512sum[2:4],
+                     sha512sum))
+
+def is_blob(name):
+    return name.startswith(BLOB_DIRECTORY + '/')
+
+def _get_blob_path(name):
+    from django.utils import _os
+    return _os.safe_join(settings.FILE_STORE_PATH, name)
+
+def _makedirs(directory):
+    try:
+        os.makedirs(directory)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+def _add_reference(sha512sum, size, write):
+    """
+    Count a new reference to a blob, calling write(path) to put the data
+    in place if the blob isn't already in the store.
+    """
+    from django.db.models import F
+    from tardis.tardis_portal.models import StoredBlob
+    name = get_blob_name(sha512sum)
+    path = _get_blob_path(name)
+    if not os.path.exists(path):
+        _makedirs(os.path.dirname(path))
+        write(path)
+    if not StoredBlob.objects.filter(sha512sum=sha512sum.lower()) \
+                             .update(refcount=F('refcount') + 1):
+        blob, created = StoredBlob.objects.get_or_create(
+            sha512sum=sha512sum.lower(), defaults={'size': size})
+        StoredBlob.objects.filter(pk=blob.pk) \
+                          .update(refcount=F('refcount') + 1)
+    # The blob may have been purged between writing and counting it
+    if not os.path.exists(path):
+        write(path)
+    return name
+
+def store_blob(content, sha512sum, size):
+    """
+    Add a reference to the blob for content, which must have the given
+    digest and size, writing it to the store if it isn't already there.
+    Returns the name of the blob.
+    """
+    def write(path):
+        # Write to a temporary file first, so a half-written blob is
+        # never visible under its digest
+        temp_path = '%s.%s.tmp' % (path, uuid4().hex)
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL |
+                     getattr(os, 'O_BINARY', 0), 0666)
+        try:
+            if hasattr(content, 'seek'):
+                content.seek(0)
+            for chunk in content.chunks():
+                os.write(fd, chunk)
+        finally:
+            os.close(fd)
+        if settings.FILE_UPLOAD_PERMISSIONS is not None:
+            os.chmod(temp_path, settings.FILE_UPLOAD_PERMISSIONS)
+        os.rename(temp_path, path)
+    return _add_reference(sha512sum, size, write)
+
+def adopt_blob(filepath, sha512sum, size):
+    """
+    Add a reference to the blob for the existing file at filepath, linking
+    the file into the store if the blob isn't already there.  The caller is
+    responsible for removing filepath once the reference is committed.
+    Returns the name of the blob.
+    """
+    def write(path):
+        os.link(filepath, path)
+    return _add_reference(sha512sum, size, write)
+
+def release_blob(name):
+    """
+    Drop a reference to a blob.  The blob stays on disk until it is purged,
+    so the release can be rolled back with the transaction it happened in.
+    """
+    from django.db.models import F
+    from tardis.tardis_portal.models import StoredBlob
+    if not is_blob(name):
+        return
+    StoredBlob.objects.filter(sha512sum=os.path.basename(name)) \
+                      .update(refcount=F('refcount') - 1)
+
+def purge_blobs(names=None):
+    """
+    Remove blobs which are no longer referenced from the store.  Only the
+    named blobs are considered, or every blob if names is None.  Returns
+    the number of blobs removed.
+    """
+    from django.db import connection, transaction
+    from tardis.tardis_portal.models import StoredBlob
+    blobs = StoredBlob.objects.filter(refcount__lte=0)
+    if names is not None:
+        blobs = blobs.filter(sha512sum__in=[os.path.basename(name)
+                                            for name in names
+                                            if is_blob(name)])
+    # Deleted with SQL, as only that says whether a row went: a blob may
+    # have been referenced again since it was read, and must then be kept
+    qn = connection.ops.quote_name
+    sql = 'DELETE FROM %s WHERE %s = %%s AND %s <= 0' % \
+        (qn(StoredBlob._meta.db_table), qn(StoredBlob._meta.pk.column),
+         qn('refcount'))
+    cursor = connection.cursor()
+    purged = 0
+    for blob_id, sha512sum in list(blobs.values_list('id', 'sha512sum')):
+        cursor.execute(sql, [blob_id])
+        if not cursor.rowcount:
+            continue
+        try:
+            os.remove(_get_blob_path(get_blob_name(sha512sum)))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        purged += 1
+    transaction.commit_unless_managed()
+    return purged
+
+def get_preview_name(data, extension):
+    """
+    Return the store-relative name of the preview image with the given
+    data, which is named after its SHA-1 digest.
+    """
+    import hashlib
+    digest = hashlib.sha1(data).hexdigest()
+    return '/'.join((PREVIEW_DIRECTORY, digest[:2],
+                     '%s.%s' % (digest, extension)))
+
+def is_preview(name):
+    return bool(name) and _PREVIEW_NAME.match(name) is not None
+
+def get_preview_path(name):
+    if not is_preview(name):
+        raise ValueError('Not the name of a preview: %r' % name)
+    return _get_blob_path(name)
+
+def store_preview(data, extension):
+    """
+    Write the data of a preview image to the store, unless an identical
+    preview is already there, and return its name, which parameters refer
+    to it by.  Previews are shared, so are never removed.
+    """
+    name = get_preview_name(data, extension)
+    path = get_preview_path(name)
+    if not os.path.exists(path):
+        _makedirs(os.path.dirname(path))
+        # As for blobs, a half-written preview is never visible
+        temp_path = '%s.%s.tmp' % (path, uuid4().hex)
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        if settings.FILE_UPLOAD_PERMISSIONS is not None:
+            os.chmod(temp_path, settings.FILE_UPLOAD_PERMISSIONS)
+        os.rename(temp_path, path)
+    return name
@@ -1,11 +1,19 @@
 from celery.task import task
 import os
 from os import path
+from django.conf import settings
+from django.core.cache import cache
 from django.db import transaction
+from django.db.models.signals import post_save
 from django.contrib.auth.models import User
 
+from tardis.tardis_portal.checksums import throughput
+from tardis.tardis_portal.filters import MISSING_TRIES, RETRY_DELAY, \
+    batched, run_filter
+from tardis.tardis_portal.iiif_pyramid import generate_pyramid, get_pyramid
 from tardis.tardis_portal.staging import stage_file
-from tardis.tardis_portal.models import Dataset_File, Dataset
+from tardis.tardis_portal.models import Dataset_File, Dataset, \
+    ImageInfo, RegistrationJob
 from tardis.tardis_portal.staging import get_staging_url_and_size
 from tardis.tardis_portal.email import email_user
 
@@ -25,27 +33,63 @@ try:
 except Exception:
     pass
 
+# Number of datafiles verified together by each verify_datafiles task
+VERIFY_BATCH_SIZE = getattr(settings, 'VERIFY_BATCH_SIZE', 100)
+
+# Number of datafiles each run_datafile_post_save_hooks task handles
+POST_SAVE_HOOKS_BATCH_SIZE = 100
+
+# Seconds changes wait to be reindexed for search, so that a burst of them
+# is indexed together
+SEARCH_INDEX_DELAY = getattr(settings, 'SEARCH_INDEX_DELAY', 30)
+
+_SEARCH_INDEX_QUEUED_KEY = 'search-index-queued'
+
+# Seconds changes to an experiment wait for its RIF-CS to be regenerated,
+# so that a burst of them is published together
+RIFCS_PUBLISH_DELAY = getattr(settings, 'RIFCS_PUBLISH_DELAY', 30)
+
 @task(name="tardis_portal.verify_files", ignore_result=True)
 def verify_files():
-    for datafile in Dataset_File.objects.filter(verified=False).exclude(protocol='staging'):
+    unverified = Dataset_File.objects.filter(verified=False)\
+                                     .exclude(protocol='staging')\
+                                     .only('id', 'protocol', 'url',
+                                           'stay_remote')
+    batch = []
+    for datafile in unverified.iterator():
         if datafile.stay_remote or datafile.is_local():
-            verify_as_remote.delay(datafile.id)
+            batch.append(datafile.id)
+            if len(batch) >= VERIFY_BATCH_SIZE:
+                verify_datafiles.delay(batch)
+                batch = []
         else:
             make_local_copy.delay(datafile.id)
+    if batch:
+        verify_datafiles.delay(batch)
+
+@task(name="tardis_portal.verify_datafiles", ignore_result=True)
+def verify_datafiles(datafile_ids):
+    # Check that we still need to verify - some might have been done already
+    if not Dataset_File.objects.filter(id__in=datafile_ids,
+                                       verified=False).exists():
+        return
+    throughput.reset()
+    for datafile_id in datafile_ids:
+        # Use a transaction for each datafile, so each is only locked while
+        # it is verified and a failure doesn't undo the rest of the batch
+        with transaction.commit_on_success():
+            # Get datafile locked for write (to prevent concurrent actions),
+            # re-checking after the lock (concurrency paranoia)
+            datafiles = Dataset_File.objects.select_for_update()\
+                                            .filter(id=datafile_id,
+                                                    verified=False)
+            for datafile in datafiles:
+                datafile.verify()
+    throughput.log()
 
 @task(name="tardis_portal.verify_as_remote", ignore_result=True)
 def verify_as_remote(datafile_id):
-    datafile = Dataset_File.objects.get(id=datafile_id)
-    # Check that we still need to verify - it might have been done already
-    if datafile.verified:
-        return
-    # Use a transaction for safety
-    with transaction.commit_on_success():
-        # Get datafile locked for write (to prevent concurrent actions)
-        datafile = Dataset_File.objects.select_for_update().get(id=datafile.id)
-        # Second check after lock (concurrency paranoia)
-        if not datafile.verified:
-            datafile.verify()
+    verify_datafiles([datafile_id])
 
 @task(name="tardis_portal.make_local_copy", ignore_result=True)
 def make_local_copy(datafile_id):
@@ -61,6 +105,126 @@ def make_local_copy(datafile_id):
         if not datafile.is_local():
             stage_file(datafile)
 
+@task(name="tardis_portal.generate_image_pyramid", ignore_result=True)
+def generate_image_pyramid(datafile_id, tries=1):
+    datafile = _get_verified_datafile(generate_image_pyramid, datafile_id,
+                                      tries)
+    if datafile and generate_pyramid(datafile):
+        # Advertise the new tiles
+        for info in ImageInfo.objects.filter(datafile=datafile):
+            info.set_pyramid(get_pyramid(datafile))
+            info.save()
+
+@task(name="tardis_portal.record_image_info", ignore_result=True)
+def record_image_info(datafile_id, tries=1):
+    datafile = _get_verified_datafile(record_image_info, datafile_id, tries)
+    if datafile:
+        ImageInfo.record(datafile)
+
+def _get_verified_datafile(task, datafile_id, tries):
+    # The task was queued as the datafile was saved verified, which may not
+    # have been committed yet, so look again in a while if it isn't
+    try:
+        datafile = Dataset_File.objects.get(id=datafile_id)
+    except Dataset_File.DoesNotExist:
+        datafile = None
+    if datafile is not None and datafile.verified:
+        return datafile
+    if tries < MISSING_TRIES:
+        task.apply_async(args=[datafile_id, tries + 1],
+                         countdown=RETRY_DELAY)
+    return None
+
+@task(name="tardis_portal.run_datafile_post_save_hooks", ignore_result=True)
+def run_datafile_post_save_hooks(datafile_ids):
+    # Bulk inserts don't send post_save, so send it now for the staging hook
+    # and post-save filters.  bulk_created tells receivers which have
+    # already been taken care of (like the statistics) to ignore it.
+    with batched():
+        for datafile in Dataset_File.objects.filter(id__in=datafile_ids):
+            post_save.send(sender=Dataset_File, instance=datafile,
+                           created=True, raw=False, using=datafile._state.db,
+                           bulk_created=True)
+
+def queue_datafile_post_save_hooks(datafile_ids):
+    """
+    Queue the post-save hooks of bulk-inserted datafiles, in batches.  Call
+    this once the datafiles have been committed.
+    """
+    datafile_ids = list(datafile_ids)
+    for i in range(0, len(datafile_ids), POST_SAVE_HOOKS_BATCH_SIZE):
+        run_datafile_post_save_hooks.delay(
+            datafile_ids[i:i + POST_SAVE_HOOKS_BATCH_SIZE])
+
+@task(name="tardis_portal.run_post_save_filter", ignore_result=True)
+def run_post_save_filter(filter_name, datafile_ids, tries=1):
+    missing = run_filter(filter_name, datafile_ids)
+    if missing is None:
+        # The filter is as busy as it may be
+        run_post_save_filter.apply_async(
+            args=[filter_name, datafile_ids, tries], countdown=RETRY_DELAY)
+    elif missing and tries < MISSING_TRIES:
+        # They may not have been committed yet
+        run_post_save_filter.apply_async(
+            args=[filter_name, missing, tries + 1], countdown=RETRY_DELAY)
+
+@task(name="tardis_portal.index_search_changes", ignore_result=True)
+def index_search_changes():
+    # Only importable with the search engine configured
+    from tardis.tardis_portal.search_indexes import index_changes
+    index_changes()
+
+def queue_search_index_update():
+    """
+    Queue the changes marked for reindexing to be indexed in
+    SEARCH_INDEX_DELAY seconds, unless that has already been queued, so
+    that a burst of changes is indexed together.
+    """
+    if cache.add(_SEARCH_INDEX_QUEUED_KEY, True, SEARCH_INDEX_DELAY):
+        index_search_changes.apply_async(countdown=SEARCH_INDEX_DELAY)
+
+@task(name="tardis_portal.publish_rifcs", ignore_result=True)
+def publish_rifcs(experiment_id):
+    from tardis.tardis_portal.models import Experiment
+    from tardis.tardis_portal.models.hooks import ensure_doi_exists, \
+        publish_public_expt_rifcs
+    from tardis.tardis_portal.publish.publishservice import remove_rifcs
+    # Changes from now on need publishing again
+    cache.delete(_get_rifcs_queued_key(experiment_id))
+    try:
+        experiment = Experiment.objects.get(id=experiment_id)
+    except Experiment.DoesNotExist:
+        remove_rifcs(settings.OAI_DOCS_PATH, experiment_id)
+        return
+    # The DOI is part of the RIF-CS
+    ensure_doi_exists(experiment)
+    publish_public_expt_rifcs(experiment)
+
+def _get_rifcs_queued_key(experiment_id):
+    return 'rifcs-publish-queued:%d' % experiment_id
+
+def queue_rifcs_publish(experiment_id):
+    """
+    Queue an experiment's RIF-CS to be regenerated in RIFCS_PUBLISH_DELAY
+    seconds, unless that has already been queued, so that it is only
+    regenerated once for a burst of changes, and once they have been
+    committed.  It is only taken to be queued for RIFCS_PUBLISH_DELAY
+    seconds, so that changes are never missed if the worker's clearing of
+    that doesn't reach this process's cache.
+    """
+    # Foreign keys can be set to ids from URLs, which are strings
+    experiment_id = int(experiment_id)
+    if cache.add(_get_rifcs_queued_key(experiment_id), True,
+                 RIFCS_PUBLISH_DELAY):
+        publish_rifcs.apply_async(args=[experiment_id],
+                                  countdown=RIFCS_PUBLISH_DELAY)
+
+@task(name="tardis_portal.register_experiment", ignore_result=True)
+def register_experiment(job_id):
+    # views imports this module
+    from tardis.tardis_portal.views import _runRegistrationJob
+    _runRegistrationJob(RegistrationJob.objects.get(id=job_id))
+
 @task(name="tardis_portal.create_staging_datafiles", ignore_result=True)
 def create_staging_datafiles(files, user_id, dataset_id, is_secure):
 
@@ -7,21 +7,25 @@ from django.contrib.humanize.templatetags.humanize import naturalday
 
 from tardis.tardis_portal.util import render_mustache
 from tardis.tardis_portal.views import get_dataset_info
-from tardis.tardis_portal.models.dataset import Dataset
+from tardis.tardis_portal.models import DatasetStatistics
 
 register = template.Library()
 
 @register.filter
 def dataset_tiles(experiment, include_thumbnails):
     datasets = experiment.datasets.all()
-    
+    # Fetch all the badge totals in one go
+    DatasetStatistics.load_for(datasets)
+
     # Get data to template (used by JSON service too)
-    data = ( get_dataset_info(ds, bool(include_thumbnails)) for ds in datasets )
+    data = ( (ds, get_dataset_info(ds, bool(include_thumbnails)))
+             for ds in datasets )
 
     class DatasetInfo(object):
 
-        def __init__(self, **data):
+        def __init__(self, dataset, **data):
             self.__dict__.update(data)
+            self._dataset = dataset
 
         def experiment_badge(self):
             count = len(self.experiments);
@@ -31,20 +35,18 @@ def dataset_tiles(experiment, include_thumbnails):
             })
 
         def dataset_size_badge(self):
-            ds = Dataset.objects.get(id=self.id)
-            return dataset_size_badge(ds)
+            return dataset_size_badge(self._dataset)
 
         def dataset_datafiles_badge(self):
-            ds = Dataset.objects.get(id=self.id)
-            return dataset_datafiles_badge(ds)
+            return dataset_datafiles_badge(self._dataset)
 
 
     class DatasetsInfo(object):
         # Generator which renders a dataset at a time
         def datasets(self):
-            for ds in data:
+            for ds, info in data:
                 yield render_mustache('tardis_portal/dataset_tile',
-                                      DatasetInfo(**ds))
+                                      DatasetInfo(ds, **info))
 
     # Render template
     return render_mustache('tardis_portal/dataset_tiles', DatasetsInfo())
@@ -65,7 +67,7 @@ def dataset_datafiles_badge(dataset):
     """
     Displays an badge with the number of datafiles for this experiment
     """
-    count = dataset.dataset_file_set.count()
+    count = DatasetStatistics.get_for(dataset).datafile_count
     return render_mustache('tardis_portal/badges/datafile_count', {
         'title': "%d file%s" % (count, pluralize(count)),
         'count': count,
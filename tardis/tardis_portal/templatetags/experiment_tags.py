@@ -2,6 +2,7 @@ from django import template
 from django.conf import settings
 from django.template.defaultfilters import pluralize, filesizeformat
 from django.contrib.humanize.templatetags.humanize import naturalday
+from tardis.tardis_portal.models import ExperimentStatistics
 from tardis.tardis_portal.util import get_local_time
 
 from tardis.tardis_portal.util import render_mustache,\
@@ -29,7 +30,7 @@ def experiment_datasets_badge(experiment):
     """
     Displays an badge with the number of datasets for this experiment
     """
-    count = experiment.datasets.all().count()
+    count = ExperimentStatistics.get_for(experiment).dataset_count
     return render_mustache('tardis_portal/badges/dataset_count', {
         'title': "%d dataset%s" % (count, pluralize(count)),
         'count': count,
@@ -40,7 +41,7 @@ def experiment_datafiles_badge(experiment):
     """
     Displays an badge with the number of datafiles for this experiment
     """
-    count = experiment.get_datafiles().count()
+    count = ExperimentStatistics.get_for(experiment).datafile_count
     return render_mustache('tardis_portal/badges/datafile_count', {
         'title': "%d file%s" % (count, pluralize(count)),
         'count': count,
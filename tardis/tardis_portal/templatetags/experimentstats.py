@@ -1,15 +1,15 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 from django import template
-from tardis.tardis_portal.models import Dataset_File
-from django.db.models import Sum
+from tardis.tardis_portal.models import Experiment, ExperimentStatistics
 
 register = template.Library()
 
 
 @register.filter
 def experiment_file_count(value):
-    return Dataset_File.objects.filter(dataset__experiments__pk=value).count()
+    # Only the id is needed to look up the totals
+    return ExperimentStatistics.get_for(Experiment(pk=value)).datafile_count
 
 # @register.filter
 # def experiment_file_size(value):....
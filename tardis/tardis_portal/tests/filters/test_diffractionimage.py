@@ -0,0 +1,97 @@
+import os
+import shutil
+import stat
+from os import path
+from tempfile import mkdtemp
+
+from compare import expect
+from django.conf import settings
+from django.test import TestCase
+
+from tardis.tardis_portal.filters.diffractionimage import make_filter
+from tardis.tardis_portal.models import Dataset, Dataset_File, \
+    DatafileParameter, DatafileParameterSet, ParameterName, Schema
+from tardis.tardis_portal.storage import get_preview_path, is_preview
+
+SCHEMA = 'http://www.tardis.edu.au/schemas/trdDatafile/1'
+
+# Stand-ins for the CCP4 programs
+DIFFDUMP = '''#!/bin/sh
+echo "Image type : ADSC"
+echo "Exposure time : 1.5 s"
+'''
+DIFF2JPEG = '''#!/bin/sh
+echo preview > "$2"
+'''
+
+
+class DiffractionImageFilterTestCase(TestCase):
+
+    def setUp(self):
+        self.tmpdir = mkdtemp()
+        self._file_store_path = settings.FILE_STORE_PATH
+        settings.FILE_STORE_PATH = path.join(self.tmpdir, 'store')
+        programs = []
+        for name, script in (('diffdump', DIFFDUMP),
+                             ('diff2jpeg', DIFF2JPEG)):
+            program = path.join(self.tmpdir, name)
+            with open(program, 'w') as f:
+                f.write(script)
+            os.chmod(program, stat.S_IRWXU)
+            programs.append(program)
+        self.filter = make_filter('DIFFRACTION', SCHEMA, *programs,
+                                  extensions=['img'])
+
+        schema = Schema.objects.create(namespace=SCHEMA, name='Diffraction',
+                                       type=Schema.DATAFILE)
+        for name, data_type in (('imageType', ParameterName.STRING),
+                                ('exposureTime', ParameterName.NUMERIC),
+                                ('previewImage', ParameterName.STRING)):
+            ParameterName.objects.create(schema=schema, name=name,
+                                         full_name=name,
+                                         data_type=data_type)
+
+        self.dataset = Dataset.objects.create(description='Frames')
+        for filename in ('frame1.img', 'frame2.img', 'notes.txt'):
+            filepath = path.join(self.tmpdir, filename)
+            with open(filepath, 'w') as f:
+                f.write(filename)
+            Dataset_File.objects.create(dataset=self.dataset,
+                                        filename=filename,
+                                        url='file://' + filepath, size=1)
+
+    def tearDown(self):
+        settings.FILE_STORE_PATH = self._file_store_path
+        shutil.rmtree(self.tmpdir)
+
+    def testProcessDataset(self):
+        expect(self.filter.process_dataset(self.dataset)).to_equal(2)
+        parametersets = DatafileParameterSet.objects.filter(
+            dataset_file__dataset=self.dataset)
+        expect(sorted(ps.dataset_file.filename for ps in parametersets)) \
+            .to_equal(['frame1.img', 'frame2.img'])
+        params = DatafileParameter.objects.filter(
+            parameterset=parametersets[0])
+        expect(params.get(name__name='imageType').string_value) \
+            .to_equal('ADSC')
+        expect(params.get(name__name='exposureTime').numerical_value) \
+            .to_equal(1.5)
+        # Previews are written to the file store
+        preview = params.get(name__name='previewImage').string_value
+        expect(is_preview(preview)).to_be_truthy()
+        with open(get_preview_path(preview)) as f:
+            expect(f.read()).to_equal('preview\n')
+
+        # Images are only processed once
+        expect(self.filter.process_dataset(self.dataset)).to_equal(0)
+        expect(parametersets.count()).to_equal(2)
+
+    def testEveryFileByDefault(self):
+        self.filter.extensions = None
+        expect(self.filter.process_dataset(self.dataset)).to_equal(3)
+
+    def testPostSave(self):
+        datafile = Dataset_File.objects.get(filename='frame1.img')
+        self.filter(Dataset_File, instance=datafile, created=True)
+        expect(DatafileParameterSet.objects.filter(dataset_file=datafile)
+               .count()).to_equal(1)
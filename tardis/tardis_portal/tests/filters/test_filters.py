@@ -0,0 +1,101 @@
+from collections import OrderedDict
+
+from compare import expect
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.test import TestCase
+
+from tardis.tardis_portal import filters
+from tardis.tardis_portal.filters import accepts, batched
+from tardis.tardis_portal.models import Dataset, Dataset_File
+
+
+class _RecordingFilter(object):
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+        self.seen = []
+
+    def __call__(self, sender, **kwargs):
+        self.seen.append(kwargs['instance'].filename)
+
+
+class _BatchFilter(_RecordingFilter):
+
+    def process_batch(self, datafiles):
+        self.seen.append(sorted(df.filename for df in datafiles))
+
+
+class _LimitedFilter(_RecordingFilter):
+
+    concurrency = 1
+
+
+class FilterFrameworkTestCase(TestCase):
+
+    def setUp(self):
+        self._filters = filters._filters
+        self.text = _RecordingFilter(mimetypes=['text/plain'])
+        self.images = _BatchFilter(mimetypes=['image/'], extensions=['img'])
+        filters._filters = OrderedDict([('text', self.text),
+                                        ('images', self.images)])
+        self.dataset = Dataset.objects.create(description='Filtered')
+
+    def tearDown(self):
+        filters._filters = self._filters
+
+    def _create(self, filename, mimetype=''):
+        return Dataset_File.objects.create(dataset=self.dataset,
+                                           filename=filename,
+                                           url='file://%s' % filename,
+                                           mimetype=mimetype, size=1)
+
+    def testAccepts(self):
+        notes = Dataset_File(filename='notes.txt', mimetype='text/plain')
+        frame = Dataset_File(filename='frame.IMG')
+        photo = Dataset_File(filename='photo', mimetype='image/png')
+        expect(accepts(self.text, notes)).to_be_truthy()
+        expect(accepts(self.text, frame)).to_be_falsy()
+        expect(accepts(self.images, frame)).to_be_truthy()
+        expect(accepts(self.images, photo)).to_be_truthy()
+        expect(accepts(self.images, notes)).to_be_falsy()
+        # Filters which don't say are interested in everything
+        expect(accepts(_RecordingFilter(), frame)).to_be_truthy()
+
+    def testConcurrencyNeedsSharedCache(self):
+        # The test settings' cache isn't shared
+        post_save_filters = getattr(settings, 'POST_SAVE_FILTERS', None)
+        settings.POST_SAVE_FILTERS = [(__name__ + '._LimitedFilter',)]
+        filters._filters = None
+        try:
+            expect(filters.get_filters).to_raise(ImproperlyConfigured)
+        finally:
+            if post_save_filters is None:
+                del settings.POST_SAVE_FILTERS
+            else:
+                settings.POST_SAVE_FILTERS = post_save_filters
+
+    def testRunOnCreationAndChange(self):
+        datafile = self._create('notes.txt', 'text/plain')
+        expect(self.text.seen).to_equal(['notes.txt'])
+        expect(self.images.seen).to_equal([])
+
+        # Saves which don't change the file don't run filters again
+        datafile = Dataset_File.objects.get(id=datafile.id)
+        datafile.size = 2
+        datafile.save()
+        expect(self.text.seen).to_equal(['notes.txt'])
+
+        datafile.url = 'file://moved/notes.txt'
+        datafile.save()
+        expect(self.text.seen).to_equal(['notes.txt', 'notes.txt'])
+
+    def testBatched(self):
+        with batched():
+            for filename in ('frame1.img', 'frame2.img'):
+                self._create(filename)
+            self._create('notes.txt', 'text/plain')
+            # Nothing runs until the batch is complete
+            expect(self.images.seen).to_equal([])
+        expect(self.images.seen).to_equal([['frame1.img', 'frame2.img']])
+        expect(self.text.seen).to_equal(['notes.txt'])
@@ -0,0 +1,110 @@
+from compare import expect
+from django.contrib.auth.models import Group, User
+from django.core.cache import get_cache
+from django.test import TestCase
+from django.test.client import RequestFactory
+
+from tardis.tardis_portal.auth import AuthService, acl_cache
+from tardis.tardis_portal.auth import decorators as authz
+from tardis.tardis_portal.auth.localdb_auth import django_group, django_user
+from tardis.tardis_portal.models import Experiment, ExperimentACL, GroupAdmin
+from tardis.tardis_portal.tests.test_authservice import MockSettings
+
+
+class ACLCacheTestCase(TestCase):
+
+    def setUp(self):
+        # The test settings disable caching, so a local memory cache stands
+        # in for a shared one
+        self._cache = acl_cache.cache
+        self._is_cache_shared = acl_cache.is_cache_shared
+        acl_cache.cache = get_cache(
+            'django.core.cache.backends.locmem.LocMemCache')
+        acl_cache.cache.clear()
+        acl_cache.is_cache_shared = lambda cache: True
+        self.user = User.objects.create_user('testuser', 'user@email.test',
+                                             'pwd')
+        self.group = Group.objects.create(name='cached')
+        self.experiment = Experiment.objects.create(title='Cached',
+                                                    created_by=self.user)
+        settings = MockSettings()
+        settings.GROUP_PROVIDERS = (
+            'tardis.tardis_portal.auth.localdb_auth.DjangoGroupProvider',
+            'tardis.tardis_portal.auth.ip_auth.IPGroupProvider')
+        self.auth_service = AuthService(settings=settings)
+
+    def tearDown(self):
+        acl_cache.cache = self._cache
+        acl_cache.is_cache_shared = self._is_cache_shared
+
+    def _request(self):
+        request = RequestFactory().get('/', REMOTE_ADDR='127.0.0.1')
+        request.user = self.user
+        request.groups = self.auth_service.getGroups(request)
+        return request
+
+    def _django_groups(self):
+        return [group for name, group in self._request().groups
+                if name == django_group]
+
+    def testGroupsCached(self):
+        self.user.groups.add(self.group)
+        expect(self._django_groups()).to_equal([self.group.id])
+        with self.assertNumQueries(0):
+            self._django_groups()
+
+        # Membership changes are seen straight away, from either side
+        self.user.groups.remove(self.group)
+        expect(self._django_groups()).to_equal([])
+        self.group.user_set.add(self.user)
+        expect(self._django_groups()).to_equal([self.group.id])
+        self.group.user_set.clear()
+        expect(self._django_groups()).to_equal([])
+
+        self.user.groups.add(self.group)
+        self._django_groups()
+        GroupAdmin.objects.create(user=self.user, group=self.group)
+        with self.assertNumQueries(1):
+            self._django_groups()
+
+    def testNotCachedLocally(self):
+        # Other processes wouldn't see the invalidations
+        acl_cache.is_cache_shared = self._is_cache_shared
+        self.user.groups.add(self.group)
+        expect(self._django_groups()).to_equal([self.group.id])
+        with self.assertNumQueries(1):
+            self._django_groups()
+        expect(acl_cache.cache.get(
+            'tardis_portal.groups.version.%s' % self.user.id)).to_be_none()
+
+    def testGrantedExperimentsCached(self):
+        self.user.groups.add(self.group)
+        expect(authz.has_experiment_access(self._request(),
+                                           self.experiment.id)).to_be_falsy()
+
+        acl = ExperimentACL(pluginId=django_group,
+                            entityId=str(self.group.id),
+                            experiment=self.experiment,
+                            canRead=True,
+                            aclOwnershipType=ExperimentACL.OWNER_OWNED)
+        acl.save()
+        request = self._request()
+        expect(authz.has_experiment_access(request, self.experiment.id)) \
+            .to_be_truthy()
+        # Another request with the same user and groups needs no queries
+        request = self._request()
+        with self.assertNumQueries(0):
+            expect(authz.has_experiment_access(request, self.experiment.id)) \
+                .to_be_truthy()
+
+        acl.delete()
+        expect(authz.has_experiment_access(self._request(),
+                                           self.experiment.id)).to_be_falsy()
+
+        ExperimentACL(pluginId=django_user,
+                      entityId=str(self.user.id),
+                      experiment=self.experiment,
+                      canRead=True,
+                      aclOwnershipType=ExperimentACL.OWNER_OWNED).save()
+        expect(authz.has_experiment_access(self._request(),
+                                           self.experiment.id)).to_be_truthy()
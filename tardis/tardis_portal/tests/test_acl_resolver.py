@@ -0,0 +1,97 @@
+from datetime import datetime, timedelta
+
+from compare import expect
+from django.contrib.auth.models import AnonymousUser, User
+from django.test import TestCase
+from django.test.client import RequestFactory
+
+from tardis.tardis_portal.auth import decorators as authz
+from tardis.tardis_portal.auth.localdb_auth import django_group, django_user
+from tardis.tardis_portal.models import Dataset, Dataset_File, Experiment, \
+    ExperimentACL
+
+
+class ACLResolverTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('testuser', 'user@email.test',
+                                             'pwd')
+        self.experiments = {}
+        self.datafiles = {}
+        for name, public_access in (
+                ('private', Experiment.PUBLIC_ACCESS_NONE),
+                ('metadata', Experiment.PUBLIC_ACCESS_METADATA),
+                ('full', Experiment.PUBLIC_ACCESS_FULL),
+                ('shared', Experiment.PUBLIC_ACCESS_NONE),
+                ('group', Experiment.PUBLIC_ACCESS_NONE),
+                ('expired', Experiment.PUBLIC_ACCESS_NONE)):
+            experiment = Experiment.objects.create(title=name,
+                                                   created_by=self.user,
+                                                   public_access=public_access)
+            dataset = Dataset.objects.create(description=name)
+            dataset.experiments.add(experiment)
+            self.experiments[name] = experiment
+            self.datafiles[name] = Dataset_File.objects.create(
+                dataset=dataset, filename=name, url=name, size=0)
+
+        def grant(name, plugin, entity, **kwargs):
+            ExperimentACL(pluginId=plugin, entityId=str(entity),
+                          experiment=self.experiments[name], canRead=True,
+                          aclOwnershipType=ExperimentACL.OWNER_OWNED,
+                          **kwargs).save()
+        grant('shared', django_user, self.user.id)
+        grant('group', django_group, 42)
+        grant('expired', django_user, self.user.id,
+              expiryDate=datetime.today() - timedelta(days=1))
+
+    def _request(self, user=None):
+        request = RequestFactory().get('/')
+        request.user = user or self.user
+        request.groups = [(django_group, 42)]
+        return request
+
+    def _ids(self, *names):
+        return set(self.experiments[name].id for name in names)
+
+    def testExperimentAccess(self):
+        resolver = authz.get_acl_resolver(self._request())
+        all_ids = self._ids(*self.experiments.keys())
+        expect(resolver.readable_experiments(all_ids)) \
+            .to_equal(self._ids('metadata', 'full', 'shared', 'group'))
+        expect(resolver.downloadable_experiments(all_ids)) \
+            .to_equal(self._ids('full', 'shared', 'group'))
+
+        request = self._request(AnonymousUser())
+        expect(authz.has_experiment_access(
+            request, self.experiments['metadata'].id)).to_be_truthy()
+        expect(authz.has_experiment_download_access(
+            request, self.experiments['metadata'].id)).to_be_falsy()
+        expect(authz.has_experiment_access(
+            request, self.experiments['shared'].id)).to_be_falsy()
+
+    def testDatafileAccess(self):
+        # A dataset in a private and a public experiment can be downloaded
+        self.datafiles['private'].dataset.experiments.add(
+            self.experiments['full'])
+        request = self._request()
+        expect(authz.has_datafile_download_access(
+            request, self.datafiles['private'].id)).to_be_truthy()
+        expect(authz.has_dataset_access(
+            request, self.datafiles['metadata'].dataset.id)).to_be_truthy()
+        expect(authz.has_dataset_download_access(
+            request, self.datafiles['metadata'].dataset.id)).to_be_falsy()
+
+    def testBulkChecksShareQueries(self):
+        request = self._request()
+        datafile_ids = [df.id for df in self.datafiles.values()]
+        # The granted experiments, the datafiles' experiments and the
+        # public access of the rest
+        with self.assertNumQueries(3):
+            allowed = authz.get_acl_resolver(request) \
+                .downloadable_datafiles(datafile_ids)
+        expect(allowed).to_equal(set(self.datafiles[name].id for name
+                                     in ('full', 'shared', 'group')))
+        # Answers about the same experiments come from the resolver
+        with self.assertNumQueries(1):
+            expect(authz.has_datafile_access(
+                request, self.datafiles['metadata'].id)).to_be_truthy()
@@ -0,0 +1,82 @@
+import hashlib
+import json
+from os import path, remove, utime
+from StringIO import StringIO
+from tempfile import mkdtemp
+from shutil import rmtree
+
+from compare import expect
+from django.core.files.base import ContentFile
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.test import TestCase
+
+from tardis.tardis_portal.models import Experiment, Dataset, Dataset_File
+from tardis.tardis_portal.staging import write_uploaded_file_to_dataset
+
+
+class CheckHashesTestCase(TestCase):
+
+    def setUp(self):
+        user = User.objects.create_user('testuser', 'user@email.test', 'pwd')
+        experiment = Experiment.objects.create(title='Check Hashes',
+                                               created_by=user)
+        self.dataset = Dataset(description='dataset')
+        self.dataset.save()
+        self.dataset.experiments.add(experiment)
+        self.good = self._create_datafile('good.txt', 'Hello World!\n')
+        self.bad = self._create_datafile('bad.txt', 'Goodbye World!\n',
+                                         sha512sum='0' * 128)
+        self.tempdir = mkdtemp()
+        self.checkpoint = path.join(self.tempdir, 'checkpoint')
+        self.report = path.join(self.tempdir, 'report.json')
+
+    def tearDown(self):
+        rmtree(self.tempdir)
+
+    def _create_datafile(self, filename, content, sha512sum=None):
+        datafile = Dataset_File(dataset=self.dataset, filename=filename,
+                                size=str(len(content)))
+        datafile.sha512sum = sha512sum or hashlib.sha512(content).hexdigest()
+        datafile.url = write_uploaded_file_to_dataset(
+            self.dataset, ContentFile(content, filename))
+        datafile.save()
+        return datafile
+
+    def _checkhashes(self, **options):
+        stdout = StringIO()
+        call_command('checkhashes', stdout=stdout, verbosity=2,
+                     checkpoint=self.checkpoint, report=self.report,
+                     **options)
+        return stdout.getvalue()
+
+    def testReportsFailures(self):
+        output = self._checkhashes()
+        expect(output).to_contain('%d/%s: OK' % (self.dataset.id, self.good))
+        expect(output).to_contain('%d/%s: FAILED' % (self.dataset.id,
+                                                      self.bad))
+        with open(self.report) as f:
+            lines = [json.loads(line) for line in f]
+        expect(len(lines)).to_equal(2)
+        expect(lines[0]['id']).to_equal(self.bad.id)
+        expect(lines[0]['status']).to_equal('FAILED')
+        expect(lines[1]['summary']['files']).to_equal(2)
+        expect(lines[1]['summary']['failed']).to_equal(1)
+
+    def testProcessPool(self):
+        output = self._checkhashes(processes=2)
+        expect(output).to_contain('Checked 2 files (0 skipped, 1 failed)')
+
+    def testScoping(self):
+        output = self._checkhashes(dataset=self.dataset.id + 1)
+        expect(output).to_contain('Checked 0 files')
+
+    def testMtimeSkip(self):
+        self._checkhashes()
+        output = self._checkhashes(mtime_skip=True)
+        # Only the failed file needs checking again
+        expect(output).to_contain('Checked 1 files (1 skipped, 1 failed)')
+        # Touching the file means it gets checked again
+        utime(self.good.get_absolute_filepath(), (0, 0))
+        output = self._checkhashes(mtime_skip=True)
+        expect(output).to_contain('Checked 2 files (0 skipped, 1 failed)')
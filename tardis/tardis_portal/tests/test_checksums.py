@@ -0,0 +1,40 @@
+import hashlib
+from os import urandom
+from StringIO import StringIO
+
+from compare import expect
+from django.test import TestCase
+
+from tardis.tardis_portal.checksums import ParallelHasher, \
+    compute_checksums, throughput
+
+
+class ChecksumsTestCase(TestCase):
+
+    def setUp(self):
+        self.content = urandom(100000)
+
+    def testParallelHasher(self):
+        hasher = ParallelHasher(queue_depth=1)
+        for i in range(0, len(self.content), 1000):
+            hasher.update(self.content[i:i + 1000])
+        digests = hasher.hexdigests()
+        expect(digests['md5'])\
+            .to_equal(hashlib.md5(self.content).hexdigest())
+        expect(digests['sha512'])\
+            .to_equal(hashlib.sha512(self.content).hexdigest())
+
+    def testComputeChecksums(self):
+        throughput.reset()
+        tempfile = StringIO()
+        digests, size, header = compute_checksums(StringIO(self.content),
+                                                  tempfile,
+                                                  header_size=5000,
+                                                  buffer_size=4096)
+        expect(digests['sha512'])\
+            .to_equal(hashlib.sha512(self.content).hexdigest())
+        expect(size).to_equal(len(self.content))
+        expect(header).to_equal(self.content[:5000])
+        expect(tempfile.getvalue()).to_equal(self.content)
+        expect(throughput.files).to_equal(1)
+        expect(throughput.bytes).to_equal(len(self.content))
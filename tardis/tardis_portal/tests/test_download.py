@@ -17,7 +17,9 @@ from nose.plugins.skip import SkipTest
 
 import filecmp
 
-from tardis.tardis_portal.download import StreamingFile, StreamableZipFile
+from tardis.tardis_portal.download import StreamableZipFile, \
+    _stream_tar, _stream_zip, _get_tar_archive_size, _get_zip_archive_size, \
+    parse_range_header
 from tardis.tardis_portal.models import Experiment, Dataset, Dataset_File
 
 from tempfile import NamedTemporaryFile, mkstemp
@@ -47,46 +49,79 @@ def _generate_test_image(testfile):
         f.write("II\x2a\x00")
         f.close()
 
-class StreamingFileTestCase(TestCase):
-
-    def testDirectCopy(self):
-
-        def writeTestData(filename):
-            with open(filename, 'w') as f:
-                from time import sleep
-                for i in range(1,10):
-                    print i
-                    sleep(0.1)
-                    f.write("%d\n" % i)
-
-        # Test the asynchronous flavor
-        reader = StreamingFile(writeTestData, asynchronous_file_creation=True)
-        expect(reader.thread.is_alive()).to_be_truthy()
-        expect(exists(reader.name)).to_be_truthy()
-        contents = reader.read(10)
-        expect(contents).to_equal("\n".join(map(str,range(1,6)))+"\n")
-        contents = reader.read(1024)
-        expect(contents).to_equal("\n".join(map(str,range(6,10)))+"\n")
-        contents = reader.read(1024)
-        expect(contents).to_equal('')
-        expect(exists(reader.name)).to_be_truthy()
-        reader.close()
-        expect(exists(reader.name)).to_be_falsy()
-        
-        # Test the synchronous flavor
-        reader = StreamingFile(writeTestData, asynchronous_file_creation=False)
-        expect(hasattr(reader, 'thread')).to_be_falsy()
-        expect(exists(reader.name)).to_be_truthy()
-        contents = reader.read(10)
-        expect(contents).to_equal("\n".join(map(str,range(1,6)))+"\n")
-        contents = reader.read(1024)
-        expect(contents).to_equal("\n".join(map(str,range(6,10)))+"\n")
-        contents = reader.read(1024)
-        expect(contents).to_equal('')
-        expect(exists(reader.name)).to_be_truthy()
-        reader.close()
-        expect(exists(reader.name)).to_be_falsy()
-        
+class StreamingArchiveTestCase(TestCase):
+
+    def setUp(self):
+        from StringIO import StringIO
+        self.contents = {'1/a.txt': 'Hello World!\n',
+                         '1/b.bin': '\x00\x01' * 40000}
+        self.files = [(lambda c=c: StringIO(c), name, len(c), 1000000000, '')
+                      for name, c in sorted(self.contents.items())]
+
+    def testStreamTar(self):
+        import tarfile
+        from StringIO import StringIO
+        chunks = list(_stream_tar(self.files))
+        expect(len(chunks) > 1).to_be_truthy()
+        content = ''.join(chunks)
+        expect(len(content) % tarfile.RECORDSIZE).to_equal(0)
+        expect(len(content)).to_equal(_get_tar_archive_size(self.files))
+        tf = tarfile.open(fileobj=StringIO(content), mode='r')
+        expect(sorted(tf.getnames())).to_equal(sorted(self.contents.keys()))
+        for name, data in self.contents.items():
+            expect(tf.extractfile(name).read()).to_equal(data)
+
+    def testStreamTarRange(self):
+        content = ''.join(_stream_tar(self.files))
+        for start, stop in ((0, 10), (100, 600), (512, 1024), (520, 70000),
+                            (len(content) - 1500, len(content))):
+            expect(''.join(_stream_tar(self.files, start, stop)))\
+                .to_equal(content[start:stop])
+
+    def testParseRangeHeader(self):
+        from django.test.client import RequestFactory
+        def parse(header):
+            request = RequestFactory().get('/', HTTP_RANGE=header)
+            return parse_range_header(request, 1000, '"etag"')
+        expect(parse('bytes=100-199')).to_equal((100, 200))
+        expect(parse('bytes=900-')).to_equal((900, 1000))
+        expect(parse('bytes=-100')).to_equal((900, 1000))
+        expect(parse('bytes=900-2000')).to_equal((900, 1000))
+        # Invalid ranges are ignored, and the whole file sent
+        for header in ('bytes=5-3', 'bytes=-', 'bytes=--5', 'bytes=a-b',
+                       'bytes=0-1,5-6', 'items=0-1'):
+            expect(parse(header)).to_be_none()
+        expect(lambda: parse('bytes=1000-')).to_raise(ValueError)
+        expect(lambda: parse('bytes=-0')).to_raise(ValueError)
+
+    def testStreamZip(self):
+        from StringIO import StringIO
+        chunks = list(_stream_zip(self.files))
+        expect(len(chunks) > 1).to_be_truthy()
+        content = ''.join(chunks)
+        expect(len(content)).to_equal(_get_zip_archive_size(self.files))
+        zf = ZipFile(StringIO(content), 'r')
+        expect(zf.testzip()).to_be_none()
+        expect(sorted(zf.namelist())).to_equal(sorted(self.contents.keys()))
+        for name, data in self.contents.items():
+            expect(zf.read(name)).to_equal(data)
+
+    def testSizeMismatch(self):
+        import tarfile
+        from StringIO import StringIO
+        # Members are always exactly the size recorded in the database
+        files = [(lambda: StringIO('short'), '1/short.txt', 10, 0, ''),
+                 (lambda: StringIO('too long'), '1/long.txt', 3, 0, '')]
+        content = ''.join(_stream_tar(files))
+        expect(len(content)).to_equal(_get_tar_archive_size(files))
+        tf = tarfile.open(fileobj=StringIO(content), mode='r')
+        expect(tf.extractfile('1/short.txt').read())\
+            .to_equal('short' + '\0' * 5)
+        expect(tf.extractfile('1/long.txt').read()).to_equal('too')
+        content = ''.join(_stream_zip(files))
+        expect(len(content)).to_equal(_get_zip_archive_size(files))
+        expect(ZipFile(StringIO(content), 'r').testzip()).to_be_none()
+
 class StreamableZipFileTestCase(TestCase):
     def testCreateZip(self):
         (zipFileObj, self.zipFilename) = mkstemp(suffix='zip')
@@ -252,19 +287,15 @@ class DownloadTestCase(TestCase):
             self.assertEqual(response.content[0:4], tiff_signature)
 
     def _check_tar_file(self, content, rootdir, datafiles):
-        # It should be a zip file
-        with NamedTemporaryFile('w') as tempfile:
-            tempfile.write(content)
-            tempfile.flush()
-            with open(tempfile.name, 'r') as zipread:
-                # It should be a zip file (all of which start with "PK")
-                expect(zipread.read(2)).to_equal('PK')
-            expect(is_zipfile(tempfile.name)).to_be_truthy()
-            with ZipFile(tempfile.name, 'r') as zf:
-                expect(len(zf.namelist())).to_equal(len(datafiles))
-                for df in datafiles:
-                    filename = join(rootdir, str(df.dataset.id), df.filename)
-                    expect(filename in zf.namelist()).to_be_truthy()
+        import tarfile
+        from StringIO import StringIO
+        # It should be a tar file
+        tf = tarfile.open(fileobj=StringIO(content), mode='r')
+        expect(len(tf.getnames())).to_equal(len(datafiles))
+        for df in datafiles:
+            filename = join(rootdir, str(df.dataset.id), df.filename)
+            expect(filename in tf.getnames()).to_be_truthy()
+            expect(tf.getmember(filename).size).to_equal(int(df.size))
 
     def _check_zip_file(self, content, rootdir, datafiles):
         # It should be a zip file
@@ -292,11 +323,58 @@ class DownloadTestCase(TestCase):
                          'attachment; filename="experiment%s-complete.zip"'
                          % self.experiment1.id)
         self.assertEqual(response.status_code, 200)
-        self._check_zip_file(response.content, str(self.experiment1.id),
+        content = response.content
+        self.assertEqual(int(response['Content-Length']), len(content))
+        self._check_zip_file(content, str(self.experiment1.id),
                              reduce(lambda x, y: x + y,
                                     [ds.dataset_file_set.all() \
                                      for ds in self.experiment1.datasets.all()]))
 
+        # check tar download for experiment1
+        response = client.get('/download/experiment/%i/tar/' % self.experiment1.id)
+        self.assertEqual(response['Content-Disposition'],
+                         'attachment; filename="experiment%s-complete.tar"'
+                         % self.experiment1.id)
+        self.assertEqual(response.status_code, 200)
+        content = response.content
+        self._check_tar_file(content, str(self.experiment1.id),
+                             reduce(lambda x, y: x + y,
+                                    [ds.dataset_file_set.all() \
+                                     for ds in self.experiment1.datasets.all()]))
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertEqual(int(response['Content-Length']), len(content))
+
+        # resume the tar download part way through
+        response = client.get('/download/experiment/%i/tar/'
+                              % self.experiment1.id,
+                              HTTP_RANGE='bytes=600-',
+                              HTTP_IF_RANGE=response['ETag'])
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'],
+                         'bytes 600-%d/%d' % (len(content) - 1, len(content)))
+        self.assertEqual(response.content, content[600:])
+
+        # a stale ETag gets the whole archive
+        response = client.get('/download/experiment/%i/tar/'
+                              % self.experiment1.id,
+                              HTTP_RANGE='bytes=600-',
+                              HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, content)
+
+        # ranges past the end can't be satisfied
+        response = client.get('/download/experiment/%i/tar/'
+                              % self.experiment1.id,
+                              HTTP_RANGE='bytes=%d-' % len(content))
+        self.assertEqual(response.status_code, 416)
+
+        # invalid ranges are ignored
+        response = client.get('/download/experiment/%i/tar/'
+                              % self.experiment1.id,
+                              HTTP_RANGE='bytes=600-599')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, content)
+
         # check download of file1
         response = client.get('/download/datafile/%i/' % self.dataset_file1.id)
 
@@ -369,7 +447,7 @@ class DownloadTestCase(TestCase):
         except:
             # XXX Test disabled because lib magic can't be loaded
             pass
-        self.assertEqual(df.size, str(13))
+        self.assertEqual(df.size, 13)
         self.assertEqual(df.md5sum, '8ddd8be4b179a529afa5f2ffae4b9858')
 
         # now check a JPG file
@@ -393,7 +471,7 @@ class DownloadTestCase(TestCase):
         except:
             # XXX Test disabled because lib magic can't be loaded
             pass
-        self.assertEqual(pdf1.size, str(14232))
+        self.assertEqual(pdf1.size, 14232)
         self.assertEqual(pdf1.md5sum, 'c450d5126ffe3d14643815204daf1bfb')
 
         # now check that we can override the physical file meta information
@@ -402,7 +480,7 @@ class DownloadTestCase(TestCase):
                             url='file://%s' % filename,
                             protocol='file',
                             mimetype='application/vnd.openxmlformats-officedocument.presentationml.presentation',
-                            size=str(0),
+                            size=0,
                             # Empty string always has the same hash
                             sha512sum='cf83e1357eefb8bdf1542850d66d8007d620e4050b5715dc83f4a921d36ce9ce47d0d13c5d85f2b0ff8318d2877eec2f63b931bd47417a81a538327af927da3e')
         pdf2.save()
@@ -412,7 +490,7 @@ class DownloadTestCase(TestCase):
         except:
             # XXX Test disabled because lib magic can't be loaded
             pass
-        self.assertEqual(pdf2.size, str(0))
+        self.assertEqual(pdf2.size, 0)
         self.assertEqual(pdf2.md5sum, '')
 
         pdf2.mimetype = ''
@@ -378,3 +378,49 @@ class ExtraTestCases(TestCase):
         # By default the image is now private, so
         ensure('private' in response['Cache-Control'], True,
                "Image should have a Cache-Control header")
+
+    def testImageIsCached(self):
+        import shutil
+        cache_path = tempfile.mkdtemp()
+        settings.IIIF_CACHE_PATH = cache_path
+        try:
+            client = Client()
+            kwargs = {'datafile_id': self.datafile.id,
+                      'region': 'full',
+                      'size': '10,',
+                      'rotation': '0',
+                      'quality': 'native',
+                      'format': 'png' }
+            url = reverse('tardis.tardis_portal.iiif.download_image',
+                          kwargs=kwargs)
+            response = client.get(url)
+            expect(response.status_code).to_equal(200)
+            cached = [name for _, _, names in os.walk(cache_path)
+                      for name in names]
+            expect(len(cached)).to_equal(1)
+            # The rendering is served from the cache the second time
+            cached_response = client.get(url)
+            expect(cached_response.status_code).to_equal(200)
+            expect(cached_response['Content-Type']).to_equal('image/png')
+            expect(cached_response.content).to_equal(response.content)
+        finally:
+            settings.IIIF_CACHE_PATH = None
+            shutil.rmtree(cache_path)
+
+    def testInfoIsRecorded(self):
+        from tardis.tardis_portal.models import ImageInfo
+        # Recorded when the datafile was verified
+        image_info = ImageInfo.objects.get(datafile=self.datafile)
+        expect((image_info.width, image_info.height)) \
+            .to_equal((self.width, self.height))
+        expect(image_info.format).to_equal('TIFF')
+        expect(image_info.pages).to_equal(1)
+
+        # The info is described from what was recorded, not the image
+        ImageInfo.objects.filter(pk=image_info.pk).update(width=7)
+        kwargs = {'datafile_id': self.datafile.id, 'format': 'json'}
+        url = reverse('tardis.tardis_portal.iiif.download_info',
+                      kwargs=kwargs)
+        response = Client().get(url)
+        expect(response.status_code).to_equal(200)
+        expect(json.loads(response.content)['width']).to_equal(7)
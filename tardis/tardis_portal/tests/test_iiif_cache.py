@@ -0,0 +1,62 @@
+import os
+import shutil
+import tempfile
+
+from compare import expect
+from django.test import TestCase
+
+from tardis.tardis_portal.iiif_cache import DerivativeCache
+
+
+class MockDatafile(object):
+
+    def __init__(self, sha512sum='', md5sum=''):
+        self.sha512sum = sha512sum
+        self.md5sum = md5sum
+
+
+class DerivativeCacheTestCase(TestCase):
+
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.cache = DerivativeCache(self.location, 1000)
+
+    def tearDown(self):
+        shutil.rmtree(self.location)
+
+    def testKeys(self):
+        datafile = MockDatafile(sha512sum='abc')
+        key = self.cache.get_key(datafile, 'full', '100,', '0', 'native', None)
+        expect(key).to_equal(self.cache.get_key(MockDatafile(sha512sum='abc'),
+                                                'full', '100,', '0', 'native',
+                                                None))
+        expect(key == self.cache.get_key(datafile, 'full', '200,', '0',
+                                         'native', None)).to_be_falsy()
+        # Without a checksum, a datafile's contents can't be told apart
+        expect(self.cache.get_key(MockDatafile(), 'full')).to_be_none()
+
+    def testGetAndPut(self):
+        expect(self.cache.get('0123')).to_be_none()
+        filename = self.cache.put('0123', 'rendering')
+        expect(self.cache.get('0123')).to_equal(filename)
+        response = self.cache.get_response(filename, 'image/png')
+        expect(response.content).to_equal('rendering')
+        expect(response['Content-Length']).to_equal('9')
+
+    def testEvictedAfterGet(self):
+        filename = self.cache.put('0123', 'rendering')
+        # Removed by another process after it was looked up
+        os.remove(filename)
+        expect(self.cache.get_response(filename, 'image/png')).to_be_none()
+
+    def testLeastRecentlyUsedEvicted(self):
+        for i in range(3):
+            filename = self.cache.put('%04d' % i, 'x' * 300)
+            # Make each one older than the last
+            os.utime(filename, (i, i))
+        # Using the oldest makes it the most recent
+        self.cache.get('0000')
+        self.cache.put('0003', 'x' * 300)
+        expect(self.cache.get('0001')).to_be_none()
+        for key in ('0000', '0002', '0003'):
+            expect(self.cache.get(key)).to_be_truthy()
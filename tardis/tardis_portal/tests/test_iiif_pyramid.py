@@ -0,0 +1,59 @@
+from os import path
+
+from compare import expect
+from django.test import TestCase
+
+from tardis.tardis_portal.iiif_pyramid import Pyramid
+
+
+class PyramidTestCase(TestCase):
+
+    def setUp(self):
+        # A 4096x2048 image, in 1024 pixel tiles
+        self.pyramid = Pyramid('/pyramid', {
+            'width': 4096,
+            'height': 2048,
+            'tile_size': 1024,
+            'levels': [
+                {'name': 'thumbnail', 'width': 100, 'height': 50,
+                 'whole': True, 'tiled': False},
+                {'name': 'level-0', 'width': 4096, 'height': 2048,
+                 'whole': False, 'tiled': True},
+                {'name': 'level-1', 'width': 2048, 'height': 1024,
+                 'whole': True, 'tiled': True},
+                {'name': 'level-2', 'width': 1024, 'height': 512,
+                 'whole': True, 'tiled': True},
+            ]})
+
+    def testScaleFactors(self):
+        expect(self.pyramid.get_scale_factors()).to_equal([1, 2, 4])
+
+    def testThumbnail(self):
+        expect(self.pyramid.find((0, 0, 4096, 2048), (80, 40))) \
+            .to_equal(('/pyramid/thumbnail.png', (0, 0, 100, 50)))
+        expect(self.pyramid.find((0, 0, 4096, 2048), (1024, 512))) \
+            .to_equal(('/pyramid/level-2/0_0.png', (0, 0, 1024, 512)))
+
+    def testTiles(self):
+        # A tile of the original
+        expect(self.pyramid.find((3072, 1024, 1024, 1024), (1024, 1024))) \
+            .to_equal(('/pyramid/level-0/3_1.png', (0, 0, 1024, 1024)))
+        # Part of a tile of a reduced level
+        expect(self.pyramid.find((2048, 0, 512, 512), (256, 256))) \
+            .to_equal(('/pyramid/level-1/1_0.png', (0, 0, 256, 256)))
+
+    def testUnalignedRegions(self):
+        # Within a tile at a lower resolution
+        expect(self.pyramid.find((1536, 0, 2048, 1024), (512, 256))) \
+            .to_equal(('/pyramid/level-2/0_0.png', (384, 0, 512, 256)))
+        # Across tiles, so cropped from a whole level
+        expect(self.pyramid.find((1536, 0, 2048, 1024), (1024, 512))) \
+            .to_equal(('/pyramid/level-1.png', (768, 0, 1024, 512)))
+        # Across tiles of the original, which isn't kept whole
+        expect(self.pyramid.find((512, 0, 1024, 1024), (1024, 1024))) \
+            .to_be_none()
+
+    def testOutOfBounds(self):
+        expect(self.pyramid.find((4000, 0, 1024, 1024), (10, 10))) \
+            .to_be_none()
+        expect(self.pyramid.find((0, 0, 0, 10), (10, 10))).to_be_none()
@@ -0,0 +1,127 @@
+import shutil
+import tempfile
+import time
+from multiprocessing import Event, Process
+from threading import Thread
+
+from compare import expect
+from django.test import TestCase
+
+from tardis.tardis_portal.iiif_render import get_size, RenderError, \
+    RenderFailed, RenderPool, RenderPoolBusy
+
+
+def _echo(data):
+    return data
+
+
+def _fail(parameter):
+    if parameter:
+        raise RenderError(parameter, 'Invalid')
+    return {}['missing']
+
+
+def _wait(taken, release):
+    taken.set()
+    release.wait(5)
+    return ''
+
+
+def _render_in_process(slot_path, taken, release):
+    # Another web server process, rendering in its own process
+    RenderPool(0, 1, 5, slot_path).run(_wait, taken, release)
+
+
+class RenderPoolTestCase(TestCase):
+
+    def setUp(self):
+        self.slot_path = tempfile.mkdtemp()
+        # One render at a time
+        self.pool = RenderPool(1, 1, 5, self.slot_path)
+
+    def tearDown(self):
+        self.pool.close()
+        shutil.rmtree(self.slot_path)
+
+    def testRender(self):
+        expect(self.pool.run(_echo, 'image')).to_equal('image')
+        expect(self.pool.run(_echo, 'rendered')).to_equal('rendered')
+        metrics = self.pool.metrics
+        expect(metrics.renders).to_equal(2)
+        expect(metrics.bytes).to_equal(len('image') + len('rendered'))
+        expect(metrics.wait).to_be_greater_than_or_equal_to(0)
+        expect(metrics.seconds).to_be_greater_than_or_equal_to(0)
+
+    def testErrors(self):
+        try:
+            self.pool.run(_fail, 'size')
+            self.fail('RenderError not raised')
+        except RenderError as e:
+            expect((e.parameter, e.text)).to_equal(('size', 'Invalid'))
+        expect(lambda: self.pool.run(_fail, None)).to_raise(RenderFailed)
+        # The pool is still usable
+        expect(self.pool.run(_echo, 'image')).to_equal('image')
+
+    def testTimeout(self):
+        self.pool.timeout = 0.1
+        expect(lambda: self.pool.run(time.sleep, 1)).to_raise(RenderPoolBusy)
+        expect(self.pool.metrics.rejected).to_equal(1)
+
+    def testTimedOutRendersKeepTheirPlace(self):
+        self.pool.timeout = 0.1
+        expect(lambda: self.pool.run(time.sleep, 0.5)) \
+            .to_raise(RenderPoolBusy)
+        # The render is still running, so there's no room for another
+        expect(lambda: self.pool.run(_echo, 'image')) \
+            .to_raise(RenderPoolBusy)
+        time.sleep(0.6)
+        expect(self.pool.run(_echo, 'image')).to_equal('image')
+
+    def testSlotLimit(self):
+        busy = Thread(target=self.pool.run, args=(time.sleep, 0.5))
+        busy.start()
+        time.sleep(0.1)
+        expect(lambda: self.pool.run(_echo, 'image')) \
+            .to_raise(RenderPoolBusy)
+        expect(self.pool.metrics.rejected).to_equal(1)
+        busy.join()
+        # The turned away request didn't hold a slot
+        expect(self.pool.run(_echo, 'image')).to_equal('image')
+
+    def testSlotsSharedByProcesses(self):
+        taken, release = Event(), Event()
+        other = Process(target=_render_in_process,
+                        args=(self.slot_path, taken, release))
+        other.start()
+        try:
+            expect(taken.wait(5)).to_be_truthy()
+            # Turned away straight away, rather than waiting for the slot
+            started = time.time()
+            expect(lambda: self.pool.run(_echo, 'image')) \
+                .to_raise(RenderPoolBusy)
+            expect(time.time() - started < 1).to_be_truthy()
+        finally:
+            release.set()
+            other.join()
+        expect(self.pool.run(_echo, 'image')).to_equal('image')
+
+    def testSlotFreedWhenProcessDies(self):
+        taken, release = Event(), Event()
+        other = Process(target=_render_in_process,
+                        args=(self.slot_path, taken, release))
+        other.start()
+        expect(taken.wait(5)).to_be_truthy()
+        other.terminate()
+        other.join()
+        expect(self.pool.run(_echo, 'image')).to_equal('image')
+
+
+class SizeTestCase(TestCase):
+
+    def testSizes(self):
+        expect(get_size('35,', 70, 46)).to_equal((35, 23))
+        expect(get_size(',23', 70, 46)).to_equal((35, 23))
+        expect(get_size('pct:50', 70, 46)).to_equal((35, 23))
+        expect(get_size('!35,35', 70, 46)).to_equal((35, 23))
+        expect(get_size('10,10', 70, 46)).to_equal((10, 10))
+        expect(get_size('10', 70, 46)).to_be_none()
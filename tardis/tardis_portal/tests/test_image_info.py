@@ -0,0 +1,146 @@
+from StringIO import StringIO
+
+from compare import expect
+from django.contrib.auth.models import User
+from django.test import TestCase
+
+from tardis.tardis_portal.iiif_pyramid import Pyramid
+from tardis.tardis_portal.iiif_render import RenderPoolBusy, \
+    UnsupportedFormat
+from tardis.tardis_portal.models import Dataset, Dataset_File, Experiment, \
+    ImageInfo
+
+
+class ImageInfoTestCase(TestCase):
+
+    def setUp(self):
+        user = User.objects.create_user('testuser', 'user@email.test', 'pwd')
+        experiment = Experiment.objects.create(title='Images',
+                                               created_by=user)
+        dataset = Dataset.objects.create(description='Images')
+        dataset.experiments.add(experiment)
+        # Not verified, so not recorded automatically
+        self.datafile = Dataset_File.objects.create(
+            dataset=dataset, filename='image.tif', url='image.tif',
+            size=1, mimetype='image/tiff')
+
+    def testGetRecorded(self):
+        ImageInfo.objects.create(datafile=self.datafile, width=70, height=46,
+                                 format='TIFF')
+        # Without touching the file
+        with self.assertNumQueries(1):
+            info = ImageInfo.get_for(self.datafile)
+        expect((info.width, info.height, info.pages)).to_equal((70, 46, 1))
+        expect(info.get_scale_factors()).to_equal([])
+
+    def testUnreadableImage(self):
+        # An unverified file can't be read
+        expect(ImageInfo.get_for(self.datafile)).to_be_none()
+        expect(ImageInfo.objects.count()).to_equal(0)
+
+    def testDecodedByPool(self):
+        class FakePool(object):
+            def __init__(self, error):
+                self.error = error
+                self.runs = 0
+            def run(self, func, source):
+                self.runs += 1
+                raise self.error
+        self.datafile.verified = True
+        self.datafile.save()
+        self.datafile.get_file = lambda: StringIO('not an image')
+        # Undecodable images have no information
+        pool = FakePool(UnsupportedFormat())
+        expect(ImageInfo.get_for(self.datafile, pool)).to_be_none()
+        expect(pool.runs).to_equal(1)
+        # A busy pool is left for the view to report
+        expect(lambda: ImageInfo.get_for(self.datafile,
+                                         FakePool(RenderPoolBusy()))) \
+            .to_raise(RenderPoolBusy)
+        expect(ImageInfo.objects.count()).to_equal(0)
+
+    def testPyramid(self):
+        info = ImageInfo(datafile=self.datafile, width=4096, height=2048)
+        levels = [{'name': 'thumbnail', 'width': 100, 'height': 50,
+                   'whole': True, 'tiled': False}]
+        pyramid = Pyramid('/pyramid', {'width': 4096, 'height': 2048,
+                                       'tile_size': 1024, 'levels': levels})
+        # No tiles to advertise
+        info.set_pyramid(pyramid)
+        expect(info.tile_size).to_be_none()
+        expect(info.get_scale_factors()).to_equal([])
+
+        levels.append({'name': 'level-0', 'width': 4096, 'height': 2048,
+                       'whole': False, 'tiled': True})
+        levels.append({'name': 'level-1', 'width': 2048, 'height': 1024,
+                       'whole': True, 'tiled': True})
+        info.set_pyramid(pyramid)
+        info.save()
+        info = ImageInfo.objects.get(pk=info.pk)
+        expect(info.tile_size).to_equal(1024)
+        expect(info.get_scale_factors()).to_equal([1, 2])
+
+        info.set_pyramid(None)
+        expect(info.tile_size).to_be_none()
+        expect(info.scale_factors).to_equal('')
+
+
+class _QueuedTask(object):
+
+    def __init__(self):
+        self.queued = []
+
+    def delay(self, *args):
+        self.queued.append(list(args))
+
+    def apply_async(self, args, **kwargs):
+        self.queued.append(args)
+
+
+class ImageProcessingQueuedTestCase(TestCase):
+
+    def setUp(self):
+        from tardis.tardis_portal import tasks
+        self.tasks = tasks
+        self._tasks = (tasks.record_image_info, tasks.generate_image_pyramid)
+        tasks.record_image_info = _QueuedTask()
+        tasks.generate_image_pyramid = _QueuedTask()
+        self.dataset = Dataset.objects.create(description='Images')
+
+    def tearDown(self):
+        self.tasks.record_image_info, self.tasks.generate_image_pyramid = \
+            self._tasks
+
+    def _create(self, verified):
+        return Dataset_File.objects.create(
+            dataset=self.dataset, filename='image.tif', url='image.tif',
+            size=1, mimetype='image/tiff', verified=verified)
+
+    def testQueuedWhenCreatedVerified(self):
+        # As uploads are
+        datafile = self._create(verified=True)
+        expect(self.tasks.record_image_info.queued) \
+            .to_equal([[datafile.id]])
+        # But not again
+        Dataset_File.objects.get(id=datafile.id).save()
+        expect(len(self.tasks.record_image_info.queued)).to_equal(1)
+
+    def testQueuedWhenVerified(self):
+        datafile = self._create(verified=False)
+        expect(self.tasks.record_image_info.queued).to_equal([])
+        datafile = Dataset_File.objects.get(id=datafile.id)
+        datafile.verified = True
+        datafile.save()
+        expect(self.tasks.record_image_info.queued) \
+            .to_equal([[datafile.id]])
+
+    def testRetriedUntilCommitted(self):
+        datafile = self._create(verified=False)
+        record_image_info = self._tasks[0]
+        # The verification hasn't been committed yet
+        record_image_info(datafile.id)
+        expect(self.tasks.record_image_info.queued) \
+            .to_equal([[datafile.id, 2]])
+        # It isn't looked for for ever
+        record_image_info(datafile.id, 3)
+        expect(len(self.tasks.record_image_info.queued)).to_equal(1)
@@ -0,0 +1,80 @@
+from os import path
+
+from compare import expect
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db.models.signals import post_save
+from django.test import TestCase
+
+from tardis.tardis_portal import metsparser
+from tardis.tardis_portal.models import DatafileParameter, \
+    Dataset_File, DatasetStatistics, Experiment
+from tardis.tardis_portal.views import _registerExperimentDocument
+
+
+class BulkIngestTestCase(TestCase):
+
+    def setUp(self):
+        call_command('loaddata', 'as_schemas')
+        self.user = User.objects.create_user('test', '', 'test')
+        self.filename = path.join(path.abspath(path.dirname(__file__)),
+                                  'METS_test.xml')
+        self.hooked = []
+        post_save.connect(self._hook, sender=Dataset_File)
+        # Write a few rows at a time, to exercise the batching
+        self._batchSize = metsparser.INGEST_BATCH_SIZE
+        metsparser.INGEST_BATCH_SIZE = 3
+
+    def tearDown(self):
+        metsparser.INGEST_BATCH_SIZE = self._batchSize
+        post_save.disconnect(self._hook, sender=Dataset_File)
+
+    def _hook(self, sender, **kwargs):
+        self.hooked.append((kwargs['instance'].filename,
+                            kwargs.get('bulk_created')))
+
+    def testIngestInBatches(self):
+        expid, _ = _registerExperimentDocument(self.filename, self.user)
+        dataset = Experiment.objects.get(id=expid).datasets.get()
+        datafiles = dataset.dataset_file_set.all()
+        # Five files with metadata, and three without
+        expect(datafiles.count()).to_equal(8)
+        expect(DatasetStatistics.get_for(dataset).size) \
+            .to_equal(sum(df.size for df in datafiles))
+        # None are left marked as being ingested
+        expect(datafiles.filter(ingest_marker__isnull=False).count()) \
+            .to_equal(0)
+
+        # Every datafile with metadata has its own parameters
+        for datafile in datafiles.filter(filename__endswith='.osc'):
+            parameters = DatafileParameter.objects.filter(
+                parameterset__dataset_file=datafile)
+            expect(parameters.count()).to_be_greater_than(0)
+        datafile = datafiles.get(filename='ment0003.osc')
+        expect(DatafileParameter.objects.get(
+            parameterset__dataset_file=datafile,
+            name__name='it').numerical_value).to_equal(288)
+
+        # The post-save hooks were run (straight away, as tasks are eager
+        # in tests) once each, after the datafiles were written
+        expect(sorted(self.hooked)).to_equal(
+            sorted((df.filename, True) for df in datafiles))
+
+    def testIngestInOnePass(self):
+        expid, sync_root = _registerExperimentDocument(self.filename,
+                                                       self.user)
+        experiment = Experiment.objects.get(id=expid)
+        expect(experiment.title).to_equal('SAXS Test')
+        expect(experiment.institution_name).to_equal('Adelaide University')
+        expect(experiment.description).to_equal('Hello world hello world')
+        expect([author.author for author in experiment.author_experiment_set
+                .order_by('order')]) \
+            .to_equal(['Gerry G.', 'Alvin K', 'Moscatto Brothers'])
+        dataset = experiment.datasets.get()
+        expect(dataset.description).to_equal('Bluebird')
+        expect(dataset.datasetparameterset_set.count()).to_equal(1)
+
+        # Files with and without metadata are synced to the same place
+        for datafile in dataset.dataset_file_set.all():
+            expect(datafile.url).to_equal(
+                'file://' + path.join(sync_root, 'Images', datafile.filename))
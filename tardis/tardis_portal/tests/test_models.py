@@ -136,7 +136,7 @@ class ModelTestCase(TestCase):
         self.assertEqual(df_file.url, 'path/file.txt')
         self.assertEqual(df_file.protocol, '')
         self.assertEqual(df_file.dataset, dataset)
-        self.assertEqual(df_file.size, '')
+        self.assertEqual(df_file.size, None)
         self.assertEqual(df_file.get_download_url(), '/test/download/datafile/1/')
         self.assertTrue(df_file.is_local())
 
@@ -150,7 +150,7 @@ class ModelTestCase(TestCase):
         self.assertEqual(df_file.url, 'path/file1.txt')
         self.assertEqual(df_file.protocol, 'vbl')
         self.assertEqual(df_file.dataset, dataset)
-        self.assertEqual(df_file.size, '')
+        self.assertEqual(df_file.size, None)
         self.assertEqual(df_file.get_download_url(),
                          '/test/vbl/download/datafile/2/')
         self.assertFalse(df_file.is_local())
@@ -166,7 +166,7 @@ class ModelTestCase(TestCase):
                          'http://localhost:8080/filestore/file1.txt')
         self.assertEqual(df_file.protocol, '')
         self.assertEqual(df_file.dataset, dataset)
-        self.assertEqual(df_file.size, '')
+        self.assertEqual(df_file.size, None)
         self.assertEqual(df_file.get_download_url(),
                          '/test/download/datafile/3/')
         self.assertFalse(df_file.is_local())
@@ -0,0 +1,109 @@
+import os
+import shutil
+from os import path
+from tempfile import mkdtemp
+
+from compare import expect
+from django.conf import settings
+from django.core.management import call_command
+from django.test import TestCase
+from django.test.client import RequestFactory
+
+from tardis.tardis_portal.models import Dataset, Dataset_File, \
+    DatafileParameter, DatafileParameterSet, ParameterName, Schema
+from tardis.tardis_portal.storage import get_preview_path, is_preview, \
+    store_preview
+from tardis.tardis_portal.views import _image_parameter_response
+
+# Enough of a PNG to be recognised as one
+PNG = '\x89PNG\r\n\x1a\n' + '\0' * 24
+
+
+class PreviewTestCase(TestCase):
+
+    def setUp(self):
+        self._file_store_path = settings.FILE_STORE_PATH
+        settings.FILE_STORE_PATH = mkdtemp()
+        self.factory = RequestFactory()
+
+    def tearDown(self):
+        shutil.rmtree(settings.FILE_STORE_PATH)
+        settings.FILE_STORE_PATH = self._file_store_path
+
+    def testStorePreviews(self):
+        schema = Schema.objects.create(namespace='http://test/previews',
+                                       type=Schema.DATAFILE)
+        name = ParameterName.objects.create(schema=schema,
+                                            name='previewImage',
+                                            full_name='Preview',
+                                            data_type=ParameterName.STRING)
+        dataset = Dataset.objects.create(description='Previews')
+        datafile = Dataset_File.objects.create(dataset=dataset,
+                                               filename='frame.img',
+                                               url='frame.img', size=1)
+        parameterset = DatafileParameterSet.objects.create(
+            schema=schema, dataset_file=datafile)
+        preview, garbage = [
+            DatafileParameter.objects.create(parameterset=parameterset,
+                                             name=name, string_value=value)
+            for value in (PNG.encode('base64').replace('\n', '').rstrip('='),
+                          'not an image')]
+
+        call_command('storepreviews', verbosity=0)
+
+        value = DatafileParameter.objects.get(id=preview.id).string_value
+        expect(is_preview(value)).to_be_truthy()
+        expect(value.endswith('.png')).to_be_truthy()
+        with open(get_preview_path(value), 'rb') as f:
+            expect(f.read()).to_equal(PNG)
+        # What isn't an image is left as it is
+        expect(DatafileParameter.objects.get(id=garbage.id).string_value) \
+            .to_equal('not an image')
+
+    def testResponse(self):
+        name = store_preview(PNG, 'png')
+        response = _image_parameter_response(self.factory.get('/'), name)
+        expect(response.status_code).to_equal(200)
+        expect(response['Content-Type']).to_equal('image/png')
+        expect(response['Content-Length']).to_equal(str(len(PNG)))
+        expect(''.join(response)).to_equal(PNG)
+        etag = response['ETag']
+
+        # Unchanged previews aren't sent again
+        for headers in ({'HTTP_IF_NONE_MATCH': etag},
+                        {'HTTP_IF_MODIFIED_SINCE': response['Last-Modified']}):
+            response = _image_parameter_response(
+                self.factory.get('/', **headers), name)
+            expect(response.status_code).to_equal(304)
+
+        response = _image_parameter_response(
+            self.factory.get('/', HTTP_RANGE='bytes=4-7'), name)
+        expect(response.status_code).to_equal(206)
+        expect(response['Content-Range']).to_equal('bytes 4-7/%d' % len(PNG))
+        expect(''.join(response)).to_equal(PNG[4:8])
+
+    def testOnlyPreviewsResponse(self):
+        datafile = path.join(settings.FILE_STORE_PATH, '12', '34',
+                             'secret.dat')
+        os.makedirs(path.dirname(datafile))
+        with open(datafile, 'w') as f:
+            f.write('secret')
+        digest = 'ab' + '0' * 38
+        for value in ('previews/../12/34/secret.dat',
+                      'previews/ab/../../12/34/secret.dat',
+                      'previews/../../../etc/passwd',
+                      'previews/cd/%s.png' % digest,
+                      'previews/ab/%s.png/../../../12/34/secret.dat'
+                      % digest):
+            expect(is_preview(value)).to_be_falsy()
+            expect(lambda: get_preview_path(value)).to_raise(ValueError)
+            response = _image_parameter_response(self.factory.get('/'),
+                                                 value)
+            expect(response.status_code).to_equal(404)
+
+    def testBase64Response(self):
+        # As filters used to store them
+        response = _image_parameter_response(self.factory.get('/'),
+                                             PNG.encode('base64'))
+        expect(response.status_code).to_equal(200)
+        expect(''.join(response)).to_equal(PNG)
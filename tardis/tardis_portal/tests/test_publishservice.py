@@ -102,4 +102,116 @@ class PublishServiceTestCase(TestCase):
         self.assertFalse(os.path.exists(rifcs_file))
 
 
+class PublishQueueTestCase(TestCase):
 
+    def setUp(self):
+        import tempfile
+        self._settings = (settings.OAI_DOCS_PATH,
+                          getattr(settings, 'RIFCS_PROVIDERS', None))
+        settings.OAI_DOCS_PATH = tempfile.mkdtemp()
+        settings.RIFCS_PROVIDERS = ('tardis.tardis_portal.tests.test_publishservice.MockRifCsProvider',)
+        self.user = User.objects.create_user(username='TestUser',
+                                             email='user@test.com',
+                                             password='secret')
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(settings.OAI_DOCS_PATH)
+        settings.OAI_DOCS_PATH, providers = self._settings
+        if providers is None:
+            del settings.RIFCS_PROVIDERS
+        else:
+            settings.RIFCS_PROVIDERS = providers
+
+    def _rifcs_file(self, experiment_id):
+        import os
+        return os.path.join(settings.OAI_DOCS_PATH,
+                            "MyTARDIS-%d.xml" % experiment_id)
+
+    def testPublishedInBackground(self):
+        import os
+        # Tasks run as soon as they are queued in the tests
+        experiment = Experiment.objects.create(
+            title="Experiment 1", created_by=self.user,
+            public_access=Experiment.PUBLIC_ACCESS_FULL)
+        rifcs_file = self._rifcs_file(experiment.id)
+        self.assertTrue(os.path.exists(rifcs_file))
+
+        experiment.public_access = Experiment.PUBLIC_ACCESS_NONE
+        experiment.save()
+        self.assertFalse(os.path.exists(rifcs_file))
+
+        experiment.public_access = Experiment.PUBLIC_ACCESS_FULL
+        experiment.save()
+        experiment.delete()
+        self.assertFalse(os.path.exists(rifcs_file))
+
+    def testQueuedOnce(self):
+        from django.core.cache import get_cache
+        from tardis.tardis_portal import tasks
+        queued = []
+        cache, publish_rifcs = tasks.cache, tasks.publish_rifcs
+        # The test settings' cache doesn't remember anything
+        tasks.cache = get_cache(
+            'django.core.cache.backends.locmem.LocMemCache')
+        tasks.publish_rifcs = type('Task', (object,), {
+            'apply_async': lambda self, **kwargs: queued.append(kwargs)})()
+        try:
+            tasks.queue_rifcs_publish(1)
+            tasks.queue_rifcs_publish(1)
+            tasks.queue_rifcs_publish(2)
+        finally:
+            tasks.cache, tasks.publish_rifcs = cache, publish_rifcs
+        self.assertEquals([kwargs['args'] for kwargs in queued], [[1], [2]])
+
+    def testQueuedAgainAfterDelay(self):
+        import time
+        from django.core.cache import get_cache
+        from tardis.tardis_portal import tasks
+        queued = []
+        cache, publish_rifcs = tasks.cache, tasks.publish_rifcs
+        delay = tasks.RIFCS_PUBLISH_DELAY
+        # The worker's clearing of the key may not reach this process
+        tasks.cache = get_cache(
+            'django.core.cache.backends.locmem.LocMemCache')
+        tasks.publish_rifcs = type('Task', (object,), {
+            'apply_async': lambda self, **kwargs: queued.append(kwargs)})()
+        tasks.RIFCS_PUBLISH_DELAY = 1
+        try:
+            tasks.queue_rifcs_publish(3)
+            time.sleep(1.1)
+            tasks.queue_rifcs_publish(3)
+        finally:
+            tasks.cache, tasks.publish_rifcs = cache, publish_rifcs
+            tasks.RIFCS_PUBLISH_DELAY = delay
+        self.assertEquals([kwargs['args'] for kwargs in queued], [[3], [3]])
+
+    def testQueuedForStringIds(self):
+        import os
+        from tardis.tardis_portal.models import ExperimentParameterSet, \
+            Schema
+        experiment = Experiment.objects.create(
+            title="Experiment 1", created_by=self.user,
+            public_access=Experiment.PUBLIC_ACCESS_FULL)
+        os.remove(self._rifcs_file(experiment.id))
+        schema = Schema.objects.create(namespace='http://test/rifcs')
+        # As views set it, from the URL
+        ExperimentParameterSet(experiment_id=str(experiment.id),
+                               schema=schema).save()
+        self.assertTrue(os.path.exists(self._rifcs_file(experiment.id)))
+
+    def testRepublishCommand(self):
+        import os
+        from django.core.management import call_command
+        experiment = Experiment.objects.create(
+            title="Experiment 1", created_by=self.user,
+            public_access=Experiment.PUBLIC_ACCESS_FULL)
+        rifcs_file = self._rifcs_file(experiment.id)
+        os.remove(rifcs_file)
+        # Left behind by an experiment which has gone
+        stale_file = self._rifcs_file(experiment.id + 1)
+        open(stale_file, 'w').close()
+
+        call_command('republishrifcs', verbosity=0)
+        self.assertTrue(os.path.exists(rifcs_file))
+        self.assertFalse(os.path.exists(stale_file))
@@ -0,0 +1,81 @@
+import json
+from os import path
+
+from compare import expect
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.test import TestCase
+from django.test.client import RequestFactory
+
+from tardis.tardis_portal import views
+from tardis.tardis_portal.auth import AuthService
+from tardis.tardis_portal.models import Dataset_File, Experiment, \
+    RegistrationJob, UserProfile
+from tardis.tardis_portal.tests.test_authservice import MockSettings
+
+
+class RegistrationJobTestCase(TestCase):
+
+    def setUp(self):
+        call_command('loaddata', 'as_schemas')
+        self.user = User.objects.create_user('test', '', 'test')
+        UserProfile(user=self.user, isDjangoAccount=True).save()
+        settings = MockSettings()
+        settings.AUTH_PROVIDERS = (
+            ('localdb', 'Local DB',
+             'tardis.tardis_portal.auth.localdb_auth.DjangoAuthBackend'),)
+        self._auth_service = views.auth_service
+        views.auth_service = AuthService(settings=settings)
+        self.factory = RequestFactory()
+
+    def tearDown(self):
+        views.auth_service = self._auth_service
+
+    def _register(self, filename):
+        with open(filename) as f:
+            request = self.factory.post('/experiment/register/async/',
+                                        {'username': 'test',
+                                         'password': 'test',
+                                         'xmldata': f})
+        return views.register_experiment_ws_xmldata(request,
+                                                     asynchronous=True)
+
+    def _status(self, job_id):
+        request = self.factory.get('/experiment/register/status/%s/'
+                                   % job_id)
+        response = views.registration_status(request, job_id)
+        expect(response.status_code).to_equal(200)
+        return json.loads(response.content)
+
+    def testRegisterInBackground(self):
+        response = self._register(path.join(path.dirname(__file__),
+                                            'METS_test.xml'))
+        expect(response.status_code).to_equal(202)
+        job = RegistrationJob.objects.get()
+        expect(response['Location']).to_equal(
+            'http://testserver/experiment/register/status/%s/' % job.job_id)
+
+        # Tasks are run straight away in tests
+        status = self._status(job.job_id)
+        expect(status['status']).to_equal('finished')
+        expect(status['phase']).to_equal('finished')
+        expect(status['datasets']).to_equal(1)
+        expect(status['datafiles']).to_equal(8)
+        expect(status['experiment_id']).to_equal(job.experiment.id)
+        expect(Dataset_File.objects.filter(
+            dataset__experiments=job.experiment).count()).to_equal(8)
+        expect(Experiment.objects.get(id=job.experiment.id).title) \
+            .to_equal('SAXS Test')
+
+    def testFailedRegistration(self):
+        response = self._register(path.join(path.dirname(__file__),
+                                            'test.jpg'))
+        expect(response.status_code).to_equal(202)
+        status = self._status(RegistrationJob.objects.get().job_id)
+        expect(status['status']).to_equal('failed')
+        expect(status['error']).to_be_truthy()
+
+    def testUnknownJob(self):
+        request = self.factory.get('/experiment/register/status/abc/')
+        expect(views.registration_status(request, 'abc').status_code) \
+            .to_equal(404)
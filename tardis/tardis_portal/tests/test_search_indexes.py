@@ -0,0 +1,219 @@
+from datetime import date, timedelta
+
+from compare import expect
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.test import TestCase
+from django.test.client import RequestFactory
+
+from tardis.tardis_portal import tasks
+from tardis.tardis_portal.models import Author_Experiment, Dataset, \
+    Dataset_File, DatafileParameter, DatafileParameterSet, \
+    DatasetParameter, DatasetParameterSet, Experiment, ExperimentACL, \
+    FreeTextSearchField, ParameterName, Schema, SearchIndexMarker
+from tardis.tardis_portal.search_indexes import clear_markers, \
+    get_changes, IndexBatch, site
+from tardis.tardis_portal.search_query import get_access_filter, \
+    get_request_principals
+
+
+class _Backend(object):
+    """Prepares documents as Solr's backend does, and keeps them."""
+
+    def __init__(self):
+        self.docs = []
+
+    def update(self, index, iterable, commit=True):
+        self.docs.extend(index.full_prepare(obj) for obj in iterable)
+
+
+class IndexBatchTestCase(TestCase):
+
+    def setUp(self):
+        user = User.objects.create_user('indexer', 'indexer@email.test',
+                                        'pwd')
+        self.experiments = [Experiment.objects.create(title=title,
+                                                      created_by=user)
+                            for title in ('First', 'Second')]
+        Author_Experiment(experiment=self.experiments[0], author='Ada',
+                          order=0).save()
+        dataset = Dataset.objects.create(description='Crystals')
+        for experiment in self.experiments:
+            dataset.experiments.add(experiment)
+
+        ds_schema = Schema.objects.create(namespace='http://test/dataset',
+                                          name='Beamline',
+                                          type=Schema.DATASET)
+        beamline = ParameterName.objects.create(schema=ds_schema,
+                                                name='beamline',
+                                                full_name='Beamline',
+                                                is_searchable=True)
+        FreeTextSearchField.objects.create(parameter_name=beamline)
+        parameterset = DatasetParameterSet.objects.create(schema=ds_schema,
+                                                          dataset=dataset)
+        DatasetParameter.objects.create(parameterset=parameterset,
+                                        name=beamline, string_value='MX2')
+
+        df_schema = Schema.objects.create(namespace='http://test/datafile',
+                                          name='Image',
+                                          type=Schema.DATAFILE)
+        exposure = ParameterName.objects.create(
+            schema=df_schema, name='exposure', full_name='Exposure',
+            data_type=ParameterName.NUMERIC, is_searchable=True)
+        self.datafiles = []
+        for i in range(3):
+            datafile = Dataset_File.objects.create(
+                dataset=dataset, filename='frame%d.img' % i,
+                url='frame%d.img' % i, size=1)
+            parameterset = DatafileParameterSet.objects.create(
+                schema=df_schema, dataset_file=datafile)
+            DatafileParameter.objects.create(parameterset=parameterset,
+                                             name=exposure,
+                                             numerical_value=i)
+            self.datafiles.append(datafile)
+        self.index = site.get_index(Dataset_File)
+
+    def testPrepareBatch(self):
+        batch = IndexBatch(Dataset_File.objects.filter(
+            dataset__description='Crystals').select_related('dataset'))
+        # Everything was fetched with the batch
+        with self.assertNumQueries(0):
+            docs = [batch.prepare(datafile) for datafile in batch.datafiles]
+        expect(len(docs)).to_equal(3)
+        doc = docs[1]
+        expect(doc['experiment_id_stored']) \
+            .to_equal([e.id for e in self.experiments])
+        expect(doc['experiment_title']).to_equal('First')
+        expect(doc['experiment_authors']).to_equal(['Ada'])
+        for word in ('First', 'Second', 'Ada', 'indexer', 'Crystals', 'MX2',
+                     'frame1.img'):
+            expect(doc['text']).to_contain(word)
+        # Searchable parameters are fields, but only those with a
+        # FreeTextSearchField are in the text
+        expect(doc['dataset_beamline_beamline']).to_equal('MX2')
+        expect(doc['datafile_image_exposure']).to_equal(1)
+
+    def testPrincipals(self):
+        first, second = self.experiments
+        second.public_access = Experiment.PUBLIC_ACCESS_FULL
+        second.save()
+        for plugin_id, entity_id, can_read, expiry in (
+                ('django_user', '1', True, None),
+                ('django_group', '2', True, date.today()),
+                ('django_group', '3', False, None),
+                ('django_group', '4', True,
+                 date.today() - timedelta(days=1))):
+            ExperimentACL.objects.create(
+                experiment=first, pluginId=plugin_id, entityId=entity_id,
+                canRead=can_read, expiryDate=expiry,
+                aclOwnershipType=ExperimentACL.OWNER_OWNED)
+        batch = IndexBatch(Dataset_File.objects.all())
+        # Readable through either experiment, unless the ACL has expired
+        expect(batch.prepare(self.datafiles[0])['access_principals']) \
+            .to_equal(['django_group:2', 'django_user:1', 'public'])
+
+    def testRequestPrincipals(self):
+        request = RequestFactory().get('/search/')
+        request.user = User.objects.get(username='indexer')
+        request.groups = [('django_group', 7), ('vbl_group', '"EPN"')]
+        principals = get_request_principals(request)
+        expect(principals).to_equal(
+            ['public', 'django_user:%d' % request.user.id,
+             'django_group:7', 'vbl_group:"EPN"'])
+        expect(get_access_filter(principals[2:])).to_equal(
+            'access_principals:("django_group:7" OR "vbl_group:\\"EPN\\"")')
+
+    def testUpdateBatch(self):
+        backend = self.index.backend
+        self.index.backend = _Backend()
+        try:
+            self.index.update_batch(Dataset_File.objects.all())
+            docs = self.index.backend.docs
+        finally:
+            self.index.backend = backend
+        expect(sorted(doc['datafile_filename'] for doc in docs)) \
+            .to_equal(['frame0.img', 'frame1.img', 'frame2.img'])
+        expect(docs[0]['dataset_description']).to_equal('Crystals')
+        expect(docs[0]['text']).to_contain('Crystals')
+
+
+class ChangeTrackingTestCase(TestCase):
+
+    def setUp(self):
+        self._enabled = getattr(settings, 'SINGLE_SEARCH_ENABLED', False)
+        settings.SINGLE_SEARCH_ENABLED = True
+        # Don't try to reach the search engine
+        self.queued = []
+        self._queue = tasks.queue_search_index_update
+        tasks.queue_search_index_update = lambda: self.queued.append(True)
+        self.user = User.objects.create_user('tracker', '', 'pwd')
+
+    def tearDown(self):
+        tasks.queue_search_index_update = self._queue
+        settings.SINGLE_SEARCH_ENABLED = self._enabled
+
+    def _create(self):
+        experiment = Experiment.objects.create(title='Tracked',
+                                               created_by=self.user)
+        dataset = Dataset.objects.create(description='Tracked')
+        dataset.experiments.add(experiment)
+        datafiles = [Dataset_File.objects.create(dataset=dataset,
+                                                 filename='file%d' % i,
+                                                 url='file%d' % i, size=1)
+                     for i in range(3)]
+        SearchIndexMarker.objects.all().delete()
+        return experiment, dataset, datafiles
+
+    def _changed(self):
+        marker_ids, datafile_ids = get_changes()
+        clear_markers(marker_ids)
+        return datafile_ids
+
+    def testChangesMarked(self):
+        experiment, dataset, datafiles = self._create()
+        expect(self._changed()).to_equal(set())
+
+        datafiles[0].filename = 'renamed'
+        datafiles[0].save()
+        expect(self._changed()).to_equal(set([datafiles[0].id]))
+        expect(len(self.queued)).to_be_greater_than(0)
+
+        # Changes to the dataset or experiment cover all their datafiles
+        all_ids = set(df.id for df in datafiles)
+        dataset.description = 'Changed'
+        dataset.save()
+        expect(self._changed()).to_equal(all_ids)
+        Author_Experiment(experiment=experiment, author='Ada',
+                          order=0).save()
+        expect(self._changed()).to_equal(all_ids)
+
+        schema = Schema.objects.create(namespace='http://test/tracked',
+                                       type=Schema.DATASET)
+        name = ParameterName.objects.create(schema=schema, name='beamline',
+                                            full_name='Beamline')
+        parameterset = DatasetParameterSet.objects.create(schema=schema,
+                                                          dataset=dataset)
+        self._changed()
+        parameter = DatasetParameter.objects.create(
+            parameterset=parameterset, name=name, string_value='MX1')
+        expect(self._changed()).to_equal(all_ids)
+        parameter.delete()
+        expect(self._changed()).to_equal(all_ids)
+
+        # Datasets outlive their experiments, but not their place in them
+        experiment.delete()
+        expect(self._changed()).to_equal(all_ids)
+
+    def testDeletionsMarked(self):
+        experiment, dataset, datafiles = self._create()
+        datafile_id = datafiles[0].id
+        datafiles[0].delete()
+        # It will be removed from the index
+        expect(self._changed()).to_equal(set([datafile_id]))
+
+    def testNotTrackedWithoutSearch(self):
+        settings.SINGLE_SEARCH_ENABLED = False
+        self._create()
+        Experiment.objects.create(title='Untracked', created_by=self.user)
+        expect(SearchIndexMarker.objects.count()).to_equal(0)
+        expect(self.queued).to_equal([])
@@ -0,0 +1,114 @@
+from compare import expect
+from django.contrib.auth.models import User
+from django.test import TestCase
+
+from tardis.tardis_portal.models import Dataset, Dataset_File, \
+    DatasetStatistics, Experiment, ExperimentStatistics
+
+
+class StatisticsTestCase(TestCase):
+
+    def setUp(self):
+        user = User.objects.create_user('testuser', 'user@email.test', 'pwd')
+        self.experiment = Experiment.objects.create(title='Statistics',
+                                                    created_by=user)
+        self.dataset = Dataset.objects.create(description='dataset')
+        self.dataset.experiments.add(self.experiment)
+
+    def _create_datafile(self, filename, size, dataset=None):
+        return Dataset_File.objects.create(dataset=dataset or self.dataset,
+                                           filename=filename,
+                                           url=filename, size=size)
+
+    def _expect_totals(self, datafile_count, size):
+        dataset_stats = DatasetStatistics.get_for(self.dataset)
+        experiment_stats = ExperimentStatistics.get_for(self.experiment)
+        for stats in (dataset_stats, experiment_stats):
+            expect(stats.datafile_count).to_equal(datafile_count)
+            expect(stats.size).to_equal(size)
+
+    def testSumSizes(self):
+        self._create_datafile('a', 10)
+        self._create_datafile('b', None)
+        self._create_datafile('c', '5')
+        expect(Dataset_File.sum_sizes(Dataset_File.objects.all())) \
+            .to_equal(15)
+        expect(Dataset_File.sum_sizes(Dataset_File.objects.none())) \
+            .to_equal(0)
+        expect(self.dataset.get_size()).to_equal(15)
+        expect(self.experiment.get_size()).to_equal(15)
+
+    def testTotalsFollowChanges(self):
+        first = self._create_datafile('a', 10)
+        # Totals are calculated when first needed...
+        self._expect_totals(1, 10)
+        # ...and then kept up to date
+        second = self._create_datafile('b', 20)
+        self._expect_totals(2, 30)
+        second = Dataset_File.objects.get(id=second.id)
+        second.size = 25
+        second.save()
+        self._expect_totals(2, 35)
+        first.delete()
+        self._expect_totals(1, 25)
+
+        other = Dataset.objects.create(description='other')
+        second.dataset = other
+        second.save()
+        self._expect_totals(0, 0)
+        expect(DatasetStatistics.get_for(other).size).to_equal(25)
+
+        # Adding a dataset to the experiment brings its files with it
+        other.experiments.add(self.experiment)
+        expect(ExperimentStatistics.get_for(self.experiment).size) \
+            .to_equal(25)
+
+    def testDatasetCount(self):
+        expect(ExperimentStatistics.get_for(self.experiment).dataset_count) \
+            .to_equal(1)
+        other = Dataset.objects.create(description='other')
+        other.experiments.add(self.experiment)
+        expect(ExperimentStatistics.get_for(self.experiment).dataset_count) \
+            .to_equal(2)
+        other.delete()
+        expect(ExperimentStatistics.get_for(self.experiment).dataset_count) \
+            .to_equal(1)
+
+    def testLoadFor(self):
+        other = Dataset.objects.create(description='other')
+        other.experiments.add(self.experiment)
+        self._create_datafile('a', 10)
+        self._create_datafile('b', 20, dataset=other)
+        self._create_datafile('c', 5, dataset=other)
+        # Totals for one dataset exist already, the other's are calculated
+        DatasetStatistics.get_for(self.dataset)
+
+        datasets = list(Dataset.objects.order_by('id'))
+        DatasetStatistics.load_for(datasets)
+        experiments = list(Experiment.objects.all())
+        ExperimentStatistics.load_for(experiments)
+        with self.assertNumQueries(0):
+            expect([DatasetStatistics.get_for(ds).size for ds in datasets]) \
+                .to_equal([10, 25])
+            stats = ExperimentStatistics.get_for(experiments[0])
+        expect(stats.dataset_count).to_equal(2)
+        expect(stats.datafile_count).to_equal(3)
+        expect(stats.size).to_equal(35)
+        expect(DatasetStatistics.objects.count()).to_equal(2)
+        expect(ExperimentStatistics.objects.count()).to_equal(1)
+
+    def testLoadForExperimentsPage(self):
+        from django.test.client import RequestFactory
+        from tardis.tardis_portal.views import _get_experiments_page
+        for i in range(54):
+            Experiment.objects.create(title='Statistics %d' % i,
+                                      created_by=self.experiment.created_by)
+        request = RequestFactory().get('/', {'page': '2'})
+        page = _get_experiments_page(request,
+                                     Experiment.objects.order_by('id'))
+        expect(len(page.object_list)).to_equal(5)
+        # Only the experiments on the page had their totals calculated
+        expect(ExperimentStatistics.objects.count()).to_equal(5)
+        with self.assertNumQueries(0):
+            for experiment in page.object_list:
+                ExperimentStatistics.get_for(experiment)
@@ -0,0 +1,102 @@
+import hashlib
+from os import path
+from StringIO import StringIO
+
+from compare import expect
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.test import TestCase
+
+from tardis.tardis_portal.models import Experiment, Dataset, Dataset_File, \
+    StoredBlob
+from tardis.tardis_portal.staging import write_uploaded_file_to_dataset
+from tardis.tardis_portal.storage import DeduplicatingFileSystemStorage, \
+    get_blob_name, is_blob
+
+
+class DeduplicatingStorageTestCase(TestCase):
+
+    content = 'Calibration data\n'
+
+    def setUp(self):
+        user = User.objects.create_user('testuser', 'user@email.test', 'pwd')
+        self.experiment = Experiment.objects.create(title='Dedup',
+                                                    created_by=user)
+        self.dataset = Dataset(description='dataset')
+        self.dataset.save()
+        self.dataset.experiments.add(self.experiment)
+        self.storage = DeduplicatingFileSystemStorage()
+        self.sha512sum = hashlib.sha512(self.content).hexdigest()
+
+    def tearDown(self):
+        for blob in StoredBlob.objects.all():
+            blob.refcount = 0
+            blob.save()
+            self.storage.delete(get_blob_name(blob.sha512sum))
+
+    def _create_datafile(self, filename, url):
+        datafile = Dataset_File(dataset=self.dataset, filename=filename,
+                                url=url, size=str(len(self.content)),
+                                sha512sum=self.sha512sum, verified=True)
+        datafile.save()
+        return datafile
+
+    def _blob_path(self):
+        return path.join(settings.FILE_STORE_PATH,
+                         get_blob_name(self.sha512sum))
+
+    def testSaveDeduplicates(self):
+        first = self.storage.save('1/1/a.txt', ContentFile(self.content))
+        second = self.storage.save('1/2/b.txt', ContentFile(self.content))
+        expect(first).to_equal(get_blob_name(self.sha512sum))
+        expect(second).to_equal(first)
+        expect(is_blob(first)).to_be_truthy()
+        with open(self._blob_path()) as f:
+            expect(f.read()).to_equal(self.content)
+        blob = StoredBlob.objects.get(sha512sum=self.sha512sum)
+        expect(blob.refcount).to_equal(2)
+        expect(blob.size).to_equal(len(self.content))
+
+    def testDeleteCompletelyReleasesBlob(self):
+        name = self.storage.save('a.txt', ContentFile(self.content))
+        self.storage.save('b.txt', ContentFile(self.content))
+        first = self._create_datafile('a.txt', name)
+        second = self._create_datafile('b.txt', name)
+        first.deleteCompletely()
+        # Still referenced by the second datafile
+        expect(path.exists(self._blob_path())).to_be_truthy()
+        expect(StoredBlob.objects.get(sha512sum=self.sha512sum).refcount) \
+            .to_equal(1)
+        second.deleteCompletely()
+        expect(path.exists(self._blob_path())).to_be_falsy()
+        expect(StoredBlob.objects.count()).to_equal(0)
+
+    def testRmExperimentReleasesBlob(self):
+        name = self.storage.save('a.txt', ContentFile(self.content))
+        self._create_datafile('a.txt', name)
+        call_command('rmexperiment', str(self.experiment.id),
+                     confirmed=True, stdout=StringIO())
+        expect(path.exists(self._blob_path())).to_be_falsy()
+        expect(StoredBlob.objects.count()).to_equal(0)
+
+    def testDedupFiles(self):
+        urls = [write_uploaded_file_to_dataset(
+                    self.dataset, ContentFile(self.content, filename))
+                for filename in ('a.txt', 'b.txt')]
+        datafiles = [self._create_datafile(path.basename(url), url)
+                     for url in urls]
+        stdout = StringIO()
+        call_command('dedupfiles', stdout=stdout)
+        expect(stdout.getvalue()).to_contain(
+            'Folded 2 files, 1 duplicates (%d bytes saved)' %
+            len(self.content))
+        for datafile, url in zip(datafiles, urls):
+            datafile = Dataset_File.objects.get(id=datafile.id)
+            expect(datafile.url).to_equal(get_blob_name(self.sha512sum))
+            expect(path.exists(path.join(settings.FILE_STORE_PATH, url))) \
+                .to_be_falsy()
+            expect(datafile.get_file().read()).to_equal(self.content)
+        expect(StoredBlob.objects.get(sha512sum=self.sha512sum).refcount) \
+            .to_equal(2)
@@ -57,6 +57,30 @@ class BackgroundTaskTestCase(TestCase):
         expect(get_datafile(datafile).verified).to_be(True)
 
 
+    def testBatchedFiles(self):
+        from tardis.tardis_portal import tasks
+        datafiles = []
+        for i in range(5):
+            content = urandom(1024)
+            cf = ContentFile(content, 'background_task_testfile_%d' % i)
+            datafile = Dataset_File(dataset=self.dataset)
+            datafile.filename = cf.name
+            datafile.size = len(content)
+            datafile.sha512sum = hashlib.sha512(content).hexdigest()
+            datafile.url = write_uploaded_file_to_dataset(self.dataset, cf)
+            datafile.save()
+            datafiles.append(datafile)
+
+        batch_size, tasks.VERIFY_BATCH_SIZE = tasks.VERIFY_BATCH_SIZE, 2
+        try:
+            verify_files()
+        finally:
+            tasks.VERIFY_BATCH_SIZE = batch_size
+        for datafile in datafiles:
+            expect(Dataset_File.objects.get(id=datafile.id).verified)\
+                .to_be(True)
+
+
     def testRemoteFile(self):
             content = urandom(1024)
             with NamedTemporaryFile() as f:
@@ -0,0 +1,143 @@
+import hashlib
+import json
+from base64 import b64encode
+from os import path
+
+from compare import expect
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.test import TestCase
+from django.test.client import RequestFactory
+
+from tardis.tardis_portal.auth.localdb_auth import django_user
+from tardis.tardis_portal.models import ChunkedUpload, Dataset, \
+    Dataset_File, Experiment, ExperimentACL, UserProfile
+from tardis.tardis_portal import upload
+
+
+class ChunkedUploadTestCase(TestCase):
+
+    content = 'The quick brown fox jumps over the lazy dog\n' * 100
+
+    def setUp(self):
+        user = User.objects.create_user('testuser', 'user@email.test', 'pwd')
+        UserProfile(user=user, isDjangoAccount=True).save()
+        experiment = Experiment.objects.create(title='Chunked Upload',
+                                               created_by=user)
+        ExperimentACL(pluginId=django_user,
+                      entityId=str(user.id),
+                      experiment=experiment,
+                      canRead=True,
+                      canWrite=True,
+                      isOwner=True,
+                      aclOwnershipType=ExperimentACL.OWNER_OWNED).save()
+        self.dataset = Dataset(description='dataset')
+        self.dataset.save()
+        self.dataset.experiments.add(experiment)
+        self.user = user
+        self.factory = RequestFactory()
+        self.base_url = '/upload/%d/chunked/' % self.dataset.id
+
+    def _call(self, request, view, **kwargs):
+        request.user = self.user
+        request.groups = []
+        return view(request, dataset_id=str(self.dataset.id), **kwargs)
+
+    def _start(self, **extra):
+        data = {'filename': 'fox.txt', 'size': len(self.content)}
+        data.update(extra)
+        return self._call(self.factory.post(self.base_url, data),
+                          upload.start_upload)
+
+    def _put(self, upload_id, chunk, data, md5=None):
+        md5 = md5 or b64encode(hashlib.md5(data).digest())
+        request = self.factory.put(
+            '%s%s/%d/' % (self.base_url, upload_id, chunk), data,
+            content_type='application/octet-stream', HTTP_CONTENT_MD5=md5)
+        return self._call(request, upload.upload_chunk, upload_id=upload_id,
+                          chunk=str(chunk))
+
+    def _complete(self, upload_id):
+        request = self.factory.post('%s%s/complete/' %
+                                    (self.base_url, upload_id))
+        return self._call(request, upload.complete_upload,
+                          upload_id=upload_id)
+
+    def testUploadInChunks(self):
+        response = self._start(
+            sha512sum=hashlib.sha512(self.content).hexdigest())
+        expect(response.status_code).to_equal(201)
+        upload_id = json.loads(response.content)['upload_id']
+
+        chunks = [self.content[i:i + 1000]
+                  for i in range(0, len(self.content), 1000)]
+        for i, chunk in enumerate(chunks):
+            response = self._put(upload_id, i, chunk)
+            expect(response.status_code).to_equal(200)
+        expect(json.loads(response.content)['offset']) \
+            .to_equal(len(self.content))
+
+        response = self._complete(upload_id)
+        expect(response.status_code).to_equal(201)
+        datafile = Dataset_File.objects.get(
+            id=json.loads(response.content)['datafile_id'])
+        expect(datafile.verified).to_be_truthy()
+        expect(datafile.size).to_equal(len(self.content))
+        expect(datafile.md5sum).to_equal(hashlib.md5(self.content).hexdigest())
+        expect(datafile.mimetype).to_equal('text/plain')
+        expect(datafile.get_file().read()).to_equal(self.content)
+        expect(ChunkedUpload.objects.count()).to_equal(0)
+
+    def testResume(self):
+        upload_id = json.loads(self._start().content)['upload_id']
+        expect(self._put(upload_id, 0, self.content[:1000]).status_code) \
+            .to_equal(200)
+        # A corrupted chunk isn't accepted
+        response = self._put(upload_id, 1, self.content[1000:2000],
+                             md5=b64encode(hashlib.md5('').digest()))
+        expect(response.status_code).to_equal(400)
+        # Chunks must arrive in order
+        expect(self._put(upload_id, 2, self.content[2000:]).status_code) \
+            .to_equal(409)
+
+        # Starting the same upload again finds where it got to, even in a
+        # process which has lost the running checksums
+        upload._checksums.discard(ChunkedUpload.objects.get())
+        response = self._start()
+        expect(response.status_code).to_equal(200)
+        status = json.loads(response.content)
+        expect(status['upload_id']).to_equal(upload_id)
+        expect(status['offset']).to_equal(1000)
+        expect(status['next_chunk']).to_equal(1)
+
+        # Completing early is refused
+        expect(self._complete(upload_id).status_code).to_equal(409)
+
+        self._put(upload_id, 1, self.content[1000:])
+        response = self._complete(upload_id)
+        expect(response.status_code).to_equal(201)
+        result = json.loads(response.content)
+        expect(result['sha512sum']) \
+            .to_equal(hashlib.sha512(self.content).hexdigest())
+        datafile = Dataset_File.objects.get(id=result['datafile_id'])
+        with open(path.join(settings.FILE_STORE_PATH, datafile.url)) as f:
+            expect(f.read()).to_equal(self.content)
+
+    def testChecksumMismatch(self):
+        upload_id = json.loads(self._start(md5sum='0' * 32).content) \
+            ['upload_id']
+        self._put(upload_id, 0, self.content)
+        expect(self._complete(upload_id).status_code).to_equal(400)
+        expect(Dataset_File.objects.count()).to_equal(0)
+        expect(ChunkedUpload.objects.count()).to_equal(0)
+
+    def testAbandon(self):
+        upload_id = json.loads(self._start().content)['upload_id']
+        url = ChunkedUpload.objects.get().url
+        request = self.factory.delete('%s%s/' % (self.base_url, upload_id))
+        response = self._call(request, upload.upload_status,
+                              upload_id=upload_id)
+        expect(response.status_code).to_equal(200)
+        expect(ChunkedUpload.objects.count()).to_equal(0)
+        expect(path.exists(path.join(settings.FILE_STORE_PATH, url))) \
+            .to_be_falsy()
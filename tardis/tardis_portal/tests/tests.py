@@ -504,7 +504,7 @@ class MetsMetadataInfoHandlerTestCase(TestCase):
         datafile = datafiles.get(filename='ment0003.osc')
         self.assertTrue(datafile is not None,
             'datafile should not be none')
-        self.assertTrue(datafile.size == '18006000',
+        self.assertTrue(datafile.size == 18006000,
             'wrong file size for ment0003.osc')
         expect(datafile.url).to_equal('file://'+path.join(self.sync_path,
                                                         'Images/ment0003.osc'))
@@ -0,0 +1,332 @@
+# -*- coding: utf-8 -*-
+
+"""
+upload.py
+
+Chunked, resumable uploads.  A client starts an upload, PUTs the file one
+numbered chunk at a time and then completes it::
+
+    POST   /upload/<dataset_id>/chunked/
+           filename, size, [md5sum], [sha512sum]
+    PUT    /upload/<dataset_id>/chunked/<upload_id>/<chunk>/
+           chunk data, with a Content-MD5 header (RFC 1864)
+    GET    /upload/<dataset_id>/chunked/<upload_id>/
+    DELETE /upload/<dataset_id>/chunked/<upload_id>/
+    POST   /upload/<dataset_id>/chunked/<upload_id>/complete/
+
+Every call returns the state of the upload as JSON.  Chunks are numbered
+from 0 and must arrive in order, but may be any size up to
+UPLOAD_CHUNK_SIZE_LIMIT.  Starting an upload of the same file again picks
+up the unfinished one, so an interrupted client carries on from the chunk
+it reports.
+
+Chunks are written straight to where the file will live in the store, and
+the whole-file checksums are updated as each chunk arrives, so completing
+an upload doesn't read the file again.
+"""
+
+import hashlib
+import json
+import logging
+import os
+from base64 import b64decode, b64encode
+from threading import Lock
+from uuid import uuid4
+
+from magic import Magic
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import get_storage_class
+from django.http import HttpResponse, HttpResponseBadRequest, \
+    HttpResponseNotAllowed, HttpResponseNotFound
+from django.views.decorators.cache import never_cache
+
+from tardis.tardis_portal.auth import decorators as authz
+from tardis.tardis_portal.checksums import BUFFER_SIZE
+from tardis.tardis_portal.models import ChunkedUpload, Dataset, Dataset_File
+from tardis.tardis_portal.staging import get_upload_path
+from tardis.tardis_portal.storage import DeduplicatingFileSystemStorage, \
+    MyTardisLocalFileSystemStorage, adopt_blob
+
+logger = logging.getLogger(__name__)
+
+# Largest chunk accepted in a single PUT
+CHUNK_SIZE_LIMIT = getattr(settings, 'UPLOAD_CHUNK_SIZE_LIMIT',
+                           64 * 1024 * 1024)
+
+# Size of the blocks chunks are copied to disk in
+_BLOCK_SIZE = 64 * 1024
+
+
+class _Checksums(object):
+    """
+    Running md5 and sha512 digests of the uploads this process is handling,
+    so each chunk only needs hashing once.  The digests can't be stored in
+    the database, so if an upload moves to another process (or the server
+    restarts) they are rebuilt from the data already on disk.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._hashes = {}
+
+    def get(self, upload, path):
+        """Return copies of the digests of the first upload.offset bytes."""
+        with self._lock:
+            offset, hashes = self._hashes.get(upload.upload_id, (None, None))
+        if offset != upload.offset:
+            hashes = dict((name, hashlib.new(name))
+                          for name in ('md5', 'sha512'))
+            with open(path, 'rb') as f:
+                remaining = upload.offset
+                while remaining > 0:
+                    data = f.read(min(BUFFER_SIZE, remaining))
+                    if not data:
+                        break
+                    remaining -= len(data)
+                    for hash_ in hashes.values():
+                        hash_.update(data)
+        return dict((name, hash_.copy()) for name, hash_ in hashes.items())
+
+    def put(self, upload, hashes):
+        with self._lock:
+            self._hashes[upload.upload_id] = (upload.offset, hashes)
+
+    def discard(self, upload):
+        with self._lock:
+            self._hashes.pop(upload.upload_id, None)
+
+_checksums = _Checksums()
+
+
+def _get_path(upload):
+    return MyTardisLocalFileSystemStorage().path(upload.url)
+
+def _json_response(data, status=200):
+    return HttpResponse(json.dumps(data), status=status,
+                        mimetype='application/json')
+
+def _status_response(upload, status=200):
+    return _json_response({'upload_id': upload.upload_id,
+                           'filename': upload.filename,
+                           'size': upload.size,
+                           'offset': upload.offset,
+                           'next_chunk': upload.chunks}, status)
+
+def _get_upload(request, dataset_id, upload_id):
+    try:
+        return ChunkedUpload.objects.select_for_update() \
+                                    .get(upload_id=upload_id,
+                                         dataset__id=dataset_id,
+                                         user=request.user)
+    except ChunkedUpload.DoesNotExist:
+        return None
+
+
+@never_cache
+@authz.dataset_write_permissions_required
+def start_upload(request, dataset_id):
+    """
+    Start a chunked upload of a file to a dataset, or find the unfinished
+    upload of the same file so it can be resumed.
+
+    :param request: a HTTP Request instance
+    :type request: :class:`django.http.HttpRequest`
+    :param dataset_id: the dataset_id
+    :type dataset_id: integer
+    :rtype: :class:`django.http.HttpResponse`
+    """
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    try:
+        filename = request.POST['filename']
+        size = int(request.POST['size'])
+    except (KeyError, ValueError):
+        return HttpResponseBadRequest('filename and size are required')
+    if not filename or size < 0:
+        return HttpResponseBadRequest('filename and size are required')
+    md5sum = request.POST.get('md5sum', '').lower()
+    sha512sum = request.POST.get('sha512sum', '').lower()
+
+    dataset = Dataset.objects.get(id=dataset_id)
+    unfinished = ChunkedUpload.objects.filter(dataset=dataset,
+                                              user=request.user,
+                                              filename=filename,
+                                              size=size,
+                                              md5sum=md5sum,
+                                              sha512sum=sha512sum)
+    if unfinished.exists():
+        return _status_response(unfinished.order_by('-offset')[0])
+
+    # Reserve the file's place in the store, so other uploads can't take it
+    url = MyTardisLocalFileSystemStorage().save(
+        get_upload_path(dataset, filename), ContentFile(''))
+    upload = ChunkedUpload.objects.create(upload_id=uuid4().hex,
+                                          dataset=dataset,
+                                          user=request.user,
+                                          filename=filename,
+                                          url=url,
+                                          size=size,
+                                          md5sum=md5sum,
+                                          sha512sum=sha512sum)
+    logger.debug('Started chunked upload %s' % upload)
+    return _status_response(upload, status=201)
+
+
+@never_cache
+@authz.dataset_write_permissions_required
+def upload_status(request, dataset_id, upload_id):
+    """
+    Report how much of a chunked upload has arrived, or abandon it.
+
+    :param request: a HTTP Request instance
+    :type request: :class:`django.http.HttpRequest`
+    :param dataset_id: the dataset_id
+    :type dataset_id: integer
+    :param upload_id: the upload_id returned by :func:`start_upload`
+    :type upload_id: string
+    :rtype: :class:`django.http.HttpResponse`
+    """
+    if request.method not in ('GET', 'DELETE'):
+        return HttpResponseNotAllowed(['GET', 'DELETE'])
+    upload = _get_upload(request, dataset_id, upload_id)
+    if not upload:
+        return HttpResponseNotFound()
+    if request.method == 'DELETE':
+        _checksums.discard(upload)
+        MyTardisLocalFileSystemStorage().delete(upload.url)
+        upload.delete()
+    return _status_response(upload)
+
+
+@never_cache
+@authz.dataset_write_permissions_required
+def upload_chunk(request, dataset_id, upload_id, chunk):
+    """
+    Write the next chunk of an upload to the store.  Chunks which have
+    already arrived are acknowledged without being written again, so a
+    client can safely retry a chunk it didn't see the response for.
+
+    :param request: a HTTP Request instance
+    :type request: :class:`django.http.HttpRequest`
+    :param dataset_id: the dataset_id
+    :type dataset_id: integer
+    :param upload_id: the upload_id returned by :func:`start_upload`
+    :type upload_id: string
+    :param chunk: the number of the chunk, counting from 0
+    :type chunk: integer
+    :rtype: :class:`django.http.HttpResponse`
+    """
+    if request.method != 'PUT':
+        return HttpResponseNotAllowed(['PUT'])
+    upload = _get_upload(request, dataset_id, upload_id)
+    if not upload:
+        return HttpResponseNotFound()
+    chunk = int(chunk)
+    if chunk < upload.chunks:
+        return _status_response(upload)
+    if chunk > upload.chunks:
+        return _status_response(upload, status=409)
+
+    try:
+        length = int(request.META.get('CONTENT_LENGTH') or 0)
+        expected_md5 = b64decode(request.META['HTTP_CONTENT_MD5'])
+    except (KeyError, TypeError, ValueError):
+        return HttpResponseBadRequest('Content-Length and Content-MD5 '
+                                      'are required')
+    if length > CHUNK_SIZE_LIMIT:
+        return HttpResponse('Chunks may be at most %d bytes' %
+                            CHUNK_SIZE_LIMIT, status=413)
+    if length == 0 or upload.offset + length > upload.size:
+        return HttpResponseBadRequest('Chunk does not fit in the file')
+
+    path = _get_path(upload)
+    hashes = _checksums.get(upload, path)
+    chunk_md5 = hashlib.md5()
+    received = 0
+    with open(path, 'r+b') as f:
+        f.seek(upload.offset)
+        while received < length:
+            data = request.read(min(_BLOCK_SIZE, length - received))
+            if not data:
+                break
+            received += len(data)
+            chunk_md5.update(data)
+            for hash_ in hashes.values():
+                hash_.update(data)
+            f.write(data)
+        # Drop anything left over from an earlier failed attempt
+        f.truncate()
+    if received != length or chunk_md5.digest() != expected_md5:
+        # Leave the upload where it was, so the chunk can be sent again
+        return _json_response({'error': 'Chunk %d was corrupted' % chunk,
+                               'content_md5': b64encode(chunk_md5.digest())},
+                              status=400)
+
+    upload.offset += length
+    upload.chunks += 1
+    upload.save()
+    _checksums.put(upload, hashes)
+    return _status_response(upload)
+
+
+@never_cache
+@authz.dataset_write_permissions_required
+def complete_upload(request, dataset_id, upload_id):
+    """
+    Turn a fully received upload into a verified datafile.
+
+    :param request: a HTTP Request instance
+    :type request: :class:`django.http.HttpRequest`
+    :param dataset_id: the dataset_id
+    :type dataset_id: integer
+    :param upload_id: the upload_id returned by :func:`start_upload`
+    :type upload_id: string
+    :rtype: :class:`django.http.HttpResponse`
+    """
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    upload = _get_upload(request, dataset_id, upload_id)
+    if not upload:
+        return HttpResponseNotFound()
+    if upload.offset != upload.size:
+        return _status_response(upload, status=409)
+
+    path = _get_path(upload)
+    digests = dict((name, hash_.hexdigest()) for name, hash_
+                   in _checksums.get(upload, path).items())
+    _checksums.discard(upload)
+    for name in ('md5', 'sha512'):
+        expected = getattr(upload, name + 'sum')
+        if expected and expected != digests[name]:
+            logger.error('Chunked upload %s failed %s check' % (upload, name))
+            MyTardisLocalFileSystemStorage().delete(upload.url)
+            upload.delete()
+            return _json_response({'error': '%s mismatch' % name}, status=400)
+
+    with open(path, 'rb') as f:
+        # Limit sniffed mimetype data as Dataset_File.verify does
+        header = f.read(8096)
+    url = upload.url
+    if issubclass(get_storage_class(), DeduplicatingFileSystemStorage):
+        url = adopt_blob(path, digests['sha512'], upload.size)
+        os.remove(path)
+    datafile = Dataset_File(dataset=upload.dataset,
+                            filename=upload.filename,
+                            url=url,
+                            size=upload.size,
+                            md5sum=digests['md5'],
+                            sha512sum=digests['sha512'],
+                            protocol='',
+                            verified=True)
+    if header:
+        datafile.mimetype = Magic(mime=True).from_buffer(header)
+    datafile.save()
+    upload.delete()
+    logger.info('Completed chunked upload of datafile #%d' % datafile.id)
+    return _json_response({'datafile_id': datafile.id,
+                           'filename': datafile.filename,
+                           'size': upload.size,
+                           'md5sum': datafile.md5sum,
+                           'sha512sum': datafile.sha512sum}, status=201)
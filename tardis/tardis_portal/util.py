@@ -30,6 +30,17 @@ def get_utc_time(dt):
         dt = dt.replace(tzinfo=LOCAL_TZ)
     return dt.astimezone(pytz.utc)
 
+def is_cache_shared(cache):
+    '''
+    Return whether a Django cache is shared between processes, as it must
+    be for state which coordinates them (or is invalidated by one for the
+    others).  The local memory cache, which Django uses when CACHES isn't
+    set, and the dummy cache aren't.
+    '''
+    from django.core.cache.backends.dummy import DummyCache
+    from django.core.cache.backends.locmem import LocMemCache
+    return not isinstance(cache, (DummyCache, LocMemCache))
+
 def _load_template(template_name):
     from mustachejs.loading import find
     with open(find(template_name), 'r') as f:
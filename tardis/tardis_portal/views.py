@@ -43,10 +43,13 @@ from tardis.tardis_portal.auth.decorators import has_datafile_download_access,\
 from base64 import b64decode
 import urllib2
 from urllib import urlencode, urlopen
+import mimetypes
+import os
 from os import path
 import logging
 import json
 from operator import itemgetter
+from uuid import uuid4
 
 from django.template import Context
 from django.conf import settings
@@ -54,7 +57,9 @@ from django.db import transaction
 from django.db.models import Q, Sum
 from django.shortcuts import render_to_response, redirect
 from django.contrib.auth.models import User, Group, AnonymousUser
-from django.http import HttpResponseRedirect, HttpResponse, HttpResponseForbidden, HttpResponseNotFound
+from django.http import HttpResponseRedirect, HttpResponse, HttpResponseForbidden, HttpResponseNotFound, \
+    HttpResponseNotModified
+from django.utils.http import http_date, parse_http_date_safe
 from django.contrib.auth.decorators import login_required, permission_required
 from django.core.urlresolvers import reverse
 from django.core.paginator import Paginator, InvalidPage, EmptyPage
@@ -86,13 +91,15 @@ from tardis.tardis_portal.staging import get_full_staging_path, \
     staging_list
 
 from tardis.tardis_portal.tasks import create_staging_datafiles,\
-    create_staging_datafile
+    create_staging_datafile, queue_datafile_post_save_hooks, \
+    register_experiment
 
 from tardis.tardis_portal.models import Experiment, ExperimentParameter, \
     DatafileParameter, DatasetParameter, ExperimentACL, Dataset_File, \
     DatafileParameterSet, ParameterName, GroupAdmin, Schema, \
     Dataset, ExperimentParameterSet, DatasetParameterSet, \
-    License, UserProfile, UserAuthentication, Token
+    License, UserProfile, UserAuthentication, Token, ExperimentStatistics, \
+    RegistrationJob
 
 from tardis.tardis_portal import constants
 from tardis.tardis_portal.auth.localdb_auth import django_user, django_group
@@ -104,13 +111,16 @@ from tardis.tardis_portal.shortcuts import render_response_index, \
     render_response_search, render_error_message, \
     get_experiment_referer
 from tardis.tardis_portal.metsparser import parseMets
+from tardis.tardis_portal.storage import PREVIEW_DIRECTORY, \
+    get_preview_path, is_preview
 from tardis.tardis_portal.creativecommonshandler import CreativeCommonsHandler
 from tardis.tardis_portal.hacks import oracle_dbops_hack
 from tardis.tardis_portal.util import render_public_access_badge
 
 from haystack.views import SearchView
 from haystack.query import SearchQuerySet
-from tardis.tardis_portal.search_query import FacetFixedSearchQuery
+from tardis.tardis_portal.search_query import FacetFixedSearchQuery, \
+    get_access_filter, get_request_principals
 from tardis.tardis_portal.forms import RawSearchForm
 from tardis.tardis_portal.search_backend import HighlightSearchBackend
 from django.contrib.auth import logout as django_logout
@@ -132,7 +142,7 @@ def get_dataset_info(dataset, include_thumbnail=False):
     obj['url'] = dataset.get_absolute_url()
 
     obj['size'] = dataset.get_size()
-    obj['size_human_readable'] = filesizeformat(dataset.get_size())
+    obj['size_human_readable'] = filesizeformat(obj['size'])
 
     if include_thumbnail:
         try:
@@ -243,6 +253,73 @@ def load_datafile_image(request, parameter_id):
         return return_response_error(request)
 
 
+def _read_file_range(filepath, start, stop, chunk_size=64 * 1024):
+    with open(filepath, 'rb') as f:
+        f.seek(start)
+        remaining = stop - start
+        while remaining > 0:
+            chunk = f.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def _image_parameter_response(request, value):
+    '''
+    Return the image held by a parameter: a preview in the file store, which
+    is streamed with an ETag and Last-Modified so it can be cached and
+    resumed, or (as filters stored them before) base64 encoded data.
+    '''
+    if not is_preview(value):
+        # Anything else in the preview directory is not ours to serve
+        if value.startswith(PREVIEW_DIRECTORY + '/'):
+            return HttpResponseNotFound()
+        return HttpResponse(b64decode(value), mimetype='image/jpeg')
+    filepath = get_preview_path(value)
+    try:
+        stat = os.stat(filepath)
+    except OSError:
+        return HttpResponseNotFound()
+    # Previews are named after their content, so never change
+    etag = '"%s"' % path.splitext(path.basename(value))[0]
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if_modified_since = parse_http_date_safe(
+        request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+    if if_none_match == etag or (if_none_match is None and
+                                 if_modified_since and
+                                 if_modified_since >= int(stat.st_mtime)):
+        response = HttpResponseNotModified()
+        response['ETag'] = etag
+        return response
+
+    # download imports this module
+    from tardis.tardis_portal.download import parse_range_header
+    mimetype = mimetypes.guess_type(filepath)[0] or 'image/jpeg'
+    length = stat.st_size
+    try:
+        byte_range = parse_range_header(request, length, etag)
+    except ValueError:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = 'bytes */%d' % length
+        return response
+    if byte_range:
+        start, stop = byte_range
+        response = HttpResponse(_read_file_range(filepath, start, stop),
+                                mimetype=mimetype, status=206)
+        response['Content-Range'] = \
+            'bytes %d-%d/%d' % (start, stop - 1, length)
+        length = stop - start
+    else:
+        response = HttpResponse(_read_file_range(filepath, 0, length),
+                                mimetype=mimetype)
+    response['Content-Length'] = str(length)
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(stat.st_mtime)
+    return response
+
+
 @authz.experiment_access_required
 def display_experiment_image(
     request, experiment_id, parameterset_id, parameter_name):
@@ -255,7 +332,7 @@ def display_experiment_image(
     image = ExperimentParameter.objects.get(name__name=parameter_name,
                                             parameterset=parameterset_id)
 
-    return HttpResponse(b64decode(image.string_value), mimetype='image/jpeg')
+    return _image_parameter_response(request, image.string_value)
 
 
 @authz.dataset_access_required
@@ -270,7 +347,7 @@ def display_dataset_image(
     image = DatasetParameter.objects.get(name__name=parameter_name,
                                          parameterset=parameterset_id)
 
-    return HttpResponse(b64decode(image.string_value), mimetype='image/jpeg')
+    return _image_parameter_response(request, image.string_value)
 
 
 @authz.datafile_access_required
@@ -285,7 +362,7 @@ def display_datafile_image(
     image = DatafileParameter.objects.get(name__name=parameter_name,
                                           parameterset=parameterset_id)
 
-    return HttpResponse(b64decode(image.string_value), mimetype='image/jpeg')
+    return _image_parameter_response(request, image.string_value)
 
 
 def about(request):
@@ -303,14 +380,35 @@ def experiment_index(request):
     else:
         return redirect('tardis_portal.experiment_list_public')
 
+def _get_experiments_page(request, experiments):
+    paginator = Paginator(experiments, 50)
+
+    try:
+        page = int(request.GET.get('page', '1'))
+    except ValueError:
+        page = 1
+
+    # If page request (9999) is out of range, deliver last page of results.
+
+    try:
+        experiments_page = paginator.page(page)
+    except (EmptyPage, InvalidPage):
+        experiments_page = paginator.page(paginator.num_pages)
+
+    # Fetch the totals shown in the page's badges in one go
+    ExperimentStatistics.load_for(experiments_page.object_list)
+    return experiments_page
+
 @login_required
 def experiment_list_mine(request):
 
+    experiments = authz.get_owned_experiments(request)\
+                       .order_by('-update_time')
+
     c = Context({
         'subtitle': 'My Experiments',
         'can_see_private': True,
-        'experiments': authz.get_owned_experiments(request)\
-                            .order_by('-update_time'),
+        'experiments': _get_experiments_page(request, experiments),
     })
 
     # TODO actually change loaders to load this based on stuff
@@ -320,11 +418,13 @@ def experiment_list_mine(request):
 @login_required
 def experiment_list_shared(request):
 
+    experiments = authz.get_shared_experiments(request) \
+                       .order_by('-update_time')
+
     c = Context({
         'subtitle': 'Shared Experiments',
         'can_see_private': True,
-        'experiments': authz.get_shared_experiments(request) \
-                            .order_by('-update_time'),
+        'experiments': _get_experiments_page(request, experiments),
     })
 
     # TODO actually change loaders to load this based on stuff
@@ -335,11 +435,13 @@ def experiment_list_public(request):
 
     private_filter = Q(public_access=Experiment.PUBLIC_ACCESS_NONE)
 
+    experiments = Experiment.objects.exclude(private_filter) \
+                                    .order_by('-update_time')
+
     c = Context({
         'subtitle': 'Public Experiments',
         'can_see_private': False,
-        'experiments': Experiment.objects.exclude(private_filter) \
-                                         .order_by('-update_time'),
+        'experiments': _get_experiments_page(request, experiments),
     })
 
     return HttpResponse(render_response_search(request,
@@ -870,9 +972,8 @@ def manage_auth_methods(request):
 
 
 # TODO removed username from arguments
-@transaction.commit_on_success
 def _registerExperimentDocument(filename, created_by, expid=None,
-                                owners=[], username=None):
+                                owners=[], username=None, progress=None):
     '''
     Register the experiment document and return the experiment id.
 
@@ -885,11 +986,25 @@ def _registerExperimentDocument(filename, created_by, expid=None,
     :param owners: a list of owners
     :type owner: list
     :param username: **UNUSED**
+    :param progress: called with the phase, and the number of datasets and
+       datafiles created so far, as the registration goes on
+    :type progress: function
     :rtype: int
 
     '''
+    datafile_ids = []
+    result = _ingestExperimentDocument(filename, created_by, expid, owners,
+                                       datafile_ids, progress)
+    # The new datafiles' post-save hooks can only run once they have been
+    # committed
+    queue_datafile_post_save_hooks(datafile_ids)
+    return result
 
 
+@transaction.commit_on_success
+def _ingestExperimentDocument(filename, created_by, expid, owners,
+                              datafile_ids, progress=None):
+
     f = open(filename)
     firstline = f.readline()
     f.close()
@@ -903,7 +1018,15 @@ def _registerExperimentDocument(filename, created_by, expid=None,
                                                           expid)
     else:
         logger.debug('processing METS')
-        eid, sync_root = parseMets(filename, created_by, expid)
+        eid, sync_root = parseMets(filename, created_by, expid,
+                                   createdDatafileIds=datafile_ids,
+                                   progress=progress)
+
+    if progress:
+        progress('setting owners',
+                 Dataset.objects.filter(experiments__id=eid).count(),
+                 Dataset_File.objects.filter(
+                     dataset__experiments__id=eid).count())
 
     auth_key = ''
     try:
@@ -950,8 +1073,113 @@ def _registerExperimentDocument(filename, created_by, expid=None,
     return (eid, sync_root)
 
 
+@transaction.commit_on_success
+def _createRegistrationJob(experiment, user, filename, owners, origin_id,
+                           from_url):
+    # The job has to be committed before its task can find it
+    return RegistrationJob.objects.create(job_id=uuid4().hex,
+                                          experiment=experiment,
+                                          user=user,
+                                          filename=filename,
+                                          owners='\n'.join(owners),
+                                          origin_id=origin_id or '',
+                                          from_url=from_url or '',
+                                          phase='queued')
+
+
+def _runRegistrationJob(job):
+    '''
+    Register the experiment document of a :class:`RegistrationJob`,
+    recording its progress in the job.
+    '''
+    job.status = RegistrationJob.STATUS_RUNNING
+    job.save()
+    local_id = job.experiment.id
+    logger.info('=== processing experiment %s in the background' % local_id)
+    try:
+        _, sync_path = _registerExperimentDocument(filename=job.filename,
+                                                   created_by=job.user,
+                                                   expid=local_id,
+                                                   owners=job.get_owners(),
+                                                   progress=job.report)
+        logger.info('=== processing experiment %s: DONE' % local_id)
+    except Exception, e:
+        logger.exception('=== processing experiment %s: FAILED!' % local_id)
+        job.status = RegistrationJob.STATUS_FAILED
+        job.phase = 'failed'
+        job.error = str(e)
+        job.save()
+        return
+
+    job.status = RegistrationJob.STATUS_FINISHED
+    job.phase = 'finished'
+    job.sync_path = sync_path
+    job.save()
+
+    if job.from_url:
+        logger.info('Sending received_remote signal')
+        from tardis.tardis_portal.signals import received_remote
+        received_remote.send(sender=Experiment,
+                instance=job.experiment,
+                uid=job.origin_id,
+                from_url=job.from_url,
+                sync_path=sync_path)
+
+
+def _registration_status_response(request, job, status=200):
+    phase, datasets, datafiles = job.get_progress()
+    experiment_url = request.build_absolute_uri(
+        '/experiment/view/%d/' % job.experiment.id)
+    result = {'job_id': job.job_id,
+              'status': job.status,
+              'phase': phase,
+              'datasets': datasets,
+              'datafiles': datafiles,
+              'experiment_id': job.experiment.id}
+    if job.status == RegistrationJob.STATUS_FINISHED:
+        result['experiment_url'] = experiment_url
+        result['sync_path'] = job.sync_path
+    elif job.status == RegistrationJob.STATUS_FAILED:
+        result['error'] = job.error
+    response = HttpResponse(json.dumps(result), status=status,
+                            mimetype='application/json')
+    if status == 202:
+        response['Location'] = request.build_absolute_uri(
+            '/experiment/register/status/%s/' % job.job_id)
+    elif job.status == RegistrationJob.STATUS_FINISHED:
+        response['Location'] = experiment_url
+    return response
+
+
+@never_cache
+def registration_status(request, job_id):
+    '''
+    Report the progress of an experiment registered in the background.  The
+    job id is only known to whoever submitted the experiment.
+
+    :param request: a HTTP Request instance
+    :type request: :class:`django.http.HttpRequest`
+    :param job_id: the job_id of the :class:`RegistrationJob`
+    :type job_id: string
+    :rtype: :class:`django.http.HttpResponse`
+    '''
+    try:
+        job = RegistrationJob.objects.get(job_id=job_id)
+    except RegistrationJob.DoesNotExist:
+        return HttpResponseNotFound()
+    return _registration_status_response(request, job)
+
+
 # web service
-def register_experiment_ws_xmldata(request):
+def register_experiment_ws_xmldata(request, asynchronous=False):
+    '''
+    Register an experiment from a METS (or simple XML) document.
+
+    With asynchronous, the document is registered by a task, and the
+    response is a 202 (Accepted) whose Location is a URL reporting the
+    registration's progress.  Otherwise the response is sent once the
+    experiment has been registered.
+    '''
 
     status = ''
     if request.method == 'POST':  # If the form has been submitted...
@@ -988,8 +1216,14 @@ def register_experiment_ws_xmldata(request):
                 f.write(chunk)
             f.close()
 
-            logger.info('=== processing experiment: START')
             owners = request.POST.getlist('experiment_owner')
+            if asynchronous:
+                job = _createRegistrationJob(e, user, filename, owners,
+                                             origin_id, from_url)
+                register_experiment.delay(job.id)
+                return _registration_status_response(request, job, 202)
+
+            logger.info('=== processing experiment: START')
             try:
                 _, sync_path = _registerExperimentDocument(filename=filename,
                                                            created_by=user,
@@ -2823,16 +3057,11 @@ class ExperimentSearchView(SearchView):
         else:
             experiment_ids = []
 
-
-        access_list = []
-
-        if self.request.user.is_authenticated():
-            access_list.extend([e.pk for e in authz.get_accessible_experiments(self.request)])
-
-        access_list.extend([e.pk for e in Experiment.objects.exclude(public_access=Experiment.PUBLIC_ACCESS_NONE)])
-
-        ids = list(set(experiment_ids) & set(access_list))
-        experiments = Experiment.objects.filter(pk__in=ids).order_by('-update_time')
+        # The search only matched documents the user may read, but a
+        # document may also be in experiments they can't, and ACLs may not
+        # be in effect yet, so check the access to these experiments alone
+        experiments = Experiment.safe.all(self.request) \
+            .filter(pk__in=experiment_ids).order_by('-update_time')
 
         results = []
         for e in experiments:
@@ -2868,7 +3097,9 @@ class ExperimentSearchView(SearchView):
 @login_required
 def single_search(request):
     search_query = FacetFixedSearchQuery(backend=HighlightSearchBackend())
-    sqs = SearchQuerySet(query=search_query)
+    # Only search what the user may read
+    sqs = SearchQuerySet(query=search_query).narrow(
+        get_access_filter(get_request_principals(request)))
     sqs.highlight()
 
     return ExperimentSearchView(
@@ -19,6 +19,14 @@ DATABASES = {
     }
 }
 
+# Rolled back test data would otherwise be remembered in the cache from
+# one test to the next
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.dummy.DummyCache',
+    }
+}
+
 # We're leaving this off for now, as most sites will until they convert DBs
 USE_TZ = False
 
@@ -188,7 +196,6 @@ UPLOADIFY_PATH = '%s/%s' % (STATIC_URL, 'js/uploadify/')
 UPLOADIFY_UPLOAD_PATH = '%s/%s' % (MEDIA_URL, 'uploads/')
 
 DOWNLOAD_ARCHIVE_SIZE_LIMIT = 0
-DOWNLOAD_SPACE_SAFETY_MARGIN = 8388608
 
 DEFAULT_INSTITUTION = "Monash University"
 
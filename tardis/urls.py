@@ -50,6 +50,9 @@ experiment_urls = patterns(
     (r'^view/$', 'experiment_index'), # Legacy URL
     (r'^search/$', 'search_experiment'),
     (r'^register/$', 'register_experiment_ws_xmldata'),
+    (r'^register/async/$', 'register_experiment_ws_xmldata',
+     {'asynchronous': True}),
+    (r'^register/status/(?P<job_id>[0-9a-f]+)/$', 'registration_status'),
     (r'^metsexport/(?P<experiment_id>\d+)/$', 'metsexport_experiment'),
     (r'^create/$', 'create_experiment'),
     (r'^control_panel/(?P<experiment_id>\d+)/access_list/add/user/'
@@ -169,6 +172,14 @@ ajax_urls = patterns(
     (r'^json/', include(json_urls))
 )
 
+chunked_upload_urls = patterns(
+    'tardis.tardis_portal.upload',
+    (r'^$', 'start_upload'),
+    (r'^(?P<upload_id>[0-9a-f]+)/$', 'upload_status'),
+    (r'^(?P<upload_id>[0-9a-f]+)/(?P<chunk>\d+)/$', 'upload_chunk'),
+    (r'^(?P<upload_id>[0-9a-f]+)/complete/$', 'complete_upload'),
+)
+
 download_urls = patterns(
     'tardis.tardis_portal.download',
     (r'^datafile/(?P<datafile_id>\d+)/$', 'download_datafile'),
@@ -250,6 +261,7 @@ urlpatterns = patterns(
     (r'^admin/', include(admin.site.urls)),
 
     (r'^upload/(?P<dataset_id>\d+)/$', 'tardis.tardis_portal.views.upload'),
+    (r'^upload/(?P<dataset_id>\d+)/chunked/', include(chunked_upload_urls)),
 
     # Search
     (r'^search/$', 'tardis.tardis_portal.views.single_search'),